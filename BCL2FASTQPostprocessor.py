@@ -1,24 +1,49 @@
 #!/usr/bin/env python3
 
 """ "Fixes" the output of bcl2fastq to meet our requirements.
+    Lanes that were demultiplexed in groups by index length, or in shards by tile, are
+    merged back together.
     Files are renamed, grouped by pool, and shifted out of the demultiplexing directory.
     projects_ready.txt is added listing the projects found
     projects_pending.txt is deleted if it exists
+    Run as "BCL2FASTQPostprocessor.py --filter_undetermined <lane_dir> ..." it just removes
+    the reads assigned in the other groups from group 1's Undetermined files, which
+    Snakefile.demux does as a cluster job before the main postprocessing.
 """
 # I guess we could go back to keeping the files in /ifs/runqc until they are renamed,
 # and this might be sensible for backup purposes. In any case I could do this with a
 # symlink so the code can stay the same.
 
 import os, sys, re, time
+import io
+import json
+import gzip
+import shutil
 from glob import glob
+import xml.etree.ElementTree as ET
 import yaml
+import numpy as np
 
 from collections import namedtuple
-from contextlib import suppress
+from contextlib import suppress, ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, islice, compress, chain
 
 # Global error collector
 ERRORS = set()
 
+# Written into group 1 of a lane once filter_group_undetermined() has run
+FILTERED_LOG = "undetermined_filtered.log"
+
+# How many reads filter_fastq() looks at in one go
+CHUNK_READS = 10000
+
+def open_gz_lines(filename):
+    """ Open a gzipped file for reading line by line. GzipFile.readline() has a lot of
+        overhead per call, so put a plain BufferedReader in front of it.
+    """
+    return io.BufferedReader(gzip.open(filename, 'rb'), buffer_size=1024*1024)
+
 def time_now():
     return time.strftime('%Y-%m-%d %H:%M', time.localtime())
 
@@ -40,6 +65,9 @@ def main(output_dir, prefix=None):
         log(f"# {sys.argv[0]}")
         log(f"# renaming files in {demux_dir} on {time_now()}")
 
+        merge_lane_groups(output_dir, log=log)
+        merge_lane_shards(output_dir, log=log)
+
         project_seen = do_renames(output_dir, prefix, log=log)
 
         if ERRORS:
@@ -85,6 +113,565 @@ def check_project_name(proj_name):
     if proj_name in "counts demultiplexing md5sums multiqc_reports QC seqdata slurm_output".split():
         raise ValueError(f"Invalid project name {proj_name!r} conflicts with reserved names.")
 
+def get_sheet_count(sample_sheet, key):
+    """ See how many groups or shards bcl2fastq_setup.py split the lane into, by looking
+        for the #IndexGroups or #TileShards line in the header. 0 means the lane was not split.
+    """
+    with suppress(FileNotFoundError):
+        with open(sample_sheet) as sfh:
+            for l in sfh:
+                if l.startswith(f'#{key},'):
+                    return int(l.split(',')[1])
+                if l.startswith('[Data]'):
+                    break
+    return 0
+
+def get_index_groups(sample_sheet):
+    return get_sheet_count(sample_sheet, 'IndexGroups')
+
+def get_tile_shards(sample_sheet):
+    return get_sheet_count(sample_sheet, 'TileShards')
+
+def merge_lane_groups(output_dir, log = lambda m: print(m)):
+    """ If bcl2fastq_setup.py split any lane into groups by index length, each group
+        was demultiplexed into demultiplexing/laneN/groupM. Put them back together so
+        that the rest of the pipeline sees an ordinary lane:
+            The FASTQ files are moved up into laneN
+            Stats.json and FastqSummaryF1LN.txt are merged
+            bcl2fastq.opts and DemuxSummaryF1LN.txt are concatenated
+        Each group sees the reads for the other groups as undetermined, so only the
+        Undetermined files for group 1 (the longest indexes) are kept, with the reads
+        assigned in the other groups filtered out by filter_group_undetermined() if
+        that was not already done, and the undetermined counts are reduced to match.
+        It's safe to run this again. Returns the list of lanes merged.
+    """
+    merged = []
+    for lane_dir in sorted(glob(os.path.join(output_dir, "demultiplexing", "lane*"))):
+        groups = get_index_groups(os.path.join(lane_dir, "SampleSheet.filtered.csv"))
+        if not groups:
+            continue
+        lane = os.path.basename(lane_dir)[4:]
+        group_dirs = [ os.path.join(lane_dir, f"group{g}") for g in range(1, groups+1) ]
+
+        missing = [ gd for gd in group_dirs if not os.path.exists(os.path.join(gd, "Stats", "Stats.json")) ]
+        if missing:
+            ERRORS.add(f"Missing Stats.json for lane {lane} in {', '.join(missing)}")
+            continue
+        log(f"# merging {groups} index groups for lane {lane}")
+
+        # Normally the filter_undetermined cluster job has done this already
+        filtered_log = os.path.join(group_dirs[0], FILTERED_LOG)
+        if not os.path.exists(filtered_log):
+            filter_group_undetermined(lane_dir, log=lambda m: None)
+        with open(filtered_log) as ffh:
+            for l in ffh:
+                log(l.rstrip("\n"))
+
+        for gnum, gd in enumerate(group_dirs, start=1):
+            # Projects, and pools within projects, as per do_renames()
+            for fastq_file in sorted( glob(os.path.join(gd, "*/*/*.fastq.gz")) +
+                                      glob(os.path.join(gd, "*/*.fastq.gz")) ):
+                new_file = os.path.join(lane_dir, os.path.relpath(fastq_file, gd))
+                os.makedirs(os.path.dirname(new_file), exist_ok=True)
+                try:
+                    log( "mv {} {}".format( os.path.relpath(fastq_file, output_dir),
+                                            os.path.relpath(new_file, output_dir) ) )
+                    os.link(fastq_file, new_file)
+                    os.unlink(fastq_file)
+                except FileExistsError:
+                    log(f"# FileExistsError moving {new_file}")
+                    raise
+
+            for undet_file in sorted(glob(os.path.join(gd, "[Uu]ndetermined_*"))):
+                if gnum == 1:
+                    new_file = os.path.join(lane_dir, os.path.basename(undet_file))
+                    log( "mv {} {}".format( os.path.relpath(undet_file, output_dir),
+                                            os.path.relpath(new_file, output_dir) ) )
+                    os.replace(undet_file, new_file)
+                else:
+                    log( "rm {}".format(os.path.relpath(undet_file, output_dir)) )
+                    os.unlink(undet_file)
+
+            # And tidy the empty directories, as per do_renames()
+            for root, dirs, files in os.walk(gd, topdown=False):
+                if root != gd and not dirs and not files:
+                    os.rmdir(root)
+
+        # Now the stats
+        os.makedirs(os.path.join(lane_dir, "Stats"), exist_ok=True)
+
+        stats = []
+        for gd in group_dirs:
+            with open(os.path.join(gd, "Stats", "Stats.json")) as jfh:
+                stats.append(json.load(jfh))
+        with open(os.path.join(lane_dir, "Stats", "Stats.json"), 'w') as jfh:
+            json.dump(merge_stats_json(stats, log=log), jfh, indent=2)
+
+        fastq_summaries = [ os.path.join(gd, "Stats", f"FastqSummaryF1L{lane}.txt") for gd in group_dirs ]
+        if all(os.path.exists(f) for f in fastq_summaries):
+            with open(os.path.join(lane_dir, "Stats", f"FastqSummaryF1L{lane}.txt"), 'w') as sfh:
+                for l in merge_fastq_summaries(fastq_summaries):
+                    print(*l, sep='\t', file=sfh)
+
+        concatenate_lane_files(lane_dir, lane, group_dirs, "Index group")
+
+        merged.append(lane)
+
+    return merged
+
+def filter_group_undetermined(lane_dir, log = lambda m: print(m), threads = None):
+    """ Each index group of a lane sees the reads assigned in the other groups as
+        undetermined. Remove these from the Undetermined files of group 1, which are the
+        ones merge_lane_groups() keeps, and save what was done in group1/undetermined_filtered.log
+        so that merge_lane_groups() can log it and knows not to do it again.
+        This reads every FASTQ file in the lane, so Snakefile.demux runs it as a cluster
+        job rather than leaving it to the postprocessor on the head node.
+        The R1, R2 and index files are filtered in parallel, up to threads (default
+        $PROCESSING_THREADS) at a time. Each file goes at about 4 million reads per minute,
+        of which re-compressing the output is the biggest part, so if group 1 of a NovaSeq
+        lane has 400 million undetermined reads the job takes around 100 minutes.
+        Returns the number of reads removed.
+    """
+    output_dir = os.path.dirname(os.path.dirname(os.path.abspath(lane_dir)))
+    groups = get_index_groups(os.path.join(lane_dir, "SampleSheet.filtered.csv"))
+    group_dirs = [ os.path.join(lane_dir, f"group{g}") for g in range(1, groups+1) ]
+
+    # Read names are the same in all the reads, so R1 is enough
+    other_files = [ f for gd in group_dirs[1:]
+                      for f in sorted( glob(os.path.join(gd, "*/*/*_R1_*.fastq.gz")) +
+                                       glob(os.path.join(gd, "*/*_R1_*.fastq.gz")) ) ]
+
+    # R1, R2 and index reads for the same reads are filtered together
+    undet_sets = {}
+    if other_files:
+        for undet_file in sorted(glob(os.path.join(group_dirs[0], "[Uu]ndetermined_*.fastq.gz"))):
+            undet_sets.setdefault( re.sub(r'_[RI]\d+_', '_', os.path.basename(undet_file)),
+                                   [] ).append(undet_file)
+
+    # The reads are matched on position, so each file can be filtered on its own
+    all_files = [ f for undet_files in undet_sets.values() for f in undet_files ]
+    threads = min( int(threads or os.environ.get('PROCESSING_THREADS') or 1), len(all_files) )
+    with ExitStack() as stack:
+        if threads > 1:
+            mapper = stack.enter_context(ProcessPoolExecutor(max_workers=threads)).map
+        else:
+            mapper = map
+        dropped_by_file = dict(zip( all_files,
+                                    mapper( filter_fastq, [ [f] for f in all_files ],
+                                                          [ [f] for f in all_files ],
+                                                          repeat(other_files) ) ))
+
+    lines = []
+    total = 0
+    for undet_files in undet_sets.values():
+        lines.append( "filter {}".format(' '.join( os.path.relpath(f, output_dir)
+                                                   for f in undet_files )) )
+        dropped = set( dropped_by_file[f] for f in undet_files )
+        if len(dropped) != 1:
+            raise ValueError(f"Files are out of step: {', '.join(undet_files)}")
+        dropped, = dropped
+        lines.append(f"# removed {dropped} reads assigned in other groups")
+        total += dropped
+
+    tmp_file = os.path.join(group_dirs[0], FILTERED_LOG + ".tmp")
+    with open(tmp_file, 'w') as lfh:
+        for l in lines:
+            log(l)
+            print(l, file=lfh)
+    os.replace(tmp_file, os.path.join(group_dirs[0], FILTERED_LOG))
+    return total
+
+def read_positions(names):
+    """ Get the tiles and the X:Y positions packed into ints from a list of read names like
+        b"@A00291:331:H2V73DRXY:1:2101:1000:1001". X and Y are well under 2**31 so each
+        position fits in an int64. Returns two arrays, (tiles, positions).
+    """
+    try:
+        fields = np.array([ n.rsplit(b':', 3)[1:] for n in names ], dtype=bytes).astype(np.int64)
+        fields = fields.reshape(-1, 3)
+    except ValueError:
+        bad = next(( n for n in names if not re.fullmatch(rb'.+(:\d+){3}', n) ), names[0])
+        raise ValueError(f"Not a bcl2fastq read header: {bad!r}")
+    return fields[:,0], (fields[:,1] << 32) | fields[:,2]
+
+def tile_runs(tiles, last_tile, what):
+    """ Yield (tile, start, end) for each run of reads from the same tile in an array of
+        tiles, checking that these are in order and follow on from last_tile.
+    """
+    if len(tiles) and ( (last_tile is not None and tiles[0] < last_tile) or
+                        np.any(np.diff(tiles) < 0) ):
+        raise ValueError(f"{what} not in tile order")
+    bounds = [0] + list(np.flatnonzero(np.diff(tiles)) + 1) + [len(tiles)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield int(tiles[start]), start, end
+
+def tile_keys(fastq_file, chunk_size=CHUNK_READS):
+    """ Yield (tile, keys) for each tile in a gzipped FASTQ file from bcl2fastq, where keys
+        is an array of the read positions from read_positions(). bcl2fastq writes the
+        tiles in order, so only one tile needs to be held in memory. If the tiles are
+        not in order you get a ValueError.
+    """
+    tile, keys = None, []
+    with open_gz_lines(fastq_file) as ffh:
+        while True:
+            lines = list(islice(ffh, chunk_size * 4))
+            if not lines:
+                break
+            tiles, chunk_keys = read_positions([ l.split(maxsplit=1)[0] for l in lines[0::4] ])
+            for t, start, end in tile_runs(tiles, tile, f"{fastq_file} is"):
+                if t != tile and keys:
+                    yield tile, np.concatenate(keys)
+                    keys = []
+                tile = t
+                keys.append(chunk_keys[start:end])
+    if keys:
+        yield tile, np.concatenate(keys)
+
+def merge_tile_keys(fastq_files):
+    """ Merge tile_keys() for several files, yielding (tile, keys) for each tile found
+        in any of them, in order. All the files are open at once.
+    """
+    iters = [ tile_keys(f) for f in fastq_files ]
+    heads = [ next(it, None) for it in iters ]
+    while any(heads):
+        tile = min( h[0] for h in heads if h )
+        yield tile, np.concatenate([ h[1] for h in heads if h and h[0] == tile ])
+        heads = [ next(it, None) if h and h[0] == tile else h
+                  for it, h in zip(iters, heads) ]
+
+def read_chunks(fastq_fhs, chunk_size=CHUNK_READS):
+    """ Read the records from some open FASTQ files which have the same reads in the same
+        order, yielding (tile, records, keys) for up to chunk_size reads from one tile at
+        a time. records has a list of 4-line records for each file, and keys is an array
+        of the read positions from read_positions().
+        The reads are handled a chunk at a time rather than one by one, since Python
+        code that runs for every read is what makes filter_fastq() slow.
+    """
+    tile = None
+    while True:
+        lines = [ list(islice(fh, chunk_size * 4)) for fh in fastq_fhs ]
+        if not any(lines):
+            break
+        names = [ l.split(maxsplit=1)[0] for l in lines[0][0::4] ]
+        for other in lines[1:]:
+            if len(other) != len(lines[0]) or [ l.split(maxsplit=1)[0] for l in other[0::4] ] != names:
+                raise ValueError(f"Files are out of step after {names[0] if names else 'the end'!r}")
+
+        tiles, keys = read_positions(names)
+        for t, start, end in tile_runs(tiles, tile, "Reads are"):
+            tile = t
+            yield t, [ list(zip(*[iter(l[start*4:end*4])] * 4)) for l in lines ], keys[start:end]
+
+def filter_fastq(in_files, out_files, drop_files):
+    """ Copy some gzipped FASTQ files which have the same reads in the same order
+        (ie. R1, R2 and the index reads) leaving out any read that is also in drop_files.
+        Reads are matched on their position, going through the tiles in order, so only
+        the positions for one tile of drop_files are held in memory at a time. This is
+        just a few MB even for a NovaSeq.
+        The output is written to temporary files and renamed into place, so out_files can
+        be the same as in_files.
+        Returns the number of reads dropped.
+    """
+    dropped = 0
+    drop_tiles = merge_tile_keys(drop_files)
+    drop_tile, drop_keys = next(drop_tiles, (None, None))
+
+    tmp_files = [ f + ".tmp" for f in out_files ]
+    with ExitStack() as stack:
+        ifhs = [ stack.enter_context(open_gz_lines(f)) for f in in_files ]
+        # Level 4 is what bcl2fastq uses by default
+        ofhs = [ stack.enter_context(gzip.open(f, 'wb', compresslevel=4)) for f in tmp_files ]
+
+        for tile, records, keys in read_chunks(ifhs):
+            while drop_tile is not None and drop_tile < tile:
+                drop_tile, drop_keys = next(drop_tiles, (None, None))
+            if drop_tile == tile:
+                drop = np.isin(keys, drop_keys)
+            else:
+                drop = np.zeros(len(keys), dtype=bool)
+            dropped += int(drop.sum())
+
+            # One write per chunk, as every call to GzipFile.write() is slow
+            keep = (~drop).tolist()
+            for ofh, recs in zip(ofhs, records):
+                ofh.write(b''.join(chain.from_iterable(compress(recs, keep))))
+
+    for tmp_file, out_file in zip(tmp_files, out_files):
+        os.replace(tmp_file, out_file)
+    return dropped
+
+def concatenate_lane_files(lane_dir, lane, sub_dirs, label):
+    """ Concatenate the bcl2fastq.opts and DemuxSummaryF1LN.txt files from the groups or
+        shards of a lane, with a comment before each, and copy bcl2fastq.version, which
+        will be the same for all.
+    """
+    for f, comment in [ (f"Stats/DemuxSummaryF1L{lane}.txt", '###'),
+                        ("bcl2fastq.opts", '#') ]:
+        with open(os.path.join(lane_dir, f), 'w') as ofh:
+            for snum, sd in enumerate(sub_dirs, start=1):
+                with suppress(FileNotFoundError):
+                    with open(os.path.join(sd, f)) as ifh:
+                        print(f"{comment} {label} {snum}", file=ofh)
+                        ofh.write(ifh.read())
+
+    with suppress(FileNotFoundError):
+        with open(os.path.join(sub_dirs[0], "bcl2fastq.version")) as ifh:
+            with open(os.path.join(lane_dir, "bcl2fastq.version"), 'w') as ofh:
+                ofh.write(ifh.read())
+
+def merge_lane_shards(output_dir, log = lambda m: print(m)):
+    """ If bcl2fastq_setup.py split any lane into shards by tile, each shard was
+        demultiplexed into demultiplexing/laneN/shardM. Put them back together so
+        that the rest of the pipeline sees an ordinary lane:
+            The FASTQ files for each sample are concatenated into laneN. A series of
+            gzip members is a valid gzip file, so there is no need to recompress.
+            Stats.json, DemultiplexingStats.xml and ConversionStats.xml are added up
+            FastqSummaryF1LN.txt is concatenated, as the tiles in each shard are different
+            bcl2fastq.opts and DemuxSummaryF1LN.txt are concatenated with a comment
+        The FASTQ files in the shards are removed once merged, so it's safe to run this
+        again. Returns the list of lanes merged.
+    """
+    merged = []
+    for lane_dir in sorted(glob(os.path.join(output_dir, "demultiplexing", "lane*"))):
+        shards = get_tile_shards(os.path.join(lane_dir, "SampleSheet.filtered.csv"))
+        if not shards:
+            continue
+        lane = os.path.basename(lane_dir)[4:]
+        shard_dirs = [ os.path.join(lane_dir, f"shard{s}") for s in range(1, shards+1) ]
+
+        missing = [ sd for sd in shard_dirs if not os.path.exists(os.path.join(sd, "Stats", "Stats.json")) ]
+        if missing:
+            ERRORS.add(f"Missing Stats.json for lane {lane} in {', '.join(missing)}")
+            continue
+        log(f"# merging {shards} tile shards for lane {lane}")
+
+        # Every shard should have the same files, but if not we just merge what is there.
+        # Projects, and pools within projects, as per do_renames()
+        fastq_files = set()
+        for sd in shard_dirs:
+            for fastq_file in ( glob(os.path.join(sd, "*/*/*.fastq.gz")) +
+                                glob(os.path.join(sd, "*/*.fastq.gz")) +
+                                glob(os.path.join(sd, "*.fastq.gz")) ):
+                fastq_files.add(os.path.relpath(fastq_file, sd))
+
+        for rel_file in sorted(fastq_files):
+            new_file = os.path.join(lane_dir, rel_file)
+            parts = [ os.path.join(sd, rel_file) for sd in shard_dirs
+                      if os.path.exists(os.path.join(sd, rel_file)) ]
+            log( "cat {} > {}".format( ' '.join(os.path.relpath(p, output_dir) for p in parts),
+                                       os.path.relpath(new_file, output_dir) ) )
+            os.makedirs(os.path.dirname(new_file), exist_ok=True)
+            try:
+                with open(new_file, 'xb') as ofh:
+                    for p in parts:
+                        with open(p, 'rb') as ifh:
+                            shutil.copyfileobj(ifh, ofh)
+            except FileExistsError:
+                log(f"# FileExistsError concatenating to {new_file}")
+                raise
+            for p in parts:
+                os.unlink(p)
+
+        # And tidy the empty directories, as per do_renames()
+        for sd in shard_dirs:
+            for root, dirs, files in os.walk(sd, topdown=False):
+                if root != sd and not dirs and not files:
+                    os.rmdir(root)
+
+        # Now the stats
+        os.makedirs(os.path.join(lane_dir, "Stats"), exist_ok=True)
+
+        stats = []
+        for sd in shard_dirs:
+            with open(os.path.join(sd, "Stats", "Stats.json")) as jfh:
+                stats.append(json.load(jfh))
+        with open(os.path.join(lane_dir, "Stats", "Stats.json"), 'w') as jfh:
+            json.dump(sum_stats_json(stats), jfh, indent=2)
+
+        for xml_file in ["DemultiplexingStats.xml", "ConversionStats.xml"]:
+            xml_files = [ os.path.join(sd, "Stats", xml_file) for sd in shard_dirs ]
+            if all(os.path.exists(f) for f in xml_files):
+                sum_stats_xml(xml_files).write( os.path.join(lane_dir, "Stats", xml_file),
+                                                encoding="utf-8", xml_declaration=True )
+
+        fastq_summaries = [ os.path.join(sd, "Stats", f"FastqSummaryF1L{lane}.txt") for sd in shard_dirs ]
+        if all(os.path.exists(f) for f in fastq_summaries):
+            with open(os.path.join(lane_dir, "Stats", f"FastqSummaryF1L{lane}.txt"), 'w') as ofh:
+                for snum, sf in enumerate(fastq_summaries):
+                    with open(sf) as ifh:
+                        header = ifh.readline()
+                        if snum == 0:
+                            ofh.write(header)
+                        ofh.write(ifh.read())
+
+        concatenate_lane_files(lane_dir, lane, shard_dirs, "Tile shard")
+
+        merged.append(lane)
+
+    return merged
+
+def merge_stats_json(stats_list, log = lambda m: print(m)):
+    """ Merge the Stats.json from each group of a lane, where the first group has the
+        longest indexes. The samples from all groups are listed, and the reads assigned
+        in the later groups are taken off the undetermined reads of the first.
+        ReadInfosForLanes is taken from the first group, as are the UnknownBarcodes, but
+        leaving out any that match the start of a barcode from another group.
+    """
+    res = json.loads(json.dumps(stats_list[0]))
+
+    for cr in res['ConversionResults']:
+        undet = cr.get('Undetermined')
+        for other_cr in [ ocr for s in stats_list[1:] for ocr in s['ConversionResults']
+                          if ocr['LaneNumber'] == cr['LaneNumber'] ]:
+            cr['DemuxResults'].extend(other_cr['DemuxResults'])
+            if not undet:
+                continue
+            for dr in other_cr['DemuxResults']:
+                undet['NumberReads'] -= dr['NumberReads']
+                undet['Yield'] -= dr['Yield']
+                for rm in undet.get('ReadMetrics', []):
+                    for orm in dr.get('ReadMetrics', []):
+                        if orm['ReadNumber'] == rm['ReadNumber']:
+                            for k in ['Yield', 'YieldQ30', 'QualityScoreSum', 'TrimmedBases']:
+                                rm[k] -= orm.get(k, 0)
+        if undet and undet['NumberReads'] < 0:
+            # This means some reads were assigned in more than one group, which
+            # bcl2fastq_setup.py should have prevented.
+            log(f"# more reads assigned than passed filter in lane {cr['LaneNumber']}")
+            ERRORS.add("Reads assigned in more than one index group")
+
+    other_barcodes = [ im['IndexSequence'].split('+')
+                       for s in stats_list[1:] for cr in s['ConversionResults']
+                       for dr in cr['DemuxResults'] for im in dr.get('IndexMetrics', []) ]
+    def _is_other(barcode):
+        barcode = barcode.split('+')
+        return any( all(b.startswith(o) for b, o in zip(barcode, ob)) for ob in other_barcodes )
+
+    for ub in res.get('UnknownBarcodes', []):
+        ub['Barcodes'] = { k: v for k, v in ub['Barcodes'].items() if not _is_other(k) }
+
+    return res
+
+def _sum_by_key(totals, items, key, add):
+    """ For lists of dicts like the DemuxResults in Stats.json, add each of items to the
+        entry in totals with the same key, or append a copy if there is none.
+    """
+    by_key = { i[key]: i for i in totals }
+    for i in items:
+        if i[key] in by_key:
+            add(by_key[i[key]], i)
+        else:
+            totals.append(json.loads(json.dumps(i)))
+            by_key[i[key]] = totals[-1]
+
+def _sum_read_metrics(total, other):
+    """ Add the NumberReads, Yield and ReadMetrics of other to total
+    """
+    for k in ['NumberReads', 'Yield']:
+        if k in other:
+            total[k] = total.get(k, 0) + other[k]
+    def _add_rm(rm, orm):
+        for k in ['Yield', 'YieldQ30', 'QualityScoreSum', 'TrimmedBases']:
+            rm[k] = rm.get(k, 0) + orm.get(k, 0)
+    _sum_by_key(total.setdefault('ReadMetrics', []), other.get('ReadMetrics', []), 'ReadNumber', _add_rm)
+
+def sum_stats_json(stats_list):
+    """ Add up the Stats.json from each shard of a lane. Unlike merge_stats_json(), the
+        samples are the same in each shard but the reads are different, so everything is
+        simply summed. The UnknownBarcodes are summed and re-sorted, keeping as many as
+        bcl2fastq would have listed for a single shard.
+    """
+    res = json.loads(json.dumps(stats_list[0]))
+
+    def _add_im(im, oim):
+        for k, v in oim.get('MismatchCounts', {}).items():
+            im['MismatchCounts'][k] = im['MismatchCounts'].get(k, 0) + v
+
+    def _add_dr(dr, odr):
+        _sum_read_metrics(dr, odr)
+        _sum_by_key(dr.setdefault('IndexMetrics', []), odr.get('IndexMetrics', []), 'IndexSequence', _add_im)
+
+    def _add_cr(cr, ocr):
+        for k in ['TotalClustersRaw', 'TotalClustersPF', 'Yield']:
+            cr[k] = cr.get(k, 0) + ocr.get(k, 0)
+        _sum_by_key(cr['DemuxResults'], ocr['DemuxResults'], 'SampleId', _add_dr)
+        if 'Undetermined' in ocr:
+            _sum_read_metrics(cr.setdefault('Undetermined', {}), ocr['Undetermined'])
+
+    def _add_ub(ub, oub):
+        for k, v in oub['Barcodes'].items():
+            ub['Barcodes'][k] = ub['Barcodes'].get(k, 0) + v
+
+    for s in stats_list[1:]:
+        _sum_by_key(res['ConversionResults'], s['ConversionResults'], 'LaneNumber', _add_cr)
+        _sum_by_key(res.setdefault('UnknownBarcodes', []), s.get('UnknownBarcodes', []), 'Lane', _add_ub)
+
+    for ub in res.get('UnknownBarcodes', []):
+        keep = max( len(oub['Barcodes']) for s in stats_list for oub in s.get('UnknownBarcodes', [])
+                    if oub['Lane'] == ub['Lane'] )
+        ub['Barcodes'] = dict( sorted( ub['Barcodes'].items(),
+                                       key = lambda i: (-i[1], i[0]) )[:keep] )
+
+    return res
+
+def sum_stats_xml(xml_files):
+    """ Add up the DemultiplexingStats.xml or ConversionStats.xml files from each shard
+        of a lane. Elements are matched on their tag and attributes. Those with a number
+        in them are added up, and the rest are merged recursively, so for ConversionStats.xml
+        the <Tile> elements from each shard are all collected under the lane.
+        Returns an ElementTree.
+    """
+    res = ET.parse(xml_files[0])
+
+    def _merge(elem, other):
+        children = { (c.tag, tuple(sorted(c.attrib.items()))): c for c in elem }
+        for oc in other:
+            c = children.get((oc.tag, tuple(sorted(oc.attrib.items()))))
+            if c is None:
+                elem.append(oc)
+            elif len(oc) == 0 and re.match(r'\d+$', (c.text or '').strip()) \
+                              and re.match(r'\d+$', (oc.text or '').strip()):
+                c.text = str(int(c.text) + int(oc.text))
+            else:
+                _merge(c, oc)
+
+    for xml_file in xml_files[1:]:
+        _merge(res.getroot(), ET.parse(xml_file).getroot())
+
+    return res
+
+def merge_fastq_summaries(summary_files):
+    """ Merge the FastqSummaryF1LN.txt files, which have a line per sample per tile,
+        with sample 0 being the undetermined reads. As with merge_stats_json(), we
+        keep sample 0 from the first group only and take the reads assigned in the other
+        groups off these. The samples are renumbered to follow on from the last group.
+        Returns a list of lists, including the header.
+    """
+    res = []
+    undetermined = dict()
+    last_sample = 0
+    for gnum, sf in enumerate(summary_files):
+        with open(sf) as sfh:
+            header = sfh.readline().split()
+            if not res:
+                res.append(header)
+            group_last_sample = last_sample
+            for l in sfh:
+                sample_num, tile, rr, rpf = l.split()
+                if sample_num == '0':
+                    if gnum == 0:
+                        undetermined[tile] = [sample_num, tile, int(rr), int(rpf)]
+                        res.append(undetermined[tile])
+                    continue
+                if gnum > 0 and tile in undetermined:
+                    undetermined[tile][2] -= int(rr)
+                    undetermined[tile][3] -= int(rpf)
+                new_num = int(sample_num) + last_sample
+                group_last_sample = max(group_last_sample, new_num)
+                res.append([str(new_num), tile, int(rr), int(rpf)])
+            last_sample = group_last_sample
+    return res
+
 def do_renames(output_dir, runid, log = lambda m: print(m)):
     """ The main part of the code that does the renaming (moving).
         Primary reason for splitting this out from main() is to separate
@@ -190,7 +777,7 @@ def do_renames(output_dir, runid, log = lambda m: print(m)):
 
         # Check lane matches the directory name
         if not lane_dir == 'lane{}'.format(lane):
-            log(f"# skipping (lane mismatch) fastq_file")
+            log(f"# skipping (lane mismatch) {fastq_file}")
             continue
 
         # Add this to the collection
@@ -309,5 +896,9 @@ def do_renames(output_dir, runid, log = lambda m: print(m)):
 
 if __name__ == '__main__':
     print("Running: " + ' '.join(sys.argv))
-    main(*sys.argv[1:])
+    if sys.argv[1:2] == ['--filter_undetermined']:
+        for lane_dir in sys.argv[2:]:
+            filter_group_undetermined(lane_dir)
+    else:
+        main(*sys.argv[1:])
     if ERRORS: exit(1)
@@ -6,12 +6,21 @@
    by the driver.sh.
    If no problems are found then the script prints no output, and then no alert will
    be sent.
+   If index_sampler.py read several tiles, the counts per tile are in tile_counts.json
+   and we use these to put error bars on the numbers, and only complain if a project is
+   clearly getting fewer reads than Undetermined.
+   With --census, the inputs are instead the census.json files from barcode_census.py,
+   which counted the indexes over the whole lane, and any warnings saved there are
+   printed. This is separate so that the barcode check is not held up by the census.
 """
 import os, sys, re
 import json
 from collections import Counter
 from pprint import pprint, pformat
 
+from illuminatus.TileEstimates import ( project_of, estimates, format_estimate,
+                                        load_tile_counts, TILE_COUNTS_FILE )
+
 # Debug output can be activated by the test framework
 import logging as L
 L.basicConfig(level = L.WARNING)
@@ -71,17 +80,36 @@ def diagnose(lane_info):
     # num_unassigned. As usual assume the first 5 chars of the SampleId are the project.
     num_by_project = Counter()
     for dr in cr["DemuxResults"]:
-        proj = dr["SampleId"][:5]
+        proj = project_of(dr["SampleId"])
         num_by_project[proj] += dr["NumberReads"]
     L.debug("Reads by project: " + str(num_by_project))
 
     # We only want ones where the count is < Undetermined
     num_by_project = { k: v for k, v in num_by_project.items() if v < num_unassigned }
 
+    # If we have the counts for several tiles, only keep the ones where the difference
+    # is bigger than the error bars.
+    tile_counts = lane_info.get('tiles')
+    ests = estimates(tile_counts) if tile_counts else {}
+    if 'Undetermined' in ests:
+        und_p, und_hw = ests['Undetermined']
+        def _clearly_low(proj):
+            p, hw = ests.get(proj, (None, None))
+            if hw is None or und_hw is None:
+                return True
+            return p + hw < und_p - und_hw
+        num_by_project = { k: v for k, v in num_by_project.items() if _clearly_low(k) }
+
     if num_by_project:
         # Probably there is only one but there could be more if we start mixing lanes again
         res = [ f"Project {k} has only {v} total reads, compared to {num_unassigned} unassigned."
                 for k, v in num_by_project.items() ]
+        if 'Undetermined' in ests:
+            res.extend( "Over {} tiles, project {} has {} of the reads, compared to {} unassigned.".format(
+                                len(tile_counts['tiles']), k,
+                                format_estimate(*ests.get(k, (None, None))),
+                                format_estimate(*ests['Undetermined']) )
+                        for k in num_by_project )
         res.append('')
 
         if lane_info['opts']:
@@ -102,6 +130,43 @@ def diagnose(lane_info):
     # Any other problems I should be diagnosing? Nope? OK cool.
     return
 
+def census_main(census_files):
+    """Report on the census.json files from barcode_census.py. An empty file means
+       the census failed for that lane, so it is skipped.
+    """
+    res = []
+
+    all_censuses = dict()
+    for cf in census_files:
+        with open(cf) as fh:
+            census = json.loads(fh.read() or 'null')
+        if census:
+            all_censuses[census['lane']] = census
+
+    for lane, census in sorted(all_censuses.items()):
+        diagnosis = diagnose_census(census)
+        if res and diagnosis:
+            # Spacer line
+            res.append('')
+        if diagnosis:
+            res.append(f"Problem in lane {lane}:")
+            res.extend(diagnosis)
+
+    return res
+
+def diagnose_census(census):
+    """Report the warnings from the census of one lane.
+       Returns a list of lines or None.
+    """
+    if not census['warnings']:
+        return
+
+    res = [ f"Counting the indexes over all {census['tiles']} tiles found:" ]
+    res.extend(census['warnings'])
+    res.append(f"{census['unassigned']['NumberReads']} of {census['clusters_pf']} reads"
+               f" are predicted to be unassigned.")
+    return res
+
 def load_stats(stats_info):
     """Load a single stats_info file and try to also load the corresponding
        ../bcl2fastq.opts, but if this is missing it's not a problem.
@@ -133,6 +198,9 @@ def load_stats(stats_info):
     except FileNotFoundError:
         res['opts'] = None
 
+    # And the counts per tile from index_sampler.py
+    res['tiles'] = load_tile_counts( os.path.join(os.path.dirname(stats_info), '..', TILE_COUNTS_FILE) )
+
     # See if there is an unassigned_table.txt to look at. Note this file only contains
     # info that can be got from the Stats.json but we already have a script to check
     # chack for revcomps so no need to repeat ourselves.
@@ -146,5 +214,9 @@ def load_stats(stats_info):
     return res
 
 if __name__ == '__main__':
-    for msg_line in main(sys.argv[1:]):
+    if sys.argv[1:2] == ['--census']:
+        msg = census_main(sys.argv[2:])
+    else:
+        msg = main(sys.argv[1:])
+    for msg_line in msg:
         print(msg_line)
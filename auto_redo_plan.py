@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Decide which runs need lanes re-doing, given some new sample sheets. See
+   illuminatus/RedoPlanner.py. This never changes anything, so running it by
+   hand shows what auto_redo.sh would do.
+   With --tsv, prints one line per sheet for auto_redo.sh to act on:
+     action (redo or skip), run_dir, lanes (comma-separated), sheet, reason
+"""
+import os, re
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.RunRegistry import RunRegistry
+from illuminatus.RedoPlanner import RedoPlanner
+
+def main(args):
+
+    if not args.seqdata:
+        exit("You need to set SEQDATA_LOCATION or use --seqdata.")
+
+    # As in RunStatus.py, use the registry if there is one.
+    registry = None
+    if os.environ.get('RUN_REGISTRY', 'none') != 'none':
+        try:
+            registry = RunRegistry(os.environ['RUN_REGISTRY'])
+        except Exception:
+            if os.environ.get('DEBUG', '0') != '0': raise
+
+    plan = RedoPlanner(args.seqdata, registry).plan(args.sheets)
+
+    if args.tsv:
+        for d in plan:
+            fields = [ d['action'],
+                       d['run_dir'] or '-',
+                       ','.join(d['lanes']) or '-',
+                       d['sheet'],
+                       d['reason'] ]
+            # Tabs or newlines in any of these would be very odd, but would confuse the shell
+            print( '\t'.join( re.sub(r'[\t\n]', ' ', f) for f in fields ) )
+    else:
+        for d in plan:
+            print( "{}\n  {}: {}".format( d['sheet'],
+                                          "REDO lanes {} of {}".format(','.join(d['lanes']), d['run_dir'])
+                                          if d['action'] == 'redo' else 'skip',
+                                          d['reason'] ) )
+
+def parse_args(*args):
+    description = """Plan which lanes to re-do in response to new sample sheets."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("sheets", nargs='*',
+                           help="The new sample sheets.")
+    argparser.add_argument("--seqdata", default=os.environ.get('SEQDATA_LOCATION'),
+                           help="The directory of runs. Defaults to $SEQDATA_LOCATION.")
+    argparser.add_argument("--tsv", action="store_true",
+                           help="Print the plan for auto_redo.sh to read.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
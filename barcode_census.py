@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""Command line interface to illuminatus.BarcodeCensus
+   Takes the same arguments as index_sampler.py but counts the index pairs on every
+   tile in the lane, and writes census.json with the predicted reads per sample and any
+   warnings. The barcode_census rule in Snakefile.read1qc runs this as soon as the index
+   reads are done.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.BarcodeCensus import BarcodeCensus
+from illuminatus.Formatters import pct
+
+def main(args):
+
+    census = BarcodeCensus(args.run_dir, args.out_dir, args.sample_sheet, args.lane)
+    census.prepare()
+    print("Counting all indexes for lane {} on {} tiles of {}".format( census.lane, len(census.tiles),
+                                                                       census.run_dir ))
+    census.run()
+    res = census.collect_stats()
+
+    for s in res['samples'] + [ dict(res['unassigned'], SampleId='Undetermined') ]:
+        print("{}\t{}\t{:.2f}%".format( s['SampleId'], s['NumberReads'],
+                                        pct(s['NumberReads'], res['clusters_pf']) ))
+
+    for w in res['warnings']:
+        print(w)
+
+def parse_args(*args):
+    description = """Count the index sequences on all the tiles of a lane, reading the
+                     base calls directly, to predict the reads per sample and the
+                     unassigned fraction before the real demultiplexing."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("run_dir", help="The run directory.")
+    argparser.add_argument("out_dir", help="Where to write census.json.")
+    argparser.add_argument("sample_sheet", help="The SampleSheet.filtered.csv from bcl2fastq_setup.py")
+    argparser.add_argument("lane", help="The lane to process.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+"""Reads new lines from the lane*/bcl2fastq.log files in a demultiplexing directory
+   (or lane*/shard*/bcl2fastq.log and lane*/group*/bcl2fastq.log for lanes that are split),
+   checks the size of the FASTQ files, and updates bcl2fastq_progress.json.
+   See illuminatus/BCL2FASTQProgress.py
+   This is called by driver.sh on every cycle while a run is in_demultiplexing,
+   but it is fine to run it by hand. Reading the logs is incremental, so it's cheap.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.BCL2FASTQProgress import BCL2FASTQProgress
+
+def main(args):
+
+    progress = BCL2FASTQProgress(args.demux_dir, args.run_dir).update()
+
+    for lane, lp in sorted(progress['lanes'].items()):
+        print( "lane{}: {} {}/{} reads, {} reads/sec, ETA {}".format( lane,
+                                                                     lp['state'],
+                                                                     lp['reads_done'],
+                                                                     lp['reads_expected'] or '?',
+                                                                     lp['reads_per_sec'] or '?',
+                                                                     lp['eta'] or 'unknown' ) )
+
+def parse_args(*args):
+    description = """Update the bcl2fastq progress file for a demultiplexing directory."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("demux_dir", nargs='?', default='.',
+                           help="The directory containing the lane* subdirectories.")
+    argparser.add_argument("--run_dir",
+                           help="The run directory, to get the tile list from RunInfo.xml and" +
+                                " the read counts from InterOp." +
+                                " Defaults to <demux_dir>/../seqdata")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
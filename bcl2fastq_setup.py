@@ -4,17 +4,41 @@
     Contains only one lane
     Contains a [bcl2fastq] section with all options
     Has optional revcomp of index2 (or 1)
+
+   Several lanes may be set up in one go, with the --output option giving the filename
+   for each. The run is only loaded once, then each lane is set up in turn.
+
+   If a lane mixes libraries with different index lengths (eg. 6 and 8 bases, or
+   single and dual indexed) it is split into groups, one per pair of lengths, and
+   a sheet is written for each group under laneN/groupM/ as well as the usual sheet
+   for the lane. Each group then gets its own base mask and is demultiplexed
+   separately, and BCL2FASTQPostprocessor.py merges the results. A lane is not split
+   if the base mask is set explicitly, or if the groups can't be told apart.
+
+   Big lanes can also be split into shards of whole tiles, each of which is demultiplexed
+   as a separate cluster job, by setting --tiles_per_shard (or tiles_per_shard in the
+   [illuminatus] section of pipeline_settings.ini). The sheets for the shards go under
+   laneN/shardM/ and BCL2FASTQPostprocessor.py concatenates the FASTQ files and adds up
+   the stats. A lane is not sharded if it is split by index length, or if --tiles is
+   set explicitly.
+
+   In --bc_check mode the sheet selects a few tiles spread over the lane (set by
+   --bc_check_tiles, or bc_check_tiles in pipeline_settings.ini) and the target for the
+   confidence intervals (--bc_check_ci or bc_check_ci), which index_sampler.py uses to
+   decide how many of these to read. The tiles are listed in a #BarcodeCheckTiles line
+   in the header, and --tiles has just the first one, so if index_sampler.py fails and
+   the pipeline falls back to bcl2fastq this still only processes a single tile.
 """
 import os, sys, re
+import math
 import configparser
 from collections import defaultdict
-from itertools import dropwhile, takewhile
+from itertools import dropwhile, takewhile, combinations
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import logging as L
 
 from illuminatus.BaseMaskExtractor import BaseMaskExtractor
-from illuminatus.RunInfoXMLParser import RunInfoXMLParser
-from illuminatus.RunParametersXMLParser import RunParametersXMLParser
+from illuminatus.IndexCollisions import choose_barcode_mismatches, min_cross_distance, MAX_MISMATCHES
 
 class BCL2FASTQPreprocessor:
     """The name is a hangover from the old script name.
@@ -28,25 +52,38 @@ class BCL2FASTQPreprocessor:
         self.runinfo_file = os.path.join(self.run_dir, "RunInfo.xml")
 
         # This code is a little crufty but is tested and working.
-        self.bme = BaseMaskExtractor(self.samplesheet, self.runinfo_file)
+        self.bme = BaseMaskExtractor( self.samplesheet, self.runinfo_file,
+                                      use_cache = kwargs.get('use_cache', False) )
+
+        # Keep the lines of the sample sheet, stripped, so we only read it once.
+        with open(self.samplesheet) as ssfh:
+            self.samplesheet_lines = [ l.strip().rstrip(',') for l in ssfh ]
 
         # If there is a settings section we don't need to make a default
         # basemask. Only count the section if it actually has some settings
         # after the header.
         self.has_settings_section = False
-        with open(self.samplesheet) as ssfh:
-            ssfh = (l.strip().rstrip(',') for l in ssfh)
-            for l in ssfh:
-                if l == '[Settings]':
-                    if next(ssfh):
-                        self.has_settings_section = True
-                    break
-
-        # Get the run name and tiles list from the RunInfo.xml
-        rip = RunInfoXMLParser( self.run_dir )
+        ssfh = iter(self.samplesheet_lines)
+        for l in ssfh:
+            if l == '[Settings]':
+                if next(ssfh, ''):
+                    self.has_settings_section = True
+                break
+
+        # Get the run name and tiles list from the RunInfo.xml (or run_meta.json)
+        rip = self.bme.rip
         self.run_info = rip.run_info
-        self.tiles = rip.tiles
+        self.geometry = rip.get_geometry()
 
+        # Parsed .ini files, kept in case we set up several lanes
+        self._ini_cache = dict()
+
+        self.set_lane(**kwargs)
+
+    def set_lane(self, **kwargs):
+        """Set (or change) the lane to be processed, along with the revcomp and bc_check
+           settings. Everything loaded for the run is re-used.
+        """
         # Check the lane is valid.
         self.lane = str(kwargs['lane'])
         assert self.bme.get_lanes(), \
@@ -72,8 +109,112 @@ class BCL2FASTQPreprocessor:
             self.revcomp = kwargs['revcomp']
             self.revcomp_label = 'override ' + self.revcomp
 
-        # Save bc_check flag
+        # Save bc_check flag, and the settings for sampling tiles in this mode. Again
+        # pipeline_settings.ini beats the command line.
         self.bc_check = kwargs.get('bc_check', False)
+        self.bc_check_tiles = int( self.ini_settings['illuminatus'].get('bc_check_tiles') or
+                                   kwargs.get('bc_check_tiles') or 1 )
+        self.bc_check_ci = float( self.ini_settings['illuminatus'].get('bc_check_ci') or
+                                  kwargs.get('bc_check_ci') or 0 )
+
+        # Set by get_bcl2fastq_opt_dict()
+        self.mismatches_label = None
+
+        # See if the lane needs splitting by index length. Start with the whole lane.
+        self.group = None
+        self.index_groups = self.get_index_groups()
+
+        # Then see if it should be sharded by tile
+        self.shard = None
+        self.tile_shards = self.get_tile_shards(kwargs.get('tiles_per_shard'))
+
+    def set_group(self, group):
+        """Set the index length group to be processed, which must be one of
+           self.index_groups, or None for the whole lane.
+        """
+        assert group is None or group in self.index_groups, \
+            "{!r} not in {!r}".format(group, self.index_groups)
+        self.group = group
+        self.mismatches_label = None
+
+    def get_index_groups(self):
+        """If the lane mixes index lengths, return the list of [ index1length , index2length ]
+           groups that it will be split into, longest first. If the lane is to be demultiplexed
+           in one go, return [].
+        """
+        groups = self.bme.ssr.get_index_length_groups_by_lane().get(self.lane, [])
+        if len(groups) < 2 or self.bc_check:
+            # The barcode check is for a quick look, so no need to split it.
+            return []
+
+        def _no_split(why):
+            L.warning("Lane {} has indexes of lengths {} but will not be split, as {}.".format(
+                            self.lane, ' '.join('{}+{}'.format(*g) for g in groups), why ))
+            return []
+
+        if self.has_settings_section or '--use-bases-mask' in self.ini_settings['bcl2fastq']:
+            return _no_split("the base mask is set explicitly")
+        if [0, 0] in groups:
+            return _no_split("some samples have no index")
+
+        # If a barcode in one group is the same as the start of a barcode in another, the
+        # reads for the longer one will be assigned to both.
+        for g1, g2 in combinations(groups, 2):
+            if self.get_cross_distance(g1, [g2]) == 0:
+                return _no_split("the shorter barcodes match the start of the longer ones")
+
+        return groups
+
+    def set_shard(self, shard):
+        """Set the shard to be processed, numbered from 1, or None for the whole lane.
+        """
+        assert shard is None or 1 <= shard <= len(self.tile_shards), \
+            "{!r} not in 1..{}".format(shard, len(self.tile_shards))
+        self.shard = shard
+
+    def get_tile_shards(self, tiles_per_shard):
+        """If the lane is to be demultiplexed in shards, return the list of tiles for each
+           shard. Otherwise return [].
+        """
+        # A setting in pipeline_settings.ini beats the command line
+        tiles_per_shard = int( self.ini_settings['illuminatus'].get('tiles_per_shard') or
+                               tiles_per_shard or 0 )
+        if not tiles_per_shard or self.bc_check:
+            return []
+
+        lane_tiles = self.geometry.tiles(self.lane)
+        num_shards = math.ceil(len(lane_tiles) / tiles_per_shard)
+        if num_shards < 2:
+            return []
+
+        def _no_shard(why):
+            L.warning("Lane {} has {} tiles but will not be sharded, as {}.".format(
+                            self.lane, len(lane_tiles), why ))
+            return []
+
+        if self.index_groups:
+            return _no_shard("it is already split by index length")
+        if self.ini_settings['bcl2fastq'].get('--tiles'):
+            return _no_shard("--tiles is set explicitly")
+
+        return self.geometry.shards(self.lane, num_shards)
+
+    def get_cross_distance(self, group, others):
+        """Get the smallest distance between the barcodes in this group and those in any
+           of the other groups, compared on the bases they have in common, or None if they
+           are all more than MAX_MISMATCHES apart.
+        """
+        res = None
+        barcodes = self.get_lane_barcodes(group)
+        for other in others:
+            common = [ min(a, b) for a, b in zip(group, other) ]
+            d, _, _ = min_cross_distance( [ tuple(i[:l] for i, l in zip(bc, common)) for bc in barcodes ],
+                                          [ tuple(i[:l] for i, l in zip(bc, common))
+                                            for bc in self.get_lane_barcodes(other) ],
+                                          MAX_MISMATCHES )
+            if d is not None and (res is None or d < res):
+                res = d
+        return res
 
     def get_ini_settings(self):
         """Extract the appropriate settings for embedding to the [bcl2fastq] section.
@@ -109,7 +250,7 @@ class BCL2FASTQPreprocessor:
 
         # Add base mask for this lane, unless there is a settings section
         if not self.has_settings_section:
-            bm = self.bme.get_base_mask_for_lane(self.lane)
+            bm = self.bme.get_base_mask_for_lane(self.lane, self.group)
             bcl2fastq_opts["--use-bases-mask"] = "'{}'".format(bm)
 
         # now that the bcl2fastq_opts array is complete, evaluate the pipeline_settings.ini file
@@ -117,7 +258,11 @@ class BCL2FASTQPreprocessor:
         bcl2fastq_opts.update(self.ini_settings['bcl2fastq'].items())
 
         # The lane to process, is controlled by --tiles
-        if bcl2fastq_opts.get("--tiles"):
+        if self.shard:
+            # Just the tiles in this shard
+            bcl2fastq_opts["--tiles"] = "'{}'".format(
+                                self.geometry.tiles_option(self.lane, self.tile_shards[self.shard - 1]) )
+        elif bcl2fastq_opts.get("--tiles"):
             # Slimmed-down runs override this setting and include $LANE to pick up the lane number,
             # but we substitute that here for consistency.
             bcl2fastq_opts["--tiles"] = "'{}'".format(
@@ -127,12 +272,55 @@ class BCL2FASTQPreprocessor:
             # The default - all tiles in the lane
             bcl2fastq_opts["--tiles"] = "'s_[{}]'".format(self.lane)
 
+        # If --barcode-mismatches was not set, see what the barcodes will allow.
+        # Otherwise do_demultiplex.sh has to try 1 then fall back to 0.
+        if "--barcode-mismatches" in bcl2fastq_opts:
+            self.mismatches_label = 'override ' + bcl2fastq_opts["--barcode-mismatches"]
+        else:
+            mismatches, min_dist = choose_barcode_mismatches(self.get_lane_barcodes())
+            self.mismatches_label = "auto {} (min distance {})".format( mismatches,
+                                                                       '>2' if min_dist is None else min_dist )
+            if self.group:
+                # Reads from the other groups are seen as unassigned reads, so to be sure
+                # none are assigned here they need to be more than mismatches away.
+                cross_dist = self.get_cross_distance(self.group, [ g for g in self.index_groups
+                                                                   if g != self.group ])
+                if cross_dist is not None:
+                    mismatches = min(mismatches, cross_dist - 1)
+                self.mismatches_label = "auto {} (min distance {}, to other groups {})".format(
+                                                mismatches,
+                                                '>2' if min_dist is None else min_dist,
+                                                '>1' if cross_dist is None else cross_dist )
+            bcl2fastq_opts["--barcode-mismatches"] = str(mismatches)
+
         return bcl2fastq_opts
 
     def get_bcl2fastq_options(self):
         opts_dict = self.get_bcl2fastq_opt_dict()
         return ['{} {}'.format(*o) for o in opts_dict.items()]
 
+    def get_lane_barcodes(self, group=None):
+        """Get the (index1, index2) pairs for this lane as bcl2fastq will see them.
+           SampleSheetReader trims trailing N's, so these are put back to make all the
+           indexes the full length for the lane. Reverse complementing makes no difference
+           to the distances but it means any message shows the barcodes actually used.
+           If group is given, or a group has been set with set_group(), only the barcodes
+           in that group are returned.
+        """
+        group = group or self.group
+        index_lengths = group or self.bme.lane_length_dict.get(self.lane, [0, 0])
+        res = []
+        for r in self.bme.ssr.get_rows(lane=self.lane):
+            if group and [len(r.index1), len(r.index2)] != group:
+                continue
+            bc = [ i.ljust(l, 'N') for i, l in zip([r.index1, r.index2], index_lengths) ]
+            if '1' in self.revcomp:
+                bc[0] = revcomp(bc[0])
+            if '2' in self.revcomp:
+                bc[1] = revcomp(bc[1])
+            res.append(tuple(bc))
+        return res
+
     def infer_revcomp(self):
         """Do we need to do the thing? This is a special hack for certain NovaSeq runs.
         """
@@ -140,7 +328,7 @@ class BCL2FASTQPreprocessor:
             # Not a NovaSeq run then
             return ''
 
-        rp = RunParametersXMLParser( self.run_dir ).run_parameters
+        rp = self.bme.rip.get_run_parameters()
         if rp.get('Consumable Version') == '3':
             # For these we want to revcomp the i5 barcode.
             return '2'
@@ -148,6 +336,25 @@ class BCL2FASTQPreprocessor:
         # In all other cases, nowt to do.
         return ''
 
+    def get_bc_check_tiles(self):
+        """The tiles to sample in bc_check mode. This is the first tile (alphabetically)
+           in the lane or, if we're to sample more tiles, some spread over the lane,
+           keeping to any tiles set in pipeline_settings.ini. index_sampler.py reads as
+           many as it needs. Returns [] if the tiles are not known.
+        """
+        first_tile = self.geometry.first_tile(self.lane)
+        if first_tile and self.bc_check_tiles > 1:
+            within = None
+            if self.ini_settings['bcl2fastq'].get('--tiles'):
+                regexes = [ re.compile(r) for r in self.ini_settings['bcl2fastq']['--tiles'].strip("\"\'")
+                                                        .replace("$LANE", self.lane).split(',') ]
+                within = [ t for t in self.geometry.tiles(self.lane)
+                           if any(r.match('s_' + t) for r in regexes) ]
+            check_tiles = self.geometry.representative_tiles(self.lane, self.bc_check_tiles, within)
+            if check_tiles:
+                return check_tiles
+        return [first_tile] if first_tile else []
+
     def get_bc_check_opts(self):
         """Return a modified list of options suitable for the barcode check phase,
            which can be run immediately after the final index cycle.
@@ -159,13 +366,14 @@ class BCL2FASTQPreprocessor:
         check_opts['--minimum-trimmed-read-length'] = '1'
 
         # Tricky ones are --tiles and --use-bases-mask
-        # For --tiles we'll take the first tile (alphabetically) in self.run_info or else
-        # assume that tile 1101 is valid (which works for MiSeq runs, even if slimmed)
-        if self.tiles:
-            tiles_for_lane = [ t for l, t in
-                               [ t.split('_') for t in self.tiles ]
-                               if l == self.lane ]
-            check_opts['--tiles'] = "'s_[{}]_{}'".format(self.lane, tiles_for_lane[0])
+        # For --tiles we'll take the first of the tiles to sample or else assume that
+        # tile 1101 is valid (which works for MiSeq runs, even if slimmed). If there are
+        # more tiles to sample, index_sampler.py gets them from the #BarcodeCheckTiles
+        # line (see get_output()) but bcl2fastq, if we have to fall back to it, only
+        # processes the one tile.
+        check_tiles = self.get_bc_check_tiles()
+        if check_tiles:
+            check_opts['--tiles'] = "'{}'".format(self.geometry.tiles_option(self.lane, check_tiles[:1]))
         else:
             check_opts["--tiles"] = "'s_[{}]_1101'".format(self.lane)
 
@@ -195,84 +403,116 @@ class BCL2FASTQPreprocessor:
             bcl2fastq_opts = self.get_bc_check_opts()
 
         # OK now we can go through the input sample sheet.
-        with open(self.run_dir + '/SampleSheet.csv') as ssfh:
-            # Make the iterator strip all lines
-            ssfh = (l.strip().rstrip(',') for l in ssfh)
-
-            # Allow for blank lines and comments at the top
-            for l in ssfh:
-                if l and (not l.startswith('#')):
-                    break
-            # We expect to have a [Header] section first
-            assert l == '[Header]'
-            for l in ssfh:
-                if l == '' or l.startswith('['):
-                    break
-                if not any(l.startswith(x) for x in ('Description', '#')):
-                    res.append(l)
-            res.append("Run ID,{}".format(self.run_info['RunId']))
-            res.append("Description,Fragment processed with {}".format(created_by))
-            res.append("#Lane,{}".format(self.lane))
-            res.append("#Revcomp,{}".format(self.revcomp_label))
-
-            # Now add the bcl2fastq_opts
-            res.append('')
-            res.append('[bcl2fastq]')
-            res.extend(bcl2fastq_opts)
-            res.append('')
-
-            # Get to the [Data] line, or there may be [Settings]
-            for l in ssfh:
-                if self.has_settings_section and l in ['[Settings]']:
-                    # Dump this section until first blank line then go back to looking for [Data]
-                    res.append(l)
-                    for l in ssfh:
-                        if l.startswith("["):
-                            res.append("")
-                            break
-                        res.append(l)
-                        if not l:
-                            break
-                    if l == "[Data]":
+        # The lines are already stripped.
+        ssfh = iter(self.samplesheet_lines)
+
+        # Allow for blank lines and comments at the top
+        for l in ssfh:
+            if l and (not l.startswith('#')):
+                break
+        # We expect to have a [Header] section first
+        assert l == '[Header]'
+        for l in ssfh:
+            if l == '' or l.startswith('['):
+                break
+            if not any(l.startswith(x) for x in ('Description', '#')):
+                res.append(l)
+        res.append("Run ID,{}".format(self.run_info['RunId']))
+        res.append("Description,Fragment processed with {}".format(created_by))
+        res.append("#Lane,{}".format(self.lane))
+        res.append("#Revcomp,{}".format(self.revcomp_label))
+        res.append("#BarcodeMismatches,{}".format(self.mismatches_label))
+        if self.group:
+            res.append("#IndexGroup,{} of {} ({}+{})".format( self.index_groups.index(self.group) + 1,
+                                                               len(self.index_groups),
+                                                               *self.group ))
+        elif self.index_groups:
+            # Snakefile.demux and BCL2FASTQPostprocessor.py look for this line.
+            res.append("#IndexGroups,{}".format(len(self.index_groups)))
+        if self.shard:
+            shard_tiles = self.tile_shards[self.shard - 1]
+            res.append("#TileShard,{} of {} ({} tiles {} to {})".format( self.shard,
+                                                                         len(self.tile_shards),
+                                                                         len(shard_tiles),
+                                                                         shard_tiles[0],
+                                                                         shard_tiles[-1] ))
+        elif self.tile_shards:
+            # Snakefile.demux and BCL2FASTQPostprocessor.py look for this line too.
+            res.append("#TileShards,{}".format(len(self.tile_shards)))
+        if self.bc_check and self.bc_check_ci:
+            # index_sampler.py looks for this line
+            res.append("#BarcodeCheckCI,{}".format(self.bc_check_ci))
+        if self.bc_check:
+            check_tiles = self.get_bc_check_tiles()
+            if len(check_tiles) > 1:
+                # And this one, which overrides --tiles
+                res.append("#BarcodeCheckTiles,{}".format(' '.join( t.split('_')[1] for t in check_tiles )))
+
+        # Now add the bcl2fastq_opts
+        res.append('')
+        res.append('[bcl2fastq]')
+        res.extend(bcl2fastq_opts)
+        res.append('')
+
+        # Get to the [Data] line, or there may be [Settings]
+        for l in ssfh:
+            if self.has_settings_section and l in ['[Settings]']:
+                # Dump this section until first blank line then go back to looking for [Data]
+                res.append(l)
+                for l in ssfh:
+                    if l.startswith("["):
+                        res.append("")
                         break
-
-                elif l == "[Data]":
-                    # Data must be the final section
-                    break
-            else:
-                # We never found a Data line
-                raise Exception("No [Data] line in SampleSheet.csv")
-
-            # Grab the header. Allow for a blank line
-            res.append('[Data]')
-            for l in ssfh:
-                if l:
-                    data_headers = [ h.lower() for h in l.split(',') ]
                     res.append(l)
+                    if not l:
+                        break
+                if l == "[Data]":
                     break
-            else:
-                # We never found the headers
-                raise Exception("No headers after the [Data] line in SampleSheet.csv")
 
-            try:
-                lane_header_idx = data_headers.index('lane')
-            except ValueError:
-                # If there is no lane the semantics say that all lines apply to all lanes.
-                lane_header_idx = None
-
-            # Get the actual entries
-            for l in ssfh:
-                if not l:
+            elif l == "[Data]":
+                # Data must be the final section
+                break
+        else:
+            # We never found a Data line
+            raise Exception("No [Data] line in SampleSheet.csv")
+
+        # Grab the header. Allow for a blank line
+        res.append('[Data]')
+        for l in ssfh:
+            if l:
+                data_headers = [ h.lower() for h in l.split(',') ]
+                res.append(l)
+                break
+        else:
+            # We never found the headers
+            raise Exception("No headers after the [Data] line in SampleSheet.csv")
+
+        try:
+            lane_header_idx = data_headers.index('lane')
+        except ValueError:
+            # If there is no lane the semantics say that all lines apply to all lanes.
+            lane_header_idx = None
+        data_columns = { h: i for i, h in enumerate(data_headers) }
+
+        # Get the actual entries
+        for l in ssfh:
+            if not l:
+                continue
+            l = l.split(',')
+            if (lane_header_idx is None) or (l[lane_header_idx] == self.lane):
+                # If the lane is split, is this line in the group? Check the lengths just
+                # as SampleSheetReader sees them.
+                if self.group and [ len(i) for i in self.bme.ssr._get_index_sequences_from_data_row(
+                                                                    l, data_columns) ] != self.group:
                     continue
-                l = l.split(',')
-                if (lane_header_idx is None) or (l[lane_header_idx] == self.lane):
-                    # Yeah we want this. But do we need any index munging?
-                    if '1' in self.revcomp and 'index' in data_headers:
-                        l[data_headers.index('index')] = revcomp(l[data_headers.index('index')])
-                    if '2' in self.revcomp and 'index2' in data_headers:
-                        l[data_headers.index('index2')] = revcomp(l[data_headers.index('index2')])
 
-                    res.append(','.join(l))
+                # Yeah we want this. But do we need any index munging?
+                if '1' in self.revcomp and 'index' in data_headers:
+                    l[data_headers.index('index')] = revcomp(l[data_headers.index('index')])
+                if '2' in self.revcomp and 'index2' in data_headers:
+                    l[data_headers.index('index2')] = revcomp(l[data_headers.index('index2')])
+
+                res.append(','.join(l))
 
         return res
 
@@ -280,12 +520,11 @@ class BCL2FASTQPreprocessor:
         """Loads the [bcl2fastq] section from self._samplesheet into self.ini_settings,
            allowing things like --barcode-mismatches to be embedded in the SampleSheet.csv
         """
-        cp = configparser.ConfigParser(empty_lines_in_values=False, delimiters=(':', '=', ' '))
-        try:
-            with open(self.samplesheet) as ssfh:
-                # Make the iterator strip all lines
-                ssfh = (l.strip().rstrip(',') for l in ssfh)
-                tail_lines = enumerate(dropwhile(lambda x: x != "[bcl2fastq]", ssfh))
+        if self.samplesheet not in self._ini_cache:
+            cp = configparser.ConfigParser(empty_lines_in_values=False, delimiters=(':', '=', ' '))
+            sections = self._ini_cache[self.samplesheet] = []
+            try:
+                tail_lines = enumerate(dropwhile(lambda x: x != "[bcl2fastq]", self.samplesheet_lines))
                 conf_lines = map( lambda p: p[1],
                                   takewhile( lambda x: not (x[0] > 1 and x[1].startswith('[')),
                                              tail_lines ) )
@@ -296,24 +535,24 @@ class BCL2FASTQPreprocessor:
                     L.debug(f"Got config section [{section}] in {self.samplesheet}")
 
                     # Cast all to strings
-                    self.ini_settings[section].update(cp.items(section))
-        except KeyError:
-            return
+                    sections.append((section, cp.items(section)))
+            except KeyError:
+                pass
 
+        for section, items in self._ini_cache[self.samplesheet]:
+            self.ini_settings[section].update(items)
 
     def load_ini_file(self, ini_file):
         """ Read the options from config_file into self.ini_settings,
             overwriting anything already there.
         """
-        cp = configparser.ConfigParser(empty_lines_in_values=False)
-        try:
+        if ini_file not in self._ini_cache:
+            cp = configparser.ConfigParser(empty_lines_in_values=False)
             cp.read(ini_file)
-            for section in cp.sections():
-                #conf_items = { k: str(v) for k, v in cp.items(section) }
-                self.ini_settings[section].update(cp.items(section))
+            self._ini_cache[ini_file] = [ (section, cp.items(section)) for section in cp.sections() ]
 
-        except Exception:
-            raise
+        for section, items in self._ini_cache[ini_file]:
+            self.ini_settings[section].update(items)
 
 def revcomp(seq, ttable=str.maketrans('ATCG','TAGC')):
     """Standard revcomp
@@ -332,9 +571,61 @@ def main(args):
     # This always comes out as a list of 1
     run_dir, = args.run_dir
 
-    pp = BCL2FASTQPreprocessor(run_source_dir=run_dir, **vars(args))
+    lanes = args.lane
+    if len(lanes) > 1 and not args.output:
+        exit("Setting up more than one lane requires --output")
 
-    print( *pp.get_output(this_script), sep='\n' )
+    def _revcomp(lane):
+        # The override file, if present and not empty, beats the --revcomp setting
+        if args.revcomp_overrides:
+            try:
+                with open(os.path.join( run_dir, "pipeline",
+                                        "index_revcomp.lane{}.OVERRIDE".format(lane) )) as ofh:
+                    return ofh.read().strip() or args.revcomp
+            except FileNotFoundError:
+                pass
+        return args.revcomp
+
+    # Use the cached sample sheet, since we're called at least once per run.
+    opts = dict(vars(args), lane=lanes[0], revcomp=_revcomp(lanes[0]))
+    pp = BCL2FASTQPreprocessor(run_source_dir=run_dir, use_cache=True, **opts)
+
+    for lane in lanes:
+        if lane != pp.lane:
+            pp.set_lane(**dict(opts, lane=lane, revcomp=_revcomp(lane)))
+        out_lines = pp.get_output(this_script)
+
+        if not args.output:
+            if pp.index_groups or pp.tile_shards:
+                L.warning("The sheets for each index length group or tile shard are only written with --output")
+            print( *out_lines, sep='\n' )
+        else:
+            out_file = args.output.format(lane=lane)
+            L.info("Writing {}".format(out_file))
+            with open(out_file, 'w') as ofh:
+                print( *out_lines, sep='\n', file=ofh )
+
+            # And the sheets for each group, if the lane is split
+            for gnum, group in enumerate(pp.index_groups, start=1):
+                pp.set_group(group)
+                group_file = os.path.join( os.path.dirname(out_file), "group{}".format(gnum),
+                                           os.path.basename(out_file) )
+                L.info("Writing {}".format(group_file))
+                os.makedirs(os.path.dirname(group_file), exist_ok=True)
+                with open(group_file, 'w') as ofh:
+                    print( *pp.get_output(this_script), sep='\n', file=ofh )
+            pp.set_group(None)
+
+            # Likewise for the tile shards
+            for snum in range(1, len(pp.tile_shards) + 1):
+                pp.set_shard(snum)
+                shard_file = os.path.join( os.path.dirname(out_file), "shard{}".format(snum),
+                                           os.path.basename(out_file) )
+                L.info("Writing {}".format(shard_file))
+                os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+                with open(shard_file, 'w') as ofh:
+                    print( *pp.get_output(this_script), sep='\n', file=ofh )
+            pp.set_shard(None)
 
 def parse_args():
     description = """Outputs a sample sheet fragment for bcl2fastq for one lane"""
@@ -344,10 +635,26 @@ def parse_args():
 
     argparser.add_argument("-r", "--revcomp", default="", choices=["none", "", "1", "2", "12", "auto"],
                            help="Reverse complement index 2 and/or 1")
-    argparser.add_argument("-l", "--lane", required=True, choices=list("12345678"),
-                           help="Lane to be demultiplexed")
+    argparser.add_argument("-l", "--lane", required=True, choices=list("12345678"), action="append",
+                           help="Lane to be demultiplexed. Repeat to set up several lanes.")
+    argparser.add_argument("-o", "--output",
+                           help="Write the sample sheet for each lane to this file, rather than" +
+                                " to stdout. {lane} is replaced by the lane number, as in" +
+                                " lane{lane}/SampleSheet.filtered.csv")
+    argparser.add_argument("--revcomp_overrides", action="store_true",
+                           help="Take the --revcomp setting for each lane from" +
+                                " pipeline/index_revcomp.laneN.OVERRIDE, if present and not empty")
+    argparser.add_argument("--tiles_per_shard", type=int, default=0,
+                           help="Split lanes with more tiles than this into shards of whole tiles," +
+                                " to be demultiplexed separately. 0 means no sharding.")
     argparser.add_argument("-c", "--bc_check", action="store_true",
-                           help="Prepare for barcode check mode (1 tile 1 base)")
+                           help="Prepare for barcode check mode (a few tiles, 1 base)")
+    argparser.add_argument("--bc_check_tiles", type=int, default=8,
+                           help="In barcode check mode, select up to this many tiles, spread over" +
+                                " the lane.")
+    argparser.add_argument("--bc_check_ci", type=float, default=0.005,
+                           help="In barcode check mode, stop sampling tiles once the fraction of reads" +
+                                " in each project is known to within this much (95%% CI).")
     argparser.add_argument("run_dir", nargs=1,
                            help="Directory containing the finished run")
     argparser.add_argument("-v", "--debug", "--verbose", action="store_true",
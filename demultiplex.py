@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+"""Command line interface to illuminatus.DemuxBackend
+   Takes the same arguments as do_demultiplex.sh, which passes the job here if
+   DEMUX_BACKEND is set to anything but bcl2fastq.
+"""
+import os
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.DemuxBackend import get_backend, BACKENDS, DEFAULT_BACKEND
+
+def main(args):
+
+    backend = get_backend( args.backend,
+                           args.run_dir, args.out_dir, args.sample_sheet, args.lane,
+                           threads = args.threads )
+
+    print("Demultiplexing lane {} of {} to {} with {}".format( backend.lane, backend.run_dir,
+                                                               backend.out_dir, backend.name ))
+    for cmd in backend.prepare():
+        print(' '.join(cmd))
+    if args.dry_run:
+        return
+
+    backend.run()
+    stats = backend.collect_stats()
+
+    manifest = backend.output_manifest()
+    for f in manifest:
+        print(f)
+    conversion, = stats['ConversionResults']
+    print("{} FASTQ files for {} samples, {} clusters PF".format( len(manifest),
+                                                                  len(conversion['DemuxResults']),
+                                                                  conversion['TotalClustersPF'] ))
+
+def parse_args(*args):
+    description = """Demultiplex one lane, or part of a lane, using the given backend.
+                     Whatever the backend, the output is laid out as bcl2fastq would do it."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("run_dir", help="The run directory.")
+    argparser.add_argument("out_dir", help="Where to write the output.")
+    argparser.add_argument("sample_sheet", help="The SampleSheet.filtered.csv from bcl2fastq_setup.py")
+    argparser.add_argument("lane", help="The lane to process.")
+    argparser.add_argument("-b", "--backend", choices = list(BACKENDS),
+                           default = os.environ.get('DEMUX_BACKEND') or DEFAULT_BACKEND,
+                           help="The demultiplexer to use. Defaults to $DEMUX_BACKEND if set.")
+    argparser.add_argument("-p", "--threads", type=int,
+                           help="Threads to use. Defaults to $PROCESSING_THREADS or 10.")
+    argparser.add_argument("-n", "--dry_run", action="store_true",
+                           help="Just print the commands that would be run.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
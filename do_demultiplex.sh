@@ -1,5 +1,6 @@
 #!/bin/bash
 # Run bcl2fastq on <rundir> to <outdir> with <samplesheet> for <lane>.
+# Set DEMUX_BACKEND to use a different demultiplexer (see illuminatus/DemuxBackend.py).
 
 set -euo pipefail
 
@@ -9,6 +10,12 @@ OUTDIR="$2"
 SAMPLESHEET="$3"
 LANE="$4"
 
+# Other demultiplexers are handled by demultiplex.py, which produces the same output
+# layout. That script runs this one for the bcl2fastq backend.
+if [ "${DEMUX_BACKEND:-bcl2fastq}" != bcl2fastq ] ; then
+    exec "$(dirname "$(readlink -f "$0")")"/demultiplex.py "$@"
+fi
+
 # bcl2fastq version, and resolve the link if there is one
 BCL2FASTQ="$(which bcl2fastq)"
 BCL2FASTQ_REAL="$(readlink -f "$BCL2FASTQ")"
@@ -50,6 +57,8 @@ if grep -w -- '^--barcode-mismatches' <<<"$opts" ; then
 else
 
     # --barcode-mismatches needs to be determined by trial and error
+    # bcl2fastq_setup.py now checks the barcodes and always sets it, so we only get here
+    # with a sample sheet made by an older version.
 
     if ! ( "$BCL2FASTQ" "${opts_list[@]}" --barcode-mismatches 1 2>"$OUTDIR"/bcl2fastq.log && \
             echo "--barcode-mismatches 1" > "$OUTDIR"/bcl2fastq.opts ) ; then
@@ -10,6 +10,8 @@ shopt -sq failglob
 # in flight at once is fine, though theoretically are race conditions possible if two
 # instances start at once and claim the same run for processing (but that will be caught
 # by touch_atomic so in the worst case you should just get an error).
+# If any run names are given as arguments, only those runs in SEQDATA_LOCATION are
+# examined and the auto-redo check is skipped. This is how run_watcher.py calls the script.
 
 # Note within this script I've tried to use ( subshell blocks ) along with "set -e"
 # to emulate eval{} statements in Perl. It does work but you have to be really careful
@@ -40,9 +42,29 @@ if [ -e "$ENVIRON_SH" ] ; then
            SSPP_HOOK           TOOLBOX           VERBOSE \
            WRITE_TO_CLARITY    DRY_RUN           \
            SNAKE_THREADS       LOCAL_CORES       EXTRA_SNAKE_FLAGS \
-           REDO_HOURS_TO_LOOK_BACK
+           REDO_HOURS_TO_LOOK_BACK MAX_CONCURRENT_ACTIONS \
+           MAX_CONCURRENT_DEMUX MAX_CONCURRENT_QC MAX_CONCURRENT_READ1 MAX_CONCURRENT_NEW \
+           LEASE_TTL           DRIVER_SHARD \
+           STALL_HOURS_DEMUX   STALL_HOURS_QC    FAIL_STALLED_RUNS \
+           DEMUX_TILES_PER_SHARD DEMUX_BACKEND DEMUX_STUB_READS BC_CENSUS
 fi
 
+# By default, only one run is advanced per invocation (see BREAK, below). Setting
+# MAX_CONCURRENT_ACTIONS >1 lets actions for several runs go in parallel, with
+# optional per-type limits MAX_CONCURRENT_DEMUX, MAX_CONCURRENT_QC, MAX_CONCURRENT_READ1
+# and MAX_CONCURRENT_NEW.
+MAX_CONCURRENT_ACTIONS="${MAX_CONCURRENT_ACTIONS:-1}"
+
+# While demultiplexing or QC is running, the driver holds a lease in pipeline/demux.lease
+# or pipeline/qc.lease, renewed by a heartbeat every LEASE_TTL/3 seconds. If the host
+# dies the lease expires and the next driver to see the run will fail it, so that it
+# can be redone. To share one SEQDATA_LOCATION between several driver hosts, set
+# DRIVER_SHARD to "0/2" on one host and "1/2" on the other. Each driver only starts work
+# on the runs in its own shard, but checks the leases on all runs, so if one host dies
+# the other will fail the runs it left behind.
+export LEASE_TTL="${LEASE_TTL:-600}"
+DRIVER_SHARD="${DRIVER_SHARD:-}"
+
 # Just because I renamed it
 if [ -n "${RSYNC_CMD:-}" ] && [ -z "${REPORT_RSYNC:-}" ] ; then
     echo 'RSYNC_CMD option is now REPORT_RSYNC. Please fix your config.'
@@ -59,6 +81,18 @@ fi
 export HOSTNAME="${HOSTNAME:-$(hostname -s)}"
 
 LOG_DIR="${LOG_DIR:-${HOME}/illuminatus/logs}"
+
+# RunStatus.py notes the state of finished runs in this registry so that it need not
+# re-examine them on every cycle. Set RUN_REGISTRY=none to disable this. Changes of state
+# are still noted in the timeline (see below) with no registry.
+export RUN_REGISTRY="${RUN_REGISTRY:-${LOG_DIR}/run_registry.sqlite}"
+# State changes and actions are logged as events to pipeline/timeline.jsonl in each
+# run and also to this central log. See run_timeline_report.py. Set to 'none' to disable.
+export TIMELINE_LOG="${TIMELINE_LOG:-${LOG_DIR}/timeline.jsonl}"
+if [ "$TIMELINE_LOG" = none ] ; then TIMELINE_LOG='' ; fi
+# samplesheet_fetch.sh and auto_redo.sh look up sample sheets by flowcell in this index,
+# rather than searching all of SAMPLESHEETS_ROOT. Set to 'none' to disable.
+export SAMPLESHEET_INDEX="${SAMPLESHEET_INDEX:-${LOG_DIR}/samplesheet_index.sqlite}"
 RUN_NAME_REGEX="${RUN_NAME_REGEX:-.*_.*_.*_[^.]*}"
 
 BIN_LOCATION="${BIN_LOCATION:-$BASH_DIR}"
@@ -172,6 +206,18 @@ save_start_time(){
     echo "${ILLUMINATUS_VERSION}@$(date +%s)" >>pipeline/start_times
 }
 
+timeline_event(){ # event [lane] [extra_json]
+    # Append an event to pipeline/timeline.jsonl and to $TIMELINE_LOG. The format must match
+    # what illuminatus/RunTimeline.py writes. Failure to log an event is not an error.
+    _ev_pid="$BASHPID"
+    _ev="$(printf '{"time": %s, "host": "%s", "run": "%s", "lane": %s, "stage": "%s", "event": "%s", "pid": %s%s}' \
+                  "$(date +%s)" "$HOSTNAME" "$RUNID" "${2:-null}" "$STATUS" "$1" "$_ev_pid" "${3:+, $3}")"
+    { echo "$_ev" >> pipeline/timeline.jsonl ; } 2>/dev/null || true
+    if [ -n "$TIMELINE_LOG" ] ; then
+        { echo "$_ev" >> "$TIMELINE_LOG" ; } 2>/dev/null || true
+    fi
+}
+
 rt_runticket_manager(){
     # Simple wrapper for ticket manager that sets the run and queue
     rt_runticket_manager.py -Q run -r "$RUNID" "$@"
@@ -201,6 +247,8 @@ action_new(){
       chgrp ${VERBOSE:+-c} --reference="$DEMUX_OUTPUT_FOLDER" ./pipeline |& log
 
       plog_start
+      # Save the RunInfo.xml and RunParameters.xml info for the other scripts to use
+      run_meta.py . |& plog
       fetch_samplesheet |& plog
     ) ; [ $? = 0 ] && BREAK=1 || { pipeline_fail Scan_new_run ; return ; }
 
@@ -221,31 +269,37 @@ action_reads_finished(){
     # by action_demultiplexed before it fires off all the QC jobs.
     log "\_READS_FINISHED $RUNID. Checking for new SampleSheet.csv and preparing to demultiplex."
     check_outdir || return 0
-    eval touch_atomic pipeline/"lane{1..$LANES}.started"
-    plog_start
-
-    # Log the start in a way we can easily read back (humans can check the main log!)
-    save_start_time
 
-    # Sort out the SampleSheet and replace with a new one from the LIMS if
-    # available.
-    fetch_samplesheet |& plog
-    summarize_lane_contents.py --yml pipeline/sample_summary.yml |& plog
-
-    # We used to run MultiQC here, before running bcl2fastq, but I think with the expanded read1
-    # processing this is redundant. But we do still want the alert to be sent to RT.
-    ( send_summary_to_rt reply demultiplexing \
-                         "The run finished and demultiplexing will now start. Report will appear at" || true
-    ) |& plog
-
-    # Now kick off the demultiplexing into $FASTQ_LOCATION
-    # Note that the preprocessor and runner are not aware of the 'demultiplexing'
-    # subdirectory and need to be passed the full location explicitly.
-    # The postprocessor does expect to find the files in a 'demultiplexing'
-    # subdirectory. This is for 'good reasons' (TM).
+    # The demux lease is taken before the run goes into in_demultiplexing, and held until
+    # it leaves, so if this host dies at any point check_lease will see the expired lease.
+    # If another driver already has the lease, or got to write the touch files first, exit
+    # with status 3 and leave the run to them.
     BREAK=1
-    plog "Preparing to demultiplex $RUNID into $DEMUX_OUTPUT_FOLDER/demultiplexing/"
     set +e ; ( set -e
+      lease_start demux || exit 3
+      eval touch_atomic pipeline/"lane{1..$LANES}.started" || exit 3
+      plog_start
+
+      # Log the start in a way we can easily read back (humans can check the main log!)
+      save_start_time
+
+      # Sort out the SampleSheet and replace with a new one from the LIMS if
+      # available.
+      fetch_samplesheet |& plog
+      summarize_lane_contents.py --yml pipeline/sample_summary.yml |& plog
+
+      # We used to run MultiQC here, before running bcl2fastq, but I think with the expanded read1
+      # processing this is redundant. But we do still want the alert to be sent to RT.
+      ( send_summary_to_rt reply demultiplexing \
+                           "The run finished and demultiplexing will now start. Report will appear at" || true
+      ) |& plog
+
+      # Now kick off the demultiplexing into $FASTQ_LOCATION
+      # Note that the preprocessor and runner are not aware of the 'demultiplexing'
+      # subdirectory and need to be passed the full location explicitly.
+      # The postprocessor does expect to find the files in a 'demultiplexing'
+      # subdirectory. This is for 'good reasons' (TM).
+      plog "Preparing to demultiplex $RUNID into $DEMUX_OUTPUT_FOLDER/demultiplexing/"
       mkdir -vp "$DEMUX_OUTPUT_FOLDER"/demultiplexing
       log "  Starting bcl2fastq on $RUNID."
       ( rundir="`pwd`"
@@ -262,7 +316,12 @@ action_reads_finished(){
         --comment 'Demultiplexing completed. QC will trigger on next CRON cycle' || true
       log "  Completed bcl2fastq on $RUNID."
 
-    ) |& plog ; [ $? = 0 ] || { pipeline_fail Demultiplexing ; return ; }
+    ) |& plog ; _retval=$?
+    if [ "$_retval" = 3 ] ; then
+        log "  Could not lock $RUNID for demultiplexing. Leaving it for now."
+        return 0
+    fi
+    [ "$_retval" = 0 ] || { pipeline_fail Demultiplexing ; return ; }
 }
 
 action_in_read1_qc_reads_finished(){
@@ -278,15 +337,25 @@ action_in_read1_qc_reads_finished(){
 # and also to see exactly where the run is. (See state diagram)
 action_demultiplexed() {
     log "\_DEMULTIPLEXED $RUNID"
-
-    # This touch file puts the run into status in_qc.
-    # Upload of report is regarded as the final QC step, so if this fails we need to
-    # log a failure.
-    touch_atomic pipeline/qc.started
     check_outdir || return 0
-    log "  Now commencing QC on $RUNID."
     BREAK=1
 
+    # As with demultiplexing, the QC lease is taken before the run goes into in_qc and is
+    # held until the QC is finished or failed. If another driver already has the lease, or
+    # got to write pipeline/qc.started first, leave the run to them.
+    set +e ; ( lease_start qc || exit 3
+
+      # This touch file puts the run into status in_qc.
+      # Upload of report is regarded as the final QC step, so if this fails we need to
+      # log a failure.
+      touch_atomic pipeline/qc.started || exit 3
+      log "  Now commencing QC on $RUNID."
+      demultiplexed_qc
+    ) ; [ $? != 3 ] || log "  Could not lock $RUNID for QC. Leaving it for now."
+}
+
+demultiplexed_qc(){
+    # The body of action_demultiplexed, which runs with the QC lease held.
     set +e
 
     # In certain cases read1_qc can make a 1-tile report with a later timestamp than the full
@@ -323,8 +392,11 @@ action_demultiplexed() {
 
 action_in_demultiplexing() {
     # in pipeline, could update some progress status
-    # TODO - maybe some attempt to detect stalled runs?
+    # If the driver doing the demultiplexing died, fail the run so it can be redone.
     debug "\_IN_DEMULTIPLEXING $RUNID"
+    bcl2fastq_progress.py "$DEMUX_OUTPUT_FOLDER"/demultiplexing |& debug || true
+    check_lease demux Demultiplexing
+    check_stalled Demultiplexing
 }
 
 action_read1_finished() {
@@ -341,8 +413,8 @@ action_read1_finished() {
     fetch_samplesheet |& plog1
 
     # Set up a message to be passed to the "-b" option of MultiQC because the numbers
-    # on the reports are for one tile only.
-    mqc_comment="A single tile was demultiplexed to check the barcodes. Await the final report for true numbers."
+    # on the reports are for a few tiles only.
+    mqc_comment="A sample of tiles was demultiplexed to check the barcodes. Await the final report for true numbers."
 
     # Now is the time for WellDups scanning. Note that we press on despite failure,
     # since we don't want a problem here to hold up demultiplexing.
@@ -380,6 +452,23 @@ action_read1_finished() {
             rt_runticket_manager --comment "$_msg" || true
         fi
         log "  $_msg"
+
+        # Optionally count the indexes over every tile. This is slow, so it comes after the
+        # barcode check has been reported, and any problems get a second alert.
+        if [ "${BC_CENSUS:-no}" = yes ] ; then
+            pushd "$DEMUX_OUTPUT_FOLDER"
+            rm -f "QC/bc_check/census.msg"
+            Snakefile.read1qc -- census_main || log "  Barcode census failed on $RUNID. See $per_run_log1"
+            popd
+
+            if [ -s "$DEMUX_OUTPUT_FOLDER/QC/bc_check/census.msg" ] ; then
+                _full_msg="Barcode census on $RUNID."$'\n\n'"$(cat "$DEMUX_OUTPUT_FOLDER/QC/bc_check/census.msg")"
+                log '  Barcode census does not look good! Reporting to RT.'
+                echo $'Barcode census problem...\n>>>\n'"$_full_msg"$'\n<<<'
+                send_summary_to_rt reply "barcode problem" \
+                    "$_full_msg"$'\n'"Report is at"
+            fi
+        fi
     ) |& plog1
 
     # We're done. If the above block was interrupted by SIGINT we'll arrive here
@@ -399,6 +488,8 @@ action_in_read1_qc() {
 
 action_in_qc() {
     debug "\_IN_QC $RUNID"
+    check_lease qc QC
+    check_stalled QC
 }
 
 action_failed() {
@@ -441,6 +532,7 @@ action_redo() {
 
         [[ "$redo" =~ .*(.)\.redo ]]
         redo_list+=(${BASH_REMATCH[1]})
+        timeline_event redo_lane ${BASH_REMATCH[1]}
     done
     # Clean out all the other flags, and the sample summary
     rm -f pipeline/{qc.started,qc.done,failed,aborted,sample_summary.yml}
@@ -469,6 +561,7 @@ action_redo() {
         "Re-Demultiplexing of lanes ${redo_list[*]} was requested. Updated report will appear at" |& plog
 
     set +e ; ( set -e
+      lease_start demux
       mkdir -vp "$DEMUX_OUTPUT_FOLDER"/demultiplexing
 
       log "  Starting bcl2fastq on $RUNID lanes ${redo_list[*]}."
@@ -497,7 +590,7 @@ action_unknown() {
 touch_atomic(){
     # Create a file or files but it's an error if the file already existed.
     for f in "$@" ; do
-        (set -o noclobber ; >"$f")
+        (set -o noclobber ; >"$f") || return 1
     done
 }
 
@@ -507,6 +600,59 @@ mv_atomic(){
     (set -o noclobber ; >"$2") && rm "$1"
 }
 
+lease_start(){ # name
+    # Take the lease pipeline/<name>.lease on behalf of the current (sub)shell and start a
+    # heartbeat to keep it alive. The lease is released when the (sub)shell exits, whether
+    # or not the work succeeded. This is an error if another live process has the lease.
+    # Note $BASHPID must be read here, not in the background job.
+    _lease_pid="$BASHPID"
+    run_lease.py --pid "$_lease_pid" acquire pipeline/"$1".lease || return 1
+    run_lease.py --pid "$_lease_pid" heartbeat pipeline/"$1".lease </dev/null >/dev/null 2>&1 &
+    trap "kill $! 2>/dev/null ; run_lease.py --pid $_lease_pid release pipeline/$1.lease" EXIT
+}
+
+check_lease(){ # name stage
+    # See if the process that holds pipeline/<name>.lease has gone away. If so, take over the
+    # lease and fail the run, so it can be redone in the usual way. Runs with no lease file
+    # at all were started by an older version of the pipeline, so leave them be.
+    _lease_state="$(run_lease.py check pipeline/"$1".lease)" || return 0
+    if [ "${_lease_state%% *}" != expired ] ; then
+        return 0
+    fi
+
+    # If two drivers get here at once, only one will manage to take over the lease.
+    _lease_pid="$BASHPID"
+    if run_lease.py --pid "$_lease_pid" acquire pipeline/"$1".lease |& log ; then
+        log "  Lease pipeline/$1.lease on $RUNID expired (was held by ${_lease_state#* })."
+        BREAK=1
+        pipeline_fail "$2"_lease_expired
+        run_lease.py --pid "$_lease_pid" release pipeline/"$1".lease |& log || true
+    fi
+}
+
+check_stalled(){ # stage
+    # RunStatus.py reports StalledSince if a run in demultiplexing or QC has shown no sign
+    # of progress for STALL_HOURS_DEMUX or STALL_HOURS_QC. By default we just log this, but
+    # with FAIL_STALLED_RUNS=yes the run is failed so it can be redone.
+    # Note that this does not kill any job that may still be running.
+    if [ -z "${STALLED_SINCE:-}" ] || [ -e pipeline/failed ] ; then
+        return 0
+    fi
+    log "  $RUNID has shown no progress since $STALLED_SINCE."
+    if [ "${FAIL_STALLED_RUNS:-no}" = yes ] ; then
+        BREAK=1
+        pipeline_fail "$1"_stalled
+    fi
+}
+
+in_my_shard(){ # run_name
+    # With DRIVER_SHARD=i/n, only runs whose name hashes to i modulo n are processed by
+    # this driver. With no DRIVER_SHARD, every run is ours.
+    [ -n "$DRIVER_SHARD" ] || return 0
+    _cksum="$(cksum <<<"$1")"
+    [ $(( ${_cksum%% *} % ${DRIVER_SHARD#*/} )) = "${DRIVER_SHARD%/*}" ]
+}
+
 check_outdir(){
     # Ensure that pipeline/output is a directory, and fail in a sensible way if it is not.
     # Caller may override the failure reason.
@@ -722,20 +868,72 @@ pipeline_fail() {
     fi
 }
 
-get_run_status() { # run_dir
+action_class() { # status
+    # Says what sort of work action_$STATUS will do, or 'none' if the action will
+    # return immediately. This must be kept in step with the actions that set BREAK=1.
+    case "$1" in
+        new)                                     echo new ;;
+        reads_finished|in_read1_qc_reads_finished|redo) echo demux ;;
+        demultiplexed)                           echo qc ;;
+        read1_finished)                          echo read1 ;;
+        *)                                       echo none ;;
+    esac
+}
+
+declare -A _running_jobs=()
+wait_for_slot() { # action_class
+    # Wait until the number of running background actions is below MAX_CONCURRENT_ACTIONS
+    # and the number of actions of the given class is below MAX_CONCURRENT_<CLASS>
+    _class_limit_var="MAX_CONCURRENT_${1^^}"
+    _class_limit="${!_class_limit_var:-$MAX_CONCURRENT_ACTIONS}"
+    while true ; do
+        # Forget about jobs that finished
+        for _pid in "${!_running_jobs[@]}" ; do
+            kill -0 "$_pid" 2>/dev/null || unset '_running_jobs[$_pid]'
+        done
+        _class_count=0
+        for _pid in "${!_running_jobs[@]}" ; do
+            [ "${_running_jobs[$_pid]}" != "$1" ] || _class_count=$(( $_class_count + 1 ))
+        done
+        if [ "${#_running_jobs[@]}" -lt "$MAX_CONCURRENT_ACTIONS" ] && [ "$_class_count" -lt "$_class_limit" ] ; then
+            return 0
+        fi
+        wait -n || true
+    done
+}
+
+# The info that get_run_status() needs from RunStatus.py, and the variables to put it in.
+RUN_STATUS_FIELDS=RUNID=RunID,INSTRUMENT=Instrument,STATUS=PipelineStatus,LANES=LaneCount,FLOWCELLID=Flowcell,STALLED_SINCE=StalledSince
+
+declare -A _prefetched_status=()
+prefetch_run_status() { # run_dir...
+  # Get the status of all the runs with a single call to RunStatus.py, rather than starting
+  # Python afresh for every run. Any run that is missed here will be looked at again
+  # by get_run_status.
+  local _line _RUNDIR
+  while read -r _line ; do
+    _RUNDIR='' ; eval "$_line"
+    [ -z "$_RUNDIR" ] || _prefetched_status["$_RUNDIR"]="$_line"
+  done < <(RunStatus.py --record_states --shell --fields "_RUNDIR=RunDir,$RUN_STATUS_FIELDS" "$@" || true)
+}
+
+get_run_status() { # run_dir [prefetched]
   # invoke RunStatus.py in CWD and collect some meta-information about the run.
   # We're passing this info to the state functions via global variables.
+  # If the second arg is set, use the info from prefetch_run_status if there is any.
   _run="$1"
+  RUNID='' INSTRUMENT='' STATUS='' LANES='' FLOWCELLID='' STALLED_SINCE=''
 
-  # This construct allows error output to be seen in the log.
-  _runstatus="$(RunStatus.py "$_run")" || RunStatus.py "$_run" | log 2>&1
+  if [ -n "${2:-}" ] && [ -n "${_prefetched_status[$_run]:-}" ] ; then
+    _runstatus="${_prefetched_status[$_run]}"
+  else
+    # This construct allows error output to be seen in the log.
+    _runstatus="$(RunStatus.py --record_states --shell --fields "$RUN_STATUS_FIELDS" "$_run")" || \
+        RunStatus.py --shell --fields "$RUN_STATUS_FIELDS" "$_run" | log 2>&1
+  fi
 
-  # Capture the various parts into variables (see test/grs.sh in Hesiod)
-  for _v in RUNID/RunID INSTRUMENT/Instrument STATUS/PipelineStatus \
-            LANES/LaneCount FLOWCELLID/Flowcell ; do
-    _line="$(awk -v FS=":" -v f="${_v#*/}" '$1==f {gsub(/^[^:]*:[[:space:]]*/,"");print}' <<<"$_runstatus")"
-    eval "${_v%/*}"='"$_line"'
-  done
+  # RunStatus.py quotes the values, so this just sets the variables named in RUN_STATUS_FIELDS
+  eval "$_runstatus"
 
   if [ -z "${STATUS:-}" ] ; then
     STATUS=unknown
@@ -752,15 +950,31 @@ get_run_status() { # run_dir
 # **** And now the main processing actions, starting with a search for updated sample sheets for
 # **** previously processed runs.
 
-if [ -n "${REDO_HOURS_TO_LOOK_BACK:-}" ] ; then
-    log "Looking for new replacement sample sheets from the last $REDO_HOURS_TO_LOOK_BACK hours."
-    auto_redo.sh |& log || true
-fi
+if [ $# != 0 ] ; then
+    # Just look at the runs requested on the command line.
+    log "Looking at $# specified run(s) in $SEQDATA_LOCATION"
+    _runs=() ; for _r in "$@" ; do _runs+=("$SEQDATA_LOCATION/$(basename "$_r")/") ; done
+    set -- "${_runs[@]}"
+else
+    if [ -n "${REDO_HOURS_TO_LOOK_BACK:-}" ] ; then
+        log "Looking for new replacement sample sheets from the last $REDO_HOURS_TO_LOOK_BACK hours."
+        auto_redo.sh |& log || true
+    fi
 
-log "Looking for run directories matching regex $SEQDATA_LOCATION/$RUN_NAME_REGEX/"
+    log "Looking for run directories matching regex $SEQDATA_LOCATION/$RUN_NAME_REGEX/"
+    set -- "$SEQDATA_LOCATION"/*/
+fi
 
 # 6) Scan for each run until we find something that needs dealing with.
-for run in "$SEQDATA_LOCATION"/*/ ; do
+# First weed out the runs we are not interested in, then get the status of the rest in one go.
+_candidates=()
+declare -A _other_shard=()
+for run in "$@" ; do
+
+  if ! [ -d "$run" ] ; then
+    log "No such run directory $run"
+    continue
+  fi
 
   # $RUN_NAME_PATTERN is now RUN_NAME_REGEX
   if ! [[ "`basename $run`" =~ ^${RUN_NAME_REGEX}$ ]] ; then
@@ -768,9 +982,22 @@ for run in "$SEQDATA_LOCATION"/*/ ; do
     continue
   fi
 
+  # Runs in another shard are still looked at, in case the host doing that shard has
+  # died and left expired leases behind, but no new work is started on them.
+  if ! in_my_shard "`basename "$run"`" ; then
+    _other_shard[$run]=1
+  fi
+
+  _candidates+=("$run")
+done
+[ "${#_candidates[@]}" = 0 ] || prefetch_run_status "${_candidates[@]}"
+
+_acted=0
+for run in ${_candidates[@]+"${_candidates[@]}"} ; do
+
   # invoke runinfo and collect some meta-information about the run. We're passing info
   # to the state functions via global variables: RUNID LANES FLOWCELLID etc.
-  get_run_status "$run"
+  get_run_status "$run" prefetched
 
   # Check that [ "$RUNID" = `basename "$run"` ] or else BAD THINGS (TM)
   # will happen when later bits of the pipeline just assume that it is!
@@ -779,17 +1006,67 @@ for run in "$SEQDATA_LOCATION"/*/ ; do
     continue
   fi
 
+  if [ -n "${_other_shard[$run]:-}" ] ; then
+    debug "Ignoring $RUNID as it is not in shard $DRIVER_SHARD"
+    BREAK=0
+    pushd "$run" >/dev/null
+    case "$STATUS" in
+        in_demultiplexing) check_lease demux Demultiplexing ;;
+        in_qc)             check_lease qc QC ;;
+    esac
+    popd >/dev/null
+    ! [ "$BREAK" = 1 ] || break
+    continue
+  fi
+
   if [ "$STATUS" = complete ] || [ "$STATUS" = aborted ] ; then _log=debug ; else _log=log ; fi
   $_log "$run has $RUNID from $INSTRUMENT with $LANES lane(s) and status=$STATUS"
 
+  # In concurrent mode, anything that does real work is run in the background.
+  _class="$(action_class "$STATUS")"
+  if [ "$MAX_CONCURRENT_ACTIONS" -gt 1 ] && [ "$_class" != none ] ; then
+    wait_for_slot "$_class"
+  fi
+
+  # If we already did something on this cycle, the prefetched status may be out of date
+  # by now, so check again before doing any real work.
+  if [ "$_class" != none ] && [ "$_acted" = 1 ] ; then
+    _old_status="$STATUS"
+    get_run_status "$run"
+    if [ "$STATUS" != "$_old_status" ] ; then
+      log "$RUNID changed from status=$_old_status to status=$STATUS. Leaving it for the next cycle."
+      continue
+    fi
+  fi
+  [ "$_class" = none ] || _acted=1
+
+  if [ "$MAX_CONCURRENT_ACTIONS" -gt 1 ] && [ "$_class" != none ] ; then
+    debug "Starting action_$STATUS on $RUNID in the background"
+    ( set +e
+      cd "$run"
+      timeline_event action_start
+      ( set -e ; eval action_"$STATUS" )
+      _retval=$?
+      [ $_retval = 0 ] || log "Error while trying to run action_$STATUS on $run"
+      timeline_event action_end '' '"status": '$_retval
+    ) &
+    _running_jobs[$!]="$_class"
+    continue
+  fi
+
   #Call the appropriate function in the appropriate directory.
   BREAK=0
-  pushd "$run" >/dev/null ; eval action_"$STATUS"
+  pushd "$run" >/dev/null
+  # Actions that do nothing are not worth noting in the timeline.
+  [ "$_class" = none ] || timeline_event action_start
+  eval action_"$STATUS"
   # Even though 'set -e' is in effect this next line is reachable if the called function turns
   # it off...
-  [ $? = 0 ] || log "Error while trying to run action_$STATUS on $run"
+  _retval=$?
+  [ $_retval = 0 ] || log "Error while trying to run action_$STATUS on $run"
   # Reset the error trap in any case
   set -e
+  [ "$_class" = none ] || timeline_event action_end '' '"status": '$_retval
   popd >/dev/null
 
   # If the driver started some actual work it should request to break, as the CRON will start
@@ -800,4 +1077,5 @@ for run in "$SEQDATA_LOCATION"/*/ ; do
   # Negated test is needed to play nicely with 'set -e'
   ! [ "$BREAK" = 1 ] || break
 done
+# This waits for any background actions, as well as anything else.
 wait
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+"""Follows the progress of bcl2fastq by reading the lane*/bcl2fastq.log files that
+   do_demultiplex.sh captures, and looking at the FASTQ files it writes.
+   bcl2fastq says nothing in the log between creating the FASTQ files and finishing (the
+   "Tile:" lines near the start are just the list of tiles to do) so the progress comes
+   from the size of the FASTQ files. bcl2fastq only writes reads that pass filter, and
+   the number of these per tile is in InterOp/TileMetricsOut.bin, which gives us the
+   number of reads to expect.
+   If a lane is split into shards by tile or groups by index length, bcl2fastq is run
+   separately in each laneN/shardM or laneN/groupM, and these are tracked separately as
+   '1/shard1', '1/shard2' etc. get_summary() adds them up for each lane.
+   Each time update() is called, only the new part of each log is read, starting
+   from the byte offset saved last time. Progress is saved in a small JSON file
+   (normally demultiplexing/bcl2fastq_progress.json) with, for each lane or part:
+     state          - waiting, running, finished or failed
+     tiles_total    - number of tiles expected, from RunInfo.xml and any --tiles option
+     reads_expected - number of PF reads in those tiles, from InterOp
+     reads_done     - estimated number of reads written to the FASTQ files so far
+     reads_per_sec  - throughput so far
+     eta            - estimated finish time
+     threads        - the loading/processing/writing threads reported by bcl2fastq, so
+                      that we can compare the effect of different settings
+"""
+import os, re
+import json
+import struct
+import time
+import zlib
+from glob import glob
+from datetime import datetime
+
+from illuminatus.RunMeta import get_run_meta
+
+PROGRESS_FILE = 'bcl2fastq_progress.json'
+
+# Every bcl2fastq log line starts like this
+_LOG_LINE = r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) \[\w+\] '
+
+START_LINE   = re.compile(_LOG_LINE + r'Command-line invocation: (.*)')
+THREADS_LINE = re.compile(_LOG_LINE + r'INFO: (Loading|Processing|Writing) threads: (\d+)')
+END_LINE     = re.compile(_LOG_LINE + r'Processing completed with (\d+) errors')
+
+TILES_OPT = re.compile(r'--tiles[= ](\S+)')
+
+# Only the start of each FASTQ file is decompressed to see how many bytes there are per
+# read. This is enough to get a good average.
+SAMPLE_BYTES = 1024 * 1024
+
+def read_pf_clusters( interop_dir ):
+    """ Reads the number of clusters passing filter for each tile from TileMetricsOut.bin.
+        Returns a dict of { (lane, tile): count } where tile is a number like 2101, or an
+        empty dict if the file is missing or in a format we don't know.
+        Version 2 files have a record of (lane, tile, code, value) for each metric, where
+        code 103 is the PF cluster count. Version 3 files (NovaSeq) have a tile record
+        with code 't' holding the cluster count and the PF cluster count.
+    """
+    res = dict()
+    try:
+        with open(os.path.join(interop_dir, 'TileMetricsOut.bin'), 'rb') as tfh:
+            version, rec_size = tfh.read(2)
+            if version == 2 and rec_size == 10:
+                rec = struct.Struct('<HHHf')
+                data = tfh.read()
+                for lane, tile, code, value in rec.iter_unpack(data[:len(data) - len(data) % rec.size]):
+                    if code == 103:
+                        res[(lane, tile)] = int(value)
+            elif version == 3 and rec_size == 15:
+                tfh.read(4) # tile area
+                rec = struct.Struct('<HIcff')
+                data = tfh.read()
+                for lane, tile, code, _clusters, pf_clusters in rec.iter_unpack(data[:len(data) - len(data) % rec.size]):
+                    if code == b't':
+                        res[(lane, tile)] = int(pf_clusters)
+    except (OSError, ValueError):
+        pass
+    return res
+
+def count_fastq_reads( fastq_file , sample_bytes = None ):
+    """ Count the complete reads in a gzipped FASTQ file that may still be being written.
+        If sample_bytes is set, stop after reading about that much of the file.
+        Returns the count and the number of bytes read, so the caller can scale it up.
+        The file may be several gzip streams, one after the other.
+    """
+    dobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    lines = 0
+    bytes_read = 0
+    with open(fastq_file, 'rb') as ffh:
+        while True:
+            chunk = ffh.read(65536)
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+            try:
+                while chunk:
+                    lines += dobj.decompress(chunk).count(b'\n')
+                    chunk = b''
+                    if dobj.eof:
+                        chunk = dobj.unused_data
+                        dobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            except zlib.error:
+                break
+            if sample_bytes and bytes_read >= sample_bytes:
+                break
+    return lines // 4, bytes_read
+
+def read_sheet_tiles( sample_sheet ):
+    """ Gets the --tiles option from the [bcl2fastq] section of a sheet made by
+        bcl2fastq_setup.py, or None.
+    """
+    try:
+        with open(sample_sheet) as sfh:
+            for l in sfh:
+                if l.startswith('[Data]'):
+                    break
+                mo = TILES_OPT.match(l)
+                if mo:
+                    return mo.group(1).strip("'\"")
+    except OSError:
+        pass
+    return None
+
+def _parse_time(t):
+    return time.mktime(time.strptime(t, '%Y-%m-%d %H:%M:%S'))
+
+def _fmt_time(t):
+    return datetime.fromtimestamp(t).isoformat(timespec='seconds') if t else None
+
+class BCL2FASTQProgress:
+
+    def __init__( self , demux_dir , run_dir = None ):
+        """ demux_dir is the directory with the lane* subdirectories. run_dir is the
+            sequencer output, and defaults to the 'seqdata' link in the parent of
+            demux_dir.
+        """
+        self.demux_dir = demux_dir
+        self.run_dir = run_dir or os.path.join(demux_dir, '..', 'seqdata')
+        self.progress_file = os.path.join(demux_dir, PROGRESS_FILE)
+        self._geometry = None
+        self._pf_clusters = None
+
+        try:
+            with open(self.progress_file) as pfh:
+                self.progress = json.load(pfh)
+        except (FileNotFoundError, ValueError):
+            self.progress = dict(lanes = {})
+
+    def get_tiles( self , lane ):
+        """ Get the list of tile names for this lane, like ['1_1101', '1_1102', ...]
+            Older RunInfo.xml files don't list the tiles so make up the names from
+            the flowcell layout.
+        """
+        if self._geometry is None:
+            self._geometry = get_run_meta(self.run_dir, save=False).get_geometry()
+
+        return self._geometry.tiles(lane)
+
+    def select_tiles( self , lane , tiles_opt = None ):
+        """ The tiles that bcl2fastq will process for this lane, taking into account any
+            --tiles option, which is a list of regexes that bcl2fastq matches against
+            names like 's_1_1101'.
+        """
+        tiles = self.get_tiles(lane)
+        if tiles_opt:
+            regexes = [ re.compile(r) for r in tiles_opt.split(',') ]
+            tiles = [ t for t in tiles if any(r.match('s_' + t) for r in regexes) ]
+        return tiles
+
+    def count_tiles( self , lane , tiles_opt = None ):
+        """ Number of tiles that bcl2fastq will process for this lane
+        """
+        return len(self.select_tiles(lane, tiles_opt))
+
+    def count_expected_reads( self , lane , tiles_opt = None ):
+        """ Number of PF reads that bcl2fastq should write for this lane, or None if
+            InterOp doesn't tell us about all the tiles.
+        """
+        if self._pf_clusters is None:
+            self._pf_clusters = read_pf_clusters(os.path.join(self.run_dir, 'InterOp'))
+
+        res = 0
+        for t in self.select_tiles(lane, tiles_opt):
+            t_lane, t_num = t.split('_')
+            pf = self._pf_clusters.get((int(t_lane), int(t_num)))
+            if pf is None:
+                return None
+            res += pf
+        return res
+
+    def count_reads_done( self , lp , out_dir ):
+        """ Estimate how many reads bcl2fastq has written so far, by looking at all the
+            read 1 FASTQ files in out_dir. Small files are counted exactly, but for
+            bigger ones we decompress the start of the file and save the bytes per read
+            in lp['bytes_per_read'] so we only need to do this once.
+        """
+        res = 0
+        for fastq_file in glob(os.path.join(out_dir, '**', '*_R1_*.fastq.gz'), recursive=True):
+            rel_name = os.path.relpath(fastq_file, out_dir)
+            try:
+                size = os.stat(fastq_file).st_size
+                if rel_name not in lp['bytes_per_read']:
+                    reads, bytes_read = count_fastq_reads(fastq_file, SAMPLE_BYTES)
+                    if bytes_read >= size:
+                        res += reads
+                        continue
+                    elif not reads:
+                        continue
+                    lp['bytes_per_read'][rel_name] = bytes_read / reads
+            except OSError:
+                # File was moved or removed
+                continue
+            res += size / lp['bytes_per_read'][rel_name]
+        return int(res)
+
+    def find_parts( self ):
+        """ Find the directories where bcl2fastq is run, as a dict of { key: out_dir }.
+            For a lane that is split into shards or groups, there is one for each part,
+            keyed like '1/shard2', as soon as bcl2fastq_setup.py has made the sheets.
+            Otherwise the key is just the lane, once there is a log.
+        """
+        res = dict()
+        for lane_dir in glob(os.path.join(self.demux_dir, 'lane*', '')):
+            lane = os.path.basename(os.path.dirname(lane_dir))[len('lane'):]
+            part_dirs = glob(os.path.join(lane_dir, 'shard*', '')) + \
+                        glob(os.path.join(lane_dir, 'group*', ''))
+            for pd in part_dirs:
+                res['{}/{}'.format(lane, os.path.basename(os.path.dirname(pd)))] = pd
+            if not part_dirs and os.path.exists(os.path.join(lane_dir, 'bcl2fastq.log')):
+                res[lane] = lane_dir
+        return res
+
+    def update_lane( self , key , out_dir ):
+        """ Read any new lines from out_dir/bcl2fastq.log, look at the FASTQ files, and
+            update self.progress['lanes'][key], where key is the lane number or a part
+            of a lane as found by find_parts().
+        """
+        lane = key.split('/')[0]
+        log_file = os.path.join(out_dir, 'bcl2fastq.log')
+        try:
+            st = os.stat(log_file)
+            inode, size = st.st_ino, st.st_size
+        except FileNotFoundError:
+            # A part that is not started yet
+            inode, size = None, 0
+        lp = self.progress['lanes'].get(key)
+
+        # If the log was replaced (eg. bcl2fastq was re-run with --barcode-mismatches 0)
+        # or truncated then start again.
+        if not lp or lp['inode'] != inode or lp['offset'] > size:
+            lp = self.progress['lanes'][key] = dict( inode = inode,
+                                                      offset = 0,
+                                                      state = 'waiting',
+                                                      start_time = None,
+                                                      last_time = None,
+                                                      tiles_opt = None,
+                                                      tiles_total = None,
+                                                      reads_expected = None,
+                                                      reads_done = 0,
+                                                      bytes_per_read = {},
+                                                      threads = {},
+                                                      errors = None )
+
+        new_data = b''
+        if inode is not None:
+            with open(log_file, 'rb') as lfh:
+                lfh.seek(lp['offset'])
+                new_data = lfh.read()
+        elif lp['tiles_opt'] is None:
+            # We can still see which tiles it will do
+            lp['tiles_opt'] = read_sheet_tiles(os.path.join(out_dir, 'SampleSheet.filtered.csv'))
+
+        # Only deal with complete lines. The last line may be in the process of being written.
+        new_data = new_data[:new_data.rfind(b'\n') + 1]
+        lp['offset'] += len(new_data)
+
+        for line in new_data.decode(errors='replace').split('\n'):
+            mo = START_LINE.match(line)
+            if mo:
+                lp['state'] = 'running'
+                lp['start_time'] = lp['last_time'] = _parse_time(mo.group(1))
+                tiles_opt = TILES_OPT.search(mo.group(2))
+                lp['tiles_opt'] = tiles_opt and tiles_opt.group(1)
+                continue
+            mo = THREADS_LINE.match(line)
+            if mo:
+                lp['threads'][mo.group(2).lower()] = int(mo.group(3))
+                continue
+            mo = END_LINE.match(line)
+            if mo:
+                lp['errors'] = int(mo.group(2))
+                lp['state'] = 'finished' if lp['errors'] == 0 else 'failed'
+                lp['last_time'] = _parse_time(mo.group(1))
+
+        if lp['state'] != 'waiting' or lp['tiles_opt']:
+            try:
+                if lp['tiles_total'] is None:
+                    lp['tiles_total'] = self.count_tiles(lane, lp['tiles_opt'])
+                if lp['reads_expected'] is None:
+                    lp['reads_expected'] = self.count_expected_reads(lane, lp['tiles_opt'])
+            except Exception:
+                # Can't read RunInfo.xml. We'll try again next time.
+                pass
+
+        if lp['state'] == 'running':
+            lp['reads_done'] = self.count_reads_done(lp, out_dir)
+            lp['last_time'] = time.time()
+
+        self.calculate_eta(lp)
+        return lp
+
+    def calculate_eta( self , lp ):
+        """ Work out reads_per_sec and eta for a lane
+        """
+        lp['reads_per_sec'] = None
+        lp['eta'] = None
+        if lp['state'] == 'finished':
+            lp['eta'] = _fmt_time(lp['last_time'])
+            if lp['reads_expected']:
+                lp['reads_done'] = lp['reads_expected']
+        if not lp['start_time'] or not lp['reads_done']:
+            return
+
+        elapsed = lp['last_time'] - lp['start_time']
+        if elapsed > 0:
+            rate = lp['reads_done'] / elapsed
+            lp['reads_per_sec'] = round(rate, 1)
+            if lp['state'] == 'running' and lp['reads_expected']:
+                remaining = max(0, lp['reads_expected'] - lp['reads_done'])
+                lp['eta'] = _fmt_time(lp['last_time'] + remaining / rate)
+
+    def update( self ):
+        """ Update all the lanes and save the progress file.
+        """
+        for key, out_dir in sorted(self.find_parts().items()):
+            self.update_lane(key, out_dir)
+
+        self.progress['updated'] = _fmt_time(time.time())
+        self.save()
+        return self.progress
+
+    def save( self ):
+        tmp_file = "{}.tmp.{}".format(self.progress_file, os.getpid())
+        with open(tmp_file, 'w') as pfh:
+            json.dump(self.progress, pfh, indent=1)
+        os.replace(tmp_file, self.progress_file)
+
+    def get_summary( self ):
+        """ Gets a dict with the percentage of reads done per lane, and the latest ETA
+            of any lane, for RunStatus to report. The parts of a split lane are added up.
+        """
+        lanes = dict()
+        for k, lp in self.progress['lanes'].items():
+            lanes.setdefault(k.split('/')[0], []).append(lp)
+
+        percent = dict()
+        for l, lps in sorted(lanes.items(), key=lambda i: int(i[0]) if i[0].isdigit() else 0):
+            if all( lp['state'] == 'finished' for lp in lps ):
+                percent[l] = 100.0
+            elif all( lp.get('reads_expected') for lp in lps ):
+                done = sum( min(lp['reads_done'], lp['reads_expected']) for lp in lps )
+                percent[l] = round(100.0 * done / sum( lp['reads_expected'] for lp in lps ), 1)
+            else:
+                percent[l] = 0.0
+
+        etas = [ lp['eta'] for lp in self.progress['lanes'].values() ]
+        return dict( DemuxPercentComplete = percent,
+                     DemuxETA = max(etas) if etas and None not in etas else 'unknown' )
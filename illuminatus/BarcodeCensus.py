@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+"""Count every index pair in a lane, straight from the base calls, as soon as the index
+   reads are done. This predicts how many reads each sample will get from the full
+   demultiplexing, and what fraction will be unassigned, so that a bad sample sheet can
+   be fixed before bcl2fastq runs for hours.
+
+   This re-uses the base call reading from IndexSampler, but reads only the index cycles
+   and does not keep the clusters. The index bases for each PF cluster are packed into a
+   single 64-bit key, 3 bits per base, and the counts for each distinct key are kept in
+   a pair of sorted arrays, merged after each tile. Memory use depends on the number of
+   distinct keys, which is far smaller than the number of clusters.
+
+   Rather than comparing every distinct key to every sample, we list all the keys that
+   would be assigned to each sample - the index with up to --barcode-mismatches changes
+   in each index read - and look these up in the sorted keys. This gives the same result
+   as IndexSampler.assign() but the time depends only on the number of samples.
+
+   The same look-up with the index or index2 (or both) reverse complemented tells us
+   if the sample sheet has the wrong orientation for either index.
+
+   The result is saved as census.json next to the bc_check output, like:
+
+     { "lane": 1, "tiles": 704, "clusters_raw": ..., "clusters_pf": ...,
+       "samples": [ { "SampleId": "...", "Project": "...", "Index": "CTTTAACT+TGACGATT",
+                      "NumberReads": ..., "Fraction": ..., "PredictedYield": ...,
+                      "Revcomp": { "index": ..., "index2": ..., "both": ... } }, ... ],
+       "unassigned": { "NumberReads": ..., "Fraction": ... },
+       "revcomp": { "index": ..., "index2": ..., "both": ... },
+       "unknown_barcodes": { "GGGGGGGG+AGATCTCG": ..., ... },
+       "warnings": [ "...", ... ] }
+
+   and assess_bc_check.py adds any warnings to the bc_check message.
+"""
+import os, sys
+import json
+from itertools import combinations, product
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from illuminatus.IndexSampler import IndexSampler, encode_seq, decode_seq, BASES
+from illuminatus.RunMeta import get_run_meta
+
+CENSUS_FILE = 'census.json'
+
+# 3 bits per base in a 64-bit key
+BITS_PER_BASE = 3
+MAX_INDEX_BASES = 64 // BITS_PER_BASE
+
+# Merge the per-tile counts into the running total after this many tiles. Merging after
+# every tile would re-sort the whole table each time.
+MERGE_TILES = 32
+
+# Only list this many unknown barcodes in the output
+MAX_UNKNOWN = 20
+
+# A sample with less than this fraction of the mean reads per sample gets a warning
+LOW_SAMPLE_FRACTION = 0.1
+
+# The ways to reverse complement the indexes
+REVCOMP_MODES = OrderedDict([ ('index',  ['index']),
+                              ('index2', ['index2']),
+                              ('both',   ['index', 'index2']) ])
+
+def revcomp( seq , rep_table = str.maketrans('ATCGatcg', 'TAGCtagc') ):
+    return seq.translate(rep_table)[::-1]
+
+def pack_keys( bases ):
+    """ Pack an array of base codes, one row per cluster, into a 64-bit key per cluster.
+        The first base goes in the lowest bits.
+    """
+    shifts = np.arange(bases.shape[1], dtype=np.uint64) * np.uint64(BITS_PER_BASE)
+    return np.bitwise_or.reduce(bases.astype(np.uint64) << shifts, axis=1, initial=np.uint64(0))
+
+def unpack_keys( keys , num_bases ):
+    """ The reverse of pack_keys()
+    """
+    shifts = np.arange(num_bases, dtype=np.uint64) * np.uint64(BITS_PER_BASE)
+    return ((keys[:, None] >> shifts) & np.uint64(7)).astype(np.uint8)
+
+def merge_counts( key_arrays , count_arrays ):
+    """ Merge any number of sets of keys with their counts, in one go.
+        Returns the sorted distinct keys and the total counts.
+    """
+    all_keys, inverse = np.unique(np.concatenate(key_arrays), return_inverse=True)
+    all_counts = np.zeros(len(all_keys), dtype=np.int64)
+    np.add.at(all_counts, inverse.reshape(-1), np.concatenate(count_arrays))
+    return all_keys, all_counts
+
+def neighbours( codes , allowed ):
+    """ All the sequences within the allowed number of mismatches of the given base codes,
+        as a list of ( codes , mismatches ). As in IndexSampler.assign(), an N in a read
+        always counts as a mismatch, unless the index itself has an N there.
+    """
+    res = []
+    for mm in range(allowed + 1):
+        for positions in combinations(range(len(codes)), mm):
+            for subs in product(*[ [ c for c in range(len(BASES)) if c != codes[p] ]
+                                   for p in positions ]):
+                variant = codes.copy()
+                variant[list(positions)] = subs
+                res.append((variant, mm))
+    return res
+
+class BarcodeCensus(IndexSampler):
+    """ Count the index pairs on every tile of the lane, and predict the result of the
+        demultiplexing.
+    """
+    name = 'census'
+
+    def prepare( self ):
+        """ As IndexSampler.prepare(), but for all the tiles in the lane and only the
+            index cycles.
+        """
+        super().prepare()
+        run_meta = get_run_meta(self.run_dir, save=False)
+
+        self.tiles = [ t.split('_')[1] for t in run_meta.get_geometry().tiles(self.lane) ]
+        self.cycles = [ c for c in self.cycles if c[1] == 'I' ]
+        if len(self.cycles) > MAX_INDEX_BASES:
+            raise RuntimeError("Too many index cycles ({}) to count".format(len(self.cycles)))
+
+        # As with the default base mask, which drops the last cycle of each read
+        self.bases_per_read = sum( int(l) - 1 for r, l in run_meta.read_and_length.items()
+                                   if run_meta.read_and_indexed[r] != 'Y' )
+
+        return self.commands
+
+    def run( self ):
+        """ Read all the tiles and count the distinct keys
+        """
+        def _log(msg):
+            print("{} [census] {}".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), msg), file=lfh)
+
+        lfh = open(os.path.join(self.out_dir, 'census.log'), 'w')
+        with lfh:
+            if not self.tiles:
+                raise RuntimeError("No tiles found for lane {}".format(self.lane))
+
+            self.clusters_raw = 0
+            key_arrays = [ np.zeros(0, dtype=np.uint64) ]
+            count_arrays = [ np.zeros(0, dtype=np.int64) ]
+            for i, tile in enumerate(self.tiles):
+                raw, bases, _ = self.read_tile(tile)
+                self.clusters_raw += raw
+
+                tile_keys, tile_counts = np.unique(pack_keys(bases), return_counts=True)
+                key_arrays.append(tile_keys)
+                count_arrays.append(tile_counts)
+                _log("INFO:   Tile: {} (index: {}) {} clusters, {} PF, {} distinct".format(
+                                                        tile, i, raw, len(bases), len(tile_keys) ))
+
+                # The first array is the running total
+                if len(key_arrays) > MERGE_TILES or i == len(self.tiles) - 1:
+                    key_arrays, count_arrays = [ [a] for a in merge_counts(key_arrays, count_arrays) ]
+                    _log("INFO:   {} distinct so far".format(len(key_arrays[0])))
+
+            self.keys, = key_arrays
+            self.key_counts, = count_arrays
+            _log("Processing completed with 0 errors.")
+
+    def sample_keys( self , rows ):
+        """ All the keys that would be assigned to each of the rows. Returns arrays of the
+            keys and the row number (from 1) for each, sorted by key, leaving out any key
+            that would match more than one row.
+        """
+        mismatches = self.get_mismatches()
+        index_cols = [ [ col for col, c in enumerate(self.cycles) if c[2] == r ]
+                       for r in range(len(mismatches)) ]
+        shifts = [ np.array(cols, dtype=np.uint64) * np.uint64(BITS_PER_BASE) for cols in index_cols ]
+
+        keys, row_numbers = [], []
+        for n, row in enumerate(rows, start=1):
+            indexes = [ row.get('index') or '', row.get('index2') or '' ]
+            # The part of the key for each index read, for each of the neighbours
+            parts = []
+            for cols, sh, index, allowed in zip(index_cols, shifts, indexes, mismatches):
+                codes = encode_seq(index[:len(cols)].ljust(len(cols), 'N'))
+                parts.append([ int(np.bitwise_or.reduce(v.astype(np.uint64) << sh, initial=np.uint64(0)))
+                               for v, _ in neighbours(codes, allowed) ])
+            row_keys = [ sum(p) for p in product(*parts) ]
+            keys.extend(row_keys)
+            row_numbers.extend([n] * len(row_keys))
+
+        keys = np.array(keys, dtype=np.uint64)
+        row_numbers = np.array(row_numbers, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        keys, row_numbers = keys[order], row_numbers[order]
+
+        # Drop the collisions, as bcl2fastq would not assign these at all
+        dup = np.zeros(len(keys), dtype=bool)
+        if len(keys):
+            same = keys[1:] == keys[:-1]
+            dup[1:] |= same
+            dup[:-1] |= same
+        return keys[~dup], row_numbers[~dup]
+
+    def count_rows( self , rows ):
+        """ Reads for each row, from the keys we counted. Returns an array with the total
+            for each row (from 1, with 0 for unassigned) and a mask of the keys that were
+            assigned.
+        """
+        keys, row_numbers = self.sample_keys(rows)
+
+        idx = np.searchsorted(self.keys, keys)
+        found = idx < len(self.keys)
+        found[found] = self.keys[idx[found]] == keys[found]
+
+        reads = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.add.at(reads, row_numbers[found], self.key_counts[idx[found]])
+        reads[0] = self.key_counts.sum() - reads[1:].sum()
+
+        assigned = np.zeros(len(self.keys), dtype=bool)
+        assigned[idx[found]] = True
+        return reads, assigned
+
+    def collect_stats( self ):
+        """ Work out the predicted numbers, write census.json and return the dict
+        """
+        clusters_pf = int(self.key_counts.sum())
+        reads, assigned = self.count_rows(self.rows)
+
+        revcomp_reads = OrderedDict()
+        for mode, fields in REVCOMP_MODES.items():
+            rc_rows = [ dict(r, **{ f: revcomp(r.get(f) or '') for f in fields }) for r in self.rows ]
+            revcomp_reads[mode] = self.count_rows(rc_rows)[0]
+
+        def _frac(n):
+            return n / clusters_pf if clusters_pf else None
+
+        samples = []
+        for n, row in enumerate(self.rows, start=1):
+            samples.append(OrderedDict([
+                    ('SampleId',       row['Sample_ID']),
+                    ('Project',        row.get('Sample_Project', '')),
+                    ('Index',          '+'.join( i for i in [row.get('index'), row.get('index2')] if i )),
+                    ('NumberReads',    int(reads[n])),
+                    ('Fraction',       _frac(int(reads[n]))),
+                    ('PredictedYield', int(reads[n]) * self.bases_per_read),
+                    ('Revcomp',        OrderedDict( (m, int(r[n])) for m, r in revcomp_reads.items() )) ]))
+
+        # The top unassigned keys, with the index reads joined by '+'
+        index_reads = [ c[2] for c in self.cycles ]
+        unknown = OrderedDict()
+        unassigned = np.flatnonzero(~assigned)
+        top = unassigned[np.argsort(-self.key_counts[unassigned], kind='stable')][:MAX_UNKNOWN]
+        for codes, count in zip(unpack_keys(self.keys[top], len(self.cycles)), self.key_counts[top]):
+            unknown['+'.join( decode_seq( c for c, r in zip(codes, index_reads) if r == ir )
+                              for ir in sorted(set(index_reads)) )] = int(count)
+
+        census = OrderedDict([ ('lane',             int(self.lane)),
+                               ('tiles',            len(self.tiles)),
+                               ('clusters_raw',     int(self.clusters_raw)),
+                               ('clusters_pf',      clusters_pf),
+                               ('samples',          samples),
+                               ('unassigned',       OrderedDict([ ('NumberReads', int(reads[0])),
+                                                                  ('Fraction',    _frac(int(reads[0]))) ])),
+                               ('revcomp',          OrderedDict( (m, int(r[1:].sum()))
+                                                                 for m, r in revcomp_reads.items() )),
+                               ('unknown_barcodes', unknown) ])
+        census['warnings'] = get_warnings(census)
+
+        with open(os.path.join(self.out_dir, CENSUS_FILE), 'w') as cfh:
+            json.dump(census, cfh, indent=2)
+        return census
+
+def get_warnings( census ):
+    """ Look for the usual barcode problems in the census. Returns a list of lines,
+        which will be empty if all is well.
+    """
+    res = []
+    samples = census['samples']
+    if not samples or not census['clusters_pf']:
+        return res
+    assigned = sum( s['NumberReads'] for s in samples )
+    mean_reads = assigned / len(samples)
+
+    # If turning an index around would assign more reads over the lane, the sample
+    # sheet is probably wrong.
+    for mode, rc_total in census['revcomp'].items():
+        if rc_total > assigned:
+            res.append( "Reverse complementing {} would assign {} reads, compared to {} as it is.".format(
+                                    ' and '.join(REVCOMP_MODES[mode]), rc_total, assigned ))
+
+    # Samples with few reads, noting if the index would match the other way around
+    for s in samples:
+        if s['NumberReads'] < mean_reads * LOW_SAMPLE_FRACTION:
+            line = "Sample {} ({}) is predicted to get only {} reads, compared to a mean of {:.0f}.".format(
+                                    s['SampleId'], s['Index'], s['NumberReads'], mean_reads )
+            best_mode = max(s['Revcomp'], key=lambda m: s['Revcomp'][m])
+            if s['Revcomp'][best_mode] > s['NumberReads']:
+                line += " With {} reverse complemented it would get {}.".format(
+                                    ' and '.join(REVCOMP_MODES[best_mode]), s['Revcomp'][best_mode] )
+            res.append(line)
+
+    # Any unknown barcode that outnumbers the average sample
+    for bc, count in census['unknown_barcodes'].items():
+        if count > mean_reads:
+            res.append("Unknown barcode {} has {} reads, more than the mean per sample.".format(bc, count))
+
+    return res
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.BarcodeCensus /path/to/run /path/to/out SampleSheet.filtered.csv 1
+    """
+    census = BarcodeCensus(*sys.argv[1:5])
+    census.prepare()
+    census.run()
+    res = census.collect_stats()
+    for s in res['samples']:
+        print("{}\t{}".format(s['SampleId'], s['NumberReads']))
+    print("Undetermined\t{}".format(res['unassigned']['NumberReads']))
+    for w in res['warnings']:
+        print(w)
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,23 @@
 
 import logging as L
 
-from .RunInfoXMLParser import RunInfoXMLParser
-from .SampleSheetReader import SampleSheetReader
+from .RunMeta import get_run_meta
+from .SampleSheetReader import SampleSheetReader, get_samplesheet_reader
 
 class BaseMaskExtractor:
 
-    def __init__( self , samplesheet_file , runinfo_file ):
-        self.rip = RunInfoXMLParser( runinfo_file )
+    def __init__( self , samplesheet_file , runinfo_file , use_cache = False ):
+        """ If use_cache is set, the sample sheet may be loaded from (and saved to)
+            the cache in the pipeline directory. See get_samplesheet_reader().
+            Likewise for pipeline/run_meta.json (see get_run_meta()), though this is
+            read in any case if it is up to date.
+        """
+        self.rip = get_run_meta( runinfo_file , save = use_cache )
         L.debug(f"{runinfo_file} : {self.rip.read_and_length}")
-        self.ssr = SampleSheetReader( samplesheet_file )
+        if use_cache:
+            self.ssr = get_samplesheet_reader( samplesheet_file )
+        else:
+            self.ssr = SampleSheetReader( samplesheet_file )
         self.lane_length_dict = self.ssr.get_index_lengths_by_lane()
         L.debug(f"LLD = {self.lane_length_dict}")
 
@@ -32,11 +40,14 @@ class BaseMaskExtractor:
                  rl in [ (l,l) for l in standard_lengths ] or
                  rl in others )
 
-    def get_base_mask_for_lane(self,lane):
+    def get_base_mask_for_lane(self,lane,index_lengths=None):
         """
         Calculates the BaseMask for a given lane.
         The function will read the run cycles from the RunInfo.xml and the
         index length from the SampleSheet(csv) file.
+        If index_lengths is given, as [ index1length , index2length ], it is used
+        in place of the lengths from the SampleSheet. This is needed when a lane
+        is split into groups by index length.
 
         Returns a string in the form of:
         "Y300n,I8,I8,Y300n"
@@ -44,6 +55,8 @@ class BaseMaskExtractor:
 
         """
         lane = str(lane)
+        if index_lengths is None:
+            index_lengths = self.lane_length_dict[lane]
 
         # how many reads do we have on this run?
         number_of_reads = len(self.rip.read_and_length)
@@ -74,7 +87,7 @@ class BaseMaskExtractor:
                 else:
                     base_mask = base_mask + delimiter + "Y" + str( read_cycles )
             elif self.rip.read_and_indexed[ str(read_nr) ] == "Y":
-                index_read_length = int( self.lane_length_dict[lane][ indexed_read_counter ] ) # index length from the samplesheet
+                index_read_length = int( index_lengths[ indexed_read_counter ] ) # index length from the samplesheet
                 #this is an indexed read
                 if read_cycles == index_read_length:
                     # consider all cycles as index
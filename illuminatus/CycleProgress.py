@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""Works out how far along sequencing is, by looking at the cycle directories
+   in Data/Intensities/BaseCalls/L00?/C*.1
+   Rather than listing or globbing every directory, we assume that cycles arrive
+   in order and do a binary search for the highest complete cycle in each lane, so
+   even for a 2x151 run this is only about 10 filesystem calls per lane.
+   The modification time of each cycle directory is recorded as its arrival time,
+   and from this we estimate when sequencing will finish.
+"""
+import os
+from datetime import datetime
+
+class CycleProgress:
+
+    def __init__( self , run_dir , total_cycles , lane_count ):
+        self.run_dir = run_dir
+        self.total_cycles = int(total_cycles)
+        self.lanes = [ str(l) for l in range(1, int(lane_count) + 1) ]
+
+        # lane -> { cycle: mtime } for every cycle directory we looked at
+        self.arrivals = { l: {} for l in self.lanes }
+
+        self._cycles_complete = {}
+
+    def _cycle_complete( self , lane , cycle ):
+        """ A cycle is complete if the directory exists and is not empty, just as
+            RunStatus._is_read_finished() judges it. If so, note the arrival time.
+        """
+        cycle_dir = os.path.join( self.run_dir, 'Data', 'Intensities', 'BaseCalls',
+                                  'L{:03d}'.format(int(lane)), 'C{}.1'.format(cycle) )
+        try:
+            with os.scandir(cycle_dir) as sdi:
+                if next(sdi, None) is None:
+                    return False
+            self.arrivals[lane][cycle] = os.stat(cycle_dir).st_mtime
+            return True
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def get_cycles_complete( self , lane ):
+        """ Binary search for the highest complete cycle in this lane. Returns 0 if
+            there is no data at all.
+        """
+        lane = str(lane)
+        if lane not in self._cycles_complete:
+            # Check the last cycle first, as for most runs that we look at sequencing
+            # will be finished.
+            if self._cycle_complete(lane, self.total_cycles):
+                self._cycles_complete[lane] = self.total_cycles
+            else:
+                # Invariant: lo is complete (or 0) and hi is not.
+                lo, hi = 0, self.total_cycles
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if self._cycle_complete(lane, mid):
+                        lo = mid
+                    else:
+                        hi = mid
+                self._cycles_complete[lane] = lo
+
+        return self._cycles_complete[lane]
+
+    def get_percent_complete( self , lane ):
+        if not self.total_cycles:
+            return 0.0
+        return round(100.0 * self.get_cycles_complete(lane) / self.total_cycles, 1)
+
+    def get_eta( self , lane ):
+        """ Estimate when the last cycle will arrive in this lane, as a UNIX timestamp,
+            by assuming the time per cycle seen so far stays constant.
+            Returns None if we can't say.
+        """
+        lane = str(lane)
+        done = self.get_cycles_complete(lane)
+        if done == self.total_cycles:
+            return self.arrivals[lane].get(done)
+        if done < 2:
+            return None
+
+        # We'll need to know when cycle 1 arrived.
+        if 1 not in self.arrivals[lane] and not self._cycle_complete(lane, 1):
+            return None
+        first, last = self.arrivals[lane][1], self.arrivals[lane][done]
+
+        secs_per_cycle = (last - first) / (done - 1)
+        return last + secs_per_cycle * (self.total_cycles - done)
+
+    def get_dict( self ):
+        """ Info to go into the RunStatus YAML. CyclesComplete and PercentComplete are
+            given per lane, and the CompletionETA is for the slowest lane.
+        """
+        etas = [ self.get_eta(l) for l in self.lanes ]
+        if etas and None not in etas:
+            eta = datetime.fromtimestamp(max(etas)).isoformat(timespec='seconds')
+        else:
+            eta = 'unknown'
+
+        return dict( CyclesComplete = { int(l): self.get_cycles_complete(l) for l in self.lanes },
+                     PercentComplete = { int(l): self.get_percent_complete(l) for l in self.lanes },
+                     CompletionETA = eta )
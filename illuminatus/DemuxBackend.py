@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+
+"""Backends for demultiplexing one lane (or one group or shard of a lane) from a
+   SampleSheet.filtered.csv as made by bcl2fastq_setup.py.
+
+   Each backend has the same four steps:
+
+     prepare()          - work out the command(s) to run, and write any input files
+     run()              - run them, writing the logs to the output directory
+     collect_stats()    - return the Stats.json contents for the output
+     output_manifest()  - list the FASTQ files made, relative to the output directory
+
+   and demultiplex() does all of these. Whatever the backend, the output directory ends up
+   looking as if bcl2fastq made it - Project/Sample_S1_L001_R1_001.fastq.gz files plus
+   Stats/Stats.json, Stats/DemultiplexingStats.xml, Stats/DemuxSummaryF{n}L{lane}.txt,
+   Stats/FastqSummaryF{n}L{lane}.txt and bcl2fastq.{opts,version,log} - so that
+   BCL2FASTQPostprocessor.py, grab_bcl2fastq_stats.py and the QC are unchanged.
+
+   The backends are:
+
+     bcl2fastq  - runs do_demultiplex.sh, which is still the one place the bcl2fastq
+                  command line and the --barcode-mismatches retry live
+     bclconvert - converts the sample sheet to the v2 format, runs bcl-convert and
+                  translates the reports in Reports/ into the bcl2fastq stats files
+     stub       - makes up reads for every sample without looking at any BCL files,
+                  for testing and benchmarking the pipeline without real data
+"""
+import os, sys, re
+import shlex
+import json
+import gzip
+import random
+import subprocess
+import csv
+from collections import OrderedDict
+from datetime import datetime
+from glob import glob
+import xml.etree.ElementTree as ET
+
+from illuminatus.RunMeta import get_run_meta
+
+# The default backend may be set in environ.sh
+DEFAULT_BACKEND = 'bcl2fastq'
+
+def read_filtered_sheet( sample_sheet , lane ):
+    """ Read the [bcl2fastq] and [Data] sections of a sample sheet made by bcl2fastq_setup.py.
+        Returns ( opts , rows ) where opts is a list of the option lines, with $LANE
+        substituted and the quotes removed as the shell would, and rows is a list of dicts.
+    """
+    section = None
+    opts = []
+    data_lines = []
+    with open(sample_sheet) as ssfh:
+        for line in ssfh:
+            line = line.rstrip('\r\n')
+            if line.startswith('['):
+                section = line.split(']')[0] + ']'
+                continue
+            if not line or line.startswith('#'):
+                continue
+            if section == '[bcl2fastq]':
+                opts.append( shlex.split(line.replace('$LANE', str(lane))) )
+            elif section == '[Data]':
+                data_lines.append(line)
+
+    rows = list(csv.DictReader(data_lines))
+    return opts, rows
+
+def read_sheet_header( sample_sheet ):
+    """ The comment lines in the [Header] section, like '#Lane,1', as a dict of
+        { '#Lane': '1' }.
+    """
+    res = dict()
+    with open(sample_sheet) as ssfh:
+        for line in ssfh:
+            line = line.rstrip('\r\n')
+            if line.startswith('[') and line != '[Header]':
+                break
+            if line.startswith('#'):
+                k, _, v = line.partition(',')
+                res[k] = v
+    return res
+
+def get_opt( opts , name , default = None ):
+    """ Value of an option from the list made by read_filtered_sheet()
+    """
+    for o in opts:
+        if o[0] == name:
+            return o[1] if len(o) > 1 else ''
+    return default
+
+def expand_base_mask( mask , read_lengths ):
+    """ Expand a bcl2fastq --use-bases-mask like '1:Y50n,I8,I8,Y50n' into a list of
+        strings with one letter per cycle, eg. ['YYYY...N', 'IIIIIIII', ...]. read_lengths
+        is the list of cycle counts for each read, to fill in any '*'.
+    """
+    mask = re.sub(r'^\d+:', '', mask)
+    res = []
+    for part, length in zip(mask.split(','), read_lengths):
+        expanded = ''
+        fill = None
+        for letter, count in re.findall(r'([YINyin])(\d+|\*)?', part):
+            if count == '*':
+                fill = (len(expanded), letter.upper())
+                continue
+            expanded += letter.upper() * int(count or 1)
+        if fill:
+            pos, letter = fill
+            expanded = expanded[:pos] + letter * (length - len(expanded)) + expanded[pos:]
+        res.append(expanded)
+    return res
+
+def run_length( cycles ):
+    """ 'YYYYN' -> [('Y', 4), ('N', 1)]
+    """
+    return [ (mo.group(1), len(mo.group(0))) for mo in re.finditer(r'(.)\1*', cycles) ]
+
+class DemuxBackend:
+    """ Base class for the backends. Sub-classes set name and implement the four steps.
+    """
+    name = None
+
+    def __init__( self , run_dir , out_dir , sample_sheet , lane , threads = None ):
+        self.run_dir = run_dir
+        self.out_dir = out_dir
+        self.sample_sheet = sample_sheet
+        self.lane = str(lane)
+        self.threads = int(threads or os.environ.get('PROCESSING_THREADS') or 10)
+
+        self.opts, self.rows = read_filtered_sheet(sample_sheet, self.lane)
+        self.commands = None
+
+    def prepare( self ):
+        """ Work out the command(s) to run, as a list of lists, and save them in self.commands.
+        """
+        raise NotImplementedError()
+
+    def run( self ):
+        """ Run the commands. Raises an exception if demultiplexing fails.
+        """
+        raise NotImplementedError()
+
+    def collect_stats( self ):
+        """ Ensure the Stats/ files are in place, and return the contents of Stats.json
+        """
+        with open(os.path.join(self.out_dir, 'Stats', 'Stats.json')) as sfh:
+            return json.load(sfh)
+
+    def output_manifest( self ):
+        """ The FASTQ files in the output, relative to out_dir, in order.
+        """
+        return sorted( os.path.relpath(f, self.out_dir)
+                       for f in glob(os.path.join(self.out_dir, '**', '*.fastq.gz'), recursive=True) )
+
+    def demultiplex( self ):
+        """ Do all the steps, returning the manifest.
+        """
+        self.prepare()
+        self.run()
+        self.collect_stats()
+        return self.output_manifest()
+
+    # Things the backends share
+    def get_base_mask( self ):
+        """ The base mask as a list of expanded reads (see expand_base_mask). Without a
+            --use-bases-mask option, all the non-index reads are Y and index reads are I.
+        """
+        run_meta = get_run_meta(self.run_dir, save=False)
+        reads = run_meta.read_and_length
+        lengths = [ int(reads[r]) for r in sorted(reads, key=int) ]
+        mask = get_opt(self.opts, '--use-bases-mask')
+        if not mask:
+            indexed = run_meta.read_and_indexed
+            mask = ','.join( ('I' if indexed[r] == 'Y' else 'Y') + '*' for r in sorted(reads, key=int) )
+        return expand_base_mask(mask, lengths)
+
+    def get_tiles( self ):
+        """ The tiles selected by --tiles, as BCL2FASTQProgress.count_tiles() does it,
+            with the lane number removed, so '2101' not '1_2101'.
+        """
+        tiles = get_run_meta(self.run_dir, save=False).get_geometry().tiles(self.lane)
+        tiles_opt = get_opt(self.opts, '--tiles')
+        if tiles_opt:
+            regexes = [ re.compile(r) for r in tiles_opt.split(',') ]
+            tiles = [ t for t in tiles if any(r.match('s_' + t) for r in regexes) ]
+        return [ t.split('_')[1] for t in tiles ]
+
+    def write_opts( self ):
+        """ Record the options used, as do_demultiplex.sh does.
+        """
+        with open(os.path.join(self.out_dir, 'bcl2fastq.opts'), 'w') as ofh:
+            for o in self.opts:
+                print(' '.join(shlex.quote(w) for w in o), file=ofh)
+
+    def fastq_name( self , row , sample_number , read_number ):
+        """ The path that bcl2fastq would use for this sample. Where the Sample_Name is
+            set and differs from the Sample_ID it is used for the filename, within a
+            directory named for the Sample_ID.
+        """
+        sample_id = row.get('Sample_ID', '')
+        sample_name = row.get('Sample_Name') or sample_id
+        filename = "{}_S{}_L{:03d}_R{}_001.fastq.gz".format( sample_name, sample_number,
+                                                            int(self.lane), read_number )
+        path = [ row.get('Sample_Project') or '' ]
+        if sample_name != sample_id:
+            path.append(sample_id)
+        return os.path.join(*path, filename)
+
+class Bcl2FastqBackend(DemuxBackend):
+    """ Runs do_demultiplex.sh, which calls bcl2fastq and produces the Stats/ files itself.
+    """
+    name = 'bcl2fastq'
+
+    def prepare( self ):
+        script = os.path.join( os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'do_demultiplex.sh' )
+        self.commands = [[ script, self.run_dir, self.out_dir, self.sample_sheet, self.lane ]]
+        return self.commands
+
+    def run( self ):
+        # Setting DEMUX_BACKEND stops do_demultiplex.sh from passing the job back to us.
+        env = dict(os.environ, DEMUX_BACKEND=self.name, PROCESSING_THREADS=str(self.threads))
+        for cmd in self.commands:
+            subprocess.run(cmd, env=env, check=True)
+
+class BclConvertBackend(DemuxBackend):
+    """ Runs bcl-convert and converts the output to look like bcl2fastq output.
+        BCL Convert reports only PF clusters, so the Raw counts are copied from the PF
+        counts. It reports per-sample rather than per-tile numbers, so FastqSummary has
+        one line per sample with a tile of 0. --barcode-mismatches must be set in the
+        sample sheet, as it is by bcl2fastq_setup.py, since there is no retry.
+    """
+    name = 'bclconvert'
+
+    # Where bcl-convert writes, within out_dir. The FASTQ files are moved out of here.
+    work_dir = 'bclconvert'
+    v2_sheet = 'SampleSheet.bclconvert.csv'
+
+    def override_cycles( self ):
+        """ The base mask in the OverrideCycles format, eg. 'Y50N1;I8;I8;Y50N1'
+        """
+        return ';'.join( ''.join( "{}{}".format(l, n) for l, n in run_length(r) )
+                         for r in self.get_base_mask() )
+
+    def make_v2_sheet( self ):
+        """ The v2 sample sheet for bcl-convert, as a list of lines.
+        """
+        mismatches = get_opt(self.opts, '--barcode-mismatches')
+        if mismatches is None:
+            raise RuntimeError("bcl-convert needs --barcode-mismatches in {}".format(self.sample_sheet))
+        has_index2 = any( r.get('index2') for r in self.rows )
+
+        res = [ "[Header]",
+                "FileFormatVersion,2",
+                "RunName,{}".format(get_run_meta(self.run_dir, save=False).run_info['RunId']),
+                "",
+                "[BCLConvert_Settings]",
+                "OverrideCycles,{}".format(self.override_cycles()),
+                "BarcodeMismatchesIndex1,{}".format(mismatches) ]
+        if has_index2:
+            res.append("BarcodeMismatchesIndex2,{}".format(mismatches))
+        for opt, setting in [ ('--minimum-trimmed-read-length', 'MinimumTrimmedReadLength'),
+                              ('--mask-short-adapter-reads',    'MaskShortReads') ]:
+            if get_opt(self.opts, opt) is not None:
+                res.append("{},{}".format(setting, get_opt(self.opts, opt)))
+        res.append("FastqCompressionFormat,gzip")
+        res.append("")
+
+        res.append("[BCLConvert_Data]")
+        res.append("Lane,Sample_ID,Sample_Project,index" + (",index2" if has_index2 else ""))
+        for r in self.rows:
+            res.append( ','.join( [ self.lane, r['Sample_ID'], r.get('Sample_Project', ''), r.get('index', '') ] +
+                                  ( [r.get('index2', '')] if has_index2 else [] ) ) )
+        return res
+
+    def prepare( self ):
+        sheet = os.path.join(self.out_dir, self.v2_sheet)
+        with open(sheet, 'w') as sfh:
+            for l in self.make_v2_sheet():
+                print(l, file=sfh)
+
+        cmd = [ 'bcl-convert', '--bcl-input-directory', self.run_dir,
+                               '--output-directory', os.path.join(self.out_dir, self.work_dir),
+                               '--sample-sheet', sheet,
+                               '--bcl-only-lane', self.lane,
+                               '--bcl-num-conversion-threads', str(self.threads),
+                               '--force' ]
+        tiles = get_opt(self.opts, '--tiles')
+        if tiles and tiles != "s_[{}]".format(self.lane):
+            cmd.extend(['--tiles', tiles])
+        self.commands = [cmd]
+        return self.commands
+
+    def run( self ):
+        with open(os.path.join(self.out_dir, 'bcl2fastq.version'), 'w') as vfh:
+            subprocess.run(['bcl-convert', '--version'], stdout=vfh, stderr=subprocess.STDOUT, check=True)
+        with open(os.path.join(self.out_dir, 'bcl2fastq.log'), 'w') as lfh:
+            for cmd in self.commands:
+                print("Command-line invocation: {}".format(' '.join(shlex.quote(w) for w in cmd)), file=lfh)
+                lfh.flush()
+                subprocess.run(cmd, stdout=lfh, stderr=subprocess.STDOUT, check=True)
+        self.write_opts()
+
+        # Move the FASTQ files to where bcl2fastq would have put them
+        work_dir = os.path.join(self.out_dir, self.work_dir)
+        for f in glob(os.path.join(work_dir, '**', '*.fastq.gz'), recursive=True):
+            dest = os.path.join(self.out_dir, os.path.relpath(f, work_dir))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(f, dest)
+
+    def read_report( self , name ):
+        """ Rows of a CSV file in Reports/, as dicts
+        """
+        with open(os.path.join(self.out_dir, self.work_dir, 'Reports', name)) as rfh:
+            return list(csv.DictReader(rfh))
+
+    def collect_stats( self ):
+        run_meta = get_run_meta(self.run_dir, save=False)
+        mask = self.get_base_mask()
+
+        demux_stats = [ r for r in self.read_report('Demultiplex_Stats.csv') if r['Lane'] == self.lane ]
+        quality = [ r for r in self.read_report('Quality_Metrics.csv') if r['Lane'] == self.lane ]
+        try:
+            unknown = [ r for r in self.read_report('Top_Unknown_Barcodes.csv') if r['Lane'] == self.lane ]
+        except FileNotFoundError:
+            unknown = []
+
+        def _read_metrics(sample_id):
+            return [ OrderedDict([ ('ReadNumber',      int(q['ReadNumber'])),
+                                   ('Yield',           int(q['Yield'])),
+                                   ('YieldQ30',        int(q['YieldQ30'])),
+                                   ('QualityScoreSum', int(q['QualityScoreSum'])),
+                                   ('TrimmedBases',    0) ])
+                     for q in quality if q['SampleID'] == sample_id and q['ReadNumber'].isdigit() ]
+
+        demux_results = []
+        undetermined = None
+        for r in demux_stats:
+            read_metrics = _read_metrics(r['SampleID'])
+            res = OrderedDict()
+            if r['SampleID'] != 'Undetermined':
+                res['SampleId'] = res['SampleName'] = r['SampleID']
+                res['IndexMetrics'] = [ OrderedDict([
+                                    ('IndexSequence', r['Index'].replace('-', '+')),
+                                    ('MismatchCounts', OrderedDict([ ('0', int(r['# Perfect Index Reads'])),
+                                                                     ('1', int(r['# One Mismatch Index Reads'])) ])) ]) ]
+            res['NumberReads'] = int(r['# Reads'])
+            res['Yield'] = sum( m['Yield'] for m in read_metrics )
+            res['ReadMetrics'] = read_metrics
+            if r['SampleID'] == 'Undetermined':
+                undetermined = res
+            else:
+                demux_results.append(res)
+
+        total_pf = sum( r['NumberReads'] for r in demux_results + [undetermined or dict(NumberReads=0)] )
+        conversion = OrderedDict([ ('LaneNumber',       int(self.lane)),
+                                   ('TotalClustersRaw', total_pf),
+                                   ('TotalClustersPF',  total_pf),
+                                   ('Yield',            sum( r['Yield'] for r in demux_results ) +
+                                                        (undetermined['Yield'] if undetermined else 0)),
+                                   ('DemuxResults',     demux_results) ])
+        if undetermined:
+            conversion['Undetermined'] = undetermined
+
+        unknown_barcodes = OrderedDict()
+        for u in unknown:
+            bc = '+'.join( u[k] for k in ['index', 'index2'] if u.get(k) )
+            unknown_barcodes[bc] = int(u['# Reads'])
+
+        stats = make_stats_json( run_meta, self.lane, mask, [conversion],
+                                 [ OrderedDict([('Lane', int(self.lane)), ('Barcodes', unknown_barcodes)]) ] )
+
+        write_stats_files( self.out_dir, self.lane, stats,
+                           { i + 1: r.get('Sample_Project', '') for i, r in enumerate(self.rows) } )
+        return stats
+
+class StubBackend(DemuxBackend):
+    """ Makes up reads without looking at the BCL files. Each sample gets around
+        DEMUX_STUB_READS reads (default 1000), spread over the tiles selected by --tiles,
+        plus some unassigned reads. The sequences are random but repeatable for any given
+        run, lane and sample, and the index reads match the sample sheet, with a few
+        mismatches.
+    """
+    name = 'stub'
+
+    def __init__( self , *args , reads_per_sample = None , **kwargs ):
+        super().__init__(*args, **kwargs)
+        self.reads_per_sample = int(reads_per_sample or os.environ.get('DEMUX_STUB_READS') or 1000)
+
+    def prepare( self ):
+        # Nothing to run as such
+        self.commands = []
+        return self.commands
+
+    def run( self ):
+        run_meta = get_run_meta(self.run_dir, save=False)
+        run_id = run_meta.run_info['RunId']
+        mask = self.get_base_mask()
+        tiles = self.get_tiles() or ['1101']
+        rnd = random.Random("{}:{}".format(run_id, self.lane))
+
+        def _log(msg):
+            print("{} [stub] {}".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), msg), file=lfh)
+
+        with open(os.path.join(self.out_dir, 'bcl2fastq.version'), 'w') as vfh:
+            print("Illuminatus demultiplexing stub", file=vfh)
+
+        lfh = open(os.path.join(self.out_dir, 'bcl2fastq.log'), 'w')
+        with lfh:
+            _log("Command-line invocation: stub {}".format(' '.join( ' '.join(o) for o in self.opts )))
+
+            # Work out how many reads each sample gets, and on what tiles.
+            samples = []
+            for n, row in enumerate(self.rows, start=1):
+                samples.append( (n, row, int(self.reads_per_sample * rnd.uniform(0.5, 1.5))) )
+            unassigned = max(1, sum( s[2] for s in samples ) // 20)
+
+            self.tile_counts = OrderedDict( (t, OrderedDict()) for t in tiles )
+            self.sample_results = []
+            for n, row, count in samples + [(0, None, unassigned)]:
+                tile_split = OrderedDict( (t, count // len(tiles) + (1 if i < count % len(tiles) else 0))
+                                          for i, t in enumerate(tiles) )
+                self.sample_results.append( self.write_sample(run_meta, mask, tile_split, n, row) )
+                for t, c in tile_split.items():
+                    self.tile_counts[t][n] = c
+
+            for i, t in enumerate(tiles):
+                _log("INFO:   Tile: {} (index: {})".format(t, i))
+            _log("Processing completed with 0 errors.")
+
+        self.write_opts()
+
+    def write_sample( self , run_meta , mask , tile_split , sample_number , row ):
+        """ Write the FASTQ files for one sample (or the unassigned reads if row is None) and
+            return a dict of the numbers needed for Stats.json.
+            tile_split says how many reads go on each tile. As with bcl2fastq, the reads are
+            written tile by tile, which BCL2FASTQPostprocessor.filter_fastq() relies on.
+        """
+        count = sum(tile_split.values())
+        read_tiles = ( t for t, c in tile_split.items() for _ in range(c) )
+        run_id = run_meta.run_info['RunId']
+        instrument, run_number = run_id.split('_')[1:3]
+        flowcell = run_meta.run_info.get('Flowcell', '')
+        rnd = random.Random("{}:{}:{}".format(run_id, self.lane, row and row['Sample_ID']))
+
+        indexes = [ (row.get(k) or '') if row else '' for k in ['index', 'index2'] ]
+        index_reads = [ r for r in mask if 'I' in r ]
+        read_masks = [ r for r in mask if 'Y' in r ]
+
+        if row:
+            names = [ self.fastq_name(row, sample_number, i + 1) for i in range(len(read_masks)) ]
+        else:
+            names = [ "Undetermined_S0_L{:03d}_R{}_001.fastq.gz".format(int(self.lane), i + 1)
+                      for i in range(len(read_masks)) ]
+        for name in names:
+            os.makedirs(os.path.join(self.out_dir, os.path.dirname(name)), exist_ok=True)
+        fhs = [ gzip.open(os.path.join(self.out_dir, name), 'wt', compresslevel=1) for name in names ]
+
+        # Most unassigned reads have one of a few common barcodes, as in real runs
+        common_unknown = [ [ ''.join( rnd.choice('ACGT') for _ in range(im.count('I')) ) for im in index_reads ]
+                           for _ in range(20) ]
+
+        mismatch_counts = [0, 0]
+        unknown = OrderedDict()
+        q30 = [0] * len(read_masks)
+        qsum = [0] * len(read_masks)
+        try:
+            for tile in read_tiles:
+                # Index sequences, with a one-base mismatch in about 1 in 50 reads
+                seen = []
+                mismatched = 0
+                for im, idx in zip(index_reads, indexes):
+                    length = im.count('I')
+                    seq = idx[:length]
+                    if not seq or not row:
+                        seq = ''.join( rnd.choice('ACGT') for _ in range(length) )
+                    elif not mismatched and rnd.random() < 0.02:
+                        p = rnd.randrange(len(seq))
+                        seq = seq[:p] + rnd.choice([ b for b in 'ACGT' if b != seq[p] ]) + seq[p+1:]
+                        mismatched = 1
+                    seen.append(seq)
+                if not row and rnd.random() < 0.7:
+                    seen = rnd.choices(common_unknown, weights=range(20, 0, -1))[0]
+                index_str = '+'.join(seen)
+                if row:
+                    mismatch_counts[mismatched] += 1
+                else:
+                    unknown[index_str] = unknown.get(index_str, 0) + 1
+
+                header = "@{}:{}:{}:{}:{}:{}:{} ".format( instrument, int(run_number), flowcell, self.lane,
+                                                         tile,
+                                                         rnd.randrange(1000, 32000), rnd.randrange(1000, 37000) )
+                for r, (fh, rm) in enumerate(zip(fhs, read_masks)):
+                    length = rm.count('Y')
+                    seq = ''.join( rnd.choice('ACGT') for _ in range(length) )
+                    # Mostly Q37, some Q25 and Q11, as on a NovaSeq
+                    qual = ''.join( rnd.choices('F:,', weights=[90, 8, 2], k=length) )
+                    q30[r] += qual.count('F')
+                    qsum[r] += qual.count('F') * 37 + qual.count(':') * 25 + qual.count(',') * 11
+                    print(header + "{}:N:0:{}".format(r + 1, index_str), seq, '+', qual, sep='\n', file=fh)
+        finally:
+            for fh in fhs:
+                fh.close()
+
+        read_metrics = [ OrderedDict([ ('ReadNumber',      r + 1),
+                                       ('Yield',           count * rm.count('Y')),
+                                       ('YieldQ30',        q30[r]),
+                                       ('QualityScoreSum', qsum[r]),
+                                       ('TrimmedBases',    0) ])
+                         for r, rm in enumerate(read_masks) ]
+        res = OrderedDict()
+        if row:
+            res['SampleId'] = row['Sample_ID']
+            res['SampleName'] = row.get('Sample_Name') or row['Sample_ID']
+            res['IndexMetrics'] = [ OrderedDict([ ('IndexSequence', '+'.join( i for i in indexes if i )),
+                                                  ('MismatchCounts', OrderedDict([ ('0', mismatch_counts[0]),
+                                                                                   ('1', mismatch_counts[1]) ])) ]) ]
+        res['NumberReads'] = count
+        res['Yield'] = sum( m['Yield'] for m in read_metrics )
+        res['ReadMetrics'] = read_metrics
+        if not row:
+            res['UnknownBarcodes'] = unknown
+        return res
+
+    def collect_stats( self ):
+        run_meta = get_run_meta(self.run_dir, save=False)
+        demux_results = [ r for r in self.sample_results if 'SampleId' in r ]
+        undetermined, = [ r for r in self.sample_results if 'SampleId' not in r ]
+        unknown = undetermined.pop('UnknownBarcodes')
+
+        # Say 10% of clusters did not pass filter
+        total_pf = sum( r['NumberReads'] for r in self.sample_results )
+        conversion = OrderedDict([ ('LaneNumber',       int(self.lane)),
+                                   ('TotalClustersRaw', total_pf * 10 // 9),
+                                   ('TotalClustersPF',  total_pf),
+                                   ('Yield',            sum( r['Yield'] for r in self.sample_results )),
+                                   ('DemuxResults',     demux_results),
+                                   ('Undetermined',     undetermined) ])
+        top_unknown = OrderedDict( sorted(unknown.items(), key=lambda i: -i[1])[:1000] )
+
+        stats = make_stats_json( run_meta, self.lane, self.get_base_mask(), [conversion],
+                                 [ OrderedDict([('Lane', int(self.lane)), ('Barcodes', top_unknown)]) ] )
+        write_stats_files( self.out_dir, self.lane, stats,
+                           { i + 1: r.get('Sample_Project', '') for i, r in enumerate(self.rows) },
+                           self.tile_counts )
+        return stats
+
+BACKENDS = OrderedDict( (b.name, b) for b in [ Bcl2FastqBackend, BclConvertBackend, StubBackend ] )
+
+def get_backend( name , *args , **kwargs ):
+    """ Make a backend by name. Raises KeyError for unknown names.
+    """
+    try:
+        backend_class = BACKENDS[name or DEFAULT_BACKEND]
+    except KeyError:
+        raise KeyError("Unknown demultiplexing backend {!r}. Options are: {}".format(name, ', '.join(BACKENDS)))
+    return backend_class(*args, **kwargs)
+
+def make_stats_json( run_meta , lane , mask , conversion_results , unknown_barcodes ):
+    """ Assemble a dict in the format of bcl2fastq's Stats.json
+    """
+    run_id = run_meta.run_info['RunId']
+    read_infos = []
+    counters = dict(Y=0, I=0)
+    for m in mask:
+        # Reads that are masked out entirely are not listed
+        if 'Y' in m:
+            kind = 'Y'
+        elif 'I' in m:
+            kind = 'I'
+        else:
+            continue
+        counters[kind] += 1
+        read_infos.append(OrderedDict([ ('Number',        counters[kind]),
+                                        ('NumCycles',     len(m) - m.count('N')),
+                                        ('IsIndexedRead', kind == 'I') ]))
+
+    return OrderedDict([ ('Flowcell',           run_meta.run_info.get('Flowcell', '')),
+                         ('RunNumber',          int(run_id.split('_')[2])),
+                         ('RunId',              run_id),
+                         ('ReadInfosForLanes',  [ OrderedDict([ ('LaneNumber', int(lane)),
+                                                                ('ReadInfos',  read_infos) ]) ]),
+                         ('ConversionResults',  conversion_results),
+                         ('UnknownBarcodes',    unknown_barcodes) ])
+
+def write_stats_files( out_dir , lane , stats , projects , tile_counts = None ):
+    """ Write Stats.json and the other files in Stats/ that bcl2fastq would have made, from
+        the Stats.json contents. projects is { sample_number: project_name }.
+        tile_counts, if given, is { tile: { sample_number: reads } }. Otherwise
+        FastqSummary has just the totals for each sample, with a tile of 0.
+    """
+    stats_dir = os.path.join(out_dir, 'Stats')
+    os.makedirs(stats_dir, exist_ok=True)
+    with open(os.path.join(stats_dir, 'Stats.json'), 'w') as sfh:
+        json.dump(stats, sfh, indent=2)
+
+    conversion, = stats['ConversionResults']
+    pf_ratio = conversion['TotalClustersRaw'] / (conversion['TotalClustersPF'] or 1)
+
+    # DemultiplexingStats.xml
+    root = ET.Element('Stats')
+    fc = ET.SubElement(root, 'Flowcell', {'flowcell-id': stats['Flowcell']})
+    for n, dr in enumerate(conversion['DemuxResults'], start=1):
+        proj = fc.find("Project[@name='{}']".format(projects.get(n, '')))
+        if proj is None:
+            proj = ET.SubElement(fc, 'Project', name=projects.get(n, ''))
+        sample = ET.SubElement(proj, 'Sample', name=dr['SampleId'])
+        for im in dr['IndexMetrics']:
+            bc_lane = ET.SubElement( ET.SubElement(sample, 'Barcode', name=im['IndexSequence']),
+                                     'Lane', number=str(lane) )
+            ET.SubElement(bc_lane, 'BarcodeCount').text = str(dr['NumberReads'])
+            ET.SubElement(bc_lane, 'PerfectBarcodeCount').text = str(im['MismatchCounts'].get('0', 0))
+            ET.SubElement(bc_lane, 'OneMismatchBarcodeCount').text = str(im['MismatchCounts'].get('1', 0))
+    ET.ElementTree(root).write( os.path.join(stats_dir, 'DemultiplexingStats.xml'),
+                                encoding="utf-8", xml_declaration=True )
+
+    # DemuxSummary, for the unknown barcodes
+    with open(os.path.join(stats_dir, 'DemuxSummaryF1L{}.txt'.format(lane)), 'w') as dfh:
+        print("### Most Popular Unknown Index Sequences", file=dfh)
+        print("### Columns: Index_Sequence Hit_Count", file=dfh)
+        for ub in stats['UnknownBarcodes']:
+            for bc, count in ub['Barcodes'].items():
+                print("{}\t{}".format(bc.replace('+', '-'), count), file=dfh)
+
+    # FastqSummary
+    if tile_counts is None:
+        tile_counts = { '0': dict( [(0, conversion.get('Undetermined', {}).get('NumberReads', 0))] +
+                                   [ (n, dr['NumberReads']) for n, dr in
+                                     enumerate(conversion['DemuxResults'], start=1) ] ) }
+    with open(os.path.join(stats_dir, 'FastqSummaryF1L{}.txt'.format(lane)), 'w') as ffh:
+        print("SampleNumber\tTile\tNumberOfReadsRaw\tNumberOfReadsPF", file=ffh)
+        for tile, counts in tile_counts.items():
+            for n in sorted(counts):
+                print("{}\t{}\t{}\t{}".format(n, tile, int(counts[n] * pf_ratio), counts[n]), file=ffh)
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.DemuxBackend stub /path/to/run /path/to/out SampleSheet.filtered.csv 1
+    """
+    backend = get_backend(*sys.argv[1:6])
+    backend.prepare()
+    print(json.dumps(backend.commands))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""The layout of the tiles on a flowcell, worked out once from the RunInfo.xml info
+   (via RunMeta or RunInfoXMLParser) so that the well dups scan, the barcode check and
+   demultiplexing can all pick tiles the same way.
+
+   Tile names are like '1_2488' - lane 1, surface 2, swath 4, tile 88. Newer RunInfo.xml
+   files list all the tiles, while for older ones (MiSeq and HiSeq 2500) we make up
+   the list from the FlowcellLayout element, as bcl2fastq does.
+
+   The tiles are held in a table keyed by (lane, surface, swath), each entry being a
+   tuple of tile names in order, so selecting a subset of the flowcell is just a matter
+   of picking out the right entries.
+"""
+import sys
+
+class FlowcellGeometry:
+
+    def __init__( self , layout , tiles = None ):
+        """ layout is the attributes of the FlowcellLayout element, as a dict.
+            tiles is the list of tile names from RunInfo.xml, if there are any.
+            If layout is None but there are tiles, the counts are inferred from the tiles.
+        """
+        self.layout = dict(layout or {})
+        self.listed = bool(tiles)
+
+        if not tiles:
+            tiles = self._make_tiles(self.layout)
+
+        # Build the table. Sorting the names keeps the order consistent with what
+        # RunInfoXMLParser.tiles gives us.
+        self.table = dict()
+        for t in sorted(tiles):
+            lane, surface, swath, _ = self.split_tile(t)
+            self.table.setdefault((lane, surface, swath), []).append(t)
+        self.table = { k: tuple(v) for k, v in self.table.items() }
+
+        self.lanes    = sorted(set( k[0] for k in self.table ))
+        self.surfaces = sorted(set( k[1] for k in self.table ))
+        self.swaths   = sorted(set( k[2] for k in self.table ))
+
+        # Counts as stated in the layout, or else as seen in the tiles
+        self.lane_count    = int(self.layout.get('LaneCount') or len(self.lanes))
+        self.surface_count = int(self.layout.get('SurfaceCount') or len(self.surfaces))
+        self.swath_count   = int(self.layout.get('SwathCount') or len(self.swaths))
+        self.tile_count    = int(self.layout.get('TileCount') or
+                                 max([len(v) for v in self.table.values()] or [0]))
+
+    @classmethod
+    def from_run_info( cls , rip ):
+        """ Make a FlowcellGeometry from a RunMeta or a RunInfoXMLParser.
+        """
+        return cls(rip.layout, rip.tiles)
+
+    @staticmethod
+    def _make_tiles( layout ):
+        """ Make the names of all the tiles from the layout counts.
+        """
+        if not layout:
+            return []
+        return [ "{}_{}{}{:02d}".format(l, s, sw, t)
+                 for l in range(1, int(layout['LaneCount']) + 1)
+                 for s in range(1, int(layout['SurfaceCount']) + 1)
+                 for sw in range(1, int(layout['SwathCount']) + 1)
+                 for t in range(1, int(layout['TileCount']) + 1) ]
+
+    @staticmethod
+    def split_tile( tile ):
+        """ '1_2488' -> (1, 2, 4, 88)
+            For five-digit tile names (NextSeq) the last part includes the camera.
+        """
+        lane, name = tile.split('_')
+        return int(lane), int(name[0]), int(name[1]), int(name[2:])
+
+    def layout_key( self ):
+        """ The layout as a string like '2/2/4/88', which is how we recognise the type
+            of flowcell.
+        """
+        return '/'.join( self.layout.get(x + "Count", '?') for x in "Lane Surface Swath Tile".split() )
+
+    def tiles( self , lane = None , surface = None , swath = None ):
+        """ All the tile names matching the given lane, surface and swath (any of which
+            may be a single number or a list), in order.
+        """
+        def _ok(v, want):
+            if want is None:
+                return True
+            if isinstance(want, (list, tuple, set)):
+                return v in [ int(w) for w in want ]
+            return v == int(want)
+
+        return [ t for k in sorted(self.table)
+                   if _ok(k[0], lane) and _ok(k[1], surface) and _ok(k[2], swath)
+                   for t in self.table[k] ]
+
+    def first_tile( self , lane = None ):
+        """ First tile in the lane, or None
+        """
+        tiles = self.tiles(lane)
+        return tiles[0] if tiles else None
+
+    def last_tile( self , lane = None ):
+        tiles = self.tiles(lane)
+        return tiles[-1] if tiles else None
+
+    def every_nth( self , n , lane = None , surface = None , offset = 0 ):
+        """ Every nth tile within each swath, by tile number. So with n=2 and offset=0
+            you get the even tiles, as used by the well dups scan on NovaSeq.
+        """
+        return [ t for t in self.tiles(lane, surface)
+                   if self.split_tile(t)[3] % n == offset ]
+
+    def representative_tiles( self , lane , n , within = None ):
+        """ n tiles spread over the lane, taking the middle of n equal segments of the
+            tile list, so they cover the surfaces and swaths evenly and avoid the ends
+            of each swath where possible. If within is a list of tiles, only pick from
+            these.
+        """
+        tiles = self.tiles(lane)
+        if within is not None:
+            tiles = [ t for t in tiles if t in set(within) ]
+        if n >= len(tiles):
+            return tiles
+        return [ tiles[(2 * i + 1) * len(tiles) // (2 * n)] for i in range(n) ]
+
+    def shards( self , lane , n ):
+        """ Split the tiles of the lane into (up to) n groups of contiguous tiles, as
+            equal in size as possible.
+        """
+        tiles = self.tiles(lane)
+        n = max(1, min(n, len(tiles)))
+        return [ tiles[len(tiles) * i // n : len(tiles) * (i + 1) // n] for i in range(n) ]
+
+    def tile_match( self , lane = None ):
+        """ Regexes for matching tile numbers on each surface, as needed by the well
+            dups scan: { 'T': '1...', 'B': '2...' }. On flowcells with four or more swaths
+            per surface only the even tiles are matched. Surfaces with no tiles are left
+            out (eg. on NovaSeq SP flowcells one surface may be disabled).
+        """
+        pat = '{}..[02468]' if self.swath_count >= 4 else '{}...'
+        present = set( k[1] for k in self.table if lane is None or k[0] == int(lane) )
+        return { side: pat.format(s) for side, s in [('T', 1), ('B', 2)] if s in present }
+
+    def tiles_option( self , lane , tiles ):
+        """ A --tiles option value for bcl2fastq selecting exactly these tiles in the lane.
+            bcl2fastq takes a comma-separated list of regexes, matched against the start
+            of names like 's_1_1101'. Where all the tiles in a swath are wanted, the swath
+            is given as one item, so a shard of whole swaths makes a short option.
+        """
+        wanted = set(tiles)
+        res = []
+        for k in sorted(self.table):
+            if k[0] != int(lane):
+                continue
+            swath_tiles = self.table[k]
+            if wanted.issuperset(swath_tiles):
+                res.append("s_[{}]_{}{}".format(k[0], k[1], k[2]))
+            else:
+                res.extend( "s_[{}]_{}".format(k[0], t.split('_')[1])
+                            for t in swath_tiles if t in wanted )
+        return ','.join(res)
+
+def get_flowcell_geometry( run_dir ):
+    """ FlowcellGeometry for a run directory, via get_run_meta()
+    """
+    from illuminatus.RunMeta import get_run_meta
+    return FlowcellGeometry.from_run_info(get_run_meta(run_dir, save=False))
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.FlowcellGeometry /path/to/run
+    """
+    geom = get_flowcell_geometry(sys.argv[1])
+    print("Layout {}, tiles {}".format(geom.layout_key(), "listed" if geom.listed else "inferred"))
+    for lane in geom.lanes:
+        print("Lane {}: {} tiles, {} to {}".format( lane, len(geom.tiles(lane)),
+                                                    geom.first_tile(lane), geom.last_tile(lane) ))
+
+if __name__ == '__main__':
+    main()
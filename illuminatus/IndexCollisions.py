@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Works out if the barcodes in a lane are far enough apart to demultiplex with
+   --barcode-mismatches 1, so we can tell bcl2fastq up front rather than running it
+   with 1 and then, on seeing "Barcode collision for barcodes", running it again
+   with 0.
+
+   bcl2fastq applies the mismatch level to each index read separately, and two
+   samples collide if every index is within 2 * mismatches of the other sample.
+   So what matters for a lane is the minimum, over all pairs of samples, of the
+   larger of the index1 and index2 Hamming distances.
+
+   Rather than comparing every pair of barcodes, we use the pigeonhole principle:
+   if two sequences are within distance d then, splitting them into d + 1 chunks,
+   at least one chunk must match exactly. Each barcode is filed under the
+   (index1 chunk, index2 chunk) combinations and only barcodes sharing a key are
+   compared. This keeps things quick even with thousands of barcodes.
+
+   N in a barcode matches any base. Barcodes with N in them can't be filed by chunk,
+   so they are compared directly against everything, but normally there are few of
+   these.
+
+   When a lane is split by index length (see bcl2fastq_setup.py) each group is
+   demultiplexed on its own, so the reads from the other groups will be seen as
+   unassigned reads with a barcode that happens to start with one of theirs. For
+   these min_cross_distance() compares the groups on the bases they have in common.
+"""
+import logging as L
+from itertools import combinations
+
+# We never go above this. It's what do_demultiplex.sh tried first.
+MAX_MISMATCHES = 1
+
+def hamming( a , b ):
+    """ Hamming distance, where N matches anything. If the lengths differ the extra
+        bases on the longer one count as N.
+    """
+    return sum( 1 for x, y in zip(a, b) if x != y and x != 'N' and y != 'N' )
+
+def pair_distance( bc1 , bc2 ):
+    """ Distance between two (index1, index2) pairs, as far as collisions go.
+    """
+    return max( hamming(bc1[0], bc2[0]), hamming(bc1[1], bc2[1]) )
+
+def _chunks( seq , n ):
+    """ Split seq into n pieces of near-equal length
+    """
+    return [ seq[len(seq) * i // n : len(seq) * (i + 1) // n] for i in range(n) ]
+
+def _is_wild( bc ):
+    return 'N' in bc[0] or 'N' in bc[1]
+
+def _bucket_keys( bc , max_dist ):
+    """ All the (index1 chunk, index2 chunk) keys to file this barcode under
+    """
+    for i, c1 in enumerate(_chunks(bc[0], max_dist + 1)):
+        for j, c2 in enumerate(_chunks(bc[1], max_dist + 1)):
+            yield (i, c1, j, c2)
+
+def min_barcode_distance( barcodes , max_dist ):
+    """ Given a list of (index1, index2) pairs, find the closest two. If they are
+        within max_dist return (distance, barcode, barcode), or else (None, None, None)
+        meaning that all the barcodes are more than max_dist apart.
+    """
+    best = (max_dist + 1, None, None)
+
+    def _check(bc1, bc2):
+        nonlocal best
+        d = pair_distance(bc1, bc2)
+        if d < best[0]:
+            best = (d, bc1, bc2)
+
+    buckets = dict()
+    wild, tame = [], []
+    for bc in barcodes:
+        if _is_wild(bc):
+            wild.append(bc)
+            continue
+        tame.append(bc)
+        for k in _bucket_keys(bc, max_dist):
+            buckets.setdefault(k, []).append(bc)
+
+    # Compare everything within each bucket. Pairs in several buckets get checked
+    # more than once but that's cheap.
+    for bucket in buckets.values():
+        for bc1, bc2 in combinations(bucket, 2):
+            _check(bc1, bc2)
+        if best[0] == 0:
+            break
+
+    # And the barcodes with N's against everything
+    for i, bc1 in enumerate(wild):
+        for bc2 in tame + wild[i+1:]:
+            _check(bc1, bc2)
+
+    return best if best[1] else (None, None, None)
+
+def choose_barcode_mismatches( barcodes , max_mismatches = MAX_MISMATCHES ):
+    """ Pick the highest mismatch level (up to max_mismatches) that won't give a
+        collision between any two of the barcodes. Returns (mismatches, min_distance)
+        where min_distance is None if the barcodes are all more than 2 * max_mismatches
+        apart.
+    """
+    dist, bc1, bc2 = min_barcode_distance(barcodes, 2 * max_mismatches)
+    if dist is None:
+        return max_mismatches, None
+
+    if dist == 0:
+        # bcl2fastq will reject this in any case
+        L.warning("Duplicate barcode {}".format('-'.join(i for i in bc1 if i)))
+    else:
+        L.debug("Closest barcodes are {} and {} (distance {})".format( '-'.join(i for i in bc1 if i),
+                                                                       '-'.join(i for i in bc2 if i),
+                                                                       dist ))
+    return max(0, (dist - 1) // 2), dist
+
+def min_cross_distance( barcodes , others , max_dist ):
+    """ Like min_barcode_distance() but only compares each of barcodes against each
+        of others, not the barcodes within either list. This is for a lane that is
+        demultiplexed in several groups by index length, where we need to know if reads
+        from one group could be assigned to a sample in another.
+        The barcodes in both lists should be the same length, so trim them first to the
+        bases they have in common. Returns (distance, barcode, other) or
+        (None, None, None) as before.
+    """
+    best = (max_dist + 1, None, None)
+
+    buckets = dict()
+    wild_others = []
+    for bc in others:
+        if _is_wild(bc):
+            wild_others.append(bc)
+            continue
+        for k in _bucket_keys(bc, max_dist):
+            buckets.setdefault(k, []).append(bc)
+
+    for bc1 in barcodes:
+        if _is_wild(bc1):
+            candidates = others
+        else:
+            candidates = [ bc2 for k in _bucket_keys(bc1, max_dist)
+                                for bc2 in buckets.get(k, []) ] + wild_others
+        for bc2 in candidates:
+            d = pair_distance(bc1, bc2)
+            if d < best[0]:
+                best = (d, bc1, bc2)
+        if best[0] == 0:
+            break
+
+    return best if best[1] else (None, None, None)
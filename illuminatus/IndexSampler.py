@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+
+"""Count the index sequences on a few tiles of a lane directly from the base calls,
+   as a quick stand-in for running bcl2fastq just to see the barcode balance.
+
+   Given a SampleSheet.filtered.csv from "bcl2fastq_setup.py --bc_check", we read the
+   cycles that the --use-bases-mask marks as Y or I, for the tiles listed in the
+   #BarcodeCheckTiles line or else selected by --tiles, and assign each PF cluster to a sample just as bcl2fastq would - each index read may
+   differ from the sample's index by up to --barcode-mismatches bases, with N counting as
+   a mismatch. The result is written as Stats/Stats.json and the other files that
+   bcl2fastq would make, so assess_bc_check.py and unassigned_to_table.py work as before,
+   but no FASTQ files are written.
+
+   Where there are several tiles, they are read in an order that spreads them over the
+   lane, and if the sample sheet has a #BarcodeCheckCI line we stop as soon as the
+   fraction of reads for each project and for Undetermined is known to within that
+   much (see TileEstimates.py). The counts per tile are saved in tile_counts.json.
+
+   Both the CBCL files from RTA3 (NovaSeq and newer) and the older per-tile BCL files
+   are supported, plus the filter files to tell which clusters passed filter. Anything
+   else raises an exception, in which case the pipeline falls back to bcl2fastq.
+
+   The CBCL format is:
+
+     uint16   version
+     uint32   header size
+     uint8    bits per base call (2)
+     uint8    bits per q-score (2)
+     uint32   number of q-score bins, then for each: uint32 bin, uint32 q-score
+     uint32   number of tiles, then for each: uint32 tile number, uint32 clusters,
+                                              uint32 uncompressed size, uint32 compressed size
+     uint8    1 if non-PF clusters are excluded from the file
+
+   then one gzipped block per tile, with each cluster in 4 bits - two bits for the base
+   (ACGT) and two for the q-score bin, where bin 0 means no call.
+"""
+import os, sys
+import struct
+import json
+import gzip
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from illuminatus.DemuxBackend import ( DemuxBackend, get_opt, read_sheet_header,
+                                        make_stats_json, write_stats_files )
+from illuminatus.TileEstimates import ( spread_order, estimates, widest_ci, format_estimate,
+                                        TILE_COUNTS_FILE )
+from illuminatus.RunMeta import get_run_meta
+
+# Bases are coded as 0-3 for ACGT and 4 for N
+BASES = 'ACGTN'
+NO_CALL = 4
+
+# Only list this many unknown barcodes, like bcl2fastq
+MAX_UNKNOWN = 1000
+
+def encode_seq( seq ):
+    """ 'ACGTN' -> np.array([0, 1, 2, 3, 4])
+    """
+    return np.array([ BASES.index(b) if b in BASES else NO_CALL for b in seq.upper() ], dtype=np.uint8)
+
+def decode_seq( codes ):
+    return ''.join( BASES[c] for c in codes )
+
+def read_filter( filename ):
+    """ Read a .filter file, returning a boolean array that is True for the PF clusters
+    """
+    with open(filename, 'rb') as ffh:
+        data = ffh.read()
+    count, = struct.unpack_from('<I', data)
+    if count == 0:
+        # Newer files have a zero, then the version, then the count
+        count, = struct.unpack_from('<I', data, 8)
+        offset = 12
+    else:
+        offset = 4
+    flags = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset)
+    return (flags & 1).astype(bool)
+
+def read_cbcl_header( filename ):
+    """ Read the header of a CBCL file, returning a dict with the q-score mapping and,
+        for each tile, the number of clusters and the position of its block in the file.
+    """
+    with open(filename, 'rb') as cfh:
+        version, header_size, base_bits, q_bits, num_bins = struct.unpack('<HIBBI', cfh.read(12))
+        if (base_bits, q_bits) != (2, 2):
+            raise RuntimeError("Unsupported CBCL format in {}".format(filename))
+
+        qmap = np.zeros(4, dtype=np.uint8)
+        for _ in range(num_bins):
+            qbin, qscore = struct.unpack('<II', cfh.read(8))
+            qmap[qbin] = qscore
+
+        num_tiles, = struct.unpack('<I', cfh.read(4))
+        tiles = OrderedDict()
+        offset = header_size
+        for _ in range(num_tiles):
+            tile, clusters, _, compressed_size = struct.unpack('<IIII', cfh.read(16))
+            tiles[str(tile)] = (clusters, offset, compressed_size)
+            offset += compressed_size
+
+        pf_excluded, = struct.unpack('<B', cfh.read(1))
+
+    return dict(version=version, qmap=qmap, tiles=tiles, pf_excluded=bool(pf_excluded))
+
+def read_cbcl_tile( filename , header , tile ):
+    """ Decode the block for one tile from a CBCL file, returning arrays of base codes
+        (with N as NO_CALL) and q-scores.
+    """
+    clusters, offset, compressed_size = header['tiles'][tile]
+    with open(filename, 'rb') as cfh:
+        cfh.seek(offset)
+        data = np.frombuffer(gzip.decompress(cfh.read(compressed_size)), dtype=np.uint8)
+
+    # Two clusters per byte, the first in the low bits
+    nibbles = np.empty(data.size * 2, dtype=np.uint8)
+    nibbles[0::2] = data & 0x0f
+    nibbles[1::2] = data >> 4
+    nibbles = nibbles[:clusters]
+
+    qbins = nibbles >> 2
+    bases = np.where(qbins == 0, NO_CALL, nibbles & 3).astype(np.uint8)
+    return bases, header['qmap'][qbins]
+
+def read_bcl( filename ):
+    """ Read a per-tile .bcl or .bcl.gz file, returning arrays of base codes and q-scores.
+        Each cluster is one byte, with the base in the low two bits and the q-score in the
+        rest, and zero meaning no call.
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as bfh:
+        data = bfh.read()
+    count, = struct.unpack_from('<I', data)
+    calls = np.frombuffer(data, dtype=np.uint8, count=count, offset=4)
+
+    bases = np.where(calls == 0, NO_CALL, calls & 3).astype(np.uint8)
+    return bases, calls >> 2
+
+class IndexSampler(DemuxBackend):
+    """ Count index sequences in the base calls for the selected tiles. This has the same
+        steps as the demultiplexing backends, but writes only the stats files and logs.
+    """
+    name = 'indexsampler'
+
+    def __init__( self , *args , ci_target = None , **kwargs ):
+        super().__init__(*args, **kwargs)
+
+        # bcl2fastq_setup.py puts the target in the sheet
+        if ci_target is None:
+            ci_target = read_sheet_header(self.sample_sheet).get('#BarcodeCheckCI')
+        self.ci_target = float(ci_target or 0)
+
+        self.basecalls_dir = os.path.join( self.run_dir, 'Data', 'Intensities', 'BaseCalls',
+                                           'L{:03d}'.format(int(self.lane)) )
+        self._cbcl_headers = dict()
+
+    def get_tiles( self ):
+        """ bcl2fastq_setup.py lists the tiles to sample in the #BarcodeCheckTiles line, and
+            leaves just the first of them in --tiles for do_demultiplex.sh in case we fail.
+            With only one tile there is no such line.
+        """
+        check_tiles = read_sheet_header(self.sample_sheet).get('#BarcodeCheckTiles')
+        if check_tiles:
+            return check_tiles.split()
+        return super().get_tiles()
+
+    def prepare( self ):
+        """ Work out which cycles to read, as a list of (cycle, kind, read_index) where
+            kind is 'Y' or 'I' and read_index counts the reads of that kind from 0.
+        """
+        run_meta = get_run_meta(self.run_dir, save=False)
+        self.mask = self.get_base_mask()
+        self.tiles = self.get_tiles()
+
+        self.cycles = []
+        first_cycle = 1
+        counters = dict(Y=0, I=0)
+        for read, read_mask in zip(sorted(run_meta.read_and_length, key=int), self.mask):
+            kind = 'I' if 'I' in read_mask else 'Y'
+            for pos, letter in enumerate(read_mask):
+                # A UMI within an index read is not wanted
+                if letter == kind:
+                    self.cycles.append( (first_cycle + pos, letter, counters[kind]) )
+            counters[kind] += 1
+            first_cycle += int(run_meta.read_and_length[read])
+
+        # Nothing to run as such
+        self.commands = []
+        return self.commands
+
+    def read_cycle( self , cycle , tile ):
+        """ Base codes and q-scores for all the clusters in the tile, or just the PF
+            clusters if the CBCL file has only these. Returns ( bases , quals , pf_only )
+        """
+        cycle_dir = os.path.join(self.basecalls_dir, 'C{}.1'.format(cycle))
+
+        for cbcl in sorted(os.listdir(cycle_dir)):
+            if not cbcl.endswith('.cbcl'):
+                continue
+            cbcl = os.path.join(cycle_dir, cbcl)
+            if cbcl not in self._cbcl_headers:
+                self._cbcl_headers[cbcl] = read_cbcl_header(cbcl)
+            header = self._cbcl_headers[cbcl]
+            if tile in header['tiles']:
+                return read_cbcl_tile(cbcl, header, tile) + (header['pf_excluded'],)
+
+        for ext in ['.bcl', '.bcl.gz']:
+            bcl = os.path.join(cycle_dir, 's_{}_{}{}'.format(self.lane, tile, ext))
+            if os.path.exists(bcl):
+                return read_bcl(bcl) + (False,)
+
+        raise FileNotFoundError("No base calls for tile {} in {}".format(tile, cycle_dir))
+
+    def read_tile( self , tile ):
+        """ Read all the cycles we need for one tile. Returns the total number of clusters,
+            and arrays of base codes and q-scores for the PF clusters, with one row per
+            cluster and one column per cycle.
+        """
+        pf = read_filter(os.path.join(self.basecalls_dir, 's_{}_{}.filter'.format(self.lane, tile)))
+
+        bases = np.empty((np.count_nonzero(pf), len(self.cycles)), dtype=np.uint8)
+        quals = np.empty_like(bases)
+        for col, (cycle, _, _) in enumerate(self.cycles):
+            cycle_bases, cycle_quals, pf_only = self.read_cycle(cycle, tile)
+            if not pf_only:
+                cycle_bases, cycle_quals = cycle_bases[pf], cycle_quals[pf]
+            bases[:, col] = cycle_bases
+            quals[:, col] = cycle_quals
+
+        return len(pf), bases, quals
+
+    def get_mismatches( self ):
+        """ The allowed mismatches for each index read. --barcode-mismatches may be a single
+            number or one per index read.
+        """
+        num_index_reads = len(set( c[2] for c in self.cycles if c[1] == 'I' ))
+        mm = [ int(m) for m in (get_opt(self.opts, '--barcode-mismatches') or '0').split(',') ]
+        return (mm * num_index_reads)[:num_index_reads] if len(mm) == 1 else mm
+
+    def assign( self , barcodes ):
+        """ Assign each of the distinct barcodes to a sample. barcodes is an array of index
+            base codes, one row per barcode. Returns arrays of the sample number for each
+            (0 for unassigned) and the total number of mismatches.
+        """
+        index_cols = [ [ col for col, c in enumerate(i for i in self.cycles if i[1] == 'I') if c[2] == r ]
+                       for r in range(len(self.get_mismatches())) ]
+        mismatches = self.get_mismatches()
+
+        sample_numbers = np.zeros(len(barcodes), dtype=np.int64)
+        sample_matches = np.zeros(len(barcodes), dtype=np.int64)
+        total_mm = np.zeros(len(barcodes), dtype=np.int64)
+        for n, row in enumerate(self.rows, start=1):
+            indexes = [ row.get('index') or '', row.get('index2') or '' ]
+            ok = np.ones(len(barcodes), dtype=bool)
+            mm_sum = np.zeros(len(barcodes), dtype=np.int64)
+            for cols, index, allowed in zip(index_cols, indexes, mismatches):
+                expected = encode_seq(index[:len(cols)].ljust(len(cols), 'N'))
+                mm = np.count_nonzero(barcodes[:, cols] != expected, axis=1)
+                ok &= mm <= allowed
+                mm_sum += mm
+            sample_numbers[ok] = n
+            sample_matches[ok] += 1
+            total_mm[ok] = mm_sum[ok]
+
+        # A barcode that matches more than one sample is not assigned. This should never
+        # happen as bcl2fastq_setup.py picks the mismatches to avoid collisions.
+        sample_numbers[sample_matches > 1] = 0
+        return sample_numbers, total_mm
+
+    def assign_clusters( self , bases ):
+        """ Assign each cluster to a sample, given the base codes for the cycles we read.
+            Returns ( barcodes , counts , bc_samples , bc_mismatches , cluster_samples )
+            where the first four are for each distinct barcode (see assign()) and
+            cluster_samples has the sample number for each cluster.
+            If there is no index then all the clusters belong to the first sample and
+            barcodes is None.
+        """
+        index_cols = [ col for col, c in enumerate(self.cycles) if c[1] == 'I' ]
+
+        if not ( index_cols and any( r.get('index') for r in self.rows ) ):
+            return None, None, None, None, np.ones(len(bases), dtype=np.int64)
+
+        # Count the distinct barcodes, and then assign those to samples
+        barcodes, inverse, counts = np.unique( bases[:, index_cols], axis=0,
+                                               return_inverse=True, return_counts=True )
+        bc_samples, bc_mismatches = self.assign(barcodes)
+        return barcodes, counts, bc_samples, bc_mismatches, bc_samples[inverse.reshape(-1)]
+
+    def get_y_read_cols( self ):
+        """ The columns of the base calls for each Y read, in order
+        """
+        y_reads = sorted(set( c[2] for c in self.cycles if c[1] == 'Y' ))
+        return [ [ col for col, c in enumerate(self.cycles) if c[1] == 'Y' and c[2] == r ]
+                 for r in y_reads ]
+
+    def tally_tile( self , bases , quals ):
+        """ Add the clusters on one tile to the running totals that collect_stats() needs,
+            so the base calls for each tile can be dropped once it is counted.
+            Returns the reads for each sample on the tile, with unassigned first.
+        """
+        barcodes, counts, _, _, cluster_samples = self.assign_clusters(bases)
+        num_slots = len(self.rows) + 1
+
+        per_sample = np.bincount(cluster_samples, minlength=num_slots)
+        self.reads_per_sample += per_sample
+        self.clusters_pf += len(bases)
+
+        for r, cols in enumerate(self.get_y_read_cols()):
+            q = quals[:, cols]
+            self.read_metrics[:, r, 0] += per_sample * len(cols)
+            for m, per_cluster in [ (1, np.count_nonzero(q >= 30, axis=1)),
+                                    (2, q.sum(axis=1, dtype=np.int64)) ]:
+                self.read_metrics[:, r, m] += np.bincount( cluster_samples, weights = per_cluster,
+                                                           minlength = num_slots ).round().astype(np.int64)
+
+        # Keep a running count of the distinct barcodes
+        if barcodes is not None:
+            if self.barcodes is not None:
+                barcodes, inverse = np.unique( np.concatenate([self.barcodes, barcodes]), axis=0,
+                                               return_inverse=True )
+                counts = np.bincount( inverse.reshape(-1),
+                                      weights = np.concatenate([self.barcode_counts, counts]),
+                                      minlength = len(barcodes) ).round().astype(np.int64)
+            self.barcodes, self.barcode_counts = barcodes, counts
+
+        return per_sample
+
+    def run( self ):
+        """ Read the tiles in an order that spreads them over the lane. If there is a
+            target for the confidence intervals, stop as soon as the estimates for all the
+            projects and Undetermined are within the target, checking after 2, 4, 8...
+            tiles. Otherwise read all the tiles.
+        """
+        def _log(msg):
+            print("{} [sampler] {}".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), msg), file=lfh)
+
+        with open(os.path.join(self.out_dir, 'bcl2fastq.version'), 'w') as vfh:
+            print("Illuminatus index sampler", file=vfh)
+
+        lfh = open(os.path.join(self.out_dir, 'bcl2fastq.log'), 'w')
+        with lfh:
+            _log("Command-line invocation: index sampler {}".format(' '.join( ' '.join(o) for o in self.opts )))
+            if not self.tiles:
+                raise RuntimeError("No tiles selected for lane {}".format(self.lane))
+
+            self.clusters_raw = 0
+            self.clusters_pf = 0
+            self.reads_per_sample = np.zeros(len(self.rows) + 1, dtype=np.int64)
+            # Yield, YieldQ30 and QualityScoreSum for each sample and each Y read
+            self.read_metrics = np.zeros( (len(self.rows) + 1, len(self.get_y_read_cols()), 3),
+                                          dtype=np.int64 )
+            self.barcodes, self.barcode_counts = None, None
+            self.tile_counts = dict( tiles = [], clusters_pf = [],
+                                     samples = OrderedDict( (r['Sample_ID'], []) for r in self.rows ),
+                                     undetermined = [],
+                                     ci_target = self.ci_target,
+                                     stopped = None )
+            for i, tile in enumerate(spread_order(self.tiles)):
+                raw, bases, quals = self.read_tile(tile)
+                self.clusters_raw += raw
+                _log("INFO:   Tile: {} (index: {}) {} clusters, {} PF".format(tile, i, raw, len(bases)))
+
+                # Tally up the samples on this tile
+                per_sample = self.tally_tile(bases, quals).tolist()
+                self.tile_counts['tiles'].append(tile)
+                self.tile_counts['clusters_pf'].append(len(bases))
+                for sample_id, c in zip(self.tile_counts['samples'], per_sample[1:]):
+                    self.tile_counts['samples'][sample_id].append(c)
+                self.tile_counts['undetermined'].append(per_sample[0])
+
+                # See if we have read enough, after 2, 4, 8... tiles
+                num_read = i + 1
+                if self.ci_target and num_read >= 2 and not (num_read & (num_read - 1)):
+                    widest = widest_ci(self.tile_counts)
+                    _log("INFO: After {} tiles the widest 95% CI is {}".format(
+                                        num_read, 'unknown' if widest is None else '± {:.2%}'.format(widest) ))
+                    if widest is not None and widest <= self.ci_target:
+                        self.tile_counts['stopped'] = 'converged'
+                        break
+            else:
+                self.tile_counts['stopped'] = 'all tiles read'
+
+            for name, est in estimates(self.tile_counts).items():
+                _log("INFO: {} {}".format(name, format_estimate(*est)))
+
+            _log("Processing completed with 0 errors.")
+
+        self.write_opts()
+        with open(os.path.join(self.out_dir, TILE_COUNTS_FILE), 'w') as tfh:
+            json.dump(self.tile_counts, tfh, indent=2)
+
+    def collect_stats( self ):
+        """ Make the Stats.json from the totals that run() added up with tally_tile()
+        """
+        y_reads = sorted(set( c[2] for c in self.cycles if c[1] == 'Y' ))
+
+        barcodes, counts = self.barcodes, self.barcode_counts
+        if barcodes is not None:
+            bc_samples, bc_mismatches = self.assign(barcodes)
+        reads_per_sample = self.reads_per_sample
+
+        def _read_metrics(n):
+            res = []
+            for r, (y_yield, y_q30, q_sum) in zip(y_reads, self.read_metrics[n].tolist()):
+                res.append(OrderedDict([ ('ReadNumber',      r + 1),
+                                         ('Yield',           y_yield),
+                                         ('YieldQ30',        y_q30),
+                                         ('QualityScoreSum', q_sum),
+                                         ('TrimmedBases',    0) ]))
+            return res
+
+        demux_results = []
+        for n, row in enumerate(self.rows, start=1):
+            res = OrderedDict()
+            res['SampleId'] = row['Sample_ID']
+            res['SampleName'] = row.get('Sample_Name') or row['Sample_ID']
+            res['IndexMetrics'] = []
+            if barcodes is not None:
+                mm_counts = OrderedDict()
+                for mm in sorted(set(bc_mismatches[bc_samples == n].tolist())):
+                    mm_counts[str(mm)] = int(counts[(bc_samples == n) & (bc_mismatches == mm)].sum())
+                res['IndexMetrics'].append(OrderedDict([
+                            ('IndexSequence', '+'.join( i for i in [row.get('index'), row.get('index2')] if i )),
+                            ('MismatchCounts', mm_counts) ]))
+            res['NumberReads'] = int(reads_per_sample[n])
+            res['ReadMetrics'] = _read_metrics(n)
+            res['Yield'] = sum( m['Yield'] for m in res['ReadMetrics'] )
+            demux_results.append(res)
+
+        conversion = OrderedDict([ ('LaneNumber',       int(self.lane)),
+                                   ('TotalClustersRaw', self.clusters_raw),
+                                   ('TotalClustersPF',  self.clusters_pf),
+                                   ('Yield',            0),
+                                   ('DemuxResults',     demux_results) ])
+        unknown = OrderedDict()
+        if barcodes is not None:
+            undetermined = OrderedDict([ ('NumberReads', int(reads_per_sample[0])),
+                                         ('ReadMetrics', _read_metrics(0)) ])
+            undetermined['Yield'] = sum( m['Yield'] for m in undetermined['ReadMetrics'] )
+            conversion['Undetermined'] = undetermined
+
+            # The most common unassigned barcodes, with the index reads joined by '+'
+            index_reads = [ c[2] for c in self.cycles if c[1] == 'I' ]
+            unassigned = np.flatnonzero(bc_samples == 0)
+            for i in unassigned[np.argsort(-counts[unassigned], kind='stable')][:MAX_UNKNOWN]:
+                codes = barcodes[i]
+                unknown['+'.join( decode_seq( c for c, r in zip(codes, index_reads) if r == ir )
+                                  for ir in sorted(set(index_reads)) )] = int(counts[i])
+
+        conversion['Yield'] = sum( r['Yield'] for r in demux_results ) + \
+                              conversion.get('Undetermined', dict(Yield=0))['Yield']
+
+        stats = make_stats_json( get_run_meta(self.run_dir, save=False), self.lane, self.mask, [conversion],
+                                 [ OrderedDict([('Lane', int(self.lane)), ('Barcodes', unknown)]) ] )
+        write_stats_files( self.out_dir, self.lane, stats,
+                           { i + 1: r.get('Sample_Project', '') for i, r in enumerate(self.rows) } )
+        return stats
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.IndexSampler /path/to/run /path/to/out SampleSheet.filtered.csv 1
+    """
+    sampler = IndexSampler(*sys.argv[1:5])
+    sampler.prepare()
+    sampler.run()
+    conversion, = sampler.collect_stats()['ConversionResults']
+    for dr in conversion['DemuxResults']:
+        print("{}\t{}".format(dr['SampleId'], dr['NumberReads']))
+    print("Undetermined\t{}".format(conversion.get('Undetermined', {}).get('NumberReads')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""Works out which runs need lanes re-doing because a new sample sheet has
+   appeared. This implements the logic described in doc/auto_lane_restart.txt, which
+   used to be all in auto_redo.sh, but looks at all the candidate sheets in one go:
+
+    - The run directories are listed once, and a map made from flowcell ID to run.
+    - For each sheet, we check the run is complete or failed, that the sheet is newer
+      than the SampleSheet.csv link, and that no OVERRIDE is in effect.
+    - Then we see which lanes changed, using SampleSheetDiff so that cosmetic edits
+      don't trigger a re-demultiplex. Failed runs have all lanes re-done.
+
+   The result is a plan - a list of dicts with the run, the lanes and the reason
+   for each decision. Applying the plan is left to auto_redo.sh.
+"""
+import os
+import re
+import difflib
+
+from illuminatus.RunStatus import get_run_dict
+from illuminatus.SampleSheetDiff import diff_samplesheets, describe_changes
+
+# Sheets are named like foo_HXXXXDRXY.csv
+SHEET_FCID = re.compile(r'_([^_]+)\.csv$')
+
+def flowcell_keys( run_name ):
+    """ All the flowcell IDs this run name could match, in upper case. Depending on the
+        machine, a run for flowcell HXXXXDRXY is named like 201125_A00291_0321_AHXXXXDRXY,
+        and a run for flowcell ADWKV like 150602_M01270_0108_000000000-ADWKV. To be lenient
+        we allow the flowcell ID to follow '_A', '_B', '_' or '-'.
+    """
+    run_name = run_name.upper()
+    res = set()
+    for i, c in enumerate(run_name):
+        tail = run_name[i+1:]
+        if c not in '_-' or not tail or '_' in tail:
+            continue
+        res.add(tail)
+        if c == '_' and tail[0] in 'AB' and tail[1:]:
+            res.add(tail[1:])
+    return res
+
+def map_flowcells_to_runs( seqdata_dir ):
+    """ List seqdata_dir just once and return a dict of { flowcell: [run_dir, ...] }
+    """
+    res = dict()
+    with os.scandir(seqdata_dir) as sdi:
+        for de in sdi:
+            if de.is_dir():
+                for k in flowcell_keys(de.name):
+                    res.setdefault(k, []).append(de.path)
+    for v in res.values():
+        v.sort()
+    return res
+
+def changed_lanes( old_sheet , new_sheet ):
+    """ See which lanes differ between two sample sheets, as far as demultiplexing goes.
+        Returns a sorted list of lane numbers as strings, and a dict of { lane: description }
+        saying what changed.
+        If either sheet can't be read by SampleSheetReader we fall back to the plain
+        text comparison.
+    """
+    try:
+        diff = diff_samplesheets(old_sheet, new_sheet)
+    except (AssertionError, ValueError, UnicodeDecodeError):
+        lanes = changed_lanes_text(old_sheet, new_sheet)
+        return lanes, { l: "sheet not readable, so compared as text" for l in lanes }
+
+    lanes = sorted(diff, key=lambda l: int(l) if l.isdigit() else 0)
+    return lanes, { l: describe_changes(diff[l]) for l in lanes }
+
+def changed_lanes_text( old_sheet , new_sheet ):
+    """ Compare two sample sheets line by line, ignoring trailing whitespace, and see which
+        lanes appear on the lines that differ. This makes the same assumption as
+        the pre-bcl2fastq filter, that the lane number is at the start of the line.
+        Returns a sorted list of lane numbers as strings.
+    """
+    def _lines(f):
+        with open(f) as fh:
+            return [ l.rstrip() for l in fh ]
+
+    old_lines, new_lines = _lines(old_sheet), _lines(new_sheet)
+    changed = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag != 'equal':
+            changed.extend(old_lines[i1:i2])
+            changed.extend(new_lines[j1:j2])
+
+    lanes = set()
+    for l in changed:
+        mo = re.match(r'(\d+),', l)
+        if mo:
+            lanes.add(mo.group(1))
+    return sorted(lanes, key=int)
+
+class RedoPlanner:
+
+    def __init__( self , seqdata_dir , registry = None ):
+        self.seqdata_dir = seqdata_dir
+        self.registry = registry
+        self.run_map = map_flowcells_to_runs(seqdata_dir)
+
+    def get_run_dict( self , run_dir ):
+        # Planning is read-only, so nothing is saved to the registry or the run timeline.
+        return get_run_dict(run_dir, '', self.registry, save=False)
+
+    def plan( self , sheets ):
+        """ Given a list of sheet files, decide what to do with each. Returns a list
+            of dicts with sheet, run_dir, action ('redo' or 'skip'), lanes and reason.
+            As in the old auto_redo.sh, if two sheets apply to the same run then the
+            first one wins, and the second is skipped since the run is now in status redo.
+        """
+        res = []
+        planned_runs = set()
+        for sheet in sheets:
+            decision = dict(sheet=sheet, run_dir=None, action='skip', lanes=[])
+            decision.update(self.check_sheet(sheet, planned_runs))
+            if decision['action'] == 'redo':
+                planned_runs.add(decision['run_dir'])
+            res.append(decision)
+        return res
+
+    def check_sheet( self , sheet , planned_runs = () ):
+        """ Decide what to do about a single sheet. Returns a dict with the reason and,
+            if we get as far as finding the run, the run_dir. If the run needs re-doing
+            the dict will also have action='redo' and the list of lanes.
+        """
+        mo = SHEET_FCID.search(os.path.basename(sheet))
+        if not mo:
+            return dict(reason="Not a sample sheet name")
+        fcid = mo.group(1)
+
+        run_dirs = self.run_map.get(fcid.upper(), [])
+        if len(run_dirs) != 1:
+            return dict(reason = "No directory found in {} for FCID {}".format(self.seqdata_dir, fcid)
+                                 if not run_dirs else
+                                 "FCID {} matches {} directories".format(fcid, len(run_dirs)) )
+        run_dir, = run_dirs
+
+        def _skip(reason):
+            return dict(run_dir=run_dir, reason=reason)
+
+        if run_dir in planned_runs:
+            return _skip("Will not touch run in status redo")
+
+        run_dict = self.get_run_dict(run_dir)
+        status = run_dict.get('PipelineStatus', 'unknown')
+        if status not in ['complete', 'failed']:
+            return _skip("Will not touch run in status {}".format(status))
+
+        # Check the timestamp. If the SampleSheet.csv link is newer than this sheet then
+        # we risk sending the pipeline round in a repeating loop (samplesheet_fetch.sh always
+        # touches the link so it's a reasonable reflection of the last fetch time).
+        # If the sample sheet is re-generated just after the fetch, the status test above will fail
+        # until the pipeline fails or completes, but then the run will become a candidate for
+        # restarting. This is desirable.
+        run_ss = os.path.join(run_dir, 'SampleSheet.csv')
+        if not os.path.islink(run_ss):
+            return _skip("Sanity check failed - {} is not a symlink".format(run_ss))
+        if os.path.basename(os.readlink(run_ss)) == 'SampleSheet.csv.OVERRIDE':
+            return _skip("OVERRIDE is in effect ({} -> {})".format(run_ss, os.readlink(run_ss)))
+
+        ts = int(os.stat(sheet).st_mtime)
+        old_ts = int(os.lstat(run_ss).st_mtime)
+        if ts <= old_ts:
+            return _skip("The candidate sheet is not newer than {} (@{})".format(run_ss, old_ts))
+
+        # See which lanes, if any, were changed.
+        lanes, lane_changes = changed_lanes(run_ss, sheet)
+        if not lanes:
+            return _skip("No changes affecting demultiplexing compared to {}".format(run_ss))
+        changes = ' '.join( "[lane {}: {}]".format(l, lane_changes[l]) for l in lanes )
+
+        if status == 'failed':
+            # Policy dictates we redo all the lanes
+            return dict( run_dir = run_dir,
+                         action = 'redo',
+                         lanes = [ str(l) for l in range(1, int(run_dict.get('LaneCount') or 0) + 1) ],
+                         reason = "Run failed, and the new sheet changes lanes {} {}".format(','.join(lanes), changes),
+                         changes = lane_changes )
+
+        return dict( run_dir = run_dir,
+                     action = 'redo',
+                     lanes = lanes,
+                     reason = "The new sheet changes lanes {} {}".format(','.join(lanes), changes),
+                     changes = lane_changes )
@@ -4,7 +4,7 @@ import os
 import re
 import xml.etree.ElementTree as ET
 
-from datetime import datetime
+from illuminatus.FlowcellGeometry import FlowcellGeometry
 
 instrument_types = "M:miseq D:hiseq2500 E:hiseqX K:hiseq4000 A:novaseq"
 
@@ -83,11 +83,14 @@ class RunInfoXMLParser:
                 # Dunno. Just use it unmodified.
                 self.run_info[ 'RunDate' ] = d
 
-        self.run_info[ 'FCType' ] = self.get_flowcell_type()
+        layouts = [ e.attrib for e in root.iter('FlowcellLayout') ]
+        self.layout = dict(layouts[0]) if len(layouts) == 1 else None
 
         # And get the list of tiles. We always want them in dictionary order
         self.tiles = sorted(self.get_tiles())
 
+        self.run_info[ 'FCType' ] = self.get_flowcell_type()
+
     def get_tiles(self):
         return [ te.text for te in self.root.findall(".//Tiles/Tile") ]
 
@@ -95,13 +98,39 @@ class RunInfoXMLParser:
         """See what type of flowcell this is by the geometry. If it is recognised, give it a name.
            Looking for something like: <FlowcellLayout LaneCount="1" SurfaceCount="2" SwathCount="1" TileCount="14" />
         """
-        try:
-            e, = self.root.iter('FlowcellLayout')
-            layout = e.attrib
-        except Exception:
+        if not self.layout:
             return "Unknown"
 
         # Simplify
-        slayout = '/'.join( layout.get(x + "Count", '?') for x in "Lane Surface Swath Tile".split() )
+        slayout = self.get_geometry().layout_key()
         return flowcell_types.get(slayout, slayout)
 
+    def get_geometry(self):
+        """A FlowcellGeometry for the run
+        """
+        return FlowcellGeometry.from_run_info(self)
+
+
+# Parsers already made by get_runinfo_xml_parser()
+_parser_cache = {}
+
+def get_runinfo_xml_parser( runinfo_file ):
+    """Gets a RunInfoXMLParser, re-using the last one made for the same file if the
+       file has not changed since (judged by the mtime and size). Use this when one
+       process may look at the same RunInfo.xml many times, as RunStatus does.
+       The parser is shared, so callers must not modify it.
+    """
+    if os.path.isdir(runinfo_file):
+        runinfo_file = os.path.join( runinfo_file, "RunInfo.xml" )
+    runinfo_file = os.path.abspath(runinfo_file)
+
+    st = os.stat(runinfo_file)
+    cache_key = (st.st_mtime_ns, st.st_size)
+
+    cached = _parser_cache.get(runinfo_file)
+    if cached and cached[0] == cache_key:
+        return cached[1]
+
+    rip = RunInfoXMLParser(runinfo_file)
+    _parser_cache[runinfo_file] = (cache_key, rip)
+    return rip
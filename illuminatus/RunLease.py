@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+"""Lease-based locks for runs, so that we can tell if the process that started
+   demultiplexing or QC on a run is still alive, and so that several driver hosts
+   can safely share one SEQDATA_LOCATION.
+   A lease is a small JSON file (normally in the pipeline/ directory) recording the
+   owner host, PID and an expiry time. The owner must renew the lease before it
+   expires. Once expired, any other process may take the lease over.
+"""
+import os
+import json
+import socket
+import time
+import uuid
+
+DEFAULT_TTL = 600
+
+class LeaseHeldError(RuntimeError):
+    pass
+
+class RunLease:
+
+    def __init__( self , lease_file , ttl = DEFAULT_TTL , pid = None ):
+        self.lease_file = lease_file
+        self.ttl = int(ttl)
+        self.host = socket.gethostname()
+        self.pid = int(pid or os.getpid())
+
+    def read( self ):
+        """Returns the current lease as a dict, or None if there is no lease.
+           A lease file that can't be parsed is treated as held until the file
+           itself is older than the TTL.
+        """
+        return self._read_file(self.lease_file)
+
+    def _read_file( self , filename ):
+        try:
+            with open(filename) as lfh:
+                return json.load(lfh)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            pass
+
+        # Leases are always linked into place fully written, so this should not happen,
+        # but if it does we can't tell who the owner is. Go by the file age instead.
+        try:
+            mtime = int(os.stat(filename).st_mtime)
+        except FileNotFoundError:
+            return None
+        return dict(owner='unknown', pid=0, expires=mtime + self.ttl)
+
+    def is_expired( self , lease = None ):
+        """A lease is expired if the time is past, or if it belongs to a process
+           on this host that no longer exists.
+        """
+        lease = lease or self.read()
+        if not lease:
+            return False
+        if lease.get('expires', 0) < time.time():
+            return True
+        if lease.get('owner') == self.host:
+            try:
+                os.kill(lease['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+        return False
+
+    def is_mine( self , lease = None ):
+        lease = lease or self.read()
+        return bool(lease) and lease.get('owner') == self.host and lease.get('pid') == self.pid
+
+    def _new_lease( self ):
+        now = int(time.time())
+        return dict( owner = self.host,
+                     pid = self.pid,
+                     acquired = now,
+                     expires = now + self.ttl )
+
+    def acquire( self ):
+        """Get the lease, taking over an expired one if need be.
+           Returns the previous lease if one was taken over, or else None.
+           Raises LeaseHeldError if there is a live lease held by another process.
+        """
+        old_lease = None
+        try:
+            self._write_exclusive()
+            return None
+        except FileExistsError:
+            old_lease = self.read()
+
+        if not old_lease:
+            # It was released just now. Have one more go.
+            try:
+                self._write_exclusive()
+                return None
+            except FileExistsError:
+                raise LeaseHeldError("{} was taken by another process".format(self.lease_file))
+        if self.is_mine(old_lease):
+            self.renew()
+            return None
+        if not self.is_expired(old_lease):
+            raise LeaseHeldError("{} is held by {}:{}".format( self.lease_file,
+                                                                old_lease.get('owner'),
+                                                                old_lease.get('pid') ))
+
+        # To take over safely, move the stale lease out of the way. Another process that
+        # saw the same stale lease may already have replaced it with a new one, in which
+        # case we give up.
+        self._move_aside(lambda l: l == old_lease)
+        try:
+            self._write_exclusive()
+        except FileExistsError:
+            raise LeaseHeldError("{} was taken over by another process".format(self.lease_file))
+
+        return old_lease
+
+    def renew( self ):
+        """Push back the expiry time. Raises LeaseHeldError if we lost the lease.
+        """
+        if not self.is_mine():
+            raise LeaseHeldError("{} is no longer held by this process".format(self.lease_file))
+
+        # Write to a temp file first, so nobody ever sees a partial file. The lease may be
+        # taken over at any time, so we can't just check it's ours then replace it.
+        # Instead move our lease aside, checking we moved the right one, then link the new
+        # one into place, which fails if anyone else got there in between. If another
+        # process acquires the lease in that moment, the lease is theirs.
+        tmp_file = self._write_tmp()
+        try:
+            if not self._move_aside(lambda l: bool(l) and self.is_mine(l)):
+                raise LeaseHeldError("{} is no longer held by this process".format(self.lease_file))
+            try:
+                os.link(tmp_file, self.lease_file)
+            except FileExistsError:
+                raise LeaseHeldError("{} was taken over by another process".format(self.lease_file))
+        finally:
+            os.remove(tmp_file)
+
+    def _move_aside( self , wanted ):
+        """Rename the lease file out of the way and delete it, if wanted(lease) is true
+           for the lease that was moved. Only one process can rename any given file, so
+           this is safe against other processes doing the same. If the lease is not
+           wanted, it is put back and LeaseHeldError is raised.
+           Returns False if there was no lease file, else True.
+        """
+        stale_file = "{}.stale.{}".format(self.lease_file, uuid.uuid4().hex)
+        try:
+            os.rename(self.lease_file, stale_file)
+        except FileNotFoundError:
+            return False
+
+        try:
+            if not wanted(self._read_file(stale_file)):
+                try:
+                    os.link(stale_file, self.lease_file)
+                except FileExistsError:
+                    pass
+                raise LeaseHeldError("{} was taken over by another process".format(self.lease_file))
+        finally:
+            os.remove(stale_file)
+        return True
+
+    def release( self ):
+        """Remove the lease, if we hold it.
+        """
+        # As with renew(), don't remove a lease that was just taken over.
+        try:
+            self._move_aside(lambda l: bool(l) and self.is_mine(l))
+        except LeaseHeldError:
+            pass
+
+    def _write_tmp( self ):
+        """Write a new lease to a temp file, ready to be linked into place.
+        """
+        tmp_file = "{}.tmp.{}.{}".format(self.lease_file, self.host, self.pid)
+        with open(tmp_file, 'w') as lfh:
+            json.dump(self._new_lease(), lfh)
+        return tmp_file
+
+    def _write_exclusive( self ):
+        """Link a new lease into place, so nobody ever sees a partial file.
+           Raises FileExistsError if there is already a lease.
+        """
+        tmp_file = self._write_tmp()
+        try:
+            os.link(tmp_file, self.lease_file)
+        finally:
+            os.remove(tmp_file)
+
+    def heartbeat( self , interval = None ):
+        """Renew the lease repeatedly until self.pid exits or the lease is lost.
+           This is meant to run in a background process, with pid set to the
+           process doing the actual work.
+        """
+        interval = interval or max(1, self.ttl // 3)
+        while True:
+            time.sleep(interval)
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                # Owner is gone. Leave the lease to expire.
+                return
+            try:
+                self.renew()
+            except LeaseHeldError:
+                # Released or taken over. Either way we're done.
+                return
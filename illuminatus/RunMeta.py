@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""The metadata for a run that we get from RunInfo.xml and RunParameters.xml, all in
+   one place. Rather than every script parsing the XML again, driver.sh saves this in
+   pipeline/run_meta.json when it first sees the run and get_run_meta() loads it from
+   there. The file records the mtime of each source file (or that it was missing), and
+   is re-made only when any of these change.
+
+   The RunMeta object stands in for a RunInfoXMLParser, having run_info,
+   read_and_length, read_and_indexed, tiles, layout and get_geometry(), and the
+   contents of RunParameters.xml are available from get_run_parameters().
+"""
+import os, sys
+import json
+import logging as L
+
+from illuminatus.RunInfoXMLParser import RunInfoXMLParser
+from illuminatus.RunParametersXMLParser import RunParametersXMLParser
+from illuminatus.FlowcellGeometry import FlowcellGeometry
+
+# Relative to the run directory
+META_FILE = 'pipeline/run_meta.json'
+# Bump this if the content changes, so old files are re-made
+META_VERSION = 1
+
+# Everything that RunInfoXMLParser and RunParametersXMLParser may look at. The start
+# time comes from the files in Recipe/, so the mtime of the directory is a reasonable
+# proxy for these.
+SOURCE_FILES = [ "RunInfo.xml",
+                 "pipeline/runParameters.OVERRIDE.yml",
+                 "pipeline/RunParameters.OVERRIDE.yml",
+                 "runParameters.OVERRIDE.yml",
+                 "RunParameters.OVERRIDE.yml",
+                 "runParameters.xml",
+                 "RunParameters.xml",
+                 "Recipe" ]
+
+class RunMeta:
+
+    def __init__( self , meta ):
+        """ Make a RunMeta from the dict made by make_run_meta(), or loaded from the
+            JSON file.
+        """
+        self.meta = meta
+        self.run_info = meta['run_info']
+        self.read_and_length = meta['read_and_length']
+        self.read_and_indexed = meta['read_and_indexed']
+        self.tiles = meta['tiles']
+        self.layout = meta['layout']
+
+    def get_geometry( self ):
+        """ A FlowcellGeometry for the run
+        """
+        return FlowcellGeometry.from_run_info(self)
+
+    def get_run_parameters( self ):
+        """ The dict from RunParametersXMLParser. If there was no RunParameters.xml,
+            raises FileNotFoundError just as RunParametersXMLParser would.
+        """
+        if self.meta['run_parameters'] is None:
+            raise FileNotFoundError( self.meta['run_parameters_error'] )
+        return self.meta['run_parameters']
+
+def get_source_mtimes( run_dir ):
+    """ { filename: mtime_ns } for each of SOURCE_FILES, with None for missing files.
+    """
+    res = dict()
+    for f in SOURCE_FILES:
+        try:
+            res[f] = os.stat(os.path.join(run_dir, f)).st_mtime_ns
+        except FileNotFoundError:
+            res[f] = None
+    return res
+
+def make_run_meta( run_dir ):
+    """ Read the XML files and make the dict that is saved as JSON. RunInfo.xml must be
+        present, but if RunParameters.xml can't be read run_parameters will be None.
+    """
+    # Take the mtimes first, so if anything changes while we're reading we'll look again
+    # next time.
+    sources = get_source_mtimes(run_dir)
+
+    rip = RunInfoXMLParser(run_dir)
+
+    meta = dict( version = META_VERSION,
+                 sources = sources,
+                 run_info = rip.run_info,
+                 read_and_length = rip.read_and_length,
+                 read_and_indexed = rip.read_and_indexed,
+                 tiles = rip.tiles,
+                 layout = rip.layout,
+                 run_parameters = None,
+                 run_parameters_error = None )
+    try:
+        meta['run_parameters'] = RunParametersXMLParser(run_dir).run_parameters
+    except Exception as e:
+        meta['run_parameters_error'] = "Unable to read RunParameters for {}: {}".format(run_dir, e)
+
+    return meta
+
+def _run_dir( run_dir ):
+    # As a convenience, allow the path to RunInfo.xml in place of run_dir.
+    if os.path.basename(run_dir) == "RunInfo.xml":
+        return os.path.dirname(run_dir) or '.'
+    return run_dir
+
+def load_run_meta( run_dir ):
+    """ Get a RunMeta from pipeline/run_meta.json, if it is there and up to date,
+        or else None.
+    """
+    run_dir = _run_dir(run_dir)
+    try:
+        with open(os.path.join(run_dir, META_FILE)) as mfh:
+            meta = json.load(mfh)
+        if meta.get('version') == META_VERSION and meta.get('sources') == get_source_mtimes(run_dir):
+            return RunMeta(meta)
+    except (OSError, ValueError):
+        # Missing or broken
+        pass
+    return None
+
+def get_run_meta( run_dir , save = True ):
+    """ Get a RunMeta for run_dir, from pipeline/run_meta.json if it is up to date, or
+        else by reading the XML files. In the latter case, if save is set and there is
+        a pipeline/ directory, the file is (re-)written.
+        You may pass the path to RunInfo.xml in place of run_dir.
+    """
+    run_dir = _run_dir(run_dir)
+    meta_file = os.path.join(run_dir, META_FILE)
+
+    run_meta = load_run_meta(run_dir)
+    if run_meta:
+        return run_meta
+
+    meta = make_run_meta(run_dir)
+    if save and os.path.isdir(os.path.dirname(meta_file)):
+        save_run_meta(meta, meta_file)
+    return RunMeta(meta)
+
+def save_run_meta( meta , meta_file ):
+    """ Write the file atomically, but a failure is only a warning.
+    """
+    try:
+        tmp_file = "{}.tmp.{}".format(meta_file, os.getpid())
+        with open(tmp_file, 'w') as mfh:
+            json.dump(meta, mfh, indent=2, sort_keys=True, default=str)
+        os.replace(tmp_file, meta_file)
+    except OSError as e:
+        L.warning("Unable to save {}: {}".format(meta_file, e))
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.RunMeta /path/to/run
+    """
+    print(json.dumps(get_run_meta(sys.argv[1], save=False).meta, indent=2, sort_keys=True, default=str))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""A small on-disk registry of run states, kept in an SQLite database.
+   Runs that have reached a final state (complete or aborted) are "cold" and
+   don't need re-evaluating on every CRON cycle. Unless the modification times
+   of the run directory or the pipeline/ directory change (eg. because a lane?.redo
+   file appears) we can simply report the last status we saw.
+   The registry is only ever a cache. If it can't be read or written then callers
+   just work out the status the slow way.
+"""
+import os, sys
+import json
+import sqlite3
+
+# States for which we trust the cached info.
+COLD_STATES = ['complete', 'aborted']
+
+class RunRegistry:
+
+    def __init__( self , db_file ):
+        """Open (and if need be create) the registry.
+        """
+        self.db_file = db_file
+
+        # Several driver.sh instances may be running at once. SQLite will do the locking
+        # but we want to wait a while rather than fail immediately.
+        self.conn = sqlite3.connect(db_file, timeout=30)
+        with self.conn:
+            self.conn.execute( """CREATE TABLE IF NOT EXISTS runs (
+                                    run_id TEXT PRIMARY KEY,
+                                    run_dir TEXT,
+                                    run_info TEXT,
+                                    status TEXT,
+                                    run_mtime INTEGER,
+                                    pipeline_mtime INTEGER )""" )
+
+    def close(self):
+        self.conn.close()
+
+    @classmethod
+    def get_mtimes( cls , run_dir ):
+        """Get the modification times of the run_dir and run_dir/pipeline in
+           nanoseconds. If pipeline/ is missing this will be 0.
+        """
+        run_mtime = os.stat(run_dir).st_mtime_ns
+        try:
+            pipeline_mtime = os.stat(os.path.join(run_dir, 'pipeline')).st_mtime_ns
+        except FileNotFoundError:
+            pipeline_mtime = 0
+
+        return run_mtime, pipeline_mtime
+
+    def get_run( self , run_id ):
+        """Gets everything we know about a run as a dict, or None if the run is
+           not in the registry.
+        """
+        row = self.conn.execute( "SELECT run_dir, run_info, status, run_mtime, pipeline_mtime"
+                                 " FROM runs WHERE run_id = ?", (run_id,) ).fetchone()
+        if not row:
+            return None
+
+        return dict( RunID = run_id,
+                     RunDir = row[0],
+                     RunInfo = json.loads(row[1]),
+                     Status = json.loads(row[2]),
+                     Mtimes = (row[3], row[4]) )
+
+    def save_run( self , run_dir , run_info , status ):
+        """Record the status of a run. run_info should be a dict of anything that
+           the caller wants to save from RunInfo.xml and status is the dict of status
+           info, which must include RunID.
+           Note that the mtimes should be collected before the status was worked out,
+           to avoid a race condition, so the caller may supply them in status['Mtimes']
+        """
+        status = status.copy()
+        mtimes = status.pop('Mtimes', None) or self.get_mtimes(run_dir)
+
+        with self.conn:
+            self.conn.execute( "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                               ( status['RunID'],
+                                 os.path.abspath(run_dir),
+                                 json.dumps(run_info),
+                                 json.dumps(status),
+                                 *mtimes ) )
+
+    def list_runs( self , status = None ):
+        """List the (run_id, status_dict) for all runs in the registry, optionally
+           filtered by PipelineStatus.
+        """
+        for run_id, st in self.conn.execute("SELECT run_id, status FROM runs ORDER BY run_id"):
+            st = json.loads(st)
+            if status is None or st.get('PipelineStatus') == status:
+                yield run_id, st
+
+def main():
+    """Dump out the contents of the registry. You can't just run this script directly,
+       but you can do:
+        python3 -m illuminatus.RunRegistry /path/to/run_registry.sqlite [status]
+    """
+    reg = RunRegistry(sys.argv[1])
+
+    for run_id, st in reg.list_runs(*sys.argv[2:3]):
+        print("{}\t{}".format(run_id, st.get('PipelineStatus')))
+
+if __name__ == '__main__':
+    main()
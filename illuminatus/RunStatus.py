@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+import os.path
+from glob import glob
+from fnmatch import fnmatchcase
+import re
+from datetime import datetime
+
+from illuminatus.RunInfoXMLParser import get_runinfo_xml_parser, instrument_types
+from illuminatus.RunMeta import load_run_meta
+from illuminatus.RunRegistry import COLD_STATES
+from illuminatus.CycleProgress import CycleProgress
+from illuminatus.RunTimeline import make_event, record_event, last_state
+from illuminatus.StallDetector import StallDetector
+from illuminatus.BCL2FASTQProgress import BCL2FASTQProgress, PROGRESS_FILE
+
+class RunStatus:
+    """This Class provides information about a sequencing run, given a run folder.
+       It will parse information from the following sources:
+         RunInfo.xml file - to obtain LaneCount (via pipeline/run_meta.json if possible)
+         Run directory content (including pipeline subdir) - to obtain status information
+       If saved_info is supplied (see get_saved_info()) then RunInfo.xml will not be read.
+       Options are 'q' for quick mode, where RunInfo.xml is not read, and 'p' to add
+       sequencing progress info (see illuminatus/CycleProgress.py) to the output.
+    """
+    def __init__( self , run_folder , opts = '', saved_info = None ):
+
+        # here the RunInfo.xml is parsed into an object
+        self.run_path_folder = get_status_dir(run_folder)
+
+        self.quick_mode = 'q' in opts
+        self.progress_mode = 'p' in opts and not self.quick_mode
+
+        runinfo_xml_location = os.path.join( self.run_path_folder , 'RunInfo.xml' )
+        self._exists_cache = {}
+
+        self.trigger_cycles = [1]
+        self.last_read1_read = 1
+
+        try:
+            if self.quick_mode:
+                # We only care about instrument (and pipelinestatus)
+                self.runinfo_xml = QuickInfo( self.run_path_folder )
+            else:
+                if saved_info:
+                    self.runinfo_xml = SavedInfo( saved_info )
+                else:
+                    # We never write run_meta.json here, as this is just a status check.
+                    self.runinfo_xml = ( load_run_meta( self.run_path_folder ) or
+                                         get_runinfo_xml_parser( runinfo_xml_location ) )
+
+                # Get a list of the first cycle number of each read
+                for r, l in sorted(self.runinfo_xml.read_and_length.items()):
+                    self.trigger_cycles.append(self.trigger_cycles[-1] + int(l))
+
+                # Correct the last one
+                self.trigger_cycles[-1] -= 1
+
+                # We can do the well dups check after 70 cycles but we can only
+                # check the indexes after the last index read is complete, so wait for that
+                try:
+                    self.last_read1_read = max( k for k, v in self.runinfo_xml.read_and_indexed.items()
+                                                if v == 'Y' )
+                except ValueError:
+                    # No index reads. Keep the default value of 1 to trigger well dups and InterOP
+                    # reporting still
+                    pass
+
+        except Exception:
+            #if we can't read it we can't get much info
+            if os.environ.get('DEBUG', '0') != '0': raise
+            self.runinfo_xml = None
+
+    def get_saved_info( self ):
+        """ Get the info from RunInfo.xml that we need to save in order to make a new
+            RunStatus without re-reading the file.
+        """
+        return dict( run_info = self.runinfo_xml.run_info,
+                     read_and_length = self.runinfo_xml.read_and_length,
+                     read_and_indexed = self.runinfo_xml.read_and_indexed )
+
+    def _is_sequencing_finished( self ):
+
+        # the following type of files exist in a run folder with the number varying depending on the number of reads:
+        # Basecalling_Netcopy_complete.txt
+        # ImageAnalysis_Netcopy_complete.txt
+        # RUN/RTARead1Complete.txt
+        # RUN/RTARead3Complete.txt
+        # RUN/RTARead2Complete.txt
+        # RUN/RTARead4Complete.txt
+        # RUN/RTAComplete.txt
+
+        # however there were no runs where the RTAComplete.txt was not the last file written to the run folder.
+        # So will only check for this file to determine if sequencing has finished or not
+        RTACOMPLETE_LOCATION = os.path.join( self.run_path_folder , 'RTAComplete.txt' )
+
+        # Oh but it's no longer that simple. NovaSeq has started writing this file before all the CBCL
+        # files are in place.
+        if not os.path.exists( RTACOMPLETE_LOCATION ):
+            return False
+
+        return self._is_read_finished(-1)
+
+    def _exists( self, glob_pattern ):
+        """ Returns if a file exists and caches the result.
+            The check will be done with glob() so wildcards can be used, and
+            the result will be the number of matches.
+            Patterns that refer directly to the contents of pipeline/ are checked against
+            a single listing of that directory, rather than each hitting the filesystem.
+        """
+        if glob_pattern not in self._exists_cache:
+            dirname, basename = os.path.split(glob_pattern)
+            if dirname == 'pipeline':
+                self._exists_cache[glob_pattern] = sum( 1 for f in self._list_pipeline_dir()
+                                                        if fnmatchcase(f, basename) )
+            else:
+                self._exists_cache[glob_pattern] = len(glob( os.path.join(self.run_path_folder, glob_pattern) ))
+
+        return self._exists_cache[glob_pattern]
+
+    def _list_pipeline_dir( self ):
+        """ Gets the names of everything in the pipeline/ directory, with one os.scandir()
+            call. If there is no such directory, the list is empty.
+            The listing is held in self._exists_cache so that clearing the cache
+            clears this too.
+        """
+        if 'pipeline/' not in self._exists_cache:
+            try:
+                with os.scandir(os.path.join(self.run_path_folder, 'pipeline')) as sdi:
+                    self._exists_cache['pipeline/'] = [ de.name for de in sdi ]
+            except (FileNotFoundError, NotADirectoryError):
+                self._exists_cache['pipeline/'] = []
+
+        return self._exists_cache['pipeline/']
+
+    def _is_read_finished( self, readnum ):
+        """ This used to check for existence of Basecalling_Netcopy_complete_ReadX.txt or RTAReadXComplete.txt with
+            X being the provided readnumber
+            However, the NovaSeq doesn't seem to write any such file and the logic being different per sequencer is
+            confusing, so we're instead looking for the actual data, even though it is possible that out-of-order
+            copying will make this unreliable.
+        """
+        try:
+            # readnum counts from 1 so trigger_cycles[readnum] is the first cycle of the
+            # next read (trigger_cycles[0] is always 1)
+            cycle = self.trigger_cycles[int(readnum)]
+            return self._exists( f"Data/Intensities/BaseCalls/L001/C{cycle}.1/*" )
+        except Exception:
+            return False
+
+    def _is_new_run( self ):
+        # if the pipeline has not yet seen this run before.
+        # the pipeline/ folder should not exist
+        return not self._exists( 'pipeline' )
+
+    def _was_restarted( self ):
+        """ returns True if any of the lanes was marked for redo
+        """
+        return self._exists( 'pipeline/lane?.redo' )
+
+    def _was_started( self ):
+        """ returns True if ANY of the lanes was marked as started [demultiplexing]
+        """
+        return self._exists( 'pipeline/lane?.started' )
+
+    def _read1_triggered( self ):
+        """ if read1 processing was started. If it completed, that implies it was started.
+        """
+        return self._exists( 'pipeline/read1.started' ) or self._exists( 'pipeline/read1.done' )
+
+    def _read1_done( self ):
+        return self._exists( 'pipeline/read1.done' )
+
+    def _was_finished( self ):
+        """ returns True if ALL lanes were marked as done [demultiplexing]
+            by comparing number of lanes with the number of lane?.done files
+        """
+        number_of_lanes = int( self.runinfo_xml.run_info[ 'LaneCount' ] )
+
+        return self._exists( 'pipeline/lane?.done' ) == number_of_lanes
+
+    def _was_demultiplexed( self ):
+        """ In contrast to the above, a run can be partially demultiplexed but ready for
+            QC nonetheless.
+            So return true if there is at least one .done file and no .started files/
+        """
+        return self._exists( 'pipeline/lane?.done' ) > 0 and self._exists( 'pipeline/lane?.started' ) == 0
+
+    def _qc_started( self ):
+        return self._exists( 'pipeline/qc.started' ) or self._exists( 'pipeline/qc.done' )
+
+    def _qc_done( self ):
+        return self._exists( 'pipeline/qc.done' )
+
+    def _was_aborted( self ):
+        """ if the processing was aborted, we have a single flag for the whole run
+        """
+        return self._exists( 'pipeline/aborted' )
+
+    def _was_failed( self ):
+        """ if the processing failed, we have a single flag for the whole run
+        """
+        # I think it also makes sense to have a single failed flag, but note that any
+        # lanes with status .done are still to be regarded as good. Ie. the interpretation
+        # of this flag is that any 'started' lane is reallY a 'failed' lane.
+        return self._exists( 'pipeline/failed' )
+
+    def _output_linked( self ):
+        """ Tests that the symlinks to fastqdata and back are in place
+        """
+        return self._exists( 'pipeline/output/seqdata/pipeline' )
+
+    def _was_ended( self ):
+        """ processing finished due to successful exit, or a failure, or was aborted
+            note that failed runs always need operator intervention, if only to say that
+            we will not process them further and flag them aborted
+        """
+        return self._qc_done() or self._was_aborted() or self._was_failed()
+
+    def get_machine_status( self ):
+        """ work out the status of a sequencer by checking the existence of various touchfiles found in the run folder.
+        """
+        if self.quick_mode:
+            return 'not_reported'
+
+        if self._is_sequencing_finished():
+            return "complete"
+        for n in range(len(self.trigger_cycles) - 2, 0 , -1):
+            if self._is_read_finished(n):
+                return f"read{n}_complete"
+        return "waiting_for_data"
+
+
+    def get_status( self ):
+        """ Work out the status of a run by checking the existence of various touchfiles
+            found in the run folder.
+            All possible values are listed in doc/qc_trigger.gv
+            Behaviour with the touchfiles in invalid states is undefined, but we'll always
+            report a valid status and in general, if in doubt, we'll report a status that
+            does not trigger an action.
+            ** This logic is convoluted. Before modifying anything, make a test that reflects
+               the change you want to see, then after making the change always run the tests.
+               Otherwise you will get bitten in the ass!
+        """
+
+        # 'new' takes precedence
+        if self._is_new_run():
+            return "new"
+
+        # RUN is 'aborted' if flagged as such. This implies there no processing running, but
+        # we can't check this directly. Maybe could add some indirect checks?
+        # Anyway, aborted trumps 'redo' and everything else.
+        if self._was_aborted():
+            # Aborted is a valid end state and takes precedence over 'failed'
+            return "aborted"
+
+        # RUN IS 'redo' if the run is marked for restarting and is ready for restarting (not running).
+        # If the _output_linked() test fails the run is not safe to redo, but let the driver worry about
+        # that!
+        # Ignore the read1 processing state here.
+        if ( self._is_sequencing_finished() and
+             self._was_restarted() and (
+                self._was_ended() or
+                (not self._was_started() and self._was_failed()) or
+                (self._was_demultiplexed() and not self._qc_started()) ) ):
+            if self._output_linked():
+                return "redo"
+            else:
+                return "redo" # or maybe unknown?
+
+        # We can't be failed until sequencing finishes, even though there could be
+        # failed flag present.
+        if self._is_sequencing_finished() and self._was_failed():
+            # But we might still be busy processing read 1
+            if self._read1_triggered() and not self._read1_done():
+                return "in_read1_qc"
+            else:
+                return "failed"
+
+        # If the run completed QC and was not aborted or restarted we're done, but because
+        # of the way the redo mechanism works it's possible for a run to fail then be partially
+        # re-done. That gives us the weird "partially_complete" state.
+        if self._qc_done():
+            if self._was_finished():
+                return "complete"
+            else:
+                return "partially_complete"
+
+        # If the RUN is 'in_qc' we want to leave it cooking
+        if self._qc_started() and (not self._qc_done()):
+            return "in_qc"
+
+        # 'read1_finished' status triggers the well dups scanner. We're currently triggering at the end of read 1 but this
+        # could change to the last index read, as controlled by the constructor above.
+        if self._is_read_finished(self.last_read1_read) or self._is_sequencing_finished():
+            if (not self._read1_triggered()):
+                # Triggering read1 processing takes precedence
+                return "read1_finished"
+            elif (not self._read1_done()) and (self._is_sequencing_finished()):
+                # Decide if demultiplexing needs to start, or is running, or has finished
+                if (self._was_finished()):
+                    return "in_read1_qc"
+                elif (self._was_started()):
+                    return "in_demultiplexing"
+                else:
+                    return "in_read1_qc_reads_finished"
+            elif (not self._read1_done()):
+                # well dupes is running and we're still waiting for data to do anything else
+                return "in_read1_qc"
+
+        # That should be all the Read1 states out of the way.
+        if self._was_demultiplexed():
+            return "demultiplexed"
+        elif self._was_started() and self._is_sequencing_finished():
+            return "in_demultiplexing"
+
+        # So that leaves us with a run that's either waiting for reads or is ready
+        # for demultiplexing.
+
+        # RUN IS 'reads_unfinished' if we're just waiting for data
+        if self._is_sequencing_finished():
+            return "reads_finished"
+        else:
+            return "reads_unfinished"
+
+    def get_dict(self):
+        """ Gets all the info that goes into the YAML as a dict.
+        """
+        pstatus = 'unknown'
+        try:
+            # Check for an 'aborted' file, since we want to recognise aborted runs no matter
+            # what else we see.
+            if self._was_aborted():
+                pstatus = 'aborted'
+
+            ri = self.runinfo_xml.run_info
+            res = dict( RunID = ri['RunId'],
+                        LaneCount = ri['LaneCount'],
+                        Instrument = ri['Instrument'],
+                        Flowcell = ri['Flowcell'],
+                        PipelineStatus = self.get_status(),
+                        MachineStatus = self.get_machine_status() )
+            if self.progress_mode:
+                res.update(self.get_cycle_progress().get_dict())
+                res.update(self.get_demux_progress())
+            if not self.quick_mode:
+                stalled_since = self.get_stalled_since(res['PipelineStatus'])
+                if stalled_since:
+                    res['StalledSince'] = datetime.fromtimestamp(stalled_since).isoformat(timespec='seconds')
+            return res
+        except Exception: # possible that the provided run folder was not a valid run folder e.g. did not contain a RunInfo.xml
+            if os.environ.get('DEBUG', '0') != '0': raise
+
+            return dict( RunID = 'unknown',
+                         LaneCount = 0,
+                         Instrument = 'unknown',
+                         Flowcell = 'unknown',
+                         PipelineStatus = pstatus,
+                         MachineStatus = 'unknown' )
+
+    def get_stalled_since(self, status=None):
+        """ If the run is in_demultiplexing or in_qc but nothing seems to have happened
+            for a while, returns the time of the last progress seen. See
+            illuminatus/StallDetector.py
+        """
+        return StallDetector( self.run_path_folder,
+                              status or self.get_status() ).get_stalled_since()
+
+    def get_demux_progress(self):
+        """ If bcl2fastq_progress.py has been run on the demultiplexing output, report
+            the percentage of reads done per lane and the ETA. Otherwise an empty dict.
+            This just reads the progress file. It doesn't look at the logs.
+        """
+        demux_dir = os.path.join(self.run_path_folder, 'pipeline', 'output', 'demultiplexing')
+        if not os.path.exists(os.path.join(demux_dir, PROGRESS_FILE)):
+            return dict()
+        return BCL2FASTQProgress(demux_dir, self.run_path_folder).get_summary()
+
+    def get_cycle_progress(self):
+        """ Gets a CycleProgress object to see how far along sequencing is in each lane.
+        """
+        return CycleProgress( self.run_path_folder,
+                              self.trigger_cycles[-1],
+                              self.runinfo_xml.run_info['LaneCount'] )
+
+    def get_yaml(self):
+        return dict_to_yaml(self.get_dict())
+
+class SavedInfo:
+    """ Stands in for a RunInfoXMLParser, with info saved from a previous
+        RunStatus.get_saved_info()
+    """
+    def __init__(self, saved_info):
+        self.run_info = saved_info['run_info']
+        self.read_and_length = saved_info['read_and_length']
+        self.read_and_indexed = saved_info['read_and_indexed']
+
+class QuickInfo:
+    """ Just get the instrument name out of the dir name.
+        Involves a little copy/paste from RunInfoXMLParser
+        We also need to know the number of lanes, in order to calculate "_was_finished",
+        which I think (!) we can reliably do with some heuristics on the flowcell ID.
+    """
+    def __init__(self, run_dir):
+
+        try:
+            runid = os.path.basename(run_dir).split('.')[0]
+            instr = runid.split('_')[1]
+        except Exception:
+            # Try a level up?
+            runid = os.path.basename(os.path.dirname(run_dir)).split('.')[0]
+            instr = runid.split('_')[1]
+
+        instr0 = instr[0]
+        for idmap in instrument_types.split():
+            if instr0 == idmap[0]:
+                instr = idmap[2:] + '_' + instr
+                break
+
+        # Guess the lane count without reading the XML
+        lane_count = 0
+        if instr0 in 'M':
+            lane_count = 1
+        elif instr0 in 'KE':
+            lane_count = 8
+        elif instr0 in 'D':
+            lane_count = 2 if runid.split('_')[3][1] == 'H' else 8
+        elif instr0 in 'A':
+            # DRX = S1, DMX = S2, DSX = S4
+            lane_count = 4 if runid.split('_')[3][6:9] in ['DSX'] else 2
+
+        # Assuming that the run id is the directory name is a little risky but fine for quick mode
+        self.run_info = dict( RunId=runid, LaneCount=lane_count, Instrument=instr, Flowcell='not_reported' )
+
+def dict_to_yaml( run_dict ):
+    """ The YAML we print is simple enough that we don't need the yaml module.
+    """
+    return '\n'.join( "{}: {}".format(k, v) for k, v in run_dict.items() )
+
+def get_status_dir( run_folder ):
+    """ The directory the status is actually read from. In the case where we're looking
+        at a fastqdata directory, examine the seqdata link.
+    """
+    if os.path.isdir(os.path.join(run_folder, 'seqdata', 'pipeline')):
+        return os.path.join(run_folder, 'seqdata')
+    return run_folder
+
+def get_run_dict( run_dir, opts = '', registry = None, timeline = None, record_states = False,
+                  save = True ):
+    """ Gets RunStatus(run_dir).get_dict() but consults the registry first, if one is
+        supplied. If the run is in a cold state (complete or aborted) and neither the
+        run directory nor the pipeline/ directory has changed since it was recorded,
+        the saved status is returned directly. Otherwise the status is worked out
+        afresh and saved. Registry errors are not fatal.
+        Progress info (opts 'p') is always worked out afresh, so the registry is not used.
+        If a registry is supplied, or record_states is set, then when the status changed
+        since we last looked a 'state' event is recorded in the run's timeline. If
+        timeline is set, the event goes into that central log too (see
+        illuminatus/RunTimeline.py). The last status is that of the last 'state' event in
+        pipeline/timeline.jsonl, or else the one saved in the registry, so runs with no
+        pipeline/ directory only get events if there is a registry.
+        With save=False the registry is only read, and nothing is saved or recorded at all.
+    """
+    if 'q' in opts:
+        return RunStatus(run_dir, opts).get_dict()
+    if 'p' in opts:
+        registry = None
+
+    run_id = os.path.basename(os.path.abspath(run_dir))
+    saved_info = None
+    saved_run = None
+    if registry:
+        record_states = save
+        try:
+            # For a fastqdata directory these are the mtimes of the seqdata directory
+            mtimes = registry.get_mtimes(get_status_dir(run_dir))
+            saved_run = registry.get_run(run_id)
+            if saved_run and saved_run['Status'].get('PipelineStatus') in COLD_STATES:
+                if saved_run['Mtimes'] == mtimes:
+                    return saved_run['Status']
+                # Else we need to re-evaluate the status but not re-read RunInfo.xml
+                saved_info = saved_run['RunInfo']
+        except Exception:
+            if os.environ.get('DEBUG', '0') != '0': raise
+            registry = None
+
+    run_status = RunStatus(run_dir, opts, saved_info)
+    res = run_status.get_dict()
+
+    # Only save or record runs that are properly named and where RunInfo.xml was read.
+    if not (run_status.runinfo_xml and res['RunID'] == run_id):
+        return res
+
+    if registry and save:
+        try:
+            registry.save_run( run_dir,
+                               run_status.get_saved_info(),
+                               dict(res, Mtimes=mtimes) )
+        except Exception:
+            if os.environ.get('DEBUG', '0') != '0': raise
+
+    # The timeline in pipeline/ says what status we last saw, or failing that the registry.
+    # With neither, there's no way to tell if the status changed so nothing is recorded.
+    if save and record_states and (registry or os.path.isdir(os.path.join(run_dir, 'pipeline'))):
+        old_status = last_state(run_dir) or (saved_run and saved_run['Status'].get('PipelineStatus'))
+        if old_status != res['PipelineStatus']:
+            record_event( run_dir,
+                          make_event(run_id, res['PipelineStatus'], 'state', previous=old_status),
+                          timeline )
+
+    return res
+
+def scan_all_runs( seqdata_dir, opts = '', run_name_regex = None, registry = None, timeline = None,
+                   record_states = False ):
+    """ Yields a dict of info for every run directory in seqdata_dir, as
+        RunStatus.get_dict() plus the RunDir.
+        The top level directory is listed just once with os.scandir(), and each
+        pipeline/ directory likewise, so the number of filesystem calls per run is
+        kept to a minimum.
+        If run_name_regex is supplied, directories with non-matching names are skipped,
+        just as driver.sh does with RUN_NAME_REGEX.
+        For the registry, timeline and record_states, see get_run_dict()
+    """
+    if run_name_regex:
+        run_name_regex = re.compile(run_name_regex)
+
+    with os.scandir(seqdata_dir) as sdi:
+        run_dirs = sorted( de.name for de in sdi if de.is_dir() )
+
+    for run_dir in run_dirs:
+        if run_name_regex and not run_name_regex.fullmatch(run_dir):
+            continue
+
+        run_path = os.path.join(seqdata_dir, run_dir)
+        res = dict(RunDir = run_path)
+        res.update(get_run_dict(run_path, opts, registry, timeline, record_states))
+
+        yield res
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""A timeline of events for each run, so we can see where the time goes.
+   Events are single lines of JSON, appended to pipeline/timeline.jsonl in the
+   run directory and also to a central log (TIMELINE_LOG, set by driver.sh) which
+   covers all runs. Each event has:
+     time  - UNIX time in seconds
+     host  - where the event was recorded
+     run   - the run ID
+     lane  - the lane number, or null if the event is for the whole run
+     stage - a run status, as given by RunStatus.get_status()
+     event - 'state' when a run is first seen in a new status, 'action_start' and
+             'action_end' around the actions in driver.sh
+   driver.sh writes events directly with printf, so if you add fields here then
+   keep that in step.
+"""
+import os
+import json
+import socket
+import time
+from collections import OrderedDict
+
+# The usual progression of a run through the pipeline. Other states will be
+# reported after these.
+STATE_ORDER = [ 'new', 'reads_unfinished', 'read1_finished', 'in_read1_qc', 'in_read1_qc_reads_finished',
+                'reads_finished', 'in_demultiplexing', 'demultiplexed', 'in_qc', 'complete' ]
+
+def make_event( run , stage , event , lane = None , when = None , **extra ):
+    ev = OrderedDict([ ('time', int(time.time() if when is None else when)),
+                       ('host', socket.gethostname()),
+                       ('run', run),
+                       ('lane', lane),
+                       ('stage', stage),
+                       ('event', event) ])
+    ev.update(extra)
+    return ev
+
+def append_event( events_file , ev ):
+    """ Add an event to the file. Opening in append mode and writing the line
+        in one go means that several writers can share a file on a local disk.
+    """
+    line = (json.dumps(ev) + '\n').encode()
+    fd = os.open(events_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def record_event( run_dir , ev , central_log = None ):
+    """ Save the event in the run's pipeline/ directory, if there is one, and in the
+        central log, if there is one. Failure to write is not fatal, since the
+        timeline is only for information.
+    """
+    targets = [ os.path.join(run_dir, 'pipeline', 'timeline.jsonl') ]
+    if central_log:
+        targets.append(central_log)
+
+    for t in targets:
+        try:
+            append_event(t, ev)
+        except OSError:
+            if os.environ.get('DEBUG', '0') != '0': raise
+
+def last_state( run_dir ):
+    """ The stage of the last whole-run 'state' event in the run's pipeline/timeline.jsonl,
+        or None if there is no such event.
+    """
+    res = None
+    try:
+        with open(os.path.join(run_dir, 'pipeline', 'timeline.jsonl')) as efh:
+            for l in efh:
+                # Quick check before parsing the JSON
+                if '"state"' not in l:
+                    continue
+                try:
+                    ev = json.loads(l)
+                except ValueError:
+                    continue
+                if ev.get('event') == 'state' and ev.get('lane') is None:
+                    res = ev.get('stage')
+    except OSError:
+        pass
+    return res
+
+def load_events( *events_files ):
+    """ Read all the events from the files, sorted by time. Lines that are not
+        valid JSON (eg. truncated by a crash) are skipped.
+    """
+    res = []
+    for ef in events_files:
+        with open(ef) as efh:
+            for l in efh:
+                try:
+                    ev = json.loads(l)
+                    ev['time'] = int(ev['time'])
+                    res.append(ev)
+                except (ValueError, KeyError, TypeError):
+                    continue
+    res.sort(key=lambda e: e['time'])
+    return res
+
+def get_state_spans( events ):
+    """ Given a list of events sorted by time, work out the time spent in each state
+        by each run. Returns a dict of { run: [ (stage, start, end) ] } where end is
+        None if the run is still in that state.
+    """
+    res = OrderedDict()
+    for ev in events:
+        if ev.get('event') != 'state' or ev.get('lane') is not None:
+            continue
+        spans = res.setdefault(ev['run'], [])
+
+        # The same state could be recorded twice, eg. by two driver hosts
+        if spans and spans[-1][0] == ev['stage']:
+            continue
+        if spans:
+            spans[-1] = (spans[-1][0], spans[-1][1], ev['time'])
+        spans.append((ev['stage'], ev['time'], None))
+
+    return res
+
+def get_action_spans( events ):
+    """ Match up action_start and action_end events, returning a dict of
+        { run: [ (stage, start, end, status) ] }. Actions with no end are
+        not reported.
+    """
+    res = OrderedDict()
+    started = dict()
+    for ev in events:
+        key = (ev['run'], ev.get('stage'), ev.get('host'), ev.get('pid'))
+        if ev.get('event') == 'action_start':
+            started[key] = ev['time']
+        elif ev.get('event') == 'action_end' and key in started:
+            res.setdefault(ev['run'], []).append( (ev['stage'], started.pop(key), ev['time'], ev.get('status')) )
+
+    return res
+
+def summarize_spans( spans ):
+    """ Given the output of get_state_spans() or get_action_spans(), gives some stats
+        on the time in each stage over all the runs, in seconds.
+        Returns a dict of { stage: dict(count, total, mean, median, p90, max) } in the
+        order of STATE_ORDER.
+    """
+    durations = dict()
+    for run_spans in spans.values():
+        for span in run_spans:
+            stage, start, end = span[:3]
+            if end is not None:
+                durations.setdefault(stage, []).append(end - start)
+
+    def _order(stage):
+        try:
+            return (STATE_ORDER.index(stage), stage)
+        except ValueError:
+            return (len(STATE_ORDER), stage)
+
+    res = OrderedDict()
+    for stage in sorted(durations, key=_order):
+        d = sorted(durations[stage])
+        res[stage] = dict( count = len(d),
+                           total = sum(d),
+                           mean = sum(d) / len(d),
+                           median = d[len(d) // 2],
+                           p90 = d[min(len(d) - 1, int(len(d) * 0.9))],
+                           max = d[-1] )
+    return res
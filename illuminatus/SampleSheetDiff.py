@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""Compares two sample sheets to see which lanes would actually demultiplex differently,
+   as opposed to a plain diff which picks up reordered rows, whitespace and changes to
+   the header or the descriptions.
+
+   For each lane we compare the samples, where a sample is the ID, name, project and
+   the index sequences, since these determine what bcl2fastq outputs. Options in the
+   [bcl2fastq] section apply to all lanes unless they end with -laneN, and anything in
+   [Settings] applies to all lanes.
+
+   The result is a dict of { lane: changes } for the lanes that differ, where changes
+   is a dict with lists of the samples added, removed and changed, plus any settings
+   that changed.
+"""
+import re
+from collections import Counter
+
+from illuminatus.SampleSheetReader import SampleSheetReader
+
+# Old-style sheets use different names for some columns
+COLUMN_ALIASES = dict( sample_id      = ['sample_id', 'sampleid'],
+                       sample_name    = ['sample_name'],
+                       sample_project = ['sample_project', 'sampleproject'] )
+
+def _get_column( ssr , row , column ):
+    for c in COLUMN_ALIASES[column]:
+        if c in ssr.column_mapping:
+            return ssr._get_column_from_data_row(row, ssr.column_mapping, c).strip()
+    return ''
+
+def lane_samples( ssr ):
+    """ Get { lane: Counter((sample_id, sample_name, project, index1, index2)) }
+        from a SampleSheetReader. A Counter is used in case any line is repeated.
+    """
+    res = dict()
+    for r in ssr.rows:
+        sample = ( _get_column(ssr, r.row, 'sample_id'),
+                   _get_column(ssr, r.row, 'sample_name'),
+                   _get_column(ssr, r.row, 'sample_project'),
+                   r.index1.strip().upper(),
+                   r.index2.strip().upper() )
+        res.setdefault(r.lane.strip(), Counter())[sample] += 1
+    return res
+
+def sheet_settings( samplesheet_file ):
+    """ Get the settings from the [bcl2fastq] and [Settings] sections as a dict of
+        { lane: { (section, key): value } } where lane is None for settings that
+        apply to all lanes.
+    """
+    res = dict()
+    section = None
+    with open(samplesheet_file) as ssfh:
+        for l in ssfh:
+            l = l.strip().rstrip(',')
+            if not l or l.startswith('#'):
+                continue
+            if l.startswith('['):
+                section = l.lower().strip('[]')
+                continue
+
+            if section == 'bcl2fastq':
+                # As with bcl2fastq_setup.py, any of ':', '=' or ' ' may separate the value
+                key, value = [ x.strip() for x in (re.split(r'[:= ]', l, 1) + [''])[:2] ]
+                mo = re.match(r'(.*)-lane([1-8])$', key)
+                lane = mo.group(2) if mo else None
+                res.setdefault(lane, dict())[(section, mo.group(1) if mo else key)] = value
+            elif section == 'settings':
+                key, _, value = l.partition(',')
+                res.setdefault(None, dict())[(section, key.strip())] = value.strip()
+    return res
+
+def _sample_label( sample ):
+    return sample[0] or '-'.join(i for i in sample[3:] if i) or '[no index]'
+
+def diff_samplesheets( old_file , new_file ):
+    """ Compare two sample sheets and return a dict of { lane: changes } for every lane
+        where the samples or settings differ. changes is a dict with the keys:
+          added, removed, changed - lists of sample IDs (or indexes if there is no ID)
+          settings                - list of setting names that changed
+        Lanes are strings, as in SampleSheetReader. Exceptions from SampleSheetReader
+        will propagate if either sheet is unreadable.
+    """
+    old_ssr, new_ssr = SampleSheetReader(old_file), SampleSheetReader(new_file)
+    old_samples, new_samples = lane_samples(old_ssr), lane_samples(new_ssr)
+    old_settings, new_settings = sheet_settings(old_file), sheet_settings(new_file)
+
+    all_lanes = sorted( set(old_samples) | set(new_samples),
+                        key = lambda l: int(l) if l.isdigit() else 0 )
+
+    def _settings_diff(lane):
+        old, new = old_settings.get(lane, {}), new_settings.get(lane, {})
+        return [ k for k in sorted(set(old) | set(new)) if old.get(k) != new.get(k) ]
+    global_settings = _settings_diff(None)
+
+    res = dict()
+    for lane in all_lanes:
+        old, new = old_samples.get(lane, Counter()), new_samples.get(lane, Counter())
+        removed = set( _sample_label(s) for s in (old - new) )
+        added   = set( _sample_label(s) for s in (new - old) )
+        settings = global_settings + _settings_diff(lane)
+
+        if added or removed or settings:
+            res[lane] = dict( added    = sorted(added - removed),
+                              removed  = sorted(removed - added),
+                              changed  = sorted(added & removed),
+                              settings = [ "[{}] {}".format(*k) for k in settings ] )
+    return res
+
+def describe_changes( changes , max_samples = 5 ):
+    """ Summarise the changes for one lane in a line of text
+    """
+    parts = []
+    for k in ['added', 'removed', 'changed']:
+        if changes[k]:
+            samples = changes[k][:max_samples] + (['...'] if len(changes[k]) > max_samples else [])
+            parts.append( "{} {} ({})".format(k, len(changes[k]), ' '.join(samples)) )
+    if changes['settings']:
+        parts.append( "settings ({})".format(', '.join(changes['settings'])) )
+    return '; '.join(parts)
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.SampleSheetDiff old.csv new.csv
+    """
+    import sys
+    for lane, changes in diff_samplesheets(sys.argv[1], sys.argv[2]).items():
+        print("Lane {}: {}".format(lane, describe_changes(changes)))
+
+if __name__ == '__main__':
+    main()
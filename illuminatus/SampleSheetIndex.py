@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""An index of the sample sheets under SAMPLESHEETS_ROOT, by flowcell ID, kept in an
+   SQLite database like the RunRegistry.
+   The LIMS writes sheets named like SAMPLESHEETS_ROOT/2023/7/foo_HXXXXDRXY.csv and
+   the tree covers many years, so rather than walking all of it for every lookup we
+   remember the modification time of every directory and only list the directories
+   that have changed. A sheet that is re-written in place does not change the mtime
+   of its directory, so directories that were modified in the last RESCAN_DAYS days
+   (ie. the current month) are listed every time anyway. Older sheets that are re-written
+   in place are only noticed by check_sheets(), when they are looked up by flowcell or
+   when get_recent() is called.
+   For each sheet we keep the mtime, size and MD5 of the contents. The MD5 is only
+   re-calculated if the mtime or size changes.
+   As with the registry, this is only a cache. Deleting the file is harmless.
+"""
+import os
+import time
+import hashlib
+import sqlite3
+
+# Directories modified within this many days are always re-listed
+RESCAN_DAYS = 7
+
+def flowcell_of( filename ):
+    """ Sample sheets are named like 'foo_HXXXXDRXY.csv' and the flowcell ID is the bit after
+        the last underscore. Returns the ID in upper case, or None if the name is not like
+        this.
+    """
+    stem, ext = os.path.splitext(filename)
+    if ext != '.csv' or '_' not in stem:
+        return None
+    return stem.rsplit('_', 1)[1].upper() or None
+
+def md5sum( filename ):
+    h = hashlib.md5()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class SampleSheetIndex:
+
+    def __init__( self , db_file , samplesheets_root ):
+        """Open (and if need be create) the index. If the index was made for a different
+           SAMPLESHEETS_ROOT it will be emptied.
+        """
+        self.db_file = db_file
+        self.root = os.path.abspath(samplesheets_root)
+
+        # Several processes may refresh the index at once. SQLite will do the locking
+        # but we want to wait a while rather than fail immediately.
+        self.conn = sqlite3.connect(db_file, timeout=30)
+        with self.conn:
+            # Paths in both tables are relative to the root
+            self.conn.execute( """CREATE TABLE IF NOT EXISTS dirs (
+                                    path TEXT PRIMARY KEY,
+                                    parent TEXT,
+                                    mtime INTEGER )""" )
+            self.conn.execute( """CREATE TABLE IF NOT EXISTS sheets (
+                                    path TEXT PRIMARY KEY,
+                                    dir TEXT,
+                                    flowcell TEXT,
+                                    mtime INTEGER,
+                                    size INTEGER,
+                                    md5 TEXT )""" )
+            self.conn.execute( "CREATE INDEX IF NOT EXISTS sheets_flowcell ON sheets (flowcell)" )
+            self.conn.execute( "CREATE INDEX IF NOT EXISTS sheets_mtime ON sheets (mtime)" )
+            self.conn.execute( """CREATE TABLE IF NOT EXISTS meta (
+                                    key TEXT PRIMARY KEY,
+                                    value TEXT )""" )
+
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+            if not row or row[0] != self.root:
+                self.conn.execute("DELETE FROM dirs")
+                self.conn.execute("DELETE FROM sheets")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)", (self.root,))
+
+    def close(self):
+        self.conn.close()
+
+    def refresh( self , now = None ):
+        """Bring the index up to date. Returns a dict with the number of directories
+           listed and the number of sheets (re-)hashed, which should normally both be small.
+        """
+        now = now or time.time()
+        stats = dict( dirs_listed = 0,
+                      sheets_hashed = 0 )
+
+        with self.conn:
+            known_dirs = dict(self.conn.execute("SELECT path, mtime FROM dirs"))
+            seen_dirs = set()
+
+            self._refresh_dir('', None, known_dirs, seen_dirs, now - RESCAN_DAYS * 86400, stats)
+
+            # Forget any directories that went away
+            for gone in set(known_dirs) - seen_dirs:
+                self.conn.execute("DELETE FROM dirs WHERE path = ?", (gone,))
+                self.conn.execute("DELETE FROM sheets WHERE dir = ?", (gone,))
+
+        return stats
+
+    def _refresh_dir( self , rel_dir , parent , known_dirs , seen_dirs , recent , stats ):
+        full_dir = os.path.join(self.root, rel_dir)
+        try:
+            st = os.stat(full_dir)
+        except OSError:
+            return
+        seen_dirs.add(rel_dir)
+
+        if known_dirs.get(rel_dir) == st.st_mtime_ns and st.st_mtime < recent:
+            # Nothing added or removed, so the subdirectories are as we saw them last time
+            subdirs = [ r[0] for r in
+                        self.conn.execute("SELECT path FROM dirs WHERE parent = ?", (rel_dir,)) ]
+        else:
+            subdirs = []
+            sheets = {}
+            try:
+                with os.scandir(full_dir) as sdi:
+                    for de in sdi:
+                        if de.is_dir():
+                            subdirs.append(os.path.join(rel_dir, de.name))
+                        elif flowcell_of(de.name) and de.is_file():
+                            sheets[de.name] = de.stat()
+                dir_mtime = st.st_mtime_ns
+            except OSError:
+                # Try again next time
+                dir_mtime = 0
+            stats['dirs_listed'] += 1
+
+            self._update_sheets(rel_dir, sheets, stats)
+            self.conn.execute( "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                               (rel_dir, parent, dir_mtime) )
+
+        for sd in subdirs:
+            self._refresh_dir(sd, rel_dir, known_dirs, seen_dirs, recent, stats)
+
+    def _update_sheets( self , rel_dir , sheets , stats ):
+        """Sync the sheets table with what we found in rel_dir
+        """
+        old_sheets = { os.path.basename(r[0]): r[1:] for r in
+                       self.conn.execute( "SELECT path, mtime, size FROM sheets WHERE dir = ?",
+                                          (rel_dir,) ) }
+
+        for name in set(old_sheets) - set(sheets):
+            self.conn.execute("DELETE FROM sheets WHERE path = ?", (os.path.join(rel_dir, name),))
+
+        for name, st in sheets.items():
+            if old_sheets.get(name) == (st.st_mtime_ns, st.st_size):
+                continue
+            self._index_sheet(rel_dir, name, st, stats)
+
+    def _index_sheet( self , rel_dir , name , st , stats ):
+        """Hash one sheet and save it in the sheets table
+        """
+        rel_path = os.path.join(rel_dir, name)
+        try:
+            md5 = md5sum(os.path.join(self.root, rel_path))
+        except OSError:
+            return
+        stats['sheets_hashed'] += 1
+        self.conn.execute( "INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?, ?, ?)",
+                           (rel_path, rel_dir, flowcell_of(name), st.st_mtime_ns, st.st_size, md5) )
+
+    def check_sheets( self , flowcell = None ):
+        """Check that the sheets for this flowcell (or all the sheets, if flowcell is None)
+           have not changed since they were indexed, as happens if a sheet in an old
+           directory is re-written in place, and update any that have. Returns the number
+           of sheets that had changed. If this is not 0, the caller may not want to trust
+           the index.
+        """
+        stats = dict( sheets_hashed = 0 )
+        changed = 0
+        with self.conn:
+            if flowcell is None:
+                rows = self.conn.execute( "SELECT path, dir, mtime, size FROM sheets" ).fetchall()
+            else:
+                rows = self.conn.execute( "SELECT path, dir, mtime, size FROM sheets WHERE flowcell = ?",
+                                          (flowcell.upper(),) ).fetchall()
+            for rel_path, rel_dir, mtime, size in rows:
+                try:
+                    st = os.stat(os.path.join(self.root, rel_path))
+                except OSError:
+                    st = None
+                if st and (st.st_mtime_ns, st.st_size) == (mtime, size):
+                    continue
+                changed += 1
+                if st:
+                    self._index_sheet(rel_dir, os.path.basename(rel_path), st, stats)
+                else:
+                    self.conn.execute("DELETE FROM sheets WHERE path = ?", (rel_path,))
+        return changed
+
+    def _sheet_dicts( self , rows ):
+        return [ dict( path = os.path.join(self.root, path),
+                       flowcell = flowcell,
+                       mtime = mtime // 1000000000,
+                       md5 = md5 )
+                 for path, flowcell, mtime, md5 in rows ]
+
+    def get_sheets( self , flowcell ):
+        """Get all the sheets for this flowcell, oldest first, as a list of dicts with
+           path, flowcell, mtime (in whole seconds) and md5.
+        """
+        return self._sheet_dicts(self.conn.execute(
+                    "SELECT path, flowcell, mtime, md5 FROM sheets WHERE flowcell = ?"
+                    " ORDER BY mtime, path", (flowcell.upper(),) ))
+
+    def get_latest( self , flowcell ):
+        """Get the newest sheet for this flowcell, or None.
+        """
+        sheets = self.get_sheets(flowcell)
+        return sheets[-1] if sheets else None
+
+    def get_recent( self , since ):
+        """Get all the sheets modified since the given UNIX time, ordered by path.
+           A sheet re-written in place in a directory that has been quiet for more than
+           RESCAN_DAYS is not seen by refresh(), so first we stat every sheet in the index.
+           This is one stat per sheet, which is still much less work than walking the tree.
+        """
+        self.check_sheets()
+        return self._sheet_dicts(self.conn.execute(
+                    "SELECT path, flowcell, mtime, md5 FROM sheets WHERE mtime >= ?"
+                    " ORDER BY path", (int(since * 1000000000),) ))
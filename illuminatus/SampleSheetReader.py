@@ -1,16 +1,84 @@
 #!/usr/bin/env python3
 
+"""Reads the SampleSheet.csv for a run.
+   The same sheet is read by several scripts in each pass of the pipeline (and by
+   bcl2fastq_setup.py once per lane) so get_samplesheet_reader() keeps the parsed
+   sheet in pipeline/samplesheet_cache.json in the run directory. The cache is keyed
+   on the MD5 of the sheet contents, so when samplesheet_fetch.sh re-links
+   SampleSheet.csv to a new sheet the old cache is simply ignored and overwritten.
+"""
 import logging as L
 import csv, sys, os
+import io
+import json
+import hashlib
 from itertools import zip_longest
 
 from .SampleSheetClass import SampleSheet
 
+# Relative to the directory containing the sheet
+CACHE_FILE = 'pipeline/samplesheet_cache.json'
+# Bump this if the reader changes in a way that makes old cache files wrong
+CACHE_VERSION = 2
+
+def get_samplesheet_reader( samplesheet_file , use_cache = True ):
+    """ Get a SampleSheetReader for samplesheet_file, loading it from the cache file
+        if the sheet content is unchanged since it was saved, or else parsing the sheet
+        and saving the cache. If there is no pipeline directory next to the sheet,
+        or the cache can't be written, you just get a fresh SampleSheetReader.
+    """
+    # Read the sheet just once, so the MD5 we save always matches what we parsed,
+    # even if the link is changed under our feet.
+    with open(samplesheet_file, 'rb') as ssfh:
+        content = ssfh.read()
+    md5 = hashlib.md5(content).hexdigest()
+
+    cache_file = os.path.join(os.path.dirname(samplesheet_file), CACHE_FILE)
+    if not (use_cache and os.path.isdir(os.path.dirname(cache_file))):
+        return SampleSheetReader( samplesheet_file, content=content )
+
+    try:
+        with open(cache_file) as cfh:
+            cached = json.load(cfh)
+        if cached.get('version') == CACHE_VERSION and cached.get('md5') == md5:
+            L.debug("Loaded {} from {}".format(samplesheet_file, cache_file))
+            return SampleSheetReader.from_cache( cached )
+    except (OSError, ValueError, KeyError, TypeError):
+        # Missing or broken. We'll replace it.
+        pass
+
+    ssr = SampleSheetReader( samplesheet_file, content=content )
+    try:
+        tmp_file = "{}.tmp.{}".format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as cfh:
+            json.dump(ssr.to_cache(md5), cfh)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        L.warning("Unable to save {}: {}".format(cache_file, e))
+    return ssr
+
+class SampleSheetRow:
+    """ One line from the [Data] section, with the columns we use most picked out.
+        The raw CSV row is kept as .row in case you need anything else.
+        Pool and library are combined in the Sample_ID as POOL__LIB, so these are split
+        out. If there is no '__' the pool is ''.
+    """
+    __slots__ = ('lane', 'sample_id', 'sample_project', 'pool', 'library', 'index1', 'index2', 'row')
+
+    def __init__( self , **kwargs ):
+        for k in self.__slots__:
+            setattr(self, k, kwargs[k])
+
+    def __repr__( self ):
+        return "SampleSheetRow({})".format(', '.join( "{}={!r}".format(k, getattr(self, k))
+                                                      for k in self.__slots__ if k != 'row' ))
+
 class SampleSheetReader:
 
-    def __init__( self , SampleSheetFile ):
+    def __init__( self , SampleSheetFile , content = None ):
         # sets self.headers, self.column_mapping, self.samplesheet_data
-        self._get_lines_from_ssfile( SampleSheetFile )
+        # If content is supplied (as bytes) it is used in place of reading the file.
+        self._get_lines_from_ssfile( SampleSheetFile , content )
         '''
          e.g.:
         self.column_mapping =
@@ -29,6 +97,86 @@ class SampleSheetReader:
         '''
         self.samplesheet = SampleSheet()
 
+        # sets self.rows and the indexes used by get_rows() etc.
+        self._build_indexes()
+
+    @classmethod
+    def from_cache( cls , cached ):
+        """ Make a reader from the dict saved by to_cache(), without looking at the
+            sample sheet at all.
+        """
+        self = cls.__new__(cls)
+        self.headers = cached['headers']
+        self.column_mapping = cached['column_mapping']
+        self.samplesheet_data = cached['samplesheet_data']
+        self.samplesheet = SampleSheet()
+        self._build_indexes( cached['rows'] )
+        return self
+
+    def to_cache( self , md5 ):
+        """ Get everything we worked out from the sheet as a dict that can be saved
+            as JSON.
+        """
+        return dict( version = CACHE_VERSION,
+                     md5 = md5,
+                     headers = self.headers,
+                     column_mapping = self.column_mapping,
+                     samplesheet_data = self.samplesheet_data,
+                     rows = [ [ getattr(r, k) for k in SampleSheetRow.__slots__ if k != 'row' ]
+                              for r in self.rows ] )
+
+    def _build_indexes(self, cached_rows=None):
+        """ Go through the data just once and make a SampleSheetRow for each line, then
+            index these by lane, project, pool and index sequences. Also work out
+            the index lengths for each lane, since everyone wants those.
+            If cached_rows is given (see to_cache()) the row values are taken from
+            there rather than worked out again from the raw CSV rows, which are still
+            attached to each SampleSheetRow as .row.
+        """
+        cm = self.column_mapping
+        self.rows = []
+        self.rows_by_lane = {}
+        self.rows_by_project = {}
+        self.rows_by_pool = {}
+        self.rows_by_index = {}
+        self.index_lengths_by_lane = {}
+
+        if cached_rows is not None and len(cached_rows) != len(self.samplesheet_data):
+            raise ValueError("Cached rows do not match the sample sheet data")
+        row_fields = [ k for k in SampleSheetRow.__slots__ if k != 'row' ]
+
+        for n, row in enumerate(self.samplesheet_data):
+            if cached_rows is not None:
+                r = SampleSheetRow( row = row, **dict(zip(row_fields, cached_rows[n])) )
+            else:
+                sample_id = self._get_column_from_data_row( row , cm , 'sample_id' )
+                pool, _, library = sample_id.rpartition('__')
+                index1, index2 = self._get_index_sequences_from_data_row( row , cm )
+
+                r = SampleSheetRow( lane = self._get_lane_from_data_row( row , cm ),
+                                    sample_id = sample_id,
+                                    sample_project = self._get_column_from_data_row( row , cm , 'sample_project' ),
+                                    pool = pool,
+                                    library = library,
+                                    index1 = index1,
+                                    index2 = index2,
+                                    row = row )
+            self._add_row(r)
+
+            # What if the indexes are different lengths? This should not happen, but logically
+            # we have to return the max values, I think...
+            self.index_lengths_by_lane[ r.lane ] = [ max(i) for i in zip_longest(
+                                    self.index_lengths_by_lane.get(r.lane, []),
+                                    [ len(r.index1), len(r.index2) ],
+                                    fillvalue = 0 ) ]
+
+    def _add_row(self, r):
+        self.rows.append(r)
+        self.rows_by_lane.setdefault(r.lane, []).append(r)
+        self.rows_by_project.setdefault(r.sample_project, []).append(r)
+        self.rows_by_pool.setdefault(r.pool, []).append(r)
+        self.rows_by_index.setdefault((r.index1, r.index2), []).append(r)
+
     def get_index_lengths_by_lane(self):
         '''
         Was get_samplesheet_data_for_BaseMaskExtractor
@@ -36,25 +184,69 @@ class SampleSheetReader:
         will return
         { "lane_number" : [ index1length , index2length ] }
 
+        This is worked out when the sheet is loaded, so calling it is cheap.
         '''
-        lane_number_index_length = {}
+        return { lane: list(lengths) for lane, lengths in self.index_lengths_by_lane.items() }
 
-        for row in self.samplesheet_data:
-            lane = self._get_lane_from_data_row( row , self.column_mapping )
-            index_sequences = self._get_index_sequences_from_data_row( row , self.column_mapping )
+    def get_index_length_groups_by_lane(self):
+        '''
+        Unlike get_index_lengths_by_lane() this does not take the max, but returns
+        all the distinct pairs of lengths in each lane, longest first.
 
-            # What if the indexes are different lengths? This should not happen, but logically
-            # we have to return the max values, I think...
-            lane_number_index_length[ lane ] = [ max(i) for i in zip_longest(
-                                    lane_number_index_length.get(lane, []),
-                                    [ len(i) for i in index_sequences ],
-                                    fillvalue = 0 ) ]
+        will return
+        { "lane_number" : [ [ index1length , index2length ] , ... ] }
 
-        return lane_number_index_length
+        So a lane with only one length of index has a single group.
+        '''
+        res = {}
+        for lane, rows in self.rows_by_lane.items():
+            groups = set( (len(r.index1), len(r.index2)) for r in rows )
+            res[lane] = [ list(g) for g in sorted(groups, key=lambda g: (-sum(g), -g[0])) ]
+        return res
 
-    def _get_lines_from_ssfile( self , SampleSheetFile ):
+    def get_lanes(self):
+        """ All the lanes in the sheet, in order, as strings. If there is no Lane column
+            this will just be ['1'].
+        """
+        return sorted(self.rows_by_lane, key=lambda l: int(l) if l.isdigit() else 0)
+
+    def get_projects(self):
+        """ All the projects in the sheet, in order of first appearance.
+            Raises KeyError if there is no Sample_Project column.
+        """
+        if 'sample_project' not in self.column_mapping:
+            raise KeyError('sample_project')
+        return list(self.rows_by_project)
+
+    def get_rows(self, lane=None, project=None, pool=None):
+        """ Get the SampleSheetRow objects for the given lane and/or project and/or pool,
+            in the order they appear in the sheet. With no arguments, gets all the rows.
+        """
+        candidates = [ idx.get(k, []) for idx, k in [ (self.rows_by_lane, lane),
+                                                      (self.rows_by_project, project),
+                                                      (self.rows_by_pool, pool) ]
+                       if k is not None ]
+        if not candidates:
+            return list(self.rows)
+
+        # Start from the smallest list and filter it by the others
+        candidates.sort(key=len)
+        res = candidates[0]
+        for other in candidates[1:]:
+            other_ids = set(map(id, other))
+            res = [ r for r in res if id(r) in other_ids ]
+        return list(res)
+
+    def get_rows_by_index(self, index1, index2=''):
+        """ Get the rows using this pair of indexes, with any trailing N's removed as
+            in get_index_lengths_by_lane().
+        """
+        return list(self.rows_by_index.get((index1, index2), []))
+
+    def _get_lines_from_ssfile( self , SampleSheetFile , content = None ):
         csvFile = SampleSheetFile
-        with open(csvFile, newline='') as csvFH:
+        with ( open(csvFile, newline='') if content is None
+               else io.StringIO(content.decode(), newline='') ) as csvFH:
             csvData = csv.reader(csvFH, delimiter=',')
             self.column_mapping = None
             in_section = None
@@ -101,6 +293,15 @@ class SampleSheetReader:
             lane_number = "1" # default
         return lane_number
 
+    def _get_column_from_data_row( self , row , column_header_mapping , column ):
+        '''
+        Get the value from any column, or '' if the column is missing.
+        '''
+        try:
+            return row[ column_header_mapping[column] ]
+        except (KeyError, IndexError):
+            return ""
+
     def _get_index_sequences_from_data_row( self , row , column_header_mapping ):
         '''
         The function will extract and return the index-sequences contained in the provided samplesheet row.
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""Looks for signs of life from runs that are in_demultiplexing or in_qc, so that
+   a hung bcl2fastq or a lost SLURM job does not go unnoticed.
+   We don't check that the processes are running (they may be on another host or
+   on the cluster) but rather when something last changed in the output directory:
+     - the start time of the stage, from the pipeline/lane?.started or qc.started files
+     - demultiplexing/lane*/bcl2fastq.log, which grows as bcl2fastq works (or the logs
+       in lane*/shard* and lane*/group* if the lane is split)
+     - any directory under demultiplexing/lane* or QC/, which changes when files are added
+     - the FASTQ files under demultiplexing/lane*, since once bcl2fastq has made all the
+       files it just writes to them, and the log goes quiet
+     - the .snakemake/ metadata and logs, which change as each Snakemake job completes
+   If none of these has changed for longer than the threshold for the stage, the run
+   is regarded as stalled.
+   The pipeline/demux.lease and pipeline/qc.lease files are deliberately not counted,
+   since the driver keeps renewing them while it waits on a hung job. A driver that has
+   died is picked up by check_lease in driver.sh instead.
+   Thresholds may be set in hours via STALL_HOURS_DEMUX and STALL_HOURS_QC.
+"""
+import os
+import time
+from glob import glob
+
+DEFAULT_STALL_HOURS = dict( in_demultiplexing = 4,
+                            in_qc = 8 )
+
+# Which environment variable overrides the threshold for each stage
+STALL_HOURS_ENV = dict( in_demultiplexing = 'STALL_HOURS_DEMUX',
+                        in_qc = 'STALL_HOURS_QC' )
+
+def get_stall_hours( stage ):
+    """ Gets the threshold for this stage, or None if we don't look for stalls in this
+        stage. Setting the threshold to 0 disables the check.
+    """
+    if stage not in DEFAULT_STALL_HOURS:
+        return None
+    hours = float(os.environ.get(STALL_HOURS_ENV[stage]) or DEFAULT_STALL_HOURS[stage])
+    return hours or None
+
+class StallDetector:
+
+    def __init__( self , run_dir , stage ):
+        self.run_dir = run_dir
+        self.stage = stage
+        self.output_dir = os.path.join(run_dir, 'pipeline', 'output')
+
+    def _latest_mtime( self , paths ):
+        """ Max mtime of all the paths that exist, or 0
+        """
+        res = 0
+        for p in paths:
+            try:
+                res = max(res, os.stat(p).st_mtime)
+            except OSError:
+                pass
+        return res
+
+    def _dirs_under( self , top_dir , file_suffix = None ):
+        """ Yields top_dir and all the directories below it. We only look at directories
+            because adding a file changes the mtime of the directory, so there's no need to
+            stat every file. But files that end with file_suffix are yielded too, if
+            writing to them counts as progress.
+        """
+        try:
+            with os.scandir(top_dir) as sdi:
+                subdirs = []
+                for de in sdi:
+                    if de.is_dir(follow_symlinks=False):
+                        subdirs.append(de.path)
+                    elif file_suffix and de.name.endswith(file_suffix):
+                        yield de.path
+        except OSError:
+            return
+        yield top_dir
+        for d in subdirs:
+            yield from self._dirs_under(d, file_suffix)
+
+    def get_progress_paths( self ):
+        """ Gets all the files and dirs whose modification indicates progress in this stage.
+        """
+        if self.stage == 'in_demultiplexing':
+            work_dir = os.path.join(self.output_dir, 'demultiplexing')
+            yield from glob(os.path.join(self.run_dir, 'pipeline', 'lane?.started'))
+            # Lanes that are split have a log for each shard or group
+            for log_dir in ['lane*', 'lane*/shard*', 'lane*/group*']:
+                yield from glob(os.path.join(work_dir, log_dir, 'bcl2fastq.log'))
+            for lane_dir in glob(os.path.join(work_dir, 'lane*')):
+                yield from self._dirs_under(lane_dir, '.fastq.gz')
+        elif self.stage == 'in_qc':
+            work_dir = self.output_dir
+            yield os.path.join(self.run_dir, 'pipeline', 'qc.started')
+            yield from self._dirs_under(os.path.join(work_dir, 'QC'))
+        else:
+            return
+
+        # Snakemake keeps a record of every job that finishes, and writes a log.
+        yield from self._dirs_under(os.path.join(work_dir, '.snakemake', 'metadata'))
+        logs = sorted(glob(os.path.join(work_dir, '.snakemake', 'log', '*.snakemake.log')))
+        yield from logs[-1:]
+
+    def get_last_progress( self ):
+        """ Time of the last sign of progress, or 0 if we can't tell.
+        """
+        return self._latest_mtime(self.get_progress_paths())
+
+    def get_stalled_since( self , now = None ):
+        """ If the run is stalled, return the time of the last sign of progress. Otherwise
+            None.
+        """
+        hours = get_stall_hours(self.stage)
+        if not hours:
+            return None
+
+        last_progress = self.get_last_progress()
+        if not last_progress:
+            return None
+
+        now = now or time.time()
+        if now - last_progress > hours * 3600:
+            return last_progress
+        return None
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""Estimates of the fraction of reads going to each project (or to Undetermined) from
+   counts on a sample of tiles, with 95% confidence intervals.
+
+   The clusters on one tile are not an independent sample of the lane - the barcode
+   balance can vary over the flowcell - so the tiles are treated as the sampling units
+   and the interval comes from the spread of the per-tile fractions (the usual ratio
+   estimator for a cluster sample). This needs at least two tiles. The simple binomial
+   interval is used as a lower bound, so a few tiles that happen to agree closely do not
+   give a falsely narrow interval.
+
+   The counts are kept in a dict like:
+
+     { "tiles":        [ "2101", "2178", ... ],
+       "clusters_pf":  [ 3019723, 2987232, ... ],
+       "samples":      { "21360GNpool01__21360GN0345L01": [ 7259, 7012, ... ], ... },
+       "undetermined": [ 416186, 409921, ... ] }
+
+   with one entry in each list per tile, in the order the tiles were read. This is
+   saved by IndexSampler as tile_counts.json next to bcl2fastq.opts, for
+   assess_bc_check.py to pick up.
+"""
+import sys
+import math
+import json
+from collections import OrderedDict
+
+# 0.975 quantiles of the t distribution for 1 to 10 degrees of freedom. Beyond
+# that, 2.0 is near enough and errs on the side of caution.
+T_975 = [ None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228 ]
+
+TILE_COUNTS_FILE = 'tile_counts.json'
+
+def project_of( sample_id ):
+    """ As usual assume the first 5 chars of the SampleId are the project.
+    """
+    return sample_id[:5]
+
+def ratio_ci( counts , totals ):
+    """ Given the count of reads in some category and the total reads for each tile,
+        return ( fraction , half_width ) for a 95% interval. half_width is None if there
+        are fewer than two tiles, and fraction is None if there are no reads at all.
+    """
+    n = sum(totals)
+    if not n:
+        return None, None
+    p = sum(counts) / n
+
+    num_tiles = len(totals)
+    if num_tiles < 2:
+        return p, None
+
+    tile_var = num_tiles / (num_tiles - 1) * sum( (c - p * t) ** 2 for c, t in zip(counts, totals) )
+    t_val = T_975[num_tiles - 1] if num_tiles - 1 < len(T_975) else 2.0
+
+    return p, max( t_val * math.sqrt(tile_var) / n,
+                   1.96 * math.sqrt(p * (1 - p) / n) )
+
+def group_counts( tile_counts ):
+    """ Sum up the per-tile counts for each project, plus Undetermined.
+        Returns an OrderedDict of { name: [ count_per_tile ] }
+    """
+    res = OrderedDict()
+    num_tiles = len(tile_counts['tiles'])
+    for sample_id, counts in tile_counts['samples'].items():
+        proj = res.setdefault(project_of(sample_id), [0] * num_tiles)
+        for i, c in enumerate(counts):
+            proj[i] += c
+    if tile_counts.get('undetermined') is not None:
+        res['Undetermined'] = tile_counts['undetermined']
+    return res
+
+def estimates( tile_counts ):
+    """ { name: ( fraction , half_width ) } for each project, plus Undetermined
+    """
+    return OrderedDict( (name, ratio_ci(counts, tile_counts['clusters_pf']))
+                        for name, counts in group_counts(tile_counts).items() )
+
+def widest_ci( tile_counts ):
+    """ The largest half_width over all the estimates, or None if any is unknown
+    """
+    hws = [ hw for p, hw in estimates(tile_counts).values() ]
+    if not hws or None in hws:
+        return None
+    return max(hws)
+
+def spread_order( items ):
+    """ Re-order a list so that every prefix of the result is spread out over the
+        original list: 0, n/2, n/4, 3n/4, n/8, ... (the van der Corput sequence)
+    """
+    res = []
+    seen = set()
+    i = 0
+    while len(res) < len(items):
+        # Reverse the bits of i to get a fraction in [0, 1)
+        x, denom, j = 0.0, 1.0, i
+        while j:
+            denom *= 2
+            x += (j & 1) / denom
+            j >>= 1
+        idx = int(x * len(items))
+        if idx not in seen:
+            seen.add(idx)
+            res.append(items[idx])
+        i += 1
+    return res
+
+def format_estimate( fraction , half_width ):
+    """ Like '12.34% ± 0.56%'
+    """
+    if fraction is None:
+        return 'no reads'
+    if half_width is None:
+        return '{:.2%}'.format(fraction)
+    return '{:.2%} ± {:.2%}'.format(fraction, half_width)
+
+def load_tile_counts( filename ):
+    """ Load the counts, or return None if the file is missing
+    """
+    try:
+        with open(filename) as tfh:
+            return json.load(tfh)
+    except FileNotFoundError:
+        return None
+
+def main():
+    """Only for testing. Run like:
+        python3 -m illuminatus.TileEstimates QC/bc_check/lane1/tile_counts.json
+    """
+    tile_counts = load_tile_counts(sys.argv[1])
+    for name, est in estimates(tile_counts).items():
+        print("{}\t{}".format(name, format_estimate(*est)))
+
+if __name__ == '__main__':
+    main()
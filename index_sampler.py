@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""Command line interface to illuminatus.IndexSampler
+   Takes the same arguments as do_demultiplex.sh and writes the same Stats/ files and
+   logs, but only counts the index sequences, with no FASTQ output. The bc_check rule
+   in Snakefile.read1qc runs this in place of bcl2fastq, falling back to bcl2fastq if
+   this fails.
+"""
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.IndexSampler import IndexSampler
+
+def main(args):
+
+    sampler = IndexSampler(args.run_dir, args.out_dir, args.sample_sheet, args.lane)
+    sampler.prepare()
+    print("Counting indexes for lane {} on {} tiles of {}".format( sampler.lane, len(sampler.tiles),
+                                                                   sampler.run_dir ))
+    sampler.run()
+    conversion, = sampler.collect_stats()['ConversionResults']
+
+    for dr in conversion['DemuxResults']:
+        print("{}\t{}".format(dr['SampleId'], dr['NumberReads']))
+    if 'Undetermined' in conversion:
+        print("Undetermined\t{}".format(conversion['Undetermined']['NumberReads']))
+
+def parse_args(*args):
+    description = """Count the index sequences on the tiles selected in a sample sheet
+                     from "bcl2fastq_setup.py --bc_check", reading the base calls directly,
+                     and write the Stats.json that bcl2fastq would have made."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("run_dir", help="The run directory.")
+    argparser.add_argument("out_dir", help="Where to write the output.")
+    argparser.add_argument("sample_sheet", help="The SampleSheet.filtered.csv from bcl2fastq_setup.py")
+    argparser.add_argument("lane", help="The lane to process.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -4,7 +4,7 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from urllib.parse import quote as url_quote
 import logging as L
 
-from illuminatus.SampleSheetReader import SampleSheetReader
+from illuminatus.SampleSheetReader import get_samplesheet_reader
 from illuminatus.RTQuery import get_project_names
 from illuminatus.yaml import load_yaml, dump_yaml, ParserError
 
@@ -21,10 +21,9 @@ def main(args):
     if args.sample_sheet:
         # Allow any exceptions to propagate. This means if the sample
         # sheet is invalid no YAML file will be saved.
-        ss_csv = SampleSheetReader(args.sample_sheet)
+        ss_csv = get_samplesheet_reader(args.sample_sheet)
 
-        for line in ss_csv.samplesheet_data:
-            proj_numbers.add(line[ss_csv.column_mapping['sample_project']])
+        proj_numbers.update(ss_csv.get_projects())
 
     # See what projects are in proj_numbers that we still need info for
     projects_already_known = set()
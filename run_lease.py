@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""Command line interface to illuminatus.RunLease, for use by driver.sh
+   Leases normally live in the pipeline/ directory of a run, eg. pipeline/demux.lease
+
+   acquire   - get the lease, taking over an expired lease if need be. Exits with
+               status 1 if somebody else has a live lease.
+   renew     - extend the lease we hold.
+   release   - remove the lease if we hold it.
+   check     - print 'none', 'held' or 'expired' followed by the owner and PID.
+   heartbeat - keep renewing the lease until --pid exits. Run this in the background.
+"""
+import os
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.RunLease import RunLease, LeaseHeldError, DEFAULT_TTL
+
+def main(args):
+
+    lease = RunLease( args.lease_file,
+                      ttl = args.ttl,
+                      pid = args.pid or os.getppid() )
+
+    try:
+        if args.action == 'acquire':
+            old_lease = lease.acquire()
+            if old_lease:
+                print("Took over expired lease from {owner}:{pid}".format(**old_lease))
+        elif args.action == 'renew':
+            lease.renew()
+        elif args.action == 'release':
+            lease.release()
+        elif args.action == 'check':
+            current = lease.read()
+            if not current:
+                print("none")
+            else:
+                print("{} {} {}".format( 'expired' if lease.is_expired(current) else 'held',
+                                         current.get('owner'), current.get('pid') ))
+        elif args.action == 'heartbeat':
+            lease.heartbeat()
+    except LeaseHeldError as e:
+        exit(str(e))
+
+def parse_args():
+    description = """Manage a lease file which shows that a run is being processed."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("action", choices="acquire renew release check heartbeat".split(),
+                           help="What to do with the lease.")
+    argparser.add_argument("lease_file",
+                           help="The lease file, eg. pipeline/demux.lease")
+    argparser.add_argument("--ttl", type=int, default=int(os.environ.get('LEASE_TTL', DEFAULT_TTL)),
+                           help="Seconds until the lease expires if not renewed.")
+    argparser.add_argument("--pid", type=int,
+                           help="PID of the process holding the lease. Defaults to the parent process.")
+
+    return argparser.parse_args()
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""Command line interface to illuminatus.RunMeta, for use by driver.sh
+   Saves pipeline/run_meta.json for a run, if it is missing or the XML files have
+   changed since it was made. Other scripts then read this rather than parsing
+   RunInfo.xml and RunParameters.xml for themselves.
+"""
+import os
+import json
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.RunMeta import get_run_meta, META_FILE
+
+def main(args):
+
+    if not os.path.isdir(os.path.join(args.run_dir, os.path.dirname(META_FILE))):
+        exit("There is no pipeline directory in {}".format(args.run_dir))
+
+    run_meta = get_run_meta(args.run_dir)
+
+    if args.print:
+        print(json.dumps(run_meta.meta, indent=2, sort_keys=True, default=str))
+
+def parse_args(*args):
+    description = """Save the metadata from RunInfo.xml and RunParameters.xml to
+                     {} in the run directory, if it is missing or out of date.""".format(META_FILE)
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("run_dir", nargs='?', default='.',
+                           help="The run directory.")
+    argparser.add_argument("-p", "--print", action="store_true",
+                           help="Print the metadata as well.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""Reads the event timeline written by driver.sh and RunStatus.py (see
+   illuminatus/RunTimeline.py) and reports how long runs spend in each state,
+   or in each driver action, over all the runs in the log.
+   By default this reads $TIMELINE_LOG, but you can give one or more
+   pipeline/timeline.jsonl files instead.
+"""
+import os, sys
+import json
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+from illuminatus.RunTimeline import load_events, get_state_spans, get_action_spans, summarize_spans
+
+def main(args):
+
+    events_files = args.events or [ os.environ.get('TIMELINE_LOG') ]
+    if not all(events_files):
+        exit("You need to set TIMELINE_LOG or supply some event files to read.")
+
+    events = load_events(*events_files)
+    if args.days:
+        cutoff = time.time() - args.days * 86400
+        events = [ e for e in events if e['time'] >= cutoff ]
+    if args.run:
+        events = [ e for e in events if e['run'] in args.run ]
+
+    if args.actions:
+        spans = get_action_spans(events)
+    else:
+        spans = get_state_spans(events)
+
+    if args.by_run:
+        # Dump out every span for every run
+        for run, run_spans in spans.items():
+            for span in run_spans:
+                stage, start, end = span[:3]
+                print( "\t".join([ run, stage, fmt_time(start), fmt_time(end),
+                                   fmt_hours(end - start) if end is not None else '-' ]) )
+        return
+
+    summary = summarize_spans(spans)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+        return
+
+    # Else print a table, with times in hours
+    grand_total = sum( s['total'] for s in summary.values() ) or 1
+    print( "\t".join([ 'stage', 'count', 'mean_h', 'median_h', 'p90_h', 'max_h', 'percent_of_total' ]) )
+    for stage, s in summary.items():
+        print( "\t".join([ stage, str(s['count']) ] +
+                         [ fmt_hours(s[k]) for k in ['mean', 'median', 'p90', 'max'] ] +
+                         [ "{:.1f}".format(100.0 * s['total'] / grand_total) ]) )
+
+def fmt_hours(secs):
+    return "{:.2f}".format(secs / 3600.0)
+
+def fmt_time(t):
+    return '-' if t is None else time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+def parse_args(*args):
+    description = """Report the time spent in each state of the pipeline, or in each action,
+                     across all the runs in the timeline."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("events", nargs='*',
+                           help="Event files to read. Defaults to $TIMELINE_LOG.")
+    argparser.add_argument("-a", "--actions", action="store_true",
+                           help="Report on driver actions, not on states.")
+    argparser.add_argument("-d", "--days", type=float,
+                           help="Only look at events from the last N days.")
+    argparser.add_argument("-r", "--run", action="append",
+                           help="Only look at this run. May be given more than once.")
+    argparser.add_argument("--by_run", action="store_true",
+                           help="List every state (or action) of every run, rather than a summary.")
+    argparser.add_argument("--json", action="store_true",
+                           help="Print the summary as JSON, with times in seconds.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+"""An optional alternative to running driver.sh from the CRON every 5 minutes.
+   This watches SEQDATA_LOCATION using Linux inotify, and as soon as a relevant file
+   appears for a run (a new run directory, RTAComplete.txt, a touch file in pipeline/,
+   or the first file in the cycle directory that triggers read1 processing) it runs
+   driver.sh for that single run.
+   Since inotify events can be missed, particularly on network filesystems, a full
+   driver.sh scan is still run every --reconcile_interval seconds, and this also picks
+   up any directories that need watching which were not there before.
+   To run with the standard settings:
+    $ ./run_watcher.py
+   You should not also run driver.sh from the CRON, though it's harmless to do so.
+"""
+
+import os, re
+import ctypes, ctypes.util
+import struct
+import select
+import subprocess
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+import logging as L
+
+from illuminatus.RunStatus import RunStatus
+
+# Flags from /usr/include/sys/inotify.h
+IN_ATTRIB      = 0x00000004
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_IGNORED     = 0x00008000
+IN_Q_OVERFLOW  = 0x00004000
+IN_ONLYDIR     = 0x01000000
+IN_CLOEXEC     = 0o2000000
+
+IN_NEW_FILES = IN_CREATE | IN_MOVED_TO
+IN_ANY_CHANGE = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ATTRIB
+
+# Files in the top level of a run that trigger a driver run when they appear.
+RUN_DIR_TRIGGERS = [ 'RTAComplete.txt', 'pipeline', 'SampleSheet.csv', 'RunInfo.xml' ]
+
+# Files in pipeline/ that do not trigger a driver run. These are the lease files (see
+# illuminatus/RunLease.py) which the heartbeat rewrites every few minutes, plus the temp
+# files it renames into place.
+PIPELINE_IGNORE = re.compile(r'.+\.lease(\.(tmp|stale)\..+)?')
+
+class Inotify:
+    """Minimal wrapper around the inotify system calls, using ctypes so we don't
+       need any extra Python packages.
+    """
+    _event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        """Returns the watch descriptor, or None if the directory is missing.
+           Adding a watch on a path that is already watched returns the existing
+           descriptor.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno in [2, 20]: # ENOENT, ENOTDIR
+                return None
+            raise OSError(errno, "inotify_add_watch failed on {}".format(path))
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching. We'll get an IN_IGNORED event for the watch.
+           Errors are ignored, since the watch may be gone already.
+        """
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds and return a list of (wd, mask, name) tuples.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        buf = os.read(self.fd, 65536)
+        res = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _cookie, name_len = self._event_header.unpack_from(buf, pos)
+            pos += self._event_header.size
+            name = buf[pos:pos+name_len].rstrip(b'\0').decode(errors='replace')
+            pos += name_len
+            res.append((wd, mask, name))
+        return res
+
+    def close(self):
+        os.close(self.fd)
+
+class RunWatcher:
+    """Keeps track of what is being watched and which runs need the driver to
+       be called on them.
+    """
+    def __init__(self, seqdata, driver, run_name_regex, max_jobs=4, settle_time=10, long_job_time=300):
+        self.seqdata = seqdata
+        self.driver = driver
+        self.run_name_regex = re.compile(run_name_regex)
+        self.max_jobs = max_jobs
+        self.settle_time = settle_time
+        self.long_job_time = long_job_time
+
+        self.inotify = Inotify()
+
+        # wd -> (run, what) where what is one of 'top', 'run', 'pipeline', 'cycles', 'trigger'
+        self.watches = dict()
+        # run -> set of cycle dir names that signal a read is complete
+        self.trigger_dirs = dict()
+
+        # run -> time at which the driver should be called, so that a burst
+        # of events only results in one call.
+        self.pending = dict()
+        # run -> Popen object. Full scans are tracked under the key None.
+        self.running = dict()
+        # run -> time the driver was started
+        self.started = dict()
+
+    def watch(self, path, mask, run, what):
+        wd = self.inotify.add_watch(path, mask)
+        if wd is not None:
+            self.watches[wd] = (run, what)
+        return wd
+
+    def watch_run(self, run):
+        """Add or refresh all the watches for a run. The directories may appear at
+           any time so this is called on every reconciliation.
+        """
+        run_dir = os.path.join(self.seqdata, run)
+
+        self.watch(run_dir, IN_NEW_FILES, run, 'run')
+        self.watch(os.path.join(run_dir, 'pipeline'), IN_ANY_CHANGE, run, 'pipeline')
+
+        # RunStatus only looks at lane 1 to see when reads are complete, so only
+        # watch that. Until RunInfo.xml appears we can't say which cycles to look for,
+        # so keep trying.
+        if not self.trigger_dirs.get(run):
+            try:
+                rs = RunStatus(run_dir)
+                trigger_dirs = set( "C{}.1".format(c) for c in rs.trigger_cycles[1:] )
+            except Exception:
+                trigger_dirs = set()
+            if trigger_dirs:
+                self.trigger_dirs[run] = trigger_dirs
+        if self.trigger_dirs.get(run):
+            self.watch(os.path.join(run_dir, 'Data', 'Intensities', 'BaseCalls', 'L001'),
+                       IN_NEW_FILES, run, 'cycles')
+
+    def watch_trigger_dir(self, run, name):
+        """A trigger cycle directory has appeared, but RunStatus looks for files in it,
+           and these are copied in after the directory is made. So watch inside the
+           directory, and queue the run as soon as it has anything in it.
+        """
+        trigger_dir = os.path.join(self.seqdata, run, 'Data', 'Intensities', 'BaseCalls', 'L001', name)
+        wd = self.watch(trigger_dir, IN_NEW_FILES, run, 'trigger')
+        try:
+            has_files = bool(os.listdir(trigger_dir))
+        except OSError:
+            has_files = False
+        if has_files:
+            # Files got there before the watch did
+            self.trigger_files_seen(run, wd)
+
+    def trigger_files_seen(self, run, wd):
+        """Queue the run once, rather than for every file in the trigger directory.
+        """
+        L.info("Files appeared in trigger cycle for {}".format(run))
+        self.queue(run)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def reconcile(self):
+        """Watch everything and queue up a full driver scan.
+        """
+        self.watch(self.seqdata, IN_NEW_FILES, None, 'top')
+        for run in sorted(os.listdir(self.seqdata)):
+            if self.run_name_regex.fullmatch(run) and os.path.isdir(os.path.join(self.seqdata, run)):
+                self.watch_run(run)
+
+        self.pending[None] = time.time()
+
+    def handle_event(self, wd, mask, name):
+        """Decide if an event means we should call the driver on a run.
+        """
+        if mask & IN_Q_OVERFLOW:
+            # We lost events, so do a full scan.
+            L.warning("inotify queue overflow. Triggering a full scan.")
+            self.pending[None] = time.time()
+            return
+        if mask & IN_IGNORED:
+            # Watch removed because the directory went away
+            self.watches.pop(wd, None)
+            return
+
+        run, what = self.watches.get(wd, (None, None))
+        if what == 'top':
+            if self.run_name_regex.fullmatch(name):
+                L.info("New run directory {}".format(name))
+                self.watch_run(name)
+                self.queue(name)
+        elif what == 'run':
+            if name in ['pipeline', 'RunInfo.xml']:
+                self.watch_run(run)
+            if name in RUN_DIR_TRIGGERS:
+                self.queue(run)
+        elif what == 'pipeline':
+            if not PIPELINE_IGNORE.fullmatch(name):
+                self.queue(run)
+        elif what == 'cycles':
+            if name in self.trigger_dirs.get(run, ()):
+                L.info("Cycle {} appeared for {}".format(name, run))
+                self.watch_trigger_dir(run, name)
+        elif what == 'trigger':
+            self.trigger_files_seen(run, wd)
+
+    def queue(self, run):
+        """Call the driver on this run once things settle down
+        """
+        self.pending.setdefault(run, time.time() + self.settle_time)
+
+    def dispatch(self):
+        """Start any jobs that are due, and reap any that finished.
+        """
+        for run, proc in list(self.running.items()):
+            if proc.poll() is not None:
+                L.debug("Driver finished for {} with status {}".format(run or 'full scan', proc.returncode))
+                del self.running[run]
+                del self.started[run]
+
+        now = time.time()
+        for run, due in sorted(self.pending.items(), key=lambda i: i[1]):
+            if due > now:
+                continue
+            # Never run two drivers on the same run at once, or two full scans. A full
+            # scan may overlap with drivers on single runs, as happens when driver.sh
+            # runs from the CRON, since the touch files and leases in pipeline/ stop
+            # two drivers acting on the same run. Otherwise a full scan that runs
+            # demultiplexing would hold up every other run for hours.
+            if run in self.running:
+                continue
+            # A driver that runs demultiplexing or QC waits for hours, so drivers that have
+            # been going for more than long_job_time don't count towards max_jobs. The full
+            # scan is our fallback for missed events, so it is never held back.
+            if run is not None and self.busy_jobs(now) >= self.max_jobs:
+                continue
+
+            del self.pending[run]
+            self.started[run] = now
+            if run is None:
+                L.info("Running full driver scan")
+                self.running[run] = subprocess.Popen([self.driver])
+            else:
+                L.info("Running driver for {}".format(run))
+                self.running[run] = subprocess.Popen([self.driver, run])
+
+    def busy_jobs(self, now):
+        """Number of drivers on single runs that count towards max_jobs.
+        """
+        return len([ r for r in self.running
+                     if r is not None and now - self.started.get(r, now) < self.long_job_time ])
+
+    def main_loop(self, reconcile_interval):
+        next_reconcile = 0
+        while True:
+            if time.time() >= next_reconcile:
+                self.reconcile()
+                next_reconcile = time.time() + reconcile_interval
+
+            for wd, mask, name in self.inotify.read_events(timeout=1):
+                self.handle_event(wd, mask, name)
+
+            self.dispatch()
+
+def load_environ(environ_sh):
+    """Get SEQDATA_LOCATION and RUN_NAME_REGEX from environ.sh, in the same way as
+       driver.sh does, and put them into os.environ.
+    """
+    if not os.path.exists(environ_sh):
+        return
+
+    cpi = subprocess.run( [ '/bin/bash', '-c',
+                            'cd "$(dirname "$1")" && source ./"$(basename "$1")" && '
+                            'export SEQDATA_LOCATION RUN_NAME_REGEX && printenv',
+                            'bash', environ_sh ],
+                          stdout = subprocess.PIPE,
+                          universal_newlines = True )
+
+    for l in cpi.stdout.split('\n'):
+        k, _, v = l.partition('=')
+        if k in ['SEQDATA_LOCATION', 'RUN_NAME_REGEX'] and v:
+            os.environ[k] = v
+
+def main(args):
+
+    if args.debug:
+        L.basicConfig(format='{name:s} {levelname:s}: {message:s}', level=L.DEBUG, style='{')
+    else:
+        L.basicConfig(format='{asctime:s} {message:s}', level=L.INFO, style='{')
+
+    load_environ(os.environ.get('ENVIRON_SH') or
+                 os.path.join(os.path.dirname(os.path.abspath(args.driver)), 'environ.sh'))
+
+    seqdata = args.seqdata or os.environ.get('SEQDATA_LOCATION')
+    if not seqdata:
+        exit("You need to set SEQDATA_LOCATION or supply --seqdata.")
+
+    watcher = RunWatcher( seqdata = seqdata,
+                          driver = args.driver,
+                          run_name_regex = os.environ.get('RUN_NAME_REGEX', '.*_.*_.*_[^.]*'),
+                          max_jobs = args.max_jobs,
+                          settle_time = args.settle_time,
+                          long_job_time = args.long_job_time )
+    watcher.main_loop(args.reconcile_interval)
+
+def parse_args():
+    description = """Watch SEQDATA_LOCATION for changes and run driver.sh on runs as soon
+                     as they need processing."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("--seqdata",
+                           help="Directory to watch. Defaults to $SEQDATA_LOCATION.")
+    argparser.add_argument("--driver", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'driver.sh'),
+                           help="The driver script to run.")
+    argparser.add_argument("--reconcile_interval", type=int, default=900,
+                           help="Seconds between full driver scans.")
+    argparser.add_argument("--settle_time", type=int, default=10,
+                           help="Seconds to wait after an event before calling the driver.")
+    argparser.add_argument("--max_jobs", type=int, default=4,
+                           help="Maximum number of driver instances to run at once on single runs.")
+    argparser.add_argument("--long_job_time", type=int, default=300,
+                           help="Seconds after which a driver instance is assumed to be waiting on"
+                                " demultiplexing or QC, and no longer counts towards --max_jobs.")
+    argparser.add_argument("-v", "--debug", "--verbose", action="store_true",
+                           help="Be verbose (print debug messages).")
+
+    return argparser.parse_args()
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -18,7 +18,7 @@ SSPP_HOOK="${SSPP_HOOK:-}"
 
 if [ -z "${FLOWCELLID:-}" ] ; then
     #Try to determine flowcell ID by asking RunStatus.py
-    FLOWCELLID=$(RunStatus.py | grep '^Flowcell:' | cut -f2 -d' ') || true
+    eval "$(RunStatus.py --shell --fields FLOWCELLID=Flowcell)" || true
 fi
 
 if [ -z "${FLOWCELLID:-}" ] ; then
@@ -125,9 +125,15 @@ fi
 
 # The latest one that matches the flowcell ID is the one we want.
 # Or do we want to sort on some other criterion?
-candidate_ss=$(find "$SAMPLESHEETS_ROOT" -name "*_*.csv" -print0 | \
-               { egrep -zi "_${FLOWCELLID}\.csv$" || true ; } | \
-               xargs -r0 ls -tr -- | tail -n 1)
+# If the driver has set SAMPLESHEET_INDEX then look it up there, rather than searching
+# the whole tree. If that fails for any reason, including a sheet having been re-written
+# since it was indexed, fall back to searching.
+if [ -z "${SAMPLESHEET_INDEX:-}" ] || [ "$SAMPLESHEET_INDEX" = none ] || \
+        ! candidate_ss=$(samplesheet_index.py --root "$SAMPLESHEETS_ROOT" latest "$FLOWCELLID") ; then
+    candidate_ss=$(find "$SAMPLESHEETS_ROOT" -name "*_*.csv" -print0 | \
+                   { egrep -zi "_${FLOWCELLID}\.csv$" || true ; } | \
+                   xargs -r0 ls -tr -- | tail -n 1)
+fi
 
 if [ ! -e "$candidate_ss" ] ; then
     echo "No candidate replacement samplesheet for ${FLOWCELLID} under $SAMPLESHEETS_ROOT"
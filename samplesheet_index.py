@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""Command line interface to illuminatus.SampleSheetIndex, for use by samplesheet_fetch.sh
+   and auto_redo.sh, so they don't need to search the whole of SAMPLESHEETS_ROOT.
+
+   refresh        - just bring the index up to date.
+   latest FCID    - print the path of the newest sheet for this flowcell, if there is one.
+                    If any of the sheets for the flowcell changed since they were indexed,
+                    exit with status 2 so the caller can fall back to searching.
+   list FCID      - print the path, mtime and MD5 of every sheet for this flowcell.
+   recent HOURS   - print the paths of all sheets modified in the last HOURS hours.
+
+   The index is refreshed before any query, unless you say --no_refresh.
+"""
+import os, sys
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import time
+
+from illuminatus.SampleSheetIndex import SampleSheetIndex
+
+def main(args):
+
+    if not args.index or args.index == 'none':
+        exit("You need to set SAMPLESHEET_INDEX or use --index.")
+    if not args.root:
+        exit("You need to set SAMPLESHEETS_ROOT or use --root.")
+
+    ssi = SampleSheetIndex(args.index, args.root)
+
+    if not args.no_refresh:
+        stats = ssi.refresh()
+        if args.verbose:
+            print("Listed {dirs_listed} directories and hashed {sheets_hashed} sheets.".format(**stats),
+                  file=sys.stderr)
+
+    end = '\0' if args.null else '\n'
+    if args.action == 'latest':
+        if ssi.check_sheets(get_arg(args)):
+            ssi.close()
+            print("Sheets for {} changed since they were indexed.".format(args.arg), file=sys.stderr)
+            exit(2)
+        sheet = ssi.get_latest(get_arg(args))
+        if sheet:
+            print(sheet['path'], end=end)
+    elif args.action == 'list':
+        ssi.check_sheets(get_arg(args))
+        for sheet in ssi.get_sheets(get_arg(args)):
+            print("{path}\t{mtime}\t{md5}".format(**sheet), end=end)
+    elif args.action == 'recent':
+        try:
+            since = time.time() - float(get_arg(args)) * 3600
+        except ValueError:
+            exit("HOURS must be a number.")
+        for sheet in ssi.get_recent(since):
+            print(sheet['path'], end=end)
+
+    ssi.close()
+
+def get_arg(args):
+    if not args.arg:
+        exit("The {} action needs an argument.".format(args.action))
+    return args.arg
+
+def parse_args(*args):
+    description = """Look up sample sheets by flowcell ID, using an index of SAMPLESHEETS_ROOT
+                     which is refreshed incrementally."""
+
+    argparser = ArgumentParser( description=description,
+                                formatter_class = ArgumentDefaultsHelpFormatter )
+
+    argparser.add_argument("action", choices="refresh latest list recent".split(),
+                           help="What to do.")
+    argparser.add_argument("arg", nargs='?',
+                           help="Flowcell ID, or number of hours for 'recent'.")
+    argparser.add_argument("--index", default=os.environ.get('SAMPLESHEET_INDEX'),
+                           help="The index file. Defaults to $SAMPLESHEET_INDEX.")
+    argparser.add_argument("--root", default=os.environ.get('SAMPLESHEETS_ROOT'),
+                           help="The directory of sample sheets. Defaults to $SAMPLESHEETS_ROOT.")
+    argparser.add_argument("--no_refresh", action="store_true",
+                           help="Don't refresh the index first.")
+    argparser.add_argument("-0", "--null", action="store_true",
+                           help="End each line of output with a NUL, like find -print0.")
+    argparser.add_argument("-v", "--verbose", action="store_true",
+                           help="Report what the refresh did.")
+
+    return argparser.parse_args(*args)
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -1,13 +1,11 @@
 #!/usr/bin/env python3
 import os, sys, re
-import datetime
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-from illuminatus.SampleSheetReader import SampleSheetReader
-from illuminatus.RunInfoXMLParser import RunInfoXMLParser
-from illuminatus.RunParametersXMLParser import RunParametersXMLParser
+from illuminatus.SampleSheetReader import SampleSheetReader, get_samplesheet_reader
+from illuminatus.RunMeta import get_run_meta
 from illuminatus.Formatters import pct, fmt_time
-from illuminatus.yaml import load_yaml, dump_yaml, ParserError
+from illuminatus.yaml import load_yaml, dump_yaml
 
 # Non-pools may either be called 'NoPool' or ''. Other names may be added here.
 NON_POOLS = ['NoPool', 'None', '']
@@ -64,7 +62,7 @@ def main(args):
             data_struct = load_yaml( sys.stdin if args.from_yml == '-'
                                      else args.from_yml )
         else:
-            data_struct = scan_for_info(args.run_dir)
+            data_struct = scan_for_info(args.run_dir, use_cache=True)
     except FileNotFoundError as e:
         exit(f"Error summarizing run.\n{e}")
 
@@ -243,9 +241,11 @@ def output_mqc(rids, fh):
 
     dump_yaml(mqc_out, fh=fh)
 
-def scan_for_info(run_dir):
+def scan_for_info(run_dir, use_cache=False):
     """Hoovers up the info and builds a data structure which can
        be serialized to YAML or converted to the various output formats.
+       If use_cache is set, the sample sheet may come from pipeline/samplesheet_cache.json
+       and pipeline/run_meta.json will be saved if it is out of date.
     """
     try:
         # File must be valid YAML or empty (which loads as None)
@@ -255,8 +255,8 @@ def scan_for_info(run_dir):
         # No matter we go without it
         project_names = dict()
 
-    # Load both the RunInfo.xml and (a little later) the SampleSheet.csv
-    ri_xml = RunInfoXMLParser(run_dir)
+    # Load both the RunInfo.xml (via run_meta.json) and (a little later) the SampleSheet.csv
+    ri_xml = get_run_meta(run_dir, save=use_cache)
 
     # Build run info data structure (rids). First just inherit the info
     # from ri_xml (RunId, Instrument, Flowcell, ...)
@@ -265,7 +265,7 @@ def scan_for_info(run_dir):
     # We need this to reliably get the NovoSeq flowcell type
     # Also we now care about the experiment name which is here and lets us link to BaseSpace
     try:
-        run_params = RunParametersXMLParser( run_dir ).run_parameters
+        run_params = ri_xml.get_run_parameters()
         if 'Flowcell Type' in run_params:
             rids['FCType'] = run_params['Flowcell Type']
         rids['ExperimentName'] = run_params.get('Experiment Name')
@@ -292,7 +292,10 @@ def scan_for_info(run_dir):
         # Weird - maybe not a link?
         rids['SampleSheet'] = "SampleSheet.csv"
     try:
-        ss_csv = SampleSheetReader(run_dir + "/SampleSheet.csv")
+        if use_cache:
+            ss_csv = get_samplesheet_reader(run_dir + "/SampleSheet.csv")
+        else:
+            ss_csv = SampleSheetReader(run_dir + "/SampleSheet.csv")
     except Exception:
         # We can live without this if the sample sheet is invalid
         ss_csv = None
@@ -315,19 +318,18 @@ def scan_for_info(run_dir):
 
         # Filter project_names to just the ones in the ss_csv. They should match already
         # but don't depend on it.
-        rids['ProjectInfo'] = { n: project_names.get(n) for n in
-                                set([ line[ss_csv.column_mapping['sample_project']]
-                                      for line in ss_csv.samplesheet_data ]) }
+        rids['ProjectInfo'] = { n: project_names.get(n) for n in ss_csv.get_projects() }
 
         # NOTE - if a samplesheet has no 'lane' column then we shouldn't really be processing it,
         # but as far as bcl2fastq is concerned this just means all lanes are identical, so for
         # the purposes of this script I'll go with that.
-        if 'lane' in ss_csv.column_mapping:
-            ss_lanes = [ line[ss_csv.column_mapping['lane']] for line in ss_csv.samplesheet_data ]
+        has_lanes = 'lane' in ss_csv.column_mapping
+        if has_lanes:
+            ss_lanes = ss_csv.get_lanes()
         else:
             ss_lanes = [ str(x + 1) for x in range(int(rids['LaneCount'])) ]
 
-        for lanenum in sorted(set(ss_lanes)):
+        for lanenum in sorted(ss_lanes):
             thislane = {'LaneNumber': lanenum}
 
             # See if there is a Basemask. This breaks the original idea of this script as showing
@@ -339,16 +341,14 @@ def scan_for_info(run_dir):
             #but here's a placeholder.
             thislane['Loading'] = get_lane_loading(rids['Flowcell'])
 
-            lines_for_lane = [ line for line in ss_csv.samplesheet_data
-                               if 'lane' not in ss_csv.column_mapping or
-                                  line[ss_csv.column_mapping['lane']] == lanenum ]
+            rows_for_lane = ss_csv.get_rows(lane=lanenum) if has_lanes else ss_csv.get_rows()
 
-            thislane['Contents'] = summarize_lane( lines_for_lane, ss_csv.column_mapping )
+            thislane['Contents'] = summarize_lane( rows_for_lane )
 
             #If the lane contains a single sample, is that one barcode or is it unindexed?
             #We'd like to report which.
-            if len(lines_for_lane) == 1:
-                index_lengths = ss_csv.get_index_lengths_by_lane()[lanenum]
+            if len(rows_for_lane) == 1:
+                index_lengths = ss_csv.index_lengths_by_lane[rows_for_lane[0].lane]
                 #It's unindexed if there are no indices or if they contain only N's.
                 thislane['Unindexed'] = not any( index_lengths )
             else:
@@ -382,28 +382,20 @@ def get_lane_basemask(run_dir, lanenum):
     # If no matching line was found
     return None
 
-def summarize_lane(lane_lines, column_mapping):
-    """Given a list of lines, summarize what they contain, returning
+def summarize_lane(lane_rows):
+    """Given a list of SampleSheetRow objects, summarize what they contain, returning
        a dict of { project: { pool: [ list of libs ] } }
-       The caller is presumed to have filtered the lines by lane already.
+       The caller is presumed to have filtered the rows by lane already.
     """
     #Make a dict of dicts keyed on all the projects seen
     res = dict()
 
-    for line in lane_lines:
-        sample_project = line[column_mapping['sample_project']]
-        sample_id = line[column_mapping['sample_id']]
-
-        #Pool and library should be combined in the sample_id
-        if '__' in sample_id:
-            sample_pool, sample_lib = sample_id.split('__')
-        else:
-            sample_pool, sample_lib = '', sample_id
-
+    for row in lane_rows:
+        #Pool and library are combined in the sample_id, and SampleSheetReader splits them.
         # I used to set 'NoPool' to '' at this point but it turned out to be a bad idea.
 
         #Avoid use of defaultdict as it gums up YAML serialization. This is equivalent.
-        res.setdefault(sample_project, dict()).setdefault(sample_pool, []).append(sample_lib)
+        res.setdefault(row.sample_project, dict()).setdefault(row.pool, []).append(row.library)
 
     return res
 
@@ -25,7 +25,7 @@ def glob():
 glob = glob()
 
 # Direct import form a runnable program. This should really be made a library.
-from RunStatus import RunStatus
+from illuminatus.RunStatus import RunStatus
 
 # Default environment
 environ = dict( ENVIRON_SH = os.environ.get("ENVIRON_SH", "./environ.sh"),
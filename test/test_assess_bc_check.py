@@ -8,12 +8,15 @@
 import sys, os, re
 import unittest
 import logging
+import json
 from glob import glob
+from tempfile import TemporaryDirectory
+from shutil import copytree
 
 DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/read1_qc_examples')
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
 
-from assess_bc_check import main as check_main, load_stats
+from assess_bc_check import main as check_main, census_main, load_stats
 
 class T(unittest.TestCase):
 
@@ -66,5 +69,59 @@ class T(unittest.TestCase):
         ex2 = self.get_ex('220113_A00291_0410_AHV23HDRXY', 'lane2')
         self.assertEqual(check_main(ex2), expected_res)
 
+    def test_tile_counts(self):
+        """With counts for several tiles from index_sampler.py, only complain if the
+           difference is clear.
+        """
+        with TemporaryDirectory() as tmp_dir:
+            lane_dir = os.path.join(tmp_dir, 'lane2')
+            copytree(os.path.join(DATA_DIR, '220113_A00291_0410_AHV23HDRXY', 'QC/bc_check/lane2'), lane_dir)
+            stats_json = [ os.path.join(lane_dir, 'Stats/Stats.json') ]
+
+            def _write_tile_counts(samples, undetermined):
+                with open(os.path.join(lane_dir, 'tile_counts.json'), 'w') as tfh:
+                    json.dump( dict( tiles = ['2101', '2178', '2278', '2201'][:len(undetermined)],
+                                     clusters_pf = [ 1000 ] * len(undetermined),
+                                     samples = { '21360GNpool01__21360GN0345L01': samples },
+                                     undetermined = undetermined ), tfh )
+
+            # The project is clearly low on every tile
+            _write_tile_counts([5, 6, 4, 5], [140, 135, 145, 140])
+            res = check_main(stats_json)
+            self.assertEqual( res[:3], [ 'Problem in lane 2:',
+                                         'Project 21360 has only 14901 total reads, compared to 416186 unassigned.',
+                                         'Over 4 tiles, project 21360 has 0.50% ± 0.22% of the reads,'
+                                         ' compared to 14.00% ± 1.08% unassigned.' ] )
+
+            # Two tiles that disagree give no confidence
+            _write_tile_counts([5, 300], [140, 100])
+            self.assertEqual(check_main(stats_json), [])
+
+    def test_census(self):
+        """Warnings from barcode_census.py are reported separately, so the bc_check
+           does not have to wait for the census.
+        """
+        with TemporaryDirectory() as tmp_dir:
+            lane_dir = os.path.join(tmp_dir, 'lane1')
+            copytree(os.path.join(DATA_DIR, '220113_A00291_0410_AHV23HDRXY', 'QC/bc_check/lane1'), lane_dir)
+            stats_json = [ os.path.join(lane_dir, 'Stats/Stats.json') ]
+            census_json = [ os.path.join(lane_dir, 'census.json') ]
+
+            # An empty file means the census failed, and is ignored
+            open(census_json[0], 'w').close()
+            self.assertEqual(census_main(census_json), [])
+
+            with open(census_json[0], 'w') as cfh:
+                json.dump( dict( lane = 1, tiles = 156, clusters_pf = 1000,
+                                 unassigned = dict(NumberReads=100, Fraction=0.1),
+                                 warnings = [ "Sample foo (AAAA+CCCC) is predicted to get only 0 reads." ] ), cfh )
+            self.assertEqual( census_main(census_json), [ 'Problem in lane 1:',
+                                                          'Counting the indexes over all 156 tiles found:',
+                                                          'Sample foo (AAAA+CCCC) is predicted to get only 0 reads.',
+                                                          '100 of 1000 reads are predicted to be unassigned.' ] )
+
+            # The bc_check takes no notice
+            self.assertEqual(check_main(stats_json), [])
+
 if __name__ == '__main__':
     unittest.main()
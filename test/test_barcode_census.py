@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import os, re
+import unittest
+from unittest.mock import patch
+import struct
+import json
+import numpy as np
+from tempfile import TemporaryDirectory
+
+from illuminatus.BarcodeCensus import BarcodeCensus, neighbours, pack_keys, unpack_keys, merge_counts
+from illuminatus.IndexSampler import IndexSampler, encode_seq
+
+from test_index_sampler import write_cbcl
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
+
+SAMPLE_SHEET = """[Header]
+Run ID,220113_A00291_0410_AHV23HDRXY
+
+[bcl2fastq]
+--barcode-mismatches 1
+--use-bases-mask 'Yn*,I8,I8,n*'
+--tiles 's_[1]_2101'
+
+[Data]
+Lane,Sample_ID,Sample_Name,Sample_Plate,Sample_Well,Sample_Project,index,index2,Description
+1,21360GNpool01__21360GN0345L01,,,,21360,CTTTAACT,TGACGATT,
+1,21360GNpool01__21360GN0346L01,,,,21360,GCCTCTAT,AAATCAGC,
+1,21360GNpool01__21360GN0347L01,,,,21360,AACCGGTA,AGCTTGCA,
+"""
+
+# The same clusters on each tile. The last sample has index2 the wrong way around.
+CLUSTERS = ( [ ('CTTTAACT', 'TGACGATT', True) ] * 10 +
+             [ ('CTTTAACA', 'TGACGATT', True) ] * 2 +
+             [ ('GCCTCTAT', 'AAATCAGC', True) ] * 8 +
+             [ ('AACCGGTA', 'TGCAAGCT', True) ] * 6 +
+             [ ('GGGGGGGG', 'AGATCTCG', True) ] * 12 +
+             [ ('CTTTAACT', 'TGACGATT', False) ] * 2 )
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.run_dir = os.path.join(tmp_dir.name, 'run')
+        self.out_dir = os.path.join(tmp_dir.name, 'out')
+        os.makedirs(self.out_dir)
+
+        # Just two tiles in the lane
+        with open(os.path.join(DATA_DIR, '220113_A00291_0410_AHV23HDRXY', 'RunInfo.xml')) as rfh:
+            run_info = re.sub(r'\s*<Tile>(?!1_210[12]<)[^<]*</Tile>', '', rfh.read())
+        os.makedirs(self.run_dir)
+        with open(os.path.join(self.run_dir, 'RunInfo.xml'), 'w') as rfh:
+            rfh.write(run_info)
+
+        basecalls = os.path.join(self.run_dir, 'Data/Intensities/BaseCalls/L001')
+        os.makedirs(basecalls)
+        for tile in [2101, 2102]:
+            with open(os.path.join(basecalls, 's_1_{}.filter'.format(tile)), 'wb') as ffh:
+                ffh.write(struct.pack('<III', 0, 3, len(CLUSTERS)))
+                ffh.write(bytes( int(c[2]) for c in CLUSTERS ))
+
+        seqs = { 1: 'A' * len(CLUSTERS) }
+        for pos in range(8):
+            seqs[152 + pos] = [ c[0][pos] for c in CLUSTERS ]
+            seqs[160 + pos] = [ c[1][pos] for c in CLUSTERS ]
+        for cycle, bases in seqs.items():
+            cycle_dir = os.path.join(basecalls, 'C{}.1'.format(cycle))
+            os.makedirs(cycle_dir)
+            calls = [ ('ACGT'.index(b), 3) for b in bases ]
+            write_cbcl(os.path.join(cycle_dir, 'L001_2.cbcl'), { 2101: calls, 2102: calls })
+
+        self.sample_sheet = os.path.join(self.out_dir, 'SampleSheet.filtered.csv')
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET)
+
+    def run_census(self):
+        census = BarcodeCensus(self.run_dir, self.out_dir, self.sample_sheet, 1)
+        census.prepare()
+        census.run()
+        return census.collect_stats()
+
+    def test_keys(self):
+        codes = encode_seq('ACGTN')
+        self.assertEqual(unpack_keys(pack_keys(codes[None, :]), 5).tolist(), [codes.tolist()])
+
+        # Each base can change to four others, including N
+        self.assertEqual(len(neighbours(encode_seq('ACGT'), 1)), 1 + 4 * 4)
+        self.assertEqual(len(neighbours(encode_seq('ACGT'), 0)), 1)
+
+        keys, counts = merge_counts( [ np.array(k, dtype=np.uint64) for k in [[3, 5], [], [5, 1], [3]] ],
+                                     [ np.array(c, dtype=np.int64) for c in [[1, 2], [], [3, 4], [5]] ] )
+        self.assertEqual(keys.tolist(), [1, 3, 5])
+        self.assertEqual(counts.tolist(), [4, 6, 5])
+
+    def test_census(self):
+        res = self.run_census()
+
+        self.assertEqual(res['tiles'], 2)
+        self.assertEqual(res['clusters_raw'], 80)
+        self.assertEqual(res['clusters_pf'], 76)
+        self.assertEqual([ s['NumberReads'] for s in res['samples'] ], [24, 16, 0])
+        self.assertEqual(res['unassigned']['NumberReads'], 36)
+        self.assertEqual(res['samples'][0]['PredictedYield'], 24 * (150 + 150))
+        self.assertEqual(res['samples'][2]['Revcomp'], dict(index=0, index2=12, both=0))
+        self.assertEqual(list(res['unknown_barcodes'].items())[:2], [ ('GGGGGGGG+AGATCTCG', 24),
+                                                                      ('AACCGGTA+TGCAAGCT', 12) ])
+        self.assertEqual(res['warnings'], [
+            "Sample 21360GNpool01__21360GN0347L01 (AACCGGTA+AGCTTGCA) is predicted to get only 0 reads,"
+            " compared to a mean of 13. With index2 reverse complemented it would get 12.",
+            "Unknown barcode GGGGGGGG+AGATCTCG has 24 reads, more than the mean per sample." ])
+
+        with open(os.path.join(self.out_dir, 'census.json')) as cfh:
+            self.assertEqual(json.load(cfh), json.loads(json.dumps(res)))
+
+        # Merging the counts after every tile gives the same answer
+        with patch('illuminatus.BarcodeCensus.MERGE_TILES', 1):
+            res2 = self.run_census()
+        self.assertEqual(res2['samples'], res['samples'])
+        self.assertEqual(res2['unknown_barcodes'], res['unknown_barcodes'])
+
+        # The numbers should agree with the index sampler reading the same tiles
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET.replace("'s_[1]_2101'", "'s_[1]_210[12]'"))
+        sampler = IndexSampler(self.run_dir, self.out_dir, self.sample_sheet, 1)
+        sampler.prepare()
+        sampler.run()
+        conversion, = sampler.collect_stats()['ConversionResults']
+        self.assertEqual( [ s['NumberReads'] for s in conversion['DemuxResults'] ],
+                          [ s['NumberReads'] for s in res['samples'] ] )
+        self.assertEqual(conversion['Undetermined']['NumberReads'], res['unassigned']['NumberReads'])
+
+    def test_revcomp_lane(self):
+        """If index2 is the wrong way around for the whole lane we should say so
+        """
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET.replace(',TGACGATT,', ',AATCGTCA,')
+                                  .replace(',AAATCAGC,', ',GCTGATTT,')
+                                  .replace(',AGCTTGCA,', ',TGCAAGCT,'))
+        res = self.run_census()
+
+        self.assertEqual([ s['NumberReads'] for s in res['samples'] ], [0, 0, 12])
+        self.assertEqual(res['revcomp'], dict(index=0, index2=40, both=0))
+        self.assertEqual( res['warnings'][0],
+                          "Reverse complementing index2 would assign 40 reads, compared to 12 as it is." )
+
+if __name__ == '__main__':
+    unittest.main()
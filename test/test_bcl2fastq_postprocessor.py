@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import unittest
 import sys, os, re
+import json
+import gzip
+import xml.etree.ElementTree as ET
 from tempfile import mkdtemp
 from shutil import rmtree, copytree
 from glob import glob
@@ -9,7 +12,8 @@ from fnmatch import fnmatch
 
 #from BCL2FASTQPostprocessor import BCL2FASTQPostprocessor
 from BCL2FASTQPostprocessor import main as pp_main
-from BCL2FASTQPostprocessor import do_renames, save_projects_ready, ERRORS
+from BCL2FASTQPostprocessor import do_renames, save_projects_ready, merge_lane_groups, merge_lane_shards, ERRORS
+from BCL2FASTQPostprocessor import filter_group_undetermined, filter_fastq, read_chunks
 
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
 
@@ -176,8 +180,181 @@ class T(unittest.TestCase):
         # projects_ready should be empty as no valid files were found
         self.assertEqual(slurp(os.path.join(out_dir, 'projects_ready.txt')), [])
 
+    def test_groups(self):
+        """Lane 1 was split into two groups by index length, which need to be merged.
+        """
+        ERRORS.clear()
+        out_dir = self.run_postprocessor('160811_D00261_0355_BC9DA7ANXX', '.groups', merge=True)
+        lane_dir = os.path.join(out_dir, 'demultiplexing/lane1')
+
+        # Only the unassigned reads from group 1 are kept, without the read that was
+        # assigned in group 2
+        fqgz = find_by_pattern(out_dir, "*.fastq.gz")
+        self.assertEqual(fqgz, [
+            '10510/10510GCpool05/160811_D00261_0355_BC9DA7ANXX_1_10510GC0017L01_1.fastq.gz',
+            '10510/10510GCpool05/160811_D00261_0355_BC9DA7ANXX_1_10510GC0018L01_1.fastq.gz',
+            '10510/10510GCpool06/160811_D00261_0355_BC9DA7ANXX_1_10510GC0019L01_1.fastq.gz',
+            '160811_D00261_0355_BC9DA7ANXX_1_unassigned_1.fastq.gz',
+            ])
+        with gzip.open(os.path.join(out_dir, '160811_D00261_0355_BC9DA7ANXX_1_unassigned_1.fastq.gz'), 'rt') as ufh:
+            self.assertEqual( [ l.split()[0] for l in ufh if l.startswith('@') ],
+                              [ '@D00261:355:C9DA7ANXX:1:1101:1000:1001',
+                                '@D00261:355:C9DA7ANXX:1:1102:1000:1003' ] )
+        self.assertIn("# removed 1 reads assigned in other groups", self.pp_log)
+        self.assertEqual(slurp(os.path.join(out_dir, 'projects_ready.txt')), ['10510'])
+        self.assertFalse(ERRORS)
+
+        # The stats show all three samples and the reads for group 2 are no longer undetermined
+        with open(os.path.join(lane_dir, 'Stats/Stats.json')) as jfh:
+            stats = json.load(jfh)
+        cr, = stats['ConversionResults']
+        self.assertEqual( [ dr['SampleId'][-5:] for dr in cr['DemuxResults'] ], ['17L01', '18L01', '19L01'] )
+        self.assertEqual( cr['Undetermined']['NumberReads'], 50 )
+        self.assertEqual( cr['Undetermined']['ReadMetrics'][0]['Yield'], 2500 )
+        self.assertEqual( stats['ReadInfosForLanes'][0]['ReadInfos'][1]['NumCycles'], 8 )
+        self.assertEqual( stats['UnknownBarcodes'][0]['Barcodes'], {"GGGGGGGG+AGATCTCG": 40} )
+
+        self.assertEqual( slurp(os.path.join(lane_dir, 'Stats/FastqSummaryF1L1.txt')), [
+                          "SampleNumber\tTile\tNumberOfReadsRaw\tNumberOfReadsPF",
+                          "0\t1101\t250\t50",  "1\t1101\t200\t200", "2\t1101\t150\t150",
+                          "0\t1102\t200\t0",   "1\t1102\t200\t200", "2\t1102\t150\t150",
+                          "3\t1101\t150\t150", "3\t1102\t100\t100" ])
+
+        # Both masks are in bcl2fastq.opts, group 1 first
+        self.assertEqual( [ l for l in slurp(os.path.join(lane_dir, 'bcl2fastq.opts'))
+                            if l.startswith('--use-bases-mask') ],
+                          [ "--use-bases-mask 'Y50n,I8,I8'", "--use-bases-mask 'Y50n,I6n*,n*'" ] )
+        self.assertEqual( slurp(os.path.join(lane_dir, 'bcl2fastq.version')), ["bcl2fastq v2.20.0.422"] )
+
+        # Merging again makes no difference
+        merge_lane_groups(out_dir, log=lambda l: self.pp_log.append(l))
+        with open(os.path.join(lane_dir, 'Stats/Stats.json')) as jfh:
+            self.assertEqual( json.load(jfh), stats )
+
+    def test_filter_undetermined(self):
+        """The filtering of group 1's Undetermined files is normally done by a separate
+           cluster job, and then merge_lane_groups() just logs what was done.
+        """
+        ERRORS.clear()
+        temp_dir = mkdtemp()
+        self.addCleanup(lambda: rmtree(temp_dir))
+        out_dir = os.path.join(temp_dir, '160811_D00261_0355_BC9DA7ANXX')
+        copytree( os.path.join(self.demuxed_dir, '160811_D00261_0355_BC9DA7ANXX.groups'), out_dir )
+        lane_dir = os.path.join(out_dir, 'demultiplexing/lane1')
+
+        self.assertEqual( filter_group_undetermined(lane_dir, log=lambda l: self.pp_log.append(l)), 1 )
+        self.assertEqual( slurp(os.path.join(lane_dir, 'group1/undetermined_filtered.log')),
+                          [ "filter demultiplexing/lane1/group1/Undetermined_S0_L001_R1_001.fastq.gz",
+                            "# removed 1 reads assigned in other groups" ] )
+
+        self.pp_log.clear()
+        merge_lane_groups(out_dir, log=lambda l: self.pp_log.append(l))
+        self.assertIn("# removed 1 reads assigned in other groups", self.pp_log)
+        with gzip.open(os.path.join(lane_dir, 'Undetermined_S0_L001_R1_001.fastq.gz'), 'rt') as ufh:
+            self.assertEqual( len([ l for l in ufh if l.startswith('@') ]), 2 )
+        self.assertFalse(ERRORS)
+
+    def test_filter_fastq(self):
+        """Paired files are filtered together, going through the tiles in order
+        """
+        temp_dir = mkdtemp()
+        self.addCleanup(lambda: rmtree(temp_dir))
+
+        def write_fastq(name, positions, read='1'):
+            with gzip.open(os.path.join(temp_dir, name), 'wt') as ffh:
+                for tile, x, y in positions:
+                    print(f"@D00261:355:C9DA7ANXX:1:{tile}:{x}:{y} {read}:N:0:AAAA", "ACGT", "+", "FFFF",
+                          sep="\n", file=ffh)
+        def read_fastq(name):
+            with gzip.open(os.path.join(temp_dir, name), 'rt') as ffh:
+                return [ l.split()[0] for n, l in enumerate(ffh) if n % 4 == 0 ]
+
+        undet = [ (1101, 1, 1), (1101, 1, 2), (1101, 2, 1), (1102, 1, 1), (1104, 5, 5), (2101, 1, 2) ]
+        write_fastq('u_R1.fastq.gz', undet)
+        write_fastq('u_R2.fastq.gz', undet, read='2')
+        # One file has a tile that is not in the undetermined reads
+        write_fastq('a_R1.fastq.gz', [ (1101, 1, 2), (1103, 1, 1), (2101, 1, 2) ])
+        write_fastq('b_R1.fastq.gz', [ (1101, 2, 1), (1102, 1, 2) ])
+
+        dropped = filter_fastq( [ os.path.join(temp_dir, f) for f in ['u_R1.fastq.gz', 'u_R2.fastq.gz'] ],
+                                [ os.path.join(temp_dir, f) for f in ['o_R1.fastq.gz', 'o_R2.fastq.gz'] ],
+                                [ os.path.join(temp_dir, f) for f in ['a_R1.fastq.gz', 'b_R1.fastq.gz'] ] )
+        self.assertEqual(dropped, 3)
+        kept = [ '@D00261:355:C9DA7ANXX:1:1101:1:1',
+                 '@D00261:355:C9DA7ANXX:1:1102:1:1',
+                 '@D00261:355:C9DA7ANXX:1:1104:5:5' ]
+        self.assertEqual(read_fastq('o_R1.fastq.gz'), kept)
+        self.assertEqual(read_fastq('o_R2.fastq.gz'), kept)
+
+        # Big tiles are read in chunks
+        with gzip.open(os.path.join(temp_dir, 'u_R1.fastq.gz'), 'rb') as ufh:
+            self.assertEqual( [ (tile, len(recs[0]), list(keys)) for tile, recs, keys in read_chunks([ufh], 2) ],
+                              [ (1101, 2, [ (1<<32) + 1, (1<<32) + 2 ]), (1101, 1, [ (2<<32) + 1 ]),
+                                (1102, 1, [ (1<<32) + 1 ]), (1104, 1, [ (5<<32) + 5 ]), (2101, 1, [ (1<<32) + 2 ]) ] )
+
+        # Tiles out of order are an error
+        write_fastq('b_R1.fastq.gz', [ (1102, 1, 2), (1101, 2, 1) ])
+        with self.assertRaises(ValueError):
+            filter_fastq( [ os.path.join(temp_dir, 'u_R1.fastq.gz') ],
+                          [ os.path.join(temp_dir, 'o_R1.fastq.gz') ],
+                          [ os.path.join(temp_dir, 'b_R1.fastq.gz') ] )
+
+    def test_shards(self):
+        """Lane 1 was demultiplexed in two shards by tile, which need to be added together.
+        """
+        ERRORS.clear()
+        out_dir = self.run_postprocessor('160811_D00261_0355_BC9DA7ANXX', '.shards', merge=True)
+        lane_dir = os.path.join(out_dir, 'demultiplexing/lane1')
+
+        fqgz = find_by_pattern(out_dir, "*.fastq.gz")
+        self.assertEqual(fqgz, [
+            '10510/10510GCpool05/160811_D00261_0355_BC9DA7ANXX_1_10510GC0017L01_1.fastq.gz',
+            '10510/10510GCpool05/160811_D00261_0355_BC9DA7ANXX_1_10510GC0018L01_1.fastq.gz',
+            '160811_D00261_0355_BC9DA7ANXX_1_unassigned_1.fastq.gz',
+            ])
+        self.assertFalse(ERRORS)
+
+        # The concatenated files are valid gzip, with the shards in order
+        with gzip.open(os.path.join(out_dir, fqgz[1]), 'rt') as zfh:
+            self.assertEqual(zfh.read(), "shard1 sample2\nshard2 sample2\n")
+        with gzip.open(os.path.join(out_dir, fqgz[2]), 'rt') as zfh:
+            self.assertEqual(zfh.read(), "shard1 undetermined\nshard2 undetermined\n")
+
+        # The stats are added up
+        with open(os.path.join(lane_dir, 'Stats/Stats.json')) as jfh:
+            stats = json.load(jfh)
+        cr, = stats['ConversionResults']
+        self.assertEqual( (cr['TotalClustersRaw'], cr['TotalClustersPF'], cr['Yield']), (2800, 1350, 67500) )
+        self.assertEqual( [ dr['NumberReads'] for dr in cr['DemuxResults'] ], [500, 500] )
+        self.assertEqual( cr['DemuxResults'][0]['IndexMetrics'][0]['MismatchCounts'], {"0": 497, "1": 3} )
+        self.assertEqual( cr['DemuxResults'][1]['ReadMetrics'][0]['YieldQ30'], 12500 )
+        self.assertEqual( cr['Undetermined']['NumberReads'], 350 )
+        self.assertEqual( stats['UnknownBarcodes'][0]['Barcodes'], { "ACGTACGG+AGATCTCG": 180,
+                                                                     "GGGGGGGG+AGATCTCG": 70 } )
+
+        demux_xml = ET.parse(os.path.join(lane_dir, 'Stats/DemultiplexingStats.xml'))
+        self.assertEqual( [ e.text for e in demux_xml.iter('BarcodeCount') ], ['500'] )
+        conv_xml = ET.parse(os.path.join(lane_dir, 'Stats/ConversionStats.xml'))
+        self.assertEqual( [ e.get('number') for e in conv_xml.iter('Tile') ], ['1101', '1102', '2101', '2102'] )
+
+        summary = slurp(os.path.join(lane_dir, 'Stats/FastqSummaryF1L1.txt'))
+        self.assertEqual( len(summary), 1 + 3 * 4 )
+        self.assertEqual( summary[-1], "2\t2102\t200\t100" )
+
+        self.assertEqual( [ l for l in slurp(os.path.join(lane_dir, 'bcl2fastq.opts'))
+                            if l.startswith('#') or l.startswith('--tiles') ],
+                          [ "# Tile shard 1", "--tiles 's_[1]_1101,s_[1]_1102'",
+                            "# Tile shard 2", "--tiles 's_[1]_2101,s_[1]_2102'" ] )
+        self.assertEqual( slurp(os.path.join(lane_dir, 'bcl2fastq.version')), ["bcl2fastq v2.20.0.422"] )
+
+        # Merging again makes no difference
+        merge_lane_shards(out_dir, log=lambda l: self.pp_log.append(l))
+        with open(os.path.join(lane_dir, 'Stats/Stats.json')) as jfh:
+            self.assertEqual( json.load(jfh), stats )
+        self.assertEqual( find_by_pattern(out_dir, "*.fastq.gz"), fqgz )
+
     # Helper functions
-    def run_postprocessor(self, run_id, suffix=''):
+    def run_postprocessor(self, run_id, suffix='', merge=False):
         """This will copy a selected test directory into a temp dir, run the postprocessor
            on it and return the path to the temp dir.
            All output will be written to self.pp_log which is just a list and can be
@@ -194,6 +371,9 @@ class T(unittest.TestCase):
                   copy_of_test_dir,
                   symlinks=True )
 
+        if merge:
+            merge_lane_groups(copy_of_test_dir, log=lambda l: self.pp_log.append(l))
+            merge_lane_shards(copy_of_test_dir, log=lambda l: self.pp_log.append(l))
         proj_seen = do_renames(copy_of_test_dir, run_id, log=lambda l: self.pp_log.append(l))
         save_projects_ready(copy_of_test_dir, proj_seen)
         self.pp_proj_list.extend(proj_seen)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""Test the incremental reading of bcl2fastq logs and FASTQ files"""
+
+import os
+import unittest
+from unittest.mock import patch
+import gzip
+import random
+import struct
+from shutil import copy
+
+from sandbox import TestSandbox
+
+import illuminatus.BCL2FASTQProgress
+from illuminatus.BCL2FASTQProgress import BCL2FASTQProgress, read_pf_clusters, count_fastq_reads
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__))
+EXAMPLE_RUN = DATA_DIR + '/seqdata_examples/201125_A00291_0321_AHWHKYDRXX'
+EXAMPLE_LOGS = DATA_DIR + '/fastqdata_examples/210129_A00291_0331_BH2V73DRXY/demultiplexing'
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.sandbox = TestSandbox()
+        self.sandbox.make('demultiplexing/lane1/')
+        self.demux_dir = os.path.join(self.sandbox.sandbox, 'demultiplexing')
+        self.log_file = os.path.join(self.demux_dir, 'lane1', 'bcl2fastq.log')
+
+        # A run with InterOp/TileMetricsOut.bin
+        self.run_dir = self.sandbox.make('seqdata/InterOp/')[:-len('InterOp/')]
+        copy(os.path.join(EXAMPLE_RUN, 'RunInfo.xml'), self.run_dir)
+
+        with open(os.path.join(EXAMPLE_LOGS, 'lane1', 'bcl2fastq.log')) as lfh:
+            self.real_log = lfh.readlines()
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def write_log(self, text, mode='a'):
+        with open(self.log_file, mode) as lfh:
+            lfh.write(text)
+
+    def write_tile_metrics(self, pf_clusters, version=3):
+        """pf_clusters is a dict of { (lane, tile): count }
+        """
+        with open(os.path.join(self.run_dir, 'InterOp', 'TileMetricsOut.bin'), 'wb') as tfh:
+            if version == 3:
+                tfh.write(struct.pack('<BBf', 3, 15, 1.0))
+                for (lane, tile), pf in sorted(pf_clusters.items()):
+                    tfh.write(struct.pack('<HIcff', lane, tile, b'r', 1, 0.0))
+                    tfh.write(struct.pack('<HIcff', lane, tile, b't', pf * 1.5, pf))
+            else:
+                tfh.write(struct.pack('<BB', 2, 10))
+                for (lane, tile), pf in sorted(pf_clusters.items()):
+                    tfh.write(struct.pack('<HHHf', lane, tile, 102, pf * 1.5))
+                    tfh.write(struct.pack('<HHHf', lane, tile, 103, pf))
+
+    def write_fastq(self, fastq_file, reads, mode='ab', part='lane1'):
+        """Add some random reads to a FASTQ file. Appending makes a new gzip stream,
+           as bcl2fastq does.
+        """
+        fastq_file = os.path.join(self.demux_dir, part, fastq_file)
+        os.makedirs(os.path.dirname(fastq_file), exist_ok=True)
+        rnd = random.Random(reads)
+        with gzip.open(fastq_file, mode) as ffh:
+            for n in range(reads):
+                seq = ''.join(rnd.choice('ACGT') for b in range(50))
+                qual = ''.join(rnd.choice('FF:,') for b in range(50))
+                ffh.write("@A00291:331:H2V73DRXY:1:2101:{}:1000 1:N:0:ACGT\n{}\n+\n{}\n".format(n, seq, qual).encode())
+
+    ### THE TESTS ###
+    def test_real_log(self):
+        """A complete log from a 1-tile run
+        """
+        self.write_log(''.join(self.real_log))
+        self.write_tile_metrics({(1, 2101): 1000})
+
+        bp = BCL2FASTQProgress(self.demux_dir, self.run_dir)
+        lp = bp.update()['lanes']['1']
+
+        self.assertEqual(lp['state'], 'finished')
+        self.assertEqual(lp['tiles_opt'], 's_[1]_2101')
+        self.assertEqual(lp['tiles_total'], 1)
+        self.assertEqual((lp['reads_done'], lp['reads_expected']), (1000, 1000))
+        self.assertEqual(lp['threads'], dict(loading=4, processing=12, writing=4))
+        self.assertEqual(lp['eta'], '2021-03-19T11:04:34')
+        self.assertEqual(bp.get_summary()['DemuxPercentComplete'], {'1': 100.0})
+
+    def test_incremental(self):
+        """Only new lines of the log are read, and partial lines are left for next time.
+           Progress comes from the FASTQ files.
+        """
+        self.write_tile_metrics({(1, 2101): 1000, (1, 2102): 5000})
+
+        # The real log up to where all the FASTQ files have been created, and bcl2fastq
+        # goes quiet until it's done. The "Tile:" line is before this and says nothing
+        # about progress.
+        created_lines = [ n for n, l in enumerate(self.real_log) if 'Created FASTQ file' in l ]
+        self.write_log(''.join(self.real_log[:created_lines[-1] + 1]))
+        # A partial line
+        partial_line = self.real_log[created_lines[-1] + 1][:20]
+        self.write_log(partial_line)
+
+        bp = BCL2FASTQProgress(self.demux_dir, self.run_dir)
+        lp = bp.update()['lanes']['1']
+        self.assertEqual(lp['state'], 'running')
+        self.assertEqual(lp['tiles_total'], 1)
+        self.assertEqual((lp['reads_done'], lp['reads_expected']), (0, 1000))
+        self.assertEqual(lp['eta'], None)
+        self.assertEqual(bp.get_summary(), dict( DemuxPercentComplete = {'1': 0.0},
+                                                 DemuxETA = 'unknown' ))
+        offset = lp['offset']
+        self.assertEqual(offset, os.stat(self.log_file).st_size - len(partial_line))
+
+        # Now bcl2fastq writes some reads. Only read 1 is counted.
+        self.write_fastq('Undetermined_S0_L001_R1_001.fastq.gz', 100)
+        self.write_fastq('Undetermined_S0_L001_R2_001.fastq.gz', 100)
+        self.write_fastq('15572/15572MApool01-N__15572MA0001L01_S1_L001_R1_001.fastq.gz', 150)
+        self.write_fastq('15572/15572MApool01-N__15572MA0001L01_S1_L001_R2_001.fastq.gz', 150)
+
+        # A new object should pick up from the saved offset
+        bp = BCL2FASTQProgress(self.demux_dir, self.run_dir)
+        self.assertEqual(bp.progress['lanes']['1']['offset'], offset)
+        lp = bp.update()['lanes']['1']
+        self.assertEqual(lp['state'], 'running')
+        self.assertEqual(lp['reads_done'], 250)
+        self.assertTrue(lp['eta'] > '2021-03-19T11:03:50')
+        self.assertEqual(bp.get_summary()['DemuxPercentComplete'], {'1': 25.0})
+
+        self.write_fastq('Undetermined_S0_L001_R1_001.fastq.gz', 250)
+        lp = bp.update()['lanes']['1']
+        self.assertEqual(lp['reads_done'], 500)
+        self.assertEqual(bp.get_summary()['DemuxPercentComplete'], {'1': 50.0})
+
+        # Finish the log
+        self.write_log(self.real_log[created_lines[-1] + 1][20:])
+        self.write_log(''.join(self.real_log[created_lines[-1] + 2:]))
+        lp = bp.update()['lanes']['1']
+        self.assertEqual(lp['state'], 'finished')
+        self.assertEqual(bp.get_summary()['DemuxPercentComplete'], {'1': 100.0})
+
+        # If the log is replaced, we start again
+        os.rename(self.log_file, self.log_file + '.old')
+        self.write_log( "2021-03-19 12:00:00 [abc] Command-line invocation: bcl2fastq -R x -o lane1 -p 12\n" +
+                        "2021-03-19 12:30:00 [abc] Processing completed with 1 errors and 0 warnings.\n" )
+        lp = bp.update()['lanes']['1']
+        self.assertEqual(lp['state'], 'failed')
+        self.assertEqual(lp['tiles_total'], len(bp.get_tiles(1)))
+        self.assertEqual(lp['reads_expected'], None)
+        self.assertEqual(lp['reads_done'], 0)
+
+    def test_split_lanes(self):
+        """Lanes split into shards or groups are tracked per part and added up
+        """
+        self.write_tile_metrics({(1, 1101): 1000, (1, 1102): 1000, (1, 1103): 2000, (2, 1101): 100})
+        def write_part(part, tiles, log_lines=()):
+            part_dir = self.sandbox.make('demultiplexing/{}/'.format(part))
+            with open(os.path.join(part_dir, 'SampleSheet.filtered.csv'), 'w') as sfh:
+                print("[Header]", "", "[bcl2fastq]", "--tiles '{}'".format(tiles), "",
+                      "[Data]", sep="\n", file=sfh)
+            with open(os.path.join(part_dir, 'bcl2fastq.log'), 'a') as lfh:
+                for l in log_lines:
+                    print(l, file=lfh)
+            if not log_lines:
+                os.unlink(os.path.join(part_dir, 'bcl2fastq.log'))
+        def start_line(part, tiles):
+            return "2021-03-19 11:00:00 [abc] Command-line invocation: bcl2fastq -o {} --tiles {} -p 12".format(part, tiles)
+        end_line = "2021-03-19 12:00:00 [abc] Processing completed with 0 errors and 0 warnings."
+
+        os.rmdir(os.path.join(self.demux_dir, 'lane1'))
+        write_part('lane1/shard1', 's_[1]_110[12]', [start_line('lane1/shard1', 's_[1]_110[12]')])
+        write_part('lane1/shard2', 's_[1]_1103')
+        write_part('lane2/group1', 's_[2]_1101', [start_line('lane2/group1', 's_[2]_1101'), end_line])
+        write_part('lane2/group2', 's_[2]_1101', [start_line('lane2/group2', 's_[2]_1101')])
+        self.write_fastq('Undetermined_S0_L001_R1_001.fastq.gz', 500, part='lane1/shard1')
+        self.write_fastq('Undetermined_S0_L002_R1_001.fastq.gz', 50, part='lane2/group2')
+
+        bp = BCL2FASTQProgress(self.demux_dir, self.run_dir)
+        progress = bp.update()
+        self.assertEqual(sorted(progress['lanes']), ['1/shard1', '1/shard2', '2/group1', '2/group2'])
+        self.assertEqual( [ (lp['state'], lp['reads_done'], lp['reads_expected'])
+                            for k, lp in sorted(progress['lanes'].items()) ],
+                          [ ('running', 500, 2000), ('waiting', 0, 2000),
+                            ('finished', 100, 100), ('running', 50, 100) ] )
+        self.assertEqual(bp.get_summary(), dict( DemuxPercentComplete = {'1': 12.5, '2': 75.0},
+                                                 DemuxETA = 'unknown' ))
+
+        # Finish everything
+        write_part('lane1/shard1', 's_[1]_110[12]', [end_line])
+        write_part('lane1/shard2', 's_[1]_1103', [start_line('lane1/shard2', 's_[1]_1103'), end_line])
+        write_part('lane2/group2', 's_[2]_1101', [end_line])
+        self.assertEqual(bp.update()['lanes']['1/shard2']['reads_expected'], 2000)
+        self.assertEqual(bp.get_summary(), dict( DemuxPercentComplete = {'1': 100.0, '2': 100.0},
+                                                 DemuxETA = '2021-03-19T12:00:00' ))
+
+    def test_sample_fastq(self):
+        """Big FASTQ files are estimated from the bytes per read at the start
+        """
+        fastq_file = os.path.join(self.demux_dir, 'lane1', 'Undetermined_S0_L001_R1_001.fastq.gz')
+        self.write_fastq(fastq_file, 1000)
+        self.write_fastq(fastq_file, 1000)
+        self.assertEqual(count_fastq_reads(fastq_file), (2000, os.stat(fastq_file).st_size))
+
+        self.write_log(''.join(self.real_log[:20]))
+        bp = BCL2FASTQProgress(self.demux_dir, self.run_dir)
+        with patch.object(illuminatus.BCL2FASTQProgress, 'SAMPLE_BYTES', 10000):
+            lp = bp.update()['lanes']['1']
+        self.assertEqual(list(lp['bytes_per_read']), ['Undetermined_S0_L001_R1_001.fastq.gz'])
+        self.assertAlmostEqual(lp['reads_done'], 2000, delta=100)
+
+    def test_tile_metrics(self):
+        """Both the old and the NovaSeq versions of TileMetricsOut.bin
+        """
+        pf_clusters = {(1, 1101): 1234, (1, 1102): 5678, (2, 1101): 9}
+        interop_dir = os.path.join(self.run_dir, 'InterOp')
+
+        self.assertEqual(read_pf_clusters(interop_dir), {})
+        for v in [2, 3]:
+            self.write_tile_metrics(pf_clusters, version=v)
+            self.assertEqual(read_pf_clusters(interop_dir), pf_clusters)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -220,7 +220,8 @@ class T(unittest.TestCase):
                                     revcomp = None )
         self.assertEqual( pp.get_bcl2fastq_options(), [ "--fastq-compression-level 6",
                                                         "--use-bases-mask 1:Y147,I8Y11,I8,Y147",
-                                                        "--tiles 's_[1]'" ] )
+                                                        "--tiles 's_[1]'",
+                                                        "--barcode-mismatches 1" ] )
 
         pp = BCL2FASTQPreprocessor( run_source_dir = shadow_dir,
                                     lane = "2",
@@ -258,7 +259,8 @@ class T(unittest.TestCase):
 
         self.assertEqual( pp.get_bcl2fastq_options(), [ "--fastq-compression-level 6",
                                                         "--use-bases-mask 'Y150n,I8,I8,Y150n'",
-                                                        "--tiles 's_[1]_2101'" ] )
+                                                        "--tiles 's_[1]_2101'",
+                                                        "--barcode-mismatches 1" ] )
 
 
     def test_slimmed_run_c(self):
@@ -273,9 +275,45 @@ class T(unittest.TestCase):
         self.assertEqual( pp.get_bc_check_opts(), [ "--fastq-compression-level 6",
                                                     "--use-bases-mask 'Yn*,I8,I8,n*'",
                                                     "--tiles 's_[1]_2101'",
+                                                    "--barcode-mismatches 1",
                                                     "--interop-dir .",
                                                     "--minimum-trimmed-read-length 1" ] )
 
+    def test_bc_check_tiles(self):
+        """With bc_check_tiles the check samples tiles spread over the lane, and the
+           target for the confidence intervals goes in the header.
+        """
+        run_id = '180619_A00291_0044_BH5WJJDMXX'
+        pp = BCL2FASTQPreprocessor( run_source_dir = self.get_ex(run_id),
+                                    lane = "1",
+                                    revcomp = None,
+                                    bc_check = True,
+                                    bc_check_tiles = 4,
+                                    bc_check_ci = 0.01 )
+
+        # bcl2fastq only does the first one, if index_sampler.py fails
+        self.assertIn( "--tiles 's_[1]_1201'", pp.get_bc_check_opts() )
+        self.assertIn( "#BarcodeCheckTiles,1201 1401 2201 2401", pp.get_output('test') )
+        self.assertIn( "#BarcodeCheckCI,0.01", pp.get_output('test') )
+
+        # Tiles from pipeline_settings.ini are respected, and settings there take priority
+        shadow_dir = self.get_ex(run_id, shadow=True)
+        with open(os.path.join(shadow_dir, "pipeline_settings.ini"), 'w') as f:
+            print("[bcl2fastq]", file=f)
+            print("--tiles: 's_[$LANE]_2'", file=f)
+            print("[illuminatus]", file=f)
+            print("bc_check_tiles: 2", file=f)
+
+        pp = BCL2FASTQPreprocessor( run_source_dir = shadow_dir,
+                                    lane = "1",
+                                    revcomp = None,
+                                    bc_check = True,
+                                    bc_check_tiles = 4 )
+
+        self.assertIn( "--tiles 's_[1]_2201'", pp.get_bc_check_opts() )
+        self.assertIn( "#BarcodeCheckTiles,2201 2401", pp.get_output('test') )
+        self.assertFalse( [ l for l in pp.get_output('test') if l.startswith('#BarcodeCheckCI') ] )
+
     def test_nocolon_override(self):
         """SampleSheet.csv should be allowed to override barcode-mismatches etc.
            To be compatible with the processed format this needs to work with no colon.
@@ -316,6 +354,169 @@ class T(unittest.TestCase):
                                                              "--foo bar",
                                                              "--barcode-mismatches 4" ] )
 
+    def test_auto_mismatches(self):
+        """If --barcode-mismatches is not set we should look at the barcodes to pick
+           a value, rather than leaving do_demultiplex.sh to try 1 then 0.
+        """
+        run_id = '180619_A00291_0044_BH5WJJDMXX'
+        shadow_dir = self.get_ex(run_id, shadow=True)
+        ss_file = os.path.join(shadow_dir, 'SampleSheet.csv')
+
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp=None)
+        self.assertEqual( pp.get_bcl2fastq_options()[-1], "--barcode-mismatches 1" )
+        self.assertIn( "#BarcodeMismatches,auto 1 (min distance >2)", pp.get_output('test') )
+
+        # Now make the second library in lane 2 one base away from the first on both indexes
+        with open(ss_file) as fh:
+            lines = list(fh)
+        with open(ss_file, 'w') as fh:
+            for l in lines:
+                if l.startswith('2,11285HMpool01__11285HM0002L01,'):
+                    l = l.replace('TTATAACC', 'CCGCGGTA').replace('GATATCGA', 'AGCGCTAA')
+                print(l, file=fh, end='')
+
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp="auto")
+        self.assertEqual( pp.get_bcl2fastq_options()[-1], "--barcode-mismatches 0" )
+        self.assertIn( "#BarcodeMismatches,auto 0 (min distance 1)", pp.get_output('test') )
+
+        # Lane 1 is unaffected
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="1", revcomp=None)
+        self.assertEqual( pp.get_bcl2fastq_options()[-1], "--barcode-mismatches 1" )
+
+    def test_set_lane(self):
+        """Setting up several lanes with one object should give the same as making a
+           new object for each lane.
+        """
+        run_id = '180619_A00291_0044_BH5WJJDMXX'
+        shadow_dir = self.get_ex(run_id, shadow=True)
+        with open(os.path.join(shadow_dir, "pipeline_settings.lane2.ini"), 'w') as fh:
+            print("[bcl2fastq]", file=fh)
+            print("--barcode-mismatches: 0", file=fh)
+
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="1", revcomp="auto")
+        for lane, rc, bc_check in [ ("2", "auto", False),
+                                    ("1", "12", False),
+                                    ("2", None, True),
+                                    ("1", "auto", True) ]:
+            pp.set_lane(lane=lane, revcomp=rc, bc_check=bc_check)
+            pp_new = BCL2FASTQPreprocessor(shadow_dir, lane=lane, revcomp=rc, bc_check=bc_check)
+
+            self.assertEqual( pp.get_output('test'), pp_new.get_output('test') )
+
+        self.assertRaises( AssertionError, pp.set_lane, lane="3", revcomp=None )
+
+    def test_index_groups(self):
+        """A lane mixing index lengths is split into a group for each pair of lengths.
+        """
+        run_id = '180619_A00291_0044_BH5WJJDMXX'
+        shadow_dir = self.get_ex(run_id, shadow=True)
+        ss_file = os.path.join(shadow_dir, 'SampleSheet.csv')
+
+        def add_lines(*extra):
+            with open(ss_file, 'a') as fh:
+                for l in extra:
+                    print(l, file=fh)
+
+        # Two single-indexed 6-base libraries in lane 2
+        add_lines( "2,11285HMpool02__11285HM0025L01,,H5WJJDMXX,,11285,X,ACGTAC,,,11285HMpool02",
+                   "2,11285HMpool02__11285HM0026L01,,H5WJJDMXX,,11285,X,TGCAGT,,,11285HMpool02" )
+
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp=None)
+        self.assertEqual( pp.index_groups, [[8, 8], [6, 0]] )
+
+        # The sheet for the whole lane is as before, but flagged.
+        out_lines = pp.get_output('test')
+        self.assertIn( "#IndexGroups,2", out_lines )
+        self.assertIn( "--use-bases-mask 'Y50n,I8,I8,Y50n'", out_lines )
+        self.assertEqual( len([ l for l in out_lines if l.startswith('2,') ]), 26 )
+
+        pp.set_group([8, 8])
+        out_lines = pp.get_output('test')
+        self.assertIn( "#IndexGroup,1 of 2 (8+8)", out_lines )
+        self.assertIn( "--use-bases-mask 'Y50n,I8,I8,Y50n'", out_lines )
+        self.assertIn( "#BarcodeMismatches,auto 1 (min distance >2, to other groups >1)", out_lines )
+        self.assertEqual( len([ l for l in out_lines if l.startswith('2,') ]), 24 )
+
+        pp.set_group([6, 0])
+        out_lines = pp.get_output('test')
+        self.assertIn( "#IndexGroup,2 of 2 (6+0)", out_lines )
+        self.assertIn( "--use-bases-mask 'Y50n,I6n*,n*,Y50n'", out_lines )
+        self.assertEqual( [ l.split(',')[1] for l in out_lines if l.startswith('2,') ],
+                          [ "11285HMpool02__11285HM0025L01", "11285HMpool02__11285HM0026L01" ] )
+
+        # Lane 1 is not split
+        pp.set_lane(lane="1", revcomp=None)
+        self.assertEqual( pp.index_groups, [] )
+        self.assertNotIn( "#IndexGroups,2", pp.get_output('test') )
+
+        # A 6-base index one away from the start of an 8-base one forces 0 mismatches
+        # in both groups.
+        add_lines( "2,11285HMpool02__11285HM0027L01,,H5WJJDMXX,,11285,X,CCGCGA,,,11285HMpool02" )
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp=None)
+        for group in pp.index_groups:
+            pp.set_group(group)
+            self.assertEqual( pp.get_bcl2fastq_options()[-1], "--barcode-mismatches 0" )
+
+        # And if it matches exactly the lane can't be split
+        add_lines( "2,11285HMpool02__11285HM0028L01,,H5WJJDMXX,,11285,X,TTATAA,,,11285HMpool02" )
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp=None)
+        self.assertEqual( pp.index_groups, [] )
+
+    def test_tile_shards(self):
+        """A big lane can be split into shards of whole tiles.
+           180619_A00291_0044_BH5WJJDMXX is an S2 flowcell with 704 tiles per lane.
+        """
+        run_id = '180619_A00291_0044_BH5WJJDMXX'
+        shadow_dir = self.get_ex(run_id, shadow=True)
+
+        # Not by default
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="1", revcomp=None)
+        self.assertEqual( pp.tile_shards, [] )
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="1", revcomp=None, tiles_per_shard=1000)
+        self.assertEqual( pp.tile_shards, [] )
+
+        # 176 tiles is two swaths
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="1", revcomp=None, tiles_per_shard=176)
+        self.assertEqual( [ len(s) for s in pp.tile_shards ], [176] * 4 )
+        whole_lane = pp.get_output('test')
+        self.assertIn( "#TileShards,4", whole_lane )
+        self.assertIn( "--tiles 's_[1]'", whole_lane )
+
+        pp.set_shard(2)
+        out_lines = pp.get_output('test')
+        self.assertIn( "#TileShard,2 of 4 (176 tiles 1_1301 to 1_1488)", out_lines )
+        self.assertIn( "--tiles 's_[1]_13,s_[1]_14'", out_lines )
+        # Otherwise the sheet is just the same
+        self.assertEqual( [ l for l in out_lines if not l.startswith(('#TileShard', '--tiles')) ],
+                          [ l for l in whole_lane if not l.startswith(('#TileShard', '--tiles')) ] )
+        pp.set_shard(None)
+        self.assertEqual( pp.get_output('test'), whole_lane )
+        self.assertRaises( AssertionError, pp.set_shard, 5 )
+
+        # Shards need not be whole swaths
+        pp.set_lane(lane="2", revcomp=None, tiles_per_shard=300)
+        self.assertEqual( [ len(s) for s in pp.tile_shards ], [234, 235, 235] )
+        pp.set_shard(1)
+        self.assertIn( "--tiles 's_[2]_11,s_[2]_12,{}'".format(
+                            ','.join("s_[2]_13{:02d}".format(t) for t in range(1, 59)) ),
+                       pp.get_bcl2fastq_options() )
+
+        # No sharding for the barcode check
+        pp.set_lane(lane="2", revcomp=None, tiles_per_shard=300, bc_check=True)
+        self.assertEqual( pp.tile_shards, [] )
+
+        # pipeline_settings.ini can override the setting, or set --tiles which stops it
+        with open(os.path.join(shadow_dir, "pipeline_settings.lane2.ini"), 'w') as fh:
+            print("[illuminatus]", file=fh)
+            print("tiles_per_shard: 352", file=fh)
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp=None, tiles_per_shard=300)
+        self.assertEqual( len(pp.tile_shards), 2 )
+        with open(os.path.join(shadow_dir, "pipeline_settings.ini"), 'w') as fh:
+            print("[bcl2fastq]", file=fh)
+            print("--tiles: s_[$LANE]_1101", file=fh)
+        pp = BCL2FASTQPreprocessor(shadow_dir, lane="2", revcomp=None, tiles_per_shard=176)
+        self.assertEqual( pp.tile_shards, [] )
+
     def test_miseq_badlane(self):
         """What if I try to demux a non-existent lane on a MiSEQ?
         """
@@ -326,7 +527,8 @@ class T(unittest.TestCase):
 
     def test_hiseq_lanes_5_retry(self):
         """ This has all sorts of stuff. Lane 5 has no index.
-            The --barcode-mismatch will not be set so we need to try both options.
+            The --barcode-mismatch is not set in the sample sheet, but with only one
+            sample there can be no collision so it is set to 1.
         """
         run_id = '160607_D00248_0174_AC9E4KANXX'
         pp = BCL2FASTQPreprocessor( run_source_dir = self.get_ex(run_id),
@@ -335,7 +537,8 @@ class T(unittest.TestCase):
 
         self.assertEqual( pp.get_bcl2fastq_options(), [ "--fastq-compression-level 6",
                                                         "--use-bases-mask 'Y50n,n*,n*'",
-                                                        "--tiles 's_[5]'" ] )
+                                                        "--tiles 's_[5]'",
+                                                        "--barcode-mismatches 1" ] )
 
     def test_hiseq_lanes_5_simple(self):
         """ This has all sorts of stuff. Lane 5 has no index.
@@ -435,7 +638,8 @@ class T(unittest.TestCase):
 
             # Check we have the expected options, with no base mask
             self.assertCountEqual( pp.get_bcl2fastq_options(), [ "--fastq-compression-level 6",
-                                                                 "--tiles 's_[1]'" ] )
+                                                                 "--tiles 's_[1]'",
+                                                                 "--barcode-mismatches 1" ] )
 
             # Check we have the [settings] as expected
             self.assertCountEqual( [ l for l in out_lines if l.startswith('[') ],
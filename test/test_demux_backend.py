@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import json
+import gzip
+from tempfile import TemporaryDirectory
+
+from illuminatus.DemuxBackend import get_backend, expand_base_mask, read_filtered_sheet
+from BCL2FASTQPostprocessor import filter_group_undetermined
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
+RUN_DIR = os.path.join(DATA_DIR, '180619_A00291_0044_BH5WJJDMXX')
+
+SAMPLE_SHEET = """[Header]
+Run ID,180619_A00291_0044_BH5WJJDMXX
+#Lane,2
+
+[bcl2fastq]
+--use-bases-mask '$LANE:Y50n,I8,I8,Y50n'
+--tiles 's_[$LANE]_21'
+--barcode-mismatches 1
+
+[Data]
+Lane,Sample_ID,Sample_Name,Sample_Plate,Sample_Well,Sample_Project,index,index2,Description
+2,10510GCpool05__10510GC0017L01,,,,10510,TAATGCGC,CAGGACGT,
+2,10510GCpool05__10510GC0018L01,Renamed,,,10510,TCCGCGAA,CAGGACGT,
+"""
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.out_dir = tmp_dir.name
+
+        self.sample_sheet = os.path.join(self.out_dir, 'SampleSheet.filtered.csv')
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET)
+
+    def test_read_sheet(self):
+        opts, rows = read_filtered_sheet(self.sample_sheet, 2)
+        self.assertEqual(opts, [ ['--use-bases-mask', '2:Y50n,I8,I8,Y50n'],
+                                 ['--tiles', 's_[2]_21'],
+                                 ['--barcode-mismatches', '1'] ])
+        self.assertEqual([ r['index'] for r in rows ], ['TAATGCGC', 'TCCGCGAA'])
+
+    def test_expand_base_mask(self):
+        self.assertEqual( expand_base_mask('1:Y3n,I2,y*', [4, 2, 5]), ['YYYN', 'II', 'YYYYY'] )
+        self.assertEqual( expand_base_mask('Yn*,I6n*', [4, 8]), ['YNNN', 'IIIIIINN'] )
+
+    def test_bcl2fastq(self):
+        """The bcl2fastq backend just runs do_demultiplex.sh
+        """
+        backend = get_backend('bcl2fastq', RUN_DIR, self.out_dir, self.sample_sheet, 2)
+        cmd, = backend.prepare()
+        self.assertEqual(os.path.basename(cmd[0]), 'do_demultiplex.sh')
+        self.assertTrue(os.access(cmd[0], os.X_OK))
+        self.assertEqual(cmd[1:], [RUN_DIR, self.out_dir, self.sample_sheet, '2'])
+
+        self.assertRaises(KeyError, get_backend, 'foo', RUN_DIR, self.out_dir, self.sample_sheet, 2)
+
+    def test_bclconvert(self):
+        """Test the sample sheet conversion and reading of the reports, without
+           actually running bcl-convert.
+        """
+        backend = get_backend('bclconvert', RUN_DIR, self.out_dir, self.sample_sheet, 2)
+        self.assertEqual(backend.override_cycles(), 'Y50N1;I8;I8;Y50N1')
+
+        cmd, = backend.prepare()
+        self.assertEqual(cmd[cmd.index('--tiles') + 1], 's_[2]_21')
+        self.assertEqual(cmd[cmd.index('--bcl-only-lane') + 1], '2')
+        with open(os.path.join(self.out_dir, 'SampleSheet.bclconvert.csv')) as sfh:
+            v2_sheet = sfh.read().split('\n')
+        self.assertIn('BarcodeMismatchesIndex2,1', v2_sheet)
+        self.assertIn('2,10510GCpool05__10510GC0017L01,10510,TAATGCGC,CAGGACGT', v2_sheet)
+
+        reports_dir = os.path.join(self.out_dir, 'bclconvert', 'Reports')
+        os.makedirs(reports_dir)
+        with open(os.path.join(reports_dir, 'Demultiplex_Stats.csv'), 'w') as rfh:
+            print("Lane,SampleID,Sample_Project,Index,# Reads,# Perfect Index Reads,# One Mismatch Index Reads,"
+                  "# Two Mismatch Index Reads,% Reads,% Perfect Index Reads,% One Mismatch Index Reads,"
+                  "% Two Mismatch Index Reads", file=rfh)
+            print("2,10510GCpool05__10510GC0017L01,10510,TAATGCGC-CAGGACGT,400,390,10,0,0.4,0.97,0.03,0", file=rfh)
+            print("2,10510GCpool05__10510GC0018L01,10510,TCCGCGAA-CAGGACGT,500,500,0,0,0.5,1,0,0", file=rfh)
+            print("2,Undetermined,,,100,100,0,0,0.1,1,0,0", file=rfh)
+        with open(os.path.join(reports_dir, 'Quality_Metrics.csv'), 'w') as rfh:
+            print("Lane,SampleID,index,index2,ReadNumber,Yield,YieldQ30,QualityScoreSum,"
+                  "Mean Quality Score (PF),% Q30", file=rfh)
+            for sample, reads in [ ('10510GCpool05__10510GC0017L01', 400),
+                                   ('10510GCpool05__10510GC0018L01', 500),
+                                   ('Undetermined', 100) ]:
+                for rn in ['1', '2']:
+                    print("2,{},,,{},{},{},{},36,0.9".format( sample, rn, reads * 50, reads * 45,
+                                                             reads * 50 * 36 ), file=rfh)
+        with open(os.path.join(reports_dir, 'Top_Unknown_Barcodes.csv'), 'w') as rfh:
+            print("Lane,index,index2,# Reads,% of Unknown Barcodes,% of All Reads", file=rfh)
+            print("2,GGGGGGGG,AGATCTCG,60,0.6,0.06", file=rfh)
+
+        stats = backend.collect_stats()
+        conversion, = stats['ConversionResults']
+        self.assertEqual(conversion['TotalClustersPF'], 1000)
+        self.assertEqual(conversion['Yield'], 1000 * 100)
+        self.assertEqual( conversion['DemuxResults'][0]['IndexMetrics'][0],
+                          dict(IndexSequence='TAATGCGC+CAGGACGT', MismatchCounts={'0': 390, '1': 10}) )
+        self.assertEqual(conversion['Undetermined']['NumberReads'], 100)
+        self.assertEqual(stats['UnknownBarcodes'][0]['Barcodes'], {'GGGGGGGG+AGATCTCG': 60})
+        self.assertEqual([ r['NumCycles'] for r in stats['ReadInfosForLanes'][0]['ReadInfos'] ], [50, 8, 8, 50])
+
+        with open(os.path.join(self.out_dir, 'Stats', 'DemuxSummaryF1L2.txt')) as dfh:
+            self.assertEqual(dfh.read().split('\n')[2], "GGGGGGGG-AGATCTCG\t60")
+        with open(os.path.join(self.out_dir, 'Stats', 'FastqSummaryF1L2.txt')) as ffh:
+            self.assertEqual(ffh.read().split('\n')[1:4], ["0\t0\t100\t100", "1\t0\t400\t400", "2\t0\t500\t500"])
+
+    def test_stub(self):
+        """The stub backend makes output that looks like it came from bcl2fastq
+        """
+        backend = get_backend('stub', RUN_DIR, self.out_dir, self.sample_sheet, 2, reads_per_sample=100)
+        manifest = backend.demultiplex()
+
+        self.assertEqual(manifest, [ '10510/10510GCpool05__10510GC0017L01_S1_L002_R1_001.fastq.gz',
+                                     '10510/10510GCpool05__10510GC0017L01_S1_L002_R2_001.fastq.gz',
+                                     '10510/10510GCpool05__10510GC0018L01/Renamed_S2_L002_R1_001.fastq.gz',
+                                     '10510/10510GCpool05__10510GC0018L01/Renamed_S2_L002_R2_001.fastq.gz',
+                                     'Undetermined_S0_L002_R1_001.fastq.gz',
+                                     'Undetermined_S0_L002_R2_001.fastq.gz' ])
+
+        with open(os.path.join(self.out_dir, 'Stats', 'Stats.json')) as sfh:
+            stats = json.load(sfh)
+        conversion, = stats['ConversionResults']
+        sample1 = conversion['DemuxResults'][0]
+
+        with gzip.open(os.path.join(self.out_dir, manifest[1]), 'rt') as ffh:
+            lines = ffh.read().split('\n')
+        self.assertEqual(len(lines), sample1['NumberReads'] * 4 + 1)
+        self.assertRegex(lines[0], r'^@A00291:44:H5WJJDMXX:2:21\d\d:\d+:\d+ 2:N:0:[ACGT]{8}\+CAGGACGT$')
+        self.assertEqual(len(lines[1]), 50)
+        self.assertEqual(sum(sample1['IndexMetrics'][0]['MismatchCounts'].values()), sample1['NumberReads'])
+        self.assertEqual( conversion['TotalClustersPF'],
+                          sum( r['NumberReads'] for r in conversion['DemuxResults'] ) +
+                          conversion['Undetermined']['NumberReads'] )
+
+        # The reads are spread over the 88 tiles in swath 1 of the bottom surface
+        with open(os.path.join(self.out_dir, 'Stats', 'FastqSummaryF1L2.txt')) as ffh:
+            tiles = set( l.split('\t')[1] for l in list(ffh)[1:] )
+        self.assertEqual(len(tiles), 88)
+
+        # And the same again makes the same reads
+        with TemporaryDirectory() as out_dir2:
+            get_backend('stub', RUN_DIR, out_dir2, self.sample_sheet, 2, reads_per_sample=100).demultiplex()
+            with open(os.path.join(out_dir2, 'Stats', 'Stats.json')) as sfh:
+                self.assertEqual(json.load(sfh), stats)
+
+    def test_stub_groups(self):
+        """The stub output is in tile order like that of bcl2fastq, so a lane that is split
+           into index groups can be filtered as normal.
+        """
+        lane_dir = os.path.join(self.out_dir, 'demultiplexing', 'lane2')
+        os.makedirs(lane_dir)
+        with open(os.path.join(lane_dir, 'SampleSheet.filtered.csv'), 'w') as sfh:
+            sfh.write(SAMPLE_SHEET.replace("#Lane,2", "#Lane,2\n#IndexGroups,2"))
+
+        results = []
+        for g, sheet_lines in [ (1, SAMPLE_SHEET), (2, SAMPLE_SHEET.replace('TAATGCGC', 'GGACTCCT')) ]:
+            group_dir = os.path.join(lane_dir, f"group{g}")
+            os.makedirs(group_dir)
+            group_sheet = os.path.join(group_dir, 'SampleSheet.filtered.csv')
+            with open(group_sheet, 'w') as sfh:
+                sfh.write(sheet_lines)
+            # Enough reads that every file goes round all 88 tiles
+            backend = get_backend('stub', RUN_DIR, group_dir, group_sheet, 2, reads_per_sample=2000)
+            backend.demultiplex()
+            results.append(backend.sample_results)
+
+        def read_names(fastq_file):
+            with gzip.open(fastq_file, 'rt') as ffh:
+                return [ l.split()[0] for n, l in enumerate(ffh) if n % 4 == 0 ]
+
+        undet_r1 = os.path.join(lane_dir, 'group1', 'Undetermined_S0_L002_R1_001.fastq.gz')
+        for fastq_file in [ undet_r1,
+                            os.path.join(lane_dir, 'group2', '10510', '10510GCpool05__10510GC0017L01_S1_L002_R1_001.fastq.gz') ]:
+            tiles = [ n.split(':')[4] for n in read_names(fastq_file) ]
+            self.assertEqual(tiles, sorted(tiles))
+            self.assertEqual(len(set(tiles)), 88)
+
+        dropped = filter_group_undetermined(lane_dir, log=lambda m: None, threads=2)
+        undet_reads = results[0][-1]['NumberReads']
+        self.assertEqual(len(read_names(undet_r1)), undet_reads - dropped)
+        self.assertEqual( read_names(undet_r1),
+                          read_names(undet_r1.replace('_R1_', '_R2_')) )
+
+if __name__ == '__main__':
+    unittest.main()
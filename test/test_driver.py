@@ -4,12 +4,16 @@ import unittest
 import sys, os, re
 
 import subprocess
+import json
+import time
+import socket
 from tempfile import mkdtemp
 from shutil import rmtree, copytree, copyfileobj
 from glob import glob
 
 # See what version Illuminatus thinks it is
 from illuminatus import illuminatus_version
+from illuminatus.RunTimeline import load_events
 
 """Here we're using a Python script to test a shell script.  The shell script calls
    various programs.  Ideally we want to have a cunning way of catching and detecting
@@ -88,13 +92,14 @@ class T(unittest.TestCase):
         with open(fname) as fh:
             copyfileobj(fh, dest)
 
-    def bm_rundriver(self, expected_retval=0, check_stderr=True):
+    def bm_rundriver(self, expected_retval=0, check_stderr=True, args=()):
         """A convenience wrapper around self.bm.runscript that sets the environment
            appropriately and runs DRIVER and returns STDOUT split into an array.
+           Any args are passed to DRIVER, as the run_watcher.py does.
         """
         # Use set_path=False because the driver.sh prepends to the PATH so we have
         # to poke the mock dir in via BIN_LOCATION instead.
-        retval = self.bm.runscript(DRIVER, set_path=False, env=self.environment)
+        retval = self.bm.runscript([DRIVER, *args] if args else DRIVER, set_path=False, env=self.environment)
 
         #Where a file is missing it's always useful to see the error.
         #(status 127 is the standard shell return code for a command not found)
@@ -250,6 +255,77 @@ class T(unittest.TestCase):
         # Log file should appear (here accessed via the output symlink)
         self.assertTrue(os.path.isfile(f"{test_data}/pipeline/output/pipeline.log") )
 
+    def test_specified_runs(self):
+        """The run watcher calls the driver with the names of the runs to look at.
+           Other runs should be left alone.
+        """
+        run1 = "160606_K00166_0102_BHF22YBBXX"
+        run2 = "150602_M01270_0108_000000000-ADWKV"
+        test_data1 = self.copy_run(run1)
+        test_data2 = self.copy_run(run2)
+
+        # Either a name or a path is fine
+        self.bm_rundriver(args=[os.path.join(self.seqdata, run2), 'nosuchrun'])
+        self.assertInStdout("Looking at 2 specified run(s)")
+        self.assertInStdout("No such run directory", "nosuchrun")
+        self.assertInStdout(run2, "NEW")
+        self.assertNotInStdout(run1)
+
+        self.assertFalse(os.path.exists(test_data1 + '/pipeline'))
+        self.assertTrue(os.path.isdir(test_data2 + '/pipeline'))
+
+    def test_prefetch_status(self):
+        """The driver gets the status of all the runs with one call to RunStatus.py,
+           and only looks again at a run if it already did something on this cycle.
+        """
+        runs = [ "150602_M01270_0108_000000000-ADWKV", "210601_A00291_0371_AHF2HCDRXY" ]
+        run_dirs = [ self.copy_run(run) + '/' for run in runs ]
+
+        # Pass the calls through to the real RunStatus.py
+        self.bm.add_mock('RunStatus.py', side_effect=f'exec {RUNSTATUS} "$@"')
+
+        # Both runs are new, so in concurrent mode the second is checked again after the
+        # first is started
+        self.environment['MAX_CONCURRENT_ACTIONS'] = '2'
+        self.bm_rundriver()
+        for run in runs:
+            self.assertInStdout(run, "NEW")
+        calls = self.bm.last_calls['RunStatus.py']
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0][:3], ['--record_states', '--shell', '--fields'])
+        self.assertTrue(calls[0][3].startswith('_RUNDIR=RunDir,'))
+        self.assertEqual(calls[0][4:], run_dirs)
+        self.assertEqual(calls[1][-1], run_dirs[1])
+
+        # Now there is nothing to do, so one call is enough
+        self.bm_rundriver()
+        for run in runs:
+            self.assertInStdout(run, "status=reads_unfinished")
+        self.assertEqual(len(self.bm.last_calls['RunStatus.py']), 1)
+
+    def test_timeline_no_registry(self):
+        """Changes of state are noted in the timeline even with RUN_REGISTRY=none
+        """
+        run = "150602_M01270_0108_000000000-ADWKV"
+        run_dir = self.copy_run(run)
+        self.bm.add_mock('RunStatus.py', side_effect=f'exec {RUNSTATUS} "$@"')
+        self.environment['RUN_REGISTRY'] = 'none'
+
+        # Events from driver.sh itself are not valid JSON as 'date' is mocked, but
+        # load_events() skips these.
+        def states(timeline_file):
+            return [ (e['run'], e['stage']) for e in load_events(timeline_file) if e['event'] == 'state' ]
+
+        # The first time there is no pipeline/ directory so nothing is recorded, but it's
+        # noted as soon as the run is seen again, and only once.
+        for n in range(3):
+            self.bm_rundriver()
+        self.assertFalse(os.path.exists(os.path.join(self.log, 'run_registry.sqlite')))
+        self.assertEqual(states(os.path.join(run_dir, 'pipeline', 'timeline.jsonl')),
+                         [ (run, 'reads_unfinished') ])
+        self.assertEqual(states(os.path.join(self.log, 'timeline.jsonl')),
+                         [ (run, 'reads_unfinished') ])
+
     def test_broken_and_new(self):
         """If a run cannot be processed at all the driver should loop to the next one.
            We'll do this by making the directory unwriteable.
@@ -439,6 +515,222 @@ class T(unittest.TestCase):
         with open(os.path.join(test_data, 'pipeline', 'start_times')) as fh:
             self.assertEqual(fh.read(), f"{illuminatus_version}@DUMMY_DATE\n")
 
+    def test_concurrent_demux(self):
+        """With MAX_CONCURRENT_ACTIONS=2 both runs are demultiplexed at once, unless
+           MAX_CONCURRENT_DEMUX=1. Runs with nothing to do do not take up a slot.
+        """
+        runs = [ "150602_M01270_0108_000000000-ADWKV", "160606_K00166_0102_BHF22YBBXX" ]
+        completed_run = "160726_K00166_0120_BHCVH2BBXX"
+
+        # Each mock demultiplexing holds 'busy' for a while, and notes if it was taken already
+        busy = os.path.join(self.sandbox.sandbox, 'busy')
+        self.bm.add_mock( 'Snakefile.demux',
+                          side_effect = f"mkdir {busy} || touch {busy}.overlap ; sleep 3 ; rmdir {busy} || true" )
+
+        def setup_runs():
+            for run in runs + [completed_run]:
+                for adir in ["seqdata", "fastqdata"]:
+                    rmtree(os.path.join(self.sandbox.sandbox, adir, run), ignore_errors=True)
+                test_data = self.copy_run(run)
+                if not os.path.exists(f"{test_data}/RTAComplete.txt"):
+                    self.sandbox.make(f"seqdata/{run}/RTAComplete.txt")
+                self.sandbox.make(f"seqdata/{run}/pipeline/read1.done")
+                self.sandbox.make(f"fastqdata/{run}/")
+                self.sandbox.link(f"fastqdata/{run}/", f"seqdata/{run}/pipeline/output")
+            for f in ["qc.done"] + [ f"lane{l}.done" for l in "12345678" ]:
+                self.sandbox.make(f"seqdata/{completed_run}/pipeline/{f}")
+
+        # One at a time
+        setup_runs()
+        self.environment.update(MAX_CONCURRENT_ACTIONS='2', MAX_CONCURRENT_DEMUX='1')
+        self.bm_rundriver()
+        self.assertEqual(len(self.bm.last_calls['Snakefile.demux']), 2)
+        self.assertFalse(os.path.exists(busy + '.overlap'))
+        self.assertInStdout(completed_run, "status=complete")
+        for run in runs:
+            self.assertInStdout(run, "READS_FINISHED")
+            self.assertTrue(os.path.exists(os.path.join(self.seqdata, run, 'pipeline/lane1.done')))
+
+        # Both together
+        setup_runs()
+        del self.environment['MAX_CONCURRENT_DEMUX']
+        self.bm_rundriver()
+        self.assertEqual(len(self.bm.last_calls['Snakefile.demux']), 2)
+        self.assertTrue(os.path.exists(busy + '.overlap'))
+        for run in runs:
+            self.assertTrue(os.path.exists(os.path.join(self.seqdata, run, 'pipeline/lane1.done')))
+
+    def test_demux_lease(self):
+        """While demultiplexing, the driver holds pipeline/demux.lease and releases it
+           after. If the lease expires while the run is in_demultiplexing the run is failed.
+        """
+        run = "160606_K00166_0102_BHF22YBBXX"
+        test_data = self.copy_run(run)
+        self.sandbox.make(f"seqdata/{run}/pipeline/read1.done")
+        self.sandbox.make(f"fastqdata/{run}/")
+        self.sandbox.link(f"fastqdata/{run}/", f"seqdata/{run}/pipeline/output")
+        lease_file = os.path.join(test_data, 'pipeline/demux.lease')
+
+        # Snakefile.demux is called with rundir=... as the third argument
+        lease_seen = os.path.join(self.sandbox.sandbox, 'lease_seen')
+        self.bm.add_mock( 'Snakefile.demux',
+                          side_effect = f'cp "${{3#rundir=}}"/pipeline/demux.lease {lease_seen}' )
+
+        self.bm_rundriver()
+        self.assertInStdout(run, "READS_FINISHED")
+        with open(lease_seen) as lfh:
+            lease = json.load(lfh)
+        self.assertEqual(lease['owner'], socket.gethostname())
+        self.assertTrue(lease['expires'] > time.time())
+        self.assertFalse(os.path.exists(lease_file))
+
+        # Now pretend it's still going
+        for l in "12345678":
+            os.rename(f"{test_data}/pipeline/lane{l}.done", f"{test_data}/pipeline/lane{l}.started")
+
+        def write_lease(**kwargs):
+            with open(lease_file, 'w') as lfh:
+                json.dump(kwargs, lfh)
+
+        # A live lease is left alone
+        write_lease(owner=socket.gethostname(), pid=os.getpid(), expires=time.time() + 60)
+        self.bm_rundriver()
+        self.assertInStdout(run, "IN_DEMULTIPLEXING")
+        self.assertNotInStdout("Lease pipeline/demux.lease")
+        self.assertFalse(os.path.exists(f"{test_data}/pipeline/failed"))
+
+        # An expired one means the run has failed
+        write_lease(owner='otherhost', pid=1234, expires=time.time() - 1)
+        self.bm_rundriver()
+        self.assertInStdout(run, "IN_DEMULTIPLEXING")
+        self.assertInStdout(f"Lease pipeline/demux.lease on {run} expired (was held by otherhost 1234)")
+        with open(f"{test_data}/pipeline/failed") as ffh:
+            self.assertTrue(ffh.read().startswith("Demultiplexing_lease_expired"))
+        self.assertFalse(os.path.exists(lease_file))
+
+    def test_demux_lease_before_start(self):
+        """The demux lease is taken before the lane?.started files are written, so a
+           driver that dies while preparing the run still leaves a lease behind.
+           A run with lane?.started but no lease can only be a legacy run, and is left
+           alone.
+        """
+        run = "160606_K00166_0102_BHF22YBBXX"
+        test_data = self.copy_run(run)
+        self.sandbox.make(f"seqdata/{run}/pipeline/read1.done")
+        self.sandbox.make(f"fastqdata/{run}/")
+        self.sandbox.link(f"fastqdata/{run}/", f"seqdata/{run}/pipeline/output")
+        lease_file = os.path.join(test_data, 'pipeline/demux.lease')
+
+        # summarize_lane_contents.py runs in the run dir before demultiplexing starts
+        lease_seen = os.path.join(self.sandbox.sandbox, 'lease_seen')
+        self.bm.add_mock( 'summarize_lane_contents.py',
+                          side_effect = f'ls pipeline/lane1.started && cp pipeline/demux.lease {lease_seen}' )
+
+        self.bm_rundriver()
+        self.assertInStdout(run, "READS_FINISHED")
+        with open(lease_seen) as lfh:
+            lease = json.load(lfh)
+        self.assertEqual(lease['owner'], socket.gethostname())
+        self.assertFalse(os.path.exists(lease_file))
+
+        # Now the lease is missing but the lanes are started
+        for l in "12345678":
+            os.rename(f"{test_data}/pipeline/lane{l}.done", f"{test_data}/pipeline/lane{l}.started")
+
+        self.bm_rundriver()
+        self.assertInStdout(run, "IN_DEMULTIPLEXING")
+        self.assertNotInStdout("Lease pipeline/demux.lease")
+        self.assertFalse(os.path.exists(f"{test_data}/pipeline/failed"))
+        self.assertFalse(os.path.exists(lease_file))
+
+    def test_stalled(self):
+        """A run that has been in_demultiplexing with no progress for too long is logged,
+           and failed if FAIL_STALLED_RUNS=yes.
+        """
+        run = "160606_K00166_0102_BHF22YBBXX"
+        test_data = self.copy_run(run)
+        self.sandbox.make(f"seqdata/{run}/pipeline/read1.done")
+        self.sandbox.make(f"fastqdata/{run}/demultiplexing/lane1/")
+        self.sandbox.link(f"fastqdata/{run}/", f"seqdata/{run}/pipeline/output")
+        for l in "12345678":
+            self.sandbox.make(f"seqdata/{run}/pipeline/lane{l}.started")
+
+        def set_age(hours):
+            then = time.time() - hours * 3600
+            for f in glob(f"{test_data}/pipeline/lane?.started") + \
+                     [ f"{self.fastqdata}/{run}/demultiplexing/lane1" ]:
+                os.utime(f, (then, then))
+
+        # 3 hours is not a stall
+        set_age(3)
+        self.bm_rundriver()
+        self.assertInStdout(run, "status=in_demultiplexing")
+        self.assertNotInStdout("has shown no progress")
+
+        # 5 hours is, but by default the run is just logged
+        set_age(5)
+        self.bm_rundriver()
+        self.assertInStdout(f"{run} has shown no progress since")
+        self.assertFalse(os.path.exists(f"{test_data}/pipeline/failed"))
+
+        # Unless the threshold is raised
+        self.environment['STALL_HOURS_DEMUX'] = '6'
+        self.bm_rundriver()
+        self.assertNotInStdout("has shown no progress")
+
+        self.environment['STALL_HOURS_DEMUX'] = '4'
+        self.environment['FAIL_STALLED_RUNS'] = 'yes'
+        self.bm_rundriver()
+        self.assertInStdout(f"{run} has shown no progress since")
+        with open(f"{test_data}/pipeline/failed") as ffh:
+            self.assertTrue(ffh.read().startswith("Demultiplexing_stalled"))
+
+    def test_driver_shard(self):
+        """With DRIVER_SHARD=i/n each run is only processed by one driver.
+        """
+        # By cksum of the names, the first run is in shard 0/3 and the second in 1/3
+        runs = [ "150602_M01270_0108_000000000-ADWKV", "210601_A00291_0371_AHF2HCDRXY" ]
+        for run in runs:
+            self.copy_run(run)
+
+        def runs_started():
+            return [ run for run in runs if os.path.isdir(os.path.join(self.seqdata, run, 'pipeline')) ]
+
+        self.environment['DRIVER_SHARD'] = '2/3'
+        self.bm_rundriver()
+        self.assertInStdout(f"Ignoring {runs[0]} as it is not in shard 2/3")
+        self.assertEqual(runs_started(), [])
+
+        self.environment['DRIVER_SHARD'] = '0/3'
+        self.bm_rundriver()
+        self.assertInStdout(runs[0], "NEW")
+        self.assertEqual(runs_started(), runs[:1])
+
+        self.environment['DRIVER_SHARD'] = '1/3'
+        self.bm_rundriver()
+        self.assertInStdout(runs[1], "NEW")
+        self.assertNotInStdout(runs[0], "status=")
+        self.assertEqual(runs_started(), runs)
+
+        # If the host doing shard 0 dies while demultiplexing, the driver for shard 1
+        # must still take over the expired lease and fail the run.
+        pipeline = os.path.join(self.seqdata, runs[0], 'pipeline')
+        for f in os.listdir(pipeline):
+            os.remove(os.path.join(pipeline, f))
+        with open(os.path.join(self.seqdata, runs[0], 'RTAComplete.txt'), 'w'): pass
+        self.sandbox.make(f"fastqdata/{runs[0]}/")
+        self.sandbox.link(f"fastqdata/{runs[0]}/", f"seqdata/{runs[0]}/pipeline/output")
+        for f in ['read1.done', 'lane1.started']:
+            self.sandbox.make(f"seqdata/{runs[0]}/pipeline/{f}")
+        with open(os.path.join(pipeline, 'demux.lease'), 'w') as lfh:
+            json.dump(dict(owner='otherhost', pid=1234, expires=time.time() - 1), lfh)
+
+        self.bm_rundriver()
+        self.assertInStdout(f"Lease pipeline/demux.lease on {runs[0]} expired (was held by otherhost 1234)")
+        with open(os.path.join(pipeline, 'failed')) as ffh:
+            self.assertTrue(ffh.read().startswith("Demultiplexing_lease_expired"))
+        self.assertFalse(os.path.exists(os.path.join(pipeline, 'demux.lease')))
+
     def test_demux_error(self):
         """Simulate an error in BCL2FASTQPreprocessor.py. This should lead to the
            run going into an error state and the message 'FAIL processing $RUNID'
@@ -889,6 +1181,36 @@ class T(unittest.TestCase):
         self.bm_rundriver()
         self.assertEqual( len(self.bm.last_calls['Snakefile.demux']), 1 )
 
+    def test_bc_census(self):
+        """With BC_CENSUS=yes the census over whole lanes runs after the barcode check
+           has been reported, and any problem it finds gets a second message.
+        """
+        run = "160606_K00166_0102_BHF22YBBXX"
+        test_data = self.copy_run(run)
+        self.sandbox.make(f"fastqdata/{run}/")
+        self.sandbox.link(f"fastqdata/{run}/", f"seqdata/{run}/pipeline/output")
+
+        # By default there is no census
+        self.bm_rundriver()
+        self.assertInStdout(run, "READ1_FINISHED")
+        self.assertEqual( self.bm.last_calls['Snakefile.read1qc'], [ "-- wd_main bc_main".split() ] )
+
+        # Now with the census, which finds a problem. The bc_check does not.
+        self.environment['BC_CENSUS'] = 'yes'
+        self.bm.add_mock( 'Snakefile.read1qc',
+                           side_effect = 'if [ "$2" = census_main ] ; then'
+                                         ' mkdir -p QC/bc_check ; echo MOCK > QC/bc_check/census.msg ; fi' )
+        os.unlink(f"{test_data}/pipeline/read1.done")
+        self.bm_rundriver()
+        self.assertInStdout(run, "READ1_FINISHED")
+
+        self.assertEqual( self.bm.last_calls['Snakefile.read1qc'], [ "-- wd_main bc_main".split(),
+                                                                     "-- census_main".split() ] )
+        rt_calls = self.bm.last_calls['rt_runticket_manager.py']
+        self.assertEqual( [ c[4:-1] for c in rt_calls ], [ ['--comment'],
+                                                          ['--subject', 'barcode problem', '--reply'] ] )
+        self.assertTrue(os.path.isfile( test_data + "/pipeline/read1.done" ))
+
     def test_qc_fail_hiesenbug_20221206(self, variant=1):
         """See doc/bugs_on_8th_dec_2022.txt. I needed to abort a running Snakefile.qc and the
            result was that the pipeline declared both success and failure.
@@ -972,7 +1294,7 @@ class T(unittest.TestCase):
 
         self.assertEqual( self.sandbox.lsdir(f"seqdata/{run}/pipeline"),
                           [ 'lane1.done', 'lane2.done', 'output/', 'read1.done', 'report_upload_url.txt',
-                            'sample_summary.yml', 'start_times' ] )
+                            'run_meta.json', 'sample_summary.yml', 'start_times', 'timeline.jsonl' ] )
 
         # Thats was just the preamble. Now go again with a redo.
         trash = self.sandbox.make("trash/")
@@ -1008,7 +1330,7 @@ class T(unittest.TestCase):
         # And the pipeline files should be exactly as before
         self.assertEqual( self.sandbox.lsdir(f"seqdata/{run}/pipeline"),
                           [ 'lane1.done', 'lane2.done', 'output/', 'read1.done', 'report_upload_url.txt',
-                            'sample_summary.yml', 'start_times' ] )
+                            'run_meta.json', 'sample_summary.yml', 'start_times', 'timeline.jsonl' ] )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import os
+import unittest
+
+from illuminatus.FlowcellGeometry import FlowcellGeometry, get_flowcell_geometry
+from illuminatus.RunInfoXMLParser import RunInfoXMLParser
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
+
+class T(unittest.TestCase):
+
+    def test_novaseq_s2(self):
+        """180619_A00291_0044_BH5WJJDMXX is an S2 flowcell with all the tiles listed
+        """
+        geom = get_flowcell_geometry(os.path.join(DATA_DIR, '180619_A00291_0044_BH5WJJDMXX'))
+
+        self.assertTrue(geom.listed)
+        self.assertEqual(geom.layout_key(), '2/2/4/88')
+        self.assertEqual(geom.lanes, [1, 2])
+        self.assertEqual(geom.surfaces, [1, 2])
+        self.assertEqual(geom.swaths, [1, 2, 3, 4])
+
+        self.assertEqual(len(geom.tiles()), 2 * 2 * 4 * 88)
+        self.assertEqual(len(geom.tiles(lane=2)), 2 * 4 * 88)
+        self.assertEqual(len(geom.tiles(lane=2, surface=1, swath=[1,2])), 2 * 88)
+        self.assertEqual(geom.tiles(lane='1', surface=2, swath=3)[:2], ['1_2301', '1_2302'])
+        self.assertEqual(geom.first_tile(), '1_1101')
+        self.assertEqual(geom.first_tile(2), '2_1101')
+        self.assertEqual(geom.last_tile(1), '1_2488')
+
+        # Same order as RunInfoXMLParser gives us
+        self.assertEqual(geom.tiles(), RunInfoXMLParser(os.path.join(DATA_DIR, '180619_A00291_0044_BH5WJJDMXX')).tiles)
+
+        self.assertEqual(len(geom.every_nth(2, lane=1)), 2 * 4 * 44)
+        self.assertEqual(geom.every_nth(2, lane=1)[:2], ['1_1102', '1_1104'])
+        self.assertEqual(geom.tile_match(), {'T': '1..[02468]', 'B': '2..[02468]'})
+
+    def test_one_surface(self):
+        """On 210903_A00291_0383_BHCYNNDRXY only the bottom surface is imaged
+        """
+        geom = get_flowcell_geometry(os.path.join(DATA_DIR, '210903_A00291_0383_BHCYNNDRXY'))
+
+        self.assertEqual(geom.surfaces, [2])
+        self.assertEqual(geom.surface_count, 2)
+        self.assertEqual(geom.tile_match(), {'B': '2...'})
+        self.assertEqual(geom.first_tile(1), '1_2101')
+        self.assertEqual(geom.tiles(lane=1, surface=1), [])
+
+    def test_inferred_tiles(self):
+        """Older RunInfo.xml files have no tiles listed so we make them up
+        """
+        geom = get_flowcell_geometry(os.path.join(DATA_DIR, '160607_D00248_0174_AC9E4KANXX'))
+
+        self.assertFalse(geom.listed)
+        self.assertEqual(geom.lanes, list(range(1, 9)))
+        self.assertEqual(len(geom.tiles(8)), 2 * 3 * 16)
+        self.assertEqual(geom.first_tile(8), '8_1101')
+        self.assertEqual(geom.last_tile(8), '8_2316')
+        self.assertEqual(geom.tile_match(), {'T': '1...', 'B': '2...'})
+
+        # And with nothing at all
+        geom = FlowcellGeometry(None, [])
+        self.assertEqual(geom.tiles(), [])
+        self.assertIsNone(geom.first_tile(1))
+        self.assertEqual(geom.tile_match(), {})
+
+    def test_selections(self):
+        """Representative tiles and shards
+        """
+        geom = FlowcellGeometry(dict(LaneCount='1', SurfaceCount='2', SwathCount='1', TileCount='14'))
+        self.assertEqual(geom.layout_key(), '1/2/1/14')
+
+        self.assertEqual(geom.representative_tiles(1, 2), ['1_1108', '1_2108'])
+        self.assertEqual(geom.representative_tiles(1, 4), ['1_1104', '1_1111', '1_2104', '1_2111'])
+        self.assertEqual(len(geom.representative_tiles(1, 100)), 28)
+
+        shards = geom.shards(1, 3)
+        self.assertEqual([len(s) for s in shards], [9, 9, 10])
+        self.assertEqual(sum(shards, []), geom.tiles(1))
+        self.assertEqual(len(geom.shards(1, 100)), 28)
+
+        self.assertEqual(geom.tiles_option(1, shards[0][:2]), 's_[1]_1101,s_[1]_1102')
+        self.assertEqual(geom.tiles_option(1, shards[0] + shards[1]), 's_[1]_11,s_[1]_2101,s_[1]_2102,s_[1]_2103,s_[1]_2104')
+        self.assertEqual(geom.tiles_option(1, geom.tiles()), 's_[1]_11,s_[1]_21')
+        self.assertEqual(geom.tiles_option(2, geom.tiles()), '')
+
+if __name__ == '__main__':
+    unittest.main()
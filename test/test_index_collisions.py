@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Test the barcode distance checks used to set --barcode-mismatches"""
+
+import unittest
+import random
+from itertools import combinations
+
+from illuminatus.IndexCollisions import ( hamming, pair_distance, min_barcode_distance,
+                                          min_cross_distance, choose_barcode_mismatches )
+
+class T(unittest.TestCase):
+
+    def test_hamming(self):
+        self.assertEqual( hamming('ACGT', 'ACGT'), 0 )
+        self.assertEqual( hamming('ACGT', 'ACGA'), 1 )
+        self.assertEqual( hamming('ACGT', 'TGCA'), 4 )
+        # N matches anything, and so does a missing base
+        self.assertEqual( hamming('ACNN', 'TCGA'), 1 )
+        self.assertEqual( hamming('AC', 'TCGA'), 1 )
+        self.assertEqual( hamming('', ''), 0 )
+
+        # For dual indexes it's the worse of the two
+        self.assertEqual( pair_distance(('AAAA', 'CCCC'), ('AAAT', 'GGCC')), 2 )
+
+    def test_choose(self):
+        # One sample, or none, can't collide
+        self.assertEqual( choose_barcode_mismatches([]), (1, None) )
+        self.assertEqual( choose_barcode_mismatches([('', '')]), (1, None) )
+
+        # Distance 3 is OK for 1 mismatch, but 2 is not
+        self.assertEqual( choose_barcode_mismatches([('AAAAAA', ''), ('AAATTT', '')]), (1, None) )
+        self.assertEqual( choose_barcode_mismatches([('AAAAAA', ''), ('AAAATT', '')]), (0, 2) )
+
+        # Combinatorial dual indexes share one index but not both
+        self.assertEqual( choose_barcode_mismatches([ ('AAAAAA', 'CCCCCC'),
+                                                      ('AAAAAA', 'GGGGGG'),
+                                                      ('TTTTTT', 'CCCCCC') ]), (1, None) )
+        self.assertEqual( choose_barcode_mismatches([ ('AAAAAA', 'CCCCCC'),
+                                                      ('AAAAAT', 'CCCCCG') ]), (0, 1) )
+
+        # Duplicates are just distance 0
+        self.assertEqual( choose_barcode_mismatches([('ACGTAC', ''), ('ACGTAC', '')]), (0, 0) )
+
+        # A padded shorter barcode can collide with a longer one
+        self.assertEqual( choose_barcode_mismatches([('ACGTNN', ''), ('ACGAGG', '')]), (0, 1) )
+
+    def test_vs_brute_force(self):
+        """The result must be the same as comparing every pair
+        """
+        rng = random.Random(42)
+        for trial in range(200):
+            alphabet = 'ACGTN' if trial % 4 == 0 else 'ACGT'
+            barcodes = [ ( ''.join(rng.choice(alphabet) for _ in range(6)),
+                           ''.join(rng.choice(alphabet[:2]) for _ in range(4)) )
+                         for _ in range(rng.randint(2, 40)) ]
+            expected = min( pair_distance(a, b) for a, b in combinations(barcodes, 2) )
+            for max_dist in [0, 1, 2, 3]:
+                got = min_barcode_distance(barcodes, max_dist)[0]
+                self.assertEqual( got, expected if expected <= max_dist else None )
+
+    def test_cross_vs_brute_force(self):
+        """Only pairs with one barcode from each list count
+        """
+        rng = random.Random(43)
+        for trial in range(200):
+            alphabet = 'ACGTN' if trial % 4 == 0 else 'ACGT'
+            bc_lists = [ [ ( ''.join(rng.choice(alphabet) for _ in range(6)), '' )
+                           for _ in range(rng.randint(1, 30)) ]
+                         for _ in range(2) ]
+            expected = min( pair_distance(a, b) for a in bc_lists[0] for b in bc_lists[1] )
+            for max_dist in [0, 1, 2]:
+                got = min_cross_distance(*bc_lists, max_dist)[0]
+                self.assertEqual( got, expected if expected <= max_dist else None )
+
+        # Duplicates within one list don't matter
+        self.assertEqual( min_cross_distance([('AAAA', ''), ('AAAA', '')], [('TTTT', '')], 1),
+                          (None, None, None) )
+
+if __name__ == '__main__':
+    unittest.main()
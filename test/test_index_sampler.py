@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import struct
+import gzip
+import json
+import shutil
+from tempfile import TemporaryDirectory
+
+from illuminatus.IndexSampler import IndexSampler, read_filter, read_bcl
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
+
+# A sample sheet as made by "bcl2fastq_setup.py --bc_check"
+SAMPLE_SHEET = """[Header]
+Run ID,220113_A00291_0410_AHV23HDRXY
+
+[bcl2fastq]
+--barcode-mismatches 1
+--use-bases-mask 'Yn*,I8,I8,n*'
+--tiles 's_[1]_2101'
+
+[Data]
+Lane,Sample_ID,Sample_Name,Sample_Plate,Sample_Well,Sample_Project,index,index2,Description
+1,21360GNpool01__21360GN0345L01,,,,21360,CTTTAACT,TGACGATT,
+1,21360GNpool01__21360GN0346L01,,,,21360,GCCTCTAT,AAATCAGC,
+"""
+
+# q-score bins as on a NovaSeq
+QBINS = [(0, 2), (1, 12), (2, 23), (3, 37)]
+
+def write_cbcl(filename, tiles, pf_excluded=0):
+    """Write a CBCL file. tiles is { tile_number: [ (base, qbin), ... ] }
+    """
+    blocks = []
+    for calls in tiles.values():
+        nibbles = [ (q << 2) | b for b, q in calls ] + [0]
+        data = bytes( nibbles[i] | (nibbles[i + 1] << 4) for i in range(0, len(calls), 2) )
+        blocks.append((data, gzip.compress(data)))
+
+    rest = struct.pack('<I', len(QBINS)) + b''.join( struct.pack('<II', *b) for b in QBINS )
+    rest += struct.pack('<I', len(tiles))
+    for tile, calls, (data, compressed) in zip(tiles, tiles.values(), blocks):
+        rest += struct.pack('<IIII', tile, len(calls), len(data), len(compressed))
+    rest += struct.pack('<B', pf_excluded)
+
+    header = struct.pack('<HIBB', 1, 8 + len(rest), 2, 2) + rest
+    with open(filename, 'wb') as cfh:
+        cfh.write(header)
+        for _, compressed in blocks:
+            cfh.write(compressed)
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.run_dir = os.path.join(tmp_dir.name, 'run')
+        self.out_dir = os.path.join(tmp_dir.name, 'out')
+        os.makedirs(self.out_dir)
+
+        os.makedirs(os.path.join(self.run_dir, 'Data/Intensities/BaseCalls/L001'))
+        shutil.copy(os.path.join(DATA_DIR, '220113_A00291_0410_AHV23HDRXY', 'RunInfo.xml'), self.run_dir)
+
+        self.sample_sheet = os.path.join(self.out_dir, 'SampleSheet.filtered.csv')
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET)
+
+    def make_base_calls(self, clusters, pf_excluded=0, tiles=(2101,)):
+        """Write the filter files and the CBCL files for tile 2101 (and a dummy tile 2102)
+           with the given clusters, which are (read1_base, index1, index2, pf).
+           If more tiles are given, they all get the same clusters.
+        """
+        basecalls = os.path.join(self.run_dir, 'Data/Intensities/BaseCalls/L001')
+        for tile in tiles:
+            with open(os.path.join(basecalls, 's_1_{}.filter'.format(tile)), 'wb') as ffh:
+                ffh.write(struct.pack('<III', 0, 3, len(clusters)))
+                ffh.write(bytes( int(c[3]) for c in clusters ))
+
+        if pf_excluded:
+            clusters = [ c for c in clusters if c[3] ]
+
+        # Read 1 is 151 cycles, so the index cycles are 152 to 167
+        seqs = { 1: [ c[0] for c in clusters ] }
+        for pos in range(8):
+            seqs[152 + pos] = [ c[1][pos] for c in clusters ]
+            seqs[160 + pos] = [ c[2][pos] for c in clusters ]
+        for cycle, bases in seqs.items():
+            cycle_dir = os.path.join(basecalls, 'C{}.1'.format(cycle))
+            os.makedirs(cycle_dir)
+            calls = [ (0, 0) if b == 'N' else ('ACGT'.index(b), 3 if i % 4 else 1) for i, b in enumerate(bases) ]
+            tile_calls = { 2102: [(0, 3)] * 3 }
+            tile_calls.update( (tile, calls) for tile in tiles )
+            write_cbcl( os.path.join(cycle_dir, 'L001_2.cbcl'), tile_calls, pf_excluded )
+
+    def run_sampler(self, **kwargs):
+        sampler = IndexSampler(self.run_dir, self.out_dir, self.sample_sheet, 1, **kwargs)
+        sampler.prepare()
+        sampler.run()
+        return sampler.collect_stats()
+
+    def test_cbcl(self):
+        """Count the indexes on a made-up tile
+        """
+        clusters = ( [ ('A', 'CTTTAACT', 'TGACGATT', True) ] * 10 +
+                     [ ('C', 'CTTTAACA', 'TGACGATT', True) ] * 3 +   # One mismatch
+                     [ ('G', 'GCCTCTAT', 'AAATCAGC', True) ] * 5 +
+                     [ ('N', 'GCCTCTAN', 'AAATCAGC', True) ] * 2 +   # N is a mismatch
+                     [ ('T', 'GGGGGGGG', 'AGATCTCG', True) ] * 4 +   # Unknown
+                     [ ('T', 'CTTTAAGG', 'TGACGATT', True) ] * 1 +   # Too many mismatches
+                     [ ('A', 'CTTTAACT', 'TGACGATT', False) ] * 3 )  # Not PF
+
+        for pf_excluded in [0, 1]:
+            with self.subTest(pf_excluded=pf_excluded):
+                shutil.rmtree(os.path.join(self.run_dir, 'Data'))
+                os.makedirs(os.path.join(self.run_dir, 'Data/Intensities/BaseCalls/L001'))
+                self.make_base_calls(clusters, pf_excluded)
+
+                stats = self.run_sampler()
+                conversion, = stats['ConversionResults']
+
+                self.assertEqual(conversion['TotalClustersRaw'], 28)
+                self.assertEqual(conversion['TotalClustersPF'], 25)
+                self.assertEqual([ r['NumberReads'] for r in conversion['DemuxResults'] ], [13, 7])
+                self.assertEqual( conversion['DemuxResults'][0]['IndexMetrics'],
+                                  [ dict(IndexSequence='CTTTAACT+TGACGATT', MismatchCounts={'0': 10, '1': 3}) ] )
+                self.assertEqual(conversion['Undetermined']['NumberReads'], 5)
+                self.assertEqual( stats['UnknownBarcodes'][0]['Barcodes'],
+                                  { 'GGGGGGGG+AGATCTCG': 4, 'CTTTAAGG+TGACGATT': 1 } )
+                self.assertEqual( [ r['NumCycles'] for r in stats['ReadInfosForLanes'][0]['ReadInfos'] ],
+                                  [1, 8, 8] )
+
+                # Read 1 yield is just the one cycle. Every fourth call is Q12 and the others are Q37.
+                rm, = conversion['DemuxResults'][0]['ReadMetrics']
+                self.assertEqual(rm['Yield'], 13)
+                self.assertEqual(rm['YieldQ30'], 9)
+                self.assertEqual(conversion['Yield'], 25)
+
+        # The output should be good for assess_bc_check.py
+        with open(os.path.join(self.out_dir, 'bcl2fastq.opts')) as ofh:
+            self.assertIn('--barcode-mismatches 1\n', list(ofh))
+        with open(os.path.join(self.out_dir, 'Stats', 'Stats.json')) as sfh:
+            self.assertEqual(json.load(sfh), json.loads(json.dumps(stats)))
+
+    def test_early_stop(self):
+        """With several tiles, stop reading once the estimates are good enough
+        """
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET.replace("[Header]\n", "[Header]\n#BarcodeCheckTiles,2101 2103 2104 2105\n"))
+
+        clusters = ( [ ('A', 'CTTTAACT', 'TGACGATT', True) ] * 10 +
+                     [ ('G', 'GCCTCTAT', 'AAATCAGC', True) ] * 5 +
+                     [ ('T', 'GGGGGGGG', 'AGATCTCG', True) ] * 5 )
+        self.make_base_calls(clusters, tiles=(2101, 2103, 2104, 2105))
+
+        # The tiles all agree, so the interval is the binomial one, about ± 15% after 2 tiles
+        for ci_target, tiles, stopped in [ (0.2,  ['2101', '2104'], 'converged'),
+                                           (0.01, ['2101', '2104', '2103', '2105'], 'all tiles read'),
+                                           (None, ['2101', '2104', '2103', '2105'], 'all tiles read') ]:
+            with self.subTest(ci_target=ci_target):
+                stats = self.run_sampler(ci_target=ci_target)
+                conversion, = stats['ConversionResults']
+                self.assertEqual(conversion['TotalClustersPF'], 20 * len(tiles))
+                self.assertEqual(conversion['Undetermined']['NumberReads'], 5 * len(tiles))
+
+                # The totals for every tile are added up
+                dr = conversion['DemuxResults'][0]
+                self.assertEqual(dr['IndexMetrics'][0]['MismatchCounts'], {'0': 10 * len(tiles)})
+                self.assertEqual( (dr['ReadMetrics'][0]['Yield'], dr['ReadMetrics'][0]['YieldQ30']),
+                                  (10 * len(tiles), 7 * len(tiles)) )
+                self.assertEqual( stats['UnknownBarcodes'][0]['Barcodes'],
+                                  { 'GGGGGGGG+AGATCTCG': 5 * len(tiles) } )
+
+                with open(os.path.join(self.out_dir, 'tile_counts.json')) as tfh:
+                    tile_counts = json.load(tfh)
+                self.assertEqual(tile_counts['tiles'], tiles)
+                self.assertEqual(tile_counts['stopped'], stopped)
+                self.assertEqual( tile_counts['samples']['21360GNpool01__21360GN0346L01'],
+                                  [5] * len(tiles) )
+
+        # The target can also come from the sample sheet
+        with open(self.sample_sheet, 'w') as sfh:
+            sfh.write(SAMPLE_SHEET.replace("'s_[1]_2101'", "'s_[1]_210[1345]'")
+                                  .replace("[Header]\n", "[Header]\n#BarcodeCheckCI,0.2\n"))
+        self.run_sampler()
+        with open(os.path.join(self.out_dir, 'tile_counts.json')) as tfh:
+            self.assertEqual(json.load(tfh)['tiles'], ['2101', '2104'])
+
+    def test_bcl(self):
+        """Older per-tile BCL files, and the old filter format
+        """
+        bcl_file = os.path.join(self.out_dir, 's_1_1101.bcl.gz')
+        with gzip.open(bcl_file, 'wb') as bfh:
+            bfh.write(struct.pack('<I', 4) + bytes([ (30 << 2) | 0, (40 << 2) | 3, 0, (2 << 2) | 1 ]))
+
+        bases, quals = read_bcl(bcl_file)
+        self.assertEqual(list(bases), [0, 3, 4, 1])
+        self.assertEqual(list(quals), [30, 40, 0, 2])
+
+        filter_file = os.path.join(self.out_dir, 's_1_1101.filter')
+        with open(filter_file, 'wb') as ffh:
+            ffh.write(struct.pack('<I', 3) + bytes([1, 0, 1]))
+        self.assertEqual(list(read_filter(filter_file)), [True, False, True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""Test the planning of auto-redo, as tested end-to-end in test_auto_redo.py
+"""
+
+import os
+import unittest
+from glob import glob
+import shutil
+
+from sandbox import TestSandbox
+
+from illuminatus.RunRegistry import RunRegistry
+from illuminatus.RedoPlanner import RedoPlanner, flowcell_keys, map_flowcells_to_runs, changed_lanes
+
+SEQDATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/auto_redo_seqdata')
+NEWSHEETS_DIR = os.path.abspath(os.path.dirname(__file__) + '/auto_redo_newsheets')
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.seqdata = TestSandbox(SEQDATA_DIR)
+        self.addCleanup(self.seqdata.cleanup)
+        self.sheets = TestSandbox()
+        self.addCleanup(self.sheets.cleanup)
+
+        # Make all the files in the sandbox 20 hours old, then copy in the
+        # new sheets with the current time.
+        self.seqdata.touch('.', hours_age=20, recursive=True)
+        for ns in glob(NEWSHEETS_DIR + '/*.csv'):
+            shutil.copy(ns, self.sheets.sandbox, follow_symlinks=True)
+
+    def plan(self, registry=None):
+        """ Get the plan as a dict of { run_name: (action, lanes) }
+        """
+        sheets = sorted(glob(self.sheets.sandbox + '/*.csv'))
+        plan = RedoPlanner(self.seqdata.sandbox, registry).plan(sheets)
+        self.assertEqual(len(plan), len(sheets))
+
+        return { os.path.basename(d['run_dir'] or d['sheet']): (d['action'], d['lanes'])
+                 for d in plan }
+
+    ### THE TESTS ###
+    def test_flowcell_keys(self):
+        self.assertEqual( flowcell_keys('201125_A00291_0321_AHWHKYDRXX'),
+                          set(['HWHKYDRXX', 'AHWHKYDRXX']) )
+        self.assertEqual( flowcell_keys('150602_M01270_0108_000000000-ADWKV'),
+                          set(['ADWKV', '000000000-ADWKV']) )
+
+        fc_map = map_flowcells_to_runs(self.seqdata.sandbox)
+        self.assertEqual( fc_map['C9E4KANXX'],
+                          [ os.path.join(self.seqdata.sandbox, '160607_D00248_0174_AC9E4KANXX') ] )
+
+    def test_changed_lanes(self):
+        run_ss = os.path.join(self.seqdata.sandbox, '160607_D00248_0174_AC9E4KANXX', 'SampleSheet.csv')
+        lanes, changes = changed_lanes(run_ss, os.path.join(self.sheets.sandbox, 'sheet_C9E4KANXX.csv'))
+        self.assertEqual( lanes, ['2', '5'] )
+        self.assertEqual( changes['2'], 'changed 1 (10464KK0021L01)' )
+        self.assertEqual( changed_lanes(run_ss, run_ss), ([], {}) )
+
+        # An unreadable sheet is compared as text
+        lanes, changes = changed_lanes(run_ss, os.path.join(self.sheets.sandbox, 'sheet_ADWKV.csv'))
+        self.assertEqual( lanes, [ str(l) for l in range(1, 9) ] )
+        self.assertIn( 'as text', changes['1'] )
+
+    def test_restarts(self):
+        """The same cases as in test_auto_redo.py
+        """
+        # Touch for #2 should make the new sheet too old.
+        self.sheets.touch('sheet_ADWKV.csv', hours_age=2)
+        self.seqdata.touch('150602_M01270_0108_000000000-ADWKV/SampleSheet.csv')
+
+        self.assertEqual( self.plan(),
+                          { '160726_K00166_0120_BHCVH2BBXX':      ('skip', []),
+                            '150602_M01270_0108_000000000-ADWKV': ('skip', []),
+                            '160614_K00368_0023_AHF724BBXX':      ('redo', ['8']),
+                            '160607_D00248_0174_AC9E4KANXX':      ('redo', ['2', '5']),
+                            '160603_M01270_0196_000000000-AKGDE': ('skip', []),
+                            '160606_K00166_0102_BHF22YBBXX':      ('redo', list('12345678')),
+                            '180430_M05898_0007_000000000-BR92R': ('redo', ['1']),
+                            '180430_M05898_0007_000000000-OVRID': ('skip', []) } )
+
+    def test_case_mismatch(self):
+        os.rename( self.seqdata.sandbox + '/180430_M05898_0007_000000000-BR92R',
+                   self.seqdata.sandbox + '/180430_M05898_0007_br92r' )
+
+        self.assertEqual( self.plan()['180430_M05898_0007_br92r'], ('redo', ['1']) )
+
+    def test_read_only(self):
+        """Planning with a registry must not save anything to it, nor to any run timeline.
+        """
+        registry = RunRegistry(os.path.join(self.sheets.sandbox, 'registry.sqlite'))
+        self.assertEqual( self.plan(registry), self.plan() )
+
+        self.assertEqual( list(registry.list_runs()), [] )
+        self.assertEqual( glob(self.seqdata.sandbox + '/*/pipeline/timeline.jsonl'), [] )
+
+if __name__ == '__main__':
+    unittest.main()
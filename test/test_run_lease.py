@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""Test the lease-based run locks"""
+
+import os
+import unittest
+from unittest.mock import patch
+import json
+import time
+import subprocess
+import threading
+
+from sandbox import TestSandbox
+
+from illuminatus.RunLease import RunLease, LeaseHeldError
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.sandbox = TestSandbox()
+        self.lease_file = os.path.join(self.sandbox.make('pipeline/'), 'demux.lease')
+
+        # A PID that is certainly not running
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        self.dead_pid = proc.pid
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def write_lease(self, **kwargs):
+        with open(self.lease_file, 'w') as lfh:
+            json.dump(kwargs, lfh)
+
+    ### THE TESTS ###
+    def test_acquire_release(self):
+        """Basic lifecycle
+        """
+        lease = RunLease(self.lease_file, ttl=60)
+        self.assertIsNone(lease.read())
+        self.assertFalse(lease.is_expired())
+
+        self.assertIsNone(lease.acquire())
+        self.assertTrue(lease.is_mine())
+        self.assertFalse(lease.is_expired())
+
+        expires = lease.read()['expires']
+        self.assertTrue(expires > time.time() + 50)
+
+        # Acquiring again is just a renewal
+        self.assertIsNone(lease.acquire())
+
+        lease.release()
+        self.assertFalse(os.path.exists(self.lease_file))
+
+    def test_held(self):
+        """Another live process has the lease
+        """
+        RunLease(self.lease_file, pid=os.getppid()).acquire()
+
+        lease = RunLease(self.lease_file)
+        self.assertFalse(lease.is_mine())
+        self.assertFalse(lease.is_expired())
+        self.assertRaises(LeaseHeldError, lease.acquire)
+        self.assertRaises(LeaseHeldError, lease.renew)
+
+        # Release does nothing as the lease is not ours
+        lease.release()
+        self.assertTrue(os.path.exists(self.lease_file))
+
+    def test_takeover(self):
+        """Leases expire by time, or if the owner process is gone
+        """
+        lease = RunLease(self.lease_file)
+
+        # Expired by time, on some other host
+        self.write_lease(owner='otherhost', pid=1234, expires=time.time() - 1)
+        self.assertTrue(lease.is_expired())
+        self.assertEqual(lease.acquire()['owner'], 'otherhost')
+        self.assertTrue(lease.is_mine())
+        lease.release()
+
+        # Not expired, on some other host
+        self.write_lease(owner='otherhost', pid=1234, expires=time.time() + 60)
+        self.assertFalse(lease.is_expired())
+
+        # Not expired but the process on this host is dead
+        self.write_lease(owner=lease.host, pid=self.dead_pid, expires=time.time() + 60)
+        self.assertTrue(lease.is_expired())
+        self.assertEqual(lease.acquire()['pid'], self.dead_pid)
+        self.assertTrue(lease.is_mine())
+        lease.release()
+
+        # A corrupted lease file counts as held until the file is older than the TTL
+        with open(self.lease_file, 'w') as lfh:
+            print("{ owner: ", file=lfh)
+        self.assertFalse(lease.is_expired())
+        self.assertRaises(LeaseHeldError, lease.acquire)
+
+        then = time.time() - lease.ttl - 1
+        os.utime(self.lease_file, (then, then))
+        self.assertTrue(lease.is_expired())
+        self.assertEqual(lease.acquire()['owner'], 'unknown')
+        self.assertTrue(lease.is_mine())
+
+        # No junk should be left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.lease_file)), ['demux.lease'])
+
+    def test_acquire_never_partial(self):
+        """The lease file must appear fully written, or another driver could see an
+           empty file while the JSON is still going in.
+        """
+        lease = RunLease(self.lease_file)
+        seen = []
+        real_dump = json.dump
+        def dump_and_look(obj, fh):
+            real_dump(obj, fh)
+            fh.flush()
+            seen.append(os.path.exists(self.lease_file))
+        with patch('json.dump', side_effect=dump_and_look):
+            lease.acquire()
+
+        self.assertEqual(seen, [False])
+        self.assertTrue(lease.is_mine())
+        self.assertEqual(os.listdir(os.path.dirname(self.lease_file)), ['demux.lease'])
+
+    def test_competing_takeover(self):
+        """Two processes see the same stale lease and both try to take it over
+        """
+        self.write_lease(owner='otherhost', pid=1234, expires=time.time() - 1)
+        lease_a = RunLease(self.lease_file, pid=os.getppid())
+        lease_b = RunLease(self.lease_file)
+        stale_lease = lease_b.read()
+
+        # A gets in first
+        self.assertEqual(lease_a.acquire()['owner'], 'otherhost')
+        a_lease = lease_a.read()
+
+        # B still thinks the lease is the stale one, so would move A's lease aside.
+        # It must notice and put it back.
+        with patch.object(lease_b, 'read', return_value=stale_lease):
+            self.assertRaises(LeaseHeldError, lease_b.acquire)
+
+        self.assertTrue(lease_a.is_mine())
+        self.assertEqual(lease_a.read(), a_lease)
+        self.assertFalse(lease_b.is_mine())
+        self.assertEqual(os.listdir(os.path.dirname(self.lease_file)), ['demux.lease'])
+
+    def test_renew_after_takeover(self):
+        """If the lease is taken over between renew() checking it and writing the new
+           lease, the new owner must keep the lease.
+        """
+        lease = RunLease(self.lease_file)
+        lease.acquire()
+        my_lease = lease.read()
+
+        # Another process takes over, but we still think the lease is ours
+        self.write_lease(owner='otherhost', pid=1234, expires=time.time() + 60)
+        other_lease = lease.read()
+        with patch.object(lease, 'read', return_value=my_lease):
+            self.assertRaises(LeaseHeldError, lease.renew)
+            lease.release()
+
+        self.assertEqual(lease.read(), other_lease)
+        self.assertEqual(os.listdir(os.path.dirname(self.lease_file)), ['demux.lease'])
+
+    def test_heartbeat(self):
+        """The heartbeat renews the lease and stops when the owner dies
+        """
+        proc = subprocess.Popen(['sleep', '2'])
+        lease = RunLease(self.lease_file, ttl=3, pid=proc.pid)
+        lease.acquire()
+        expires = lease.read()['expires']
+
+        # The sleep process must be reaped as soon as it exits, or else it will linger
+        # as a zombie and the heartbeat will go on forever.
+        threading.Thread(target=proc.wait, daemon=True).start()
+        lease.heartbeat(interval=1)
+
+        # The heartbeat must have renewed the lease at least once before returning.
+        self.assertTrue(lease.read()['expires'] > expires)
+        self.assertTrue(lease.is_expired())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import os
+import unittest
+import json
+
+from sandbox import TestSandbox
+
+from illuminatus.RunMeta import get_run_meta, load_run_meta, META_FILE
+from illuminatus.RunInfoXMLParser import RunInfoXMLParser
+from illuminatus.RunParametersXMLParser import RunParametersXMLParser
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
+
+class T(unittest.TestCase):
+
+    def get_sandbox(self, run_id):
+        sandbox = TestSandbox(os.path.join(DATA_DIR, run_id))
+        self.addCleanup(sandbox.cleanup)
+        return sandbox
+
+    def test_matches_parsers(self):
+        """The RunMeta should have the same info as the XML parsers
+        """
+        run_dir = os.path.join(DATA_DIR, '180619_A00291_0044_BH5WJJDMXX')
+        rm = get_run_meta(run_dir, save=False)
+        rip = RunInfoXMLParser(run_dir)
+
+        self.assertEqual(rm.run_info, rip.run_info)
+        self.assertEqual(rm.read_and_length, rip.read_and_length)
+        self.assertEqual(rm.read_and_indexed, rip.read_and_indexed)
+        self.assertEqual(rm.tiles, rip.tiles)
+        self.assertEqual(rm.layout['LaneCount'], '2')
+
+        self.assertEqual( json.dumps(rm.get_run_parameters(), default=str),
+                          json.dumps(RunParametersXMLParser(run_dir).run_parameters, default=str) )
+
+        # And the path to RunInfo.xml works too
+        self.assertEqual(get_run_meta(run_dir + '/RunInfo.xml', save=False).tiles, rip.tiles)
+
+    def test_no_run_parameters(self):
+        """Older runs in the examples have no RunParameters.xml
+        """
+        rm = get_run_meta(os.path.join(DATA_DIR, '150602_M01270_0108_000000000-ADWKV'), save=False)
+        self.assertEqual(rm.run_info['RunId'], '150602_M01270_0108_000000000-ADWKV')
+        self.assertRaises(FileNotFoundError, rm.get_run_parameters)
+
+    def test_save_and_refresh(self):
+        """The file is saved in pipeline/ and re-made only when RunInfo.xml changes
+        """
+        sandbox = self.get_sandbox('180619_A00291_0044_BH5WJJDMXX')
+        run_dir = sandbox.sandbox
+        meta_file = os.path.join(run_dir, META_FILE)
+
+        # No pipeline directory, no file
+        get_run_meta(run_dir)
+        self.assertFalse(os.path.exists(meta_file))
+        self.assertIsNone(load_run_meta(run_dir))
+
+        sandbox.make('pipeline/')
+        get_run_meta(run_dir, save=False)
+        self.assertFalse(os.path.exists(meta_file))
+        get_run_meta(run_dir)
+        self.assertTrue(os.path.exists(meta_file))
+
+        # Doctor the file to prove that it is used
+        with open(meta_file) as mfh:
+            meta = json.load(mfh)
+        meta['run_info']['RunId'] = 'doctored'
+        with open(meta_file, 'w') as mfh:
+            json.dump(meta, mfh)
+        self.assertEqual(load_run_meta(run_dir).run_info['RunId'], 'doctored')
+        self.assertEqual(get_run_meta(run_dir).run_info['RunId'], 'doctored')
+
+        # Touching RunInfo.xml makes it stale
+        sandbox.touch('RunInfo.xml', hours_age=1)
+        self.assertIsNone(load_run_meta(run_dir))
+        self.assertEqual(get_run_meta(run_dir).run_info['RunId'], '180619_A00291_0044_BH5WJJDMXX')
+        self.assertEqual(load_run_meta(run_dir).run_info['RunId'], '180619_A00291_0044_BH5WJJDMXX')
+
+        # As does adding an override file
+        sandbox.make('pipeline/RunParameters.OVERRIDE.yml', content="Foo: bar")
+        self.assertIsNone(load_run_meta(run_dir))
+
+        # A corrupt file is just replaced
+        with open(meta_file, 'w') as mfh:
+            print("{", file=mfh)
+        self.assertIsNone(load_run_meta(run_dir))
+        get_run_meta(run_dir)
+        self.assertIsNotNone(load_run_meta(run_dir))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,20 @@
 
 import unittest
 import sys, os
+import time
 import glob
+import json
+import subprocess
 from tempfile import mkdtemp
 from shutil import rmtree, copytree
 from pprint import pprint
 
-from RunStatus import RunStatus
+from illuminatus.RunStatus import RunStatus, scan_all_runs, get_run_dict
+from illuminatus.RunRegistry import RunRegistry
+from illuminatus.RunTimeline import load_events
+from illuminatus.RunInfoXMLParser import get_runinfo_xml_parser
 
+RUNSTATUS = os.path.abspath(os.path.dirname(__file__) + '/../RunStatus.py')
 DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
 VERBOSE = os.environ.get('VERBOSE', '0') != '0'
 
@@ -462,6 +469,282 @@ class T(unittest.TestCase):
         ri = dictify(run_info.get_yaml())
         self.assertEqual(ri['PipelineStatus:'], 'redo')
 
+    def test_scan_all_runs(self):
+        """The batch mode should give the same answers as looking at each
+           run individually.
+        """
+        all_runs = list(scan_all_runs(DATA_DIR))
+
+        self.assertEqual( [ os.path.basename(r['RunDir']) for r in all_runs ],
+                          sorted(os.listdir(DATA_DIR)) )
+
+        for r in all_runs:
+            self.assertEqual( dictify(RunStatus(r['RunDir']).get_yaml()),
+                              dictify('\n'.join( "{}: {}".format(k, v) for k, v in r.items()
+                                                  if k != 'RunDir' )) )
+
+        # And with a regex
+        all_runs = list(scan_all_runs(DATA_DIR, run_name_regex='.*_M.*'))
+        self.assertEqual( len(all_runs), 6 )
+        self.assertEqual( [ os.path.basename(r['RunDir']).split('_')[1][0] for r in all_runs ],
+                          ['M'] * 6 )
+
+    def test_pipeline_listing(self):
+        """Touch files in pipeline/ are checked against a single listing
+        """
+        run_info = self.use_run('160726_K00166_0120_BHCVH2BBXX', copy=True)
+
+        self.assertEqual( run_info._exists('pipeline/lane?.done'), 0 )
+        self.assertTrue( 'pipeline/' in run_info._exists_cache )
+
+        # Now the listing is cached, adding a file will not be seen
+        self.touch('pipeline/lane1.done')
+        self.touch('pipeline/lane2.done')
+        self.assertEqual( run_info._exists('pipeline/lane?.done'), 0 )
+
+        run_info._exists_cache = dict()
+        self.assertEqual( run_info._exists('pipeline/lane?.done'), 2 )
+        self.assertEqual( run_info._exists('pipeline/lane[2-8].done'), 1 )
+
+    def test_registry(self):
+        """Complete runs are remembered in the registry, until something changes.
+        """
+        self.use_run('160726_K00166_0120_BHCVH2BBXX', copy=True, make_run_info=False)
+        run_dir = os.path.join(self.run_dir, self.current_run)
+        registry = RunRegistry(os.path.join(self.run_dir, 'registry.sqlite'))
+
+        # Not a cold state
+        self.assertEqual(get_run_dict(run_dir, registry=registry)['PipelineStatus'], 'reads_unfinished')
+        self.assertEqual(registry.get_run(self.current_run)['Status']['PipelineStatus'], 'reads_unfinished')
+
+        # Make it complete
+        self.md('pipeline/output/seqdata/pipeline')
+        self.touch('RTAComplete.txt')
+        for f in ['read1.done', 'qc.done'] + ['lane{}.done'.format(l) for l in '12345678']:
+            self.touch('pipeline/' + f)
+        self.assertEqual(get_run_dict(run_dir, registry=registry)['PipelineStatus'], 'complete')
+
+        # Now if I remove RunInfo.xml it doesn't matter as the status is saved.
+        os.rename(os.path.join(run_dir, 'RunInfo.xml'), os.path.join(run_dir, 'RunInfo.xml.x'))
+        self.assertEqual(get_run_dict(run_dir, registry=registry)['PipelineStatus'], 'complete')
+        self.assertEqual(get_run_dict(run_dir, registry=registry)['LaneCount'], 8)
+
+        # Adding a redo file is noticed, and the saved RunInfo is used
+        self.touch('pipeline/lane1.redo')
+        self.assertEqual(get_run_dict(run_dir, registry=registry)['PipelineStatus'], 'redo')
+
+        # Without the registry, no joy
+        self.assertEqual(get_run_dict(run_dir)['PipelineStatus'], 'unknown')
+
+        self.assertEqual([ r for r, st in registry.list_runs('redo') ], [self.current_run])
+        registry.close()
+
+        # Each change of state was noted in the timeline
+        events = load_events(os.path.join(run_dir, 'pipeline', 'timeline.jsonl'))
+        self.assertEqual( [ (e['previous'], e['stage']) for e in events ],
+                          [ (None, 'reads_unfinished'), ('reads_unfinished', 'complete'), ('complete', 'redo') ] )
+
+    def test_timeline_no_registry(self):
+        """Without a registry, changes of state can still be noted in the timeline, by
+           looking at the last state recorded there.
+        """
+        self.use_run('160726_K00166_0120_BHCVH2BBXX', copy=True, make_run_info=False)
+        run_dir = os.path.join(self.run_dir, self.current_run)
+
+        # Nothing is recorded unless asked
+        self.assertEqual(get_run_dict(run_dir)['PipelineStatus'], 'reads_unfinished')
+        self.assertFalse(os.path.exists(os.path.join(run_dir, 'pipeline', 'timeline.jsonl')))
+
+        self.assertEqual(get_run_dict(run_dir, record_states=True)['PipelineStatus'], 'reads_unfinished')
+        self.assertEqual(get_run_dict(run_dir, 'p', record_states=True)['PipelineStatus'], 'reads_unfinished')
+
+        self.touch('RTAComplete.txt')
+        self.assertEqual(get_run_dict(run_dir, 'p', record_states=True)['PipelineStatus'], 'read1_finished')
+        self.assertEqual(get_run_dict(run_dir, record_states=True)['PipelineStatus'], 'read1_finished')
+
+        events = load_events(os.path.join(run_dir, 'pipeline', 'timeline.jsonl'))
+        self.assertEqual( [ (e['previous'], e['stage']) for e in events ],
+                          [ (None, 'reads_unfinished'), ('reads_unfinished', 'read1_finished') ] )
+
+    def test_registry_fastqdata(self):
+        """For a fastqdata directory the status comes from the seqdata link, so the
+           registry must check the seqdata directory for changes.
+        """
+        self.use_run('160726_K00166_0120_BHCVH2BBXX', copy=True, make_run_info=False)
+        run_dir = os.path.join(self.run_dir, self.current_run)
+        fastq_dir = os.path.join(self.run_dir, 'fastqdata', self.current_run)
+        os.makedirs(fastq_dir)
+        os.symlink(run_dir, os.path.join(fastq_dir, 'seqdata'))
+        registry = RunRegistry(os.path.join(self.run_dir, 'registry.sqlite'))
+
+        self.md('pipeline/output/seqdata/pipeline')
+        self.touch('RTAComplete.txt')
+        for f in ['read1.done', 'qc.done'] + ['lane{}.done'.format(l) for l in '12345678']:
+            self.touch('pipeline/' + f)
+        self.assertEqual(get_run_dict(fastq_dir, registry=registry)['PipelineStatus'], 'complete')
+
+        # The fastqdata directory itself does not change, but the status does
+        self.touch('pipeline/lane1.redo')
+        self.assertEqual(get_run_dict(fastq_dir, registry=registry)['PipelineStatus'], 'redo')
+        registry.close()
+
+    def test_stalled(self):
+        """Runs in QC with no sign of progress are stalled
+        """
+        self.use_run('160726_K00166_0120_BHCVH2BBXX', copy=True, make_run_info=False)
+        run_dir = os.path.join(self.run_dir, self.current_run)
+        self.touch('pipeline/qc.started')
+
+        def age(fp, hours):
+            t = time.time() - hours * 3600
+            os.utime(os.path.join(run_dir, fp), (t, t))
+
+        age('pipeline/qc.started', 10)
+        res = RunStatus(run_dir).get_dict()
+        self.assertEqual(res['PipelineStatus'], 'in_qc')
+        self.assertTrue('StalledSince' in res)
+
+        # Some QC output makes it not stalled
+        self.md('pipeline/output/QC/lane1')
+        age('pipeline/output/QC', 10)
+        self.assertTrue('StalledSince' not in RunStatus(run_dir).get_dict())
+
+        # Unless it's old
+        age('pipeline/output/QC/lane1', 9)
+        self.assertTrue('StalledSince' in RunStatus(run_dir).get_dict())
+
+        # A fresh lease does not help, as the driver renews it while waiting on a hung job
+        self.touch('pipeline/qc.lease')
+        self.assertTrue('StalledSince' in RunStatus(run_dir).get_dict())
+
+        # Or the threshold is raised
+        os.environ['STALL_HOURS_QC'] = '12'
+        try:
+            self.assertTrue('StalledSince' not in RunStatus(run_dir).get_dict())
+        finally:
+            del os.environ['STALL_HOURS_QC']
+
+        # Only in_demultiplexing and in_qc are checked
+        self.touch('pipeline/qc.done')
+        age('pipeline/qc.started', 10)
+        self.assertTrue('StalledSince' not in RunStatus(run_dir).get_dict())
+
+    def test_stalled_demux(self):
+        """A long bcl2fastq job only writes to the FASTQ files, so this shows the run is
+           not stalled. But the driver keeps renewing the lease while it waits on a hung job,
+           so a fresh lease alone does not count as progress.
+        """
+        self.use_run('160726_K00166_0120_BHCVH2BBXX', copy=True, make_run_info=False)
+        run_dir = os.path.join(self.run_dir, self.current_run)
+        self.touch('RTAComplete.txt')
+        self.touch('pipeline/read1.done')
+        for l in '12345678':
+            self.touch('pipeline/lane{}.started'.format(l))
+        self.md('pipeline/output/demultiplexing/lane1/Project')
+        self.touch('pipeline/output/demultiplexing/lane1/Project/x_R1.fastq.gz')
+
+        def age(fp, hours):
+            t = time.time() - hours * 3600
+            os.utime(os.path.join(run_dir, fp), (t, t))
+
+        def stalled():
+            res = RunStatus(run_dir).get_dict()
+            self.assertEqual(res['PipelineStatus'], 'in_demultiplexing')
+            return 'StalledSince' in res
+
+        for f in ['pipeline/lane{}.started'.format(l) for l in '12345678'] + \
+                 ['pipeline/output/demultiplexing/lane1/Project',
+                  'pipeline/output/demultiplexing/lane1']:
+            age(f, 5)
+        self.assertFalse(stalled())
+
+        age('pipeline/output/demultiplexing/lane1/Project/x_R1.fastq.gz', 5)
+        self.assertTrue(stalled())
+
+        self.touch('pipeline/demux.lease')
+        self.assertTrue(stalled())
+
+        # The log for one shard of a lane is still being written
+        self.md('pipeline/output/demultiplexing/lane1/shard1')
+        self.touch('pipeline/output/demultiplexing/lane1/shard1/bcl2fastq.log')
+        for f in ['pipeline/output/demultiplexing/lane1/shard1',
+                  'pipeline/output/demultiplexing/lane1']:
+            age(f, 5)
+        self.assertFalse(stalled())
+
+        age('pipeline/output/demultiplexing/lane1/shard1/bcl2fastq.log', 5)
+        self.assertTrue(stalled())
+
+    def test_cycle_progress(self):
+        """Sequencing progress is found per lane by binary search
+        """
+        run_info = self.use_run('180430_M05898_0007_000000000-BR92R', copy=True)
+        self.rm('Data/Intensities/BaseCalls/L001')
+
+        # Lay down cycles 1 to 30 (of 68) at one minute intervals
+        for c in range(1, 31):
+            self.md('Data/Intensities/BaseCalls/L001/C{}.1'.format(c))
+            self.touch('Data/Intensities/BaseCalls/L001/C{}.1/s_1_1101.bcl'.format(c))
+            os.utime( os.path.join(self.run_dir, self.current_run, 'Data/Intensities/BaseCalls/L001/C{}.1'.format(c)),
+                      (1000000 + c * 60,) * 2 )
+        # An empty cycle dir does not count
+        self.md('Data/Intensities/BaseCalls/L001/C31.1')
+
+        cp = run_info.get_cycle_progress()
+        self.assertEqual(cp.get_cycles_complete(1), 30)
+        self.assertEqual(cp.get_percent_complete(1), 44.1)
+        # Binary search should not need to look at many dirs
+        self.assertTrue(len(cp.arrivals['1']) < 8)
+        self.assertEqual(cp.get_eta(1), 1000000 + 68 * 60)
+
+        res = RunStatus(os.path.join(self.run_dir, self.current_run), opts='p').get_dict()
+        self.assertEqual(res['CyclesComplete'], {1: 30})
+        self.assertEqual(res['PercentComplete'], {1: 44.1})
+        self.assertEqual(len(res['CompletionETA']), 19)
+
+        # No progress info without the 'p' option
+        self.assertFalse('CyclesComplete' in run_info.get_dict())
+
+    def test_command_line(self):
+        """ The RunStatus.py script can pick out fields for the shell, and look at
+            several runs in one go.
+        """
+        run_a = os.path.join(DATA_DIR, '160606_K00166_0102_BHF22YBBXX')
+        run_b = os.path.join(DATA_DIR, '160607_D00248_0174_AC9E4KANXX_weird')
+        env = dict(os.environ, RUN_REGISTRY='none', TIMELINE_LOG='none')
+
+        def runstatus(*args):
+            return subprocess.check_output([RUNSTATUS] + list(args), env=env, universal_newlines=True)
+
+        # Default is the YAML, as before
+        self.assertEqual( dictify(runstatus(run_a)),
+                          dictify(RunStatus(run_a).get_yaml()) )
+
+        out = runstatus('--shell', '--fields', 'STATUS=PipelineStatus,LANES=LaneCount,RunDir,X=Foo',
+                        run_a, run_b).split('\n')
+        self.assertEqual(out, [ "STATUS=new LANES=8 RunDir={} X=''".format(run_a),
+                                "STATUS=complete LANES=8 RunDir={} X=''".format(run_b),
+                                "" ])
+
+        out = [ json.loads(l) for l in runstatus('--json', '--fields', 'RunID', run_b).split('\n') if l ]
+        self.assertEqual(out, [ dict(RunID='160607_D00248_0174_AC9E4KANXX') ])
+
+    def test_runinfo_cache(self):
+        """ RunInfo.xml is only re-parsed if it changes
+        """
+        self.use_run('160606_K00166_0102_BHF22YBBXX', copy=True)
+        run_path = os.path.join(self.run_dir, self.current_run)
+
+        rip1 = get_runinfo_xml_parser(run_path)
+        self.assertIs(get_runinfo_xml_parser(os.path.join(run_path, 'RunInfo.xml')), rip1)
+
+        # Modify the file
+        with open(os.path.join(run_path, 'RunInfo.xml'), 'a') as fh:
+            print("<!-- changed -->", file=fh)
+        rip2 = get_runinfo_xml_parser(run_path)
+        self.assertIsNot(rip2, rip1)
+        self.assertEqual(rip2.run_info, rip1.run_info)
+
     def md(self, fp):
         os.makedirs(os.path.join(self.run_dir, self.current_run, fp))
 
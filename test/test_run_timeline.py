@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""Test the analysis of the event timeline"""
+
+import os
+import unittest
+
+from sandbox import TestSandbox
+
+from illuminatus.RunTimeline import ( make_event, record_event, load_events,
+                                      get_state_spans, get_action_spans, summarize_spans )
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.sandbox = TestSandbox()
+        self.sandbox.make('run1/pipeline/')
+        self.run_dir = os.path.join(self.sandbox.sandbox, 'run1')
+        self.central_log = os.path.join(self.sandbox.sandbox, 'timeline.jsonl')
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def record(self, run, stage, event, when, **extra):
+        record_event( self.run_dir,
+                      make_event(run, stage, event, when=when, **extra),
+                      self.central_log )
+
+    ### THE TESTS ###
+    def test_record_and_load(self):
+        """Events go to both files, and junk lines are ignored
+        """
+        self.record('run1', 'new', 'state', 200)
+        self.record('run1', 'new', 'action_start', 100, pid=123)
+        with open(self.central_log, 'a') as fh:
+            print('{"time": 300, "trunc', file=fh)
+
+        per_run = load_events(os.path.join(self.run_dir, 'pipeline', 'timeline.jsonl'))
+        central = load_events(self.central_log)
+        self.assertEqual(per_run, central)
+
+        # Sorted by time
+        self.assertEqual([ e['event'] for e in central ], ['action_start', 'state'])
+        self.assertEqual(central[0]['pid'], 123)
+        self.assertEqual(central[0]['lane'], None)
+
+    def test_spans(self):
+        """Time spent in each state and action
+        """
+        hour = 3600
+        for run, start in [('run1', 0), ('run2', 10 * hour)]:
+            self.record(run, 'reads_finished', 'state', start)
+            self.record(run, 'reads_finished', 'action_start', start + 5, pid=1)
+            self.record(run, 'in_demultiplexing', 'state', start + hour)
+            # Seen again by another driver
+            self.record(run, 'in_demultiplexing', 'state', start + hour + 300)
+            self.record(run, 'reads_finished', 'action_end', start + 2 * hour + 5, pid=1, status=0)
+            self.record(run, 'demultiplexed', 'state', start + 3 * hour)
+        self.record('run2', 'in_qc', 'state', 14 * hour)
+
+        events = load_events(self.central_log)
+
+        spans = get_state_spans(events)
+        self.assertEqual( spans['run1'], [ ('reads_finished', 0, hour),
+                                           ('in_demultiplexing', hour, 3 * hour),
+                                           ('demultiplexed', 3 * hour, None) ] )
+
+        summary = summarize_spans(spans)
+        self.assertEqual(list(summary), ['reads_finished', 'in_demultiplexing', 'demultiplexed'])
+        self.assertEqual(summary['in_demultiplexing']['count'], 2)
+        self.assertEqual(summary['in_demultiplexing']['mean'], 2 * hour)
+        self.assertEqual(summary['demultiplexed']['count'], 1)
+
+        aspans = get_action_spans(events)
+        self.assertEqual(aspans['run2'], [ ('reads_finished', 10 * hour + 5, 12 * hour + 5, 0) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""Test the inotify-based run watcher"""
+
+import os
+import time
+import unittest
+import logging
+from shutil import copytree, copy
+
+from sandbox import TestSandbox
+
+DATA_DIR = os.path.abspath(os.path.dirname(__file__) + '/seqdata_examples')
+VERBOSE = os.environ.get('VERBOSE', '0') != '0'
+
+from run_watcher import RunWatcher
+from illuminatus.RunLease import RunLease
+
+class T(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        #Prevent the logger from printing messages - I like my tests to look pretty.
+        if VERBOSE:
+            logging.getLogger().setLevel(logging.DEBUG)
+        else:
+            logging.getLogger().setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.sandbox = TestSandbox()
+        self.seqdata = self.sandbox.make('seqdata/').rstrip('/')
+
+        # Use 'true' as the driver so nothing actually happens
+        self.watcher = RunWatcher( self.seqdata, driver = 'true', run_name_regex = '.*_.*_.*_[^.]*',
+                                   settle_time = 0 )
+
+    def tearDown(self):
+        self.watcher.inotify.close()
+        self.sandbox.cleanup()
+
+    def get_events(self):
+        """Process all the events and return the list of pending runs
+        """
+        for e in self.watcher.inotify.read_events(timeout=0.1):
+            self.watcher.handle_event(*e)
+        return sorted(self.watcher.pending, key=str)
+
+    ### THE TESTS ###
+    def test_new_run(self):
+        """Starting up triggers a full scan, then a new run triggers a run scan.
+        """
+        self.watcher.reconcile()
+        self.assertEqual(self.get_events(), [None])
+
+        self.watcher.dispatch()
+        self.assertEqual(list(self.watcher.pending), [])
+        self.assertEqual(list(self.watcher.running), [None])
+
+        run = '160726_K00166_0120_BHCVH2BBXX'
+        copytree(os.path.join(DATA_DIR, run), os.path.join(self.seqdata, run))
+        os.mkdir(os.path.join(self.seqdata, 'not_a_run'))
+        self.assertEqual(self.get_events(), [run])
+
+        self.watcher.dispatch()
+        self.assertEqual(list(self.watcher.pending), [])
+        self.assertIn(run, self.watcher.running)
+
+    def test_overlap(self):
+        """Drivers on single runs may overlap with a full scan and with each other,
+           but not with another driver on the same run, or a full scan with a full scan.
+        """
+        class StillRunning:
+            def poll(self):
+                return None
+
+        run1, run2 = '160726_K00166_0120_BHCVH2BBXX', '160811_D00261_0355_BC9DA7ANXX'
+
+        # A long per-run job must not hold up the full scan, or another run.
+        self.watcher.running[run1] = StillRunning()
+        self.watcher.pending.update({None: 0, run1: 0, run2: 0})
+        self.watcher.dispatch()
+        self.assertEqual(list(self.watcher.pending), [run1])
+        self.assertEqual(sorted(self.watcher.running, key=str), sorted([None, run1, run2], key=str))
+
+        # And a long full scan must not hold up a single run, but does hold up
+        # the next full scan.
+        self.watcher.running.clear()
+        self.watcher.pending.clear()
+        self.watcher.running[None] = StillRunning()
+        self.watcher.pending.update({None: 0, run1: 0})
+        self.watcher.dispatch()
+        self.assertEqual(list(self.watcher.pending), [None])
+        self.assertEqual(sorted(self.watcher.running, key=str), sorted([None, run1], key=str))
+
+    def test_max_jobs(self):
+        """Drivers that have been running a long time, which are waiting on demultiplexing
+           or QC, don't count towards max_jobs, and the full scan is never held back.
+        """
+        class StillRunning:
+            def poll(self):
+                return None
+
+        runs = [ "run_{}_x_y".format(n) for n in range(6) ]
+        self.watcher.max_jobs = 2
+        self.watcher.long_job_time = 300
+        now = time.time()
+
+        self.watcher.running.update({ runs[0]: StillRunning(), runs[1]: StillRunning() })
+        self.watcher.started.update({ runs[0]: now, runs[1]: now })
+        self.watcher.pending.update({ None: 0, runs[2]: 0 })
+        self.watcher.dispatch()
+        self.assertEqual(list(self.watcher.pending), [runs[2]])
+        self.assertIn(None, self.watcher.running)
+
+        # Once one of them has been going a while, another run can start
+        self.watcher.started[runs[0]] = now - 301
+        self.watcher.dispatch()
+        self.assertEqual(list(self.watcher.pending), [])
+        self.assertIn(runs[2], self.watcher.running)
+
+    def test_touch_files(self):
+        """Adding files to pipeline/ or the trigger cycle should trigger a driver
+           run, but adding other cycles should not. RunStatus needs files in the
+           trigger cycle, so the directory alone is not enough.
+        """
+        run = '160726_K00166_0120_BHCVH2BBXX'
+        copytree(os.path.join(DATA_DIR, run), os.path.join(self.seqdata, run))
+        run_dir = os.path.join(self.seqdata, run)
+
+        self.watcher.reconcile()
+        self.watcher.pending.clear()
+
+        with open(os.path.join(run_dir, 'pipeline/lane1.redo'), 'w'): pass
+        self.assertEqual(self.get_events(), [run])
+        self.watcher.pending.clear()
+
+        os.mkdir(os.path.join(run_dir, 'Data/Intensities/BaseCalls/L001/C100.1'))
+        self.assertEqual(self.get_events(), [])
+
+        # 151 + 8 + 8 + 1
+        trigger_dir = os.path.join(run_dir, 'Data/Intensities/BaseCalls/L001/C168.1')
+        os.mkdir(trigger_dir)
+        self.assertEqual(self.get_events(), [])
+        with open(os.path.join(trigger_dir, 's_1_1101.bcl.gz'), 'w'): pass
+        self.assertEqual(self.get_events(), [run])
+        self.watcher.pending.clear()
+
+        # Only the first file counts
+        with open(os.path.join(trigger_dir, 's_1_1102.bcl.gz'), 'w'): pass
+        self.assertEqual(self.get_events(), [])
+
+        with open(os.path.join(run_dir, 'RTAComplete.txt'), 'w'): pass
+        self.assertEqual(self.get_events(), [run])
+
+    def test_lease_heartbeat(self):
+        """Taking and renewing a lease in pipeline/ must not trigger a driver run,
+           or the heartbeat would keep calling the driver.
+        """
+        run = '160726_K00166_0120_BHCVH2BBXX'
+        copytree(os.path.join(DATA_DIR, run), os.path.join(self.seqdata, run))
+        run_dir = os.path.join(self.seqdata, run)
+
+        self.watcher.reconcile()
+        self.watcher.pending.clear()
+
+        lease = RunLease(os.path.join(run_dir, 'pipeline/demux.lease'))
+        lease.acquire()
+        lease.renew()
+        lease.release()
+        self.assertEqual(self.get_events(), [])
+
+        # Expired leases get moved aside on takeover
+        with open(os.path.join(run_dir, 'pipeline/demux.lease'), 'w') as lfh:
+            print('{"owner": "otherhost", "pid": 1, "expires": 0}', file=lfh)
+        self.watcher.pending.clear()
+        lease.acquire()
+        self.assertEqual(self.get_events(), [])
+
+        with open(os.path.join(run_dir, 'pipeline/lane1.redo'), 'w'): pass
+        self.assertEqual(self.get_events(), [run])
+
+    def test_late_run_info(self):
+        """A new run directory has no RunInfo.xml at first. The cycle directory
+           should be watched once it appears.
+        """
+        run = '160726_K00166_0120_BHCVH2BBXX'
+        run_dir = os.path.join(self.seqdata, run)
+        os.mkdir(run_dir)
+
+        self.watcher.reconcile()
+        self.watcher.pending.clear()
+        self.assertNotIn((run, 'cycles'), self.watcher.watches.values())
+
+        os.makedirs(os.path.join(run_dir, 'Data/Intensities/BaseCalls/L001'))
+        copy(os.path.join(DATA_DIR, run, 'RunInfo.xml'), run_dir)
+        self.assertEqual(self.get_events(), [run])
+        self.assertIn((run, 'cycles'), self.watcher.watches.values())
+        self.watcher.pending.clear()
+
+        # Files may be in the trigger cycle before it can be watched
+        os.mkdir(os.path.join(run_dir, 'Data/Intensities/BaseCalls/L001/C168.1'))
+        with open(os.path.join(run_dir, 'Data/Intensities/BaseCalls/L001/C168.1/s_1_1101.bcl.gz'), 'w'): pass
+        self.assertEqual(self.get_events(), [run])
+
+        # And the same if the event was missed, once the watcher reconciles
+        self.watcher.trigger_dirs.clear()
+        self.watcher.watches.clear()
+        self.watcher.reconcile()
+        self.assertIn((run, 'cycles'), self.watcher.watches.values())
+
+if __name__ == '__main__':
+    unittest.main()
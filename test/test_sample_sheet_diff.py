@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""Test the comparison of sample sheets used to decide which lanes to re-do"""
+
+import os, re
+import unittest
+
+from sandbox import TestSandbox
+
+from illuminatus.SampleSheetDiff import diff_samplesheets, describe_changes, sheet_settings
+
+EXAMPLE_SHEET = os.path.join( os.path.dirname(__file__), 'seqdata_examples',
+                              '180619_A00291_0044_BH5WJJDMXX', 'SampleSheet.csv' )
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.sandbox = TestSandbox()
+        self.addCleanup(self.sandbox.cleanup)
+
+        with open(EXAMPLE_SHEET) as fh:
+            self.lines = [ l.rstrip('\n') for l in fh ]
+        self.data_start = self.lines.index('[Data]') + 2
+
+    def diff(self, new_lines):
+        new_sheet = os.path.join(self.sandbox.sandbox, 'new.csv')
+        with open(new_sheet, 'w') as fh:
+            print(*new_lines, sep='\n', file=fh)
+        return diff_samplesheets(EXAMPLE_SHEET, new_sheet)
+
+    ### THE TESTS ###
+    def test_no_change(self):
+        self.assertEqual( diff_samplesheets(EXAMPLE_SHEET, EXAMPLE_SHEET), {} )
+
+    def test_cosmetic(self):
+        """Reordering rows, changing the header and descriptions, and adding
+           whitespace and blank lines make no difference.
+        """
+        header, data = self.lines[:self.data_start], self.lines[self.data_start:]
+        header = [ re.sub('^Investigator Name,.*', 'Investigator Name,Someone Else', l)
+                   for l in header ]
+        data = [ re.sub(r',([^,]*)$', r',new description ', l) for l in reversed(data) ]
+        data.insert(3, '')
+
+        self.assertEqual( self.diff(header + data), {} )
+
+    def test_sample_changes(self):
+        new_lines = list(self.lines)
+        # Change an index in lane 1
+        new_lines[self.data_start] = new_lines[self.data_start].replace('TAATGCGC', 'TAATGCGA')
+        # Remove a sample in lane 2, and add one
+        removed = new_lines.pop()
+        new_lines.append( removed.replace('L01,', 'L02,', 1)
+                                 .replace('ATGAGGCC', 'ACACACAC') )
+
+        res = self.diff(new_lines)
+        self.assertEqual( sorted(res), ['1', '2'] )
+        self.assertEqual( res['1'], dict( added = [],
+                                          removed = [],
+                                          changed = ['11354SAPool01__11354SA0001L01'],
+                                          settings = [] ) )
+        self.assertEqual( res['2']['added'], ['11285HMpool01__11285HM0024L02'] )
+        self.assertEqual( res['2']['removed'], ['11285HMpool01__11285HM0024L01'] )
+
+        self.assertEqual( describe_changes(res['2']),
+                          'added 1 (11285HMpool01__11285HM0024L02); '
+                          'removed 1 (11285HMpool01__11285HM0024L01)' )
+
+        # Moving a sample to another lane affects both lanes
+        new_lines = list(self.lines)
+        new_lines[self.data_start] = '2' + new_lines[self.data_start][1:]
+        res = self.diff(new_lines)
+        self.assertEqual( res['1']['removed'], ['11354SAPool01__11354SA0001L01'] )
+        self.assertEqual( res['2']['added'], ['11354SAPool01__11354SA0001L01'] )
+
+    def test_settings(self):
+        bcl2fastq_pos = self.lines.index('[bcl2fastq]') + 1
+
+        # A per-lane setting only affects that lane
+        new_lines = list(self.lines)
+        new_lines.insert(bcl2fastq_pos, '--barcode-mismatches-lane2: 0')
+        res = self.diff(new_lines)
+        self.assertEqual( list(res), ['2'] )
+        self.assertEqual( res['2']['settings'], ['[bcl2fastq] --barcode-mismatches'] )
+
+        # Otherwise all the lanes
+        new_lines = list(self.lines)
+        new_lines.insert(bcl2fastq_pos, '--barcode-mismatches 0')
+        self.assertEqual( sorted(self.diff(new_lines)), ['1', '2'] )
+
+        # Writing the same option differently is fine
+        self.assertEqual( sheet_settings(self.sandbox.make('s1.csv', content='[bcl2fastq]\n--foo: 1\n')),
+                          sheet_settings(self.sandbox.make('s2.csv', content='[bcl2fastq]\n--foo 1,,\n')) )
+
+        # As is a [Settings] section
+        new_lines = list(self.lines)
+        new_lines[self.data_start-2:self.data_start-2] = ['[Settings]', 'Read1UMILength,8', '']
+        res = self.diff(new_lines)
+        self.assertEqual( sorted(res), ['1', '2'] )
+        self.assertEqual( res['1']['settings'], ['[settings] Read1UMILength'] )
+
+if __name__ == '__main__':
+    unittest.main()
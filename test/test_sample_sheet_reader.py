@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import sys, os, glob, re
 import unittest
+import json
 
-from illuminatus.SampleSheetReader import SampleSheetReader
+from sandbox import TestSandbox
+
+from illuminatus.SampleSheetReader import SampleSheetReader, get_samplesheet_reader, CACHE_FILE
 
 class T(unittest.TestCase):
 
@@ -59,6 +62,10 @@ class T(unittest.TestCase):
         self.assertEqual( ilbl['7'], [0, 0] )
         self.assertEqual( ilbl['8'], [8, 0] )
 
+        # No lane mixes lengths so there is one group per lane
+        ilgbl = r.get_index_length_groups_by_lane()
+        self.assertEqual( ilgbl, { k: [v] for k, v in ilbl.items() } )
+
     def test_miseq_run(self):
         """Run 160603_M01270_0196_000000000-AKGDE has 1 lane, with single barcodes
            length 10
@@ -68,3 +75,90 @@ class T(unittest.TestCase):
         self.assertEqual( sorted(ilbl.keys()), list('1') )
 
         self.assertEqual( ilbl['1'], [10, 0] )
+
+    def test_lookups(self):
+        """Run 180619_A00291_0044_BH5WJJDMXX has two lanes with one pool each
+        """
+        r = self.get_reader_for_sample_sheet('180619_A00291_0044_BH5WJJDMXX')
+
+        self.assertEqual( r.get_lanes(), ['1', '2'] )
+        self.assertEqual( r.get_projects(), ['11354', '11285'] )
+        self.assertEqual( len(r.get_rows()), 36 )
+        self.assertEqual( len(r.get_rows(lane='1')), 12 )
+        self.assertEqual( len(r.get_rows(lane='1', project='11285')), 0 )
+        self.assertEqual( len(r.get_rows(pool='11285HMpool01', project='11285')), 24 )
+
+        row, = r.get_rows_by_index('CCGCGGTT', 'AGCGCTAG')
+        self.assertEqual( (row.lane, row.pool, row.library),
+                          ('2', '11285HMpool01', '11285HM0001L01') )
+        self.assertEqual( r.get_rows_by_index('CCGCGGTT'), [] )
+
+    def test_no_project(self):
+        """Run 160607_D00248_0174_AC9E4KANXX_weird has a SampleProject column, which
+           bcl2fastq does not recognise, so get_projects() should complain.
+        """
+        r = self.get_reader_for_sample_sheet('160607_D00248_0174_AC9E4KANXX_weird')
+        self.assertRaises(KeyError, r.get_projects)
+
+    def test_cache(self):
+        """The parsed sheet is saved in pipeline/samplesheet_cache.json and used
+           until the sheet changes.
+        """
+        sandbox = TestSandbox(os.path.join( os.path.dirname(__file__),
+                                            'seqdata_examples',
+                                            '180619_A00291_0044_BH5WJJDMXX' ))
+        self.addCleanup(sandbox.cleanup)
+        ssfile = os.path.join(sandbox.sandbox, 'SampleSheet.csv')
+        cache_file = os.path.join(sandbox.sandbox, CACHE_FILE)
+
+        # No pipeline directory, no cache
+        r1 = get_samplesheet_reader(ssfile)
+        self.assertFalse(os.path.exists(cache_file))
+
+        sandbox.make('pipeline/')
+        r2 = get_samplesheet_reader(ssfile)
+        self.assertTrue(os.path.exists(cache_file))
+
+        # Doctor the cache to prove that it is used, and that the result is the same
+        with open(cache_file) as cfh:
+            cached = json.load(cfh)
+        r3 = get_samplesheet_reader(ssfile)
+        for r in [r2, r3]:
+            self.assertEqual( r.get_index_lengths_by_lane(), r1.get_index_lengths_by_lane() )
+            self.assertEqual( r.get_projects(), r1.get_projects() )
+            self.assertEqual( repr(r.get_rows(lane='2')), repr(r1.get_rows(lane='2')) )
+            self.assertEqual( r.headers, r1.headers )
+
+        # Rows and index lengths come from the cached values, not the raw CSV rows
+        self.assertEqual( cached['rows'][0][0], '1' )
+        cached['rows'][0][0] = '9'
+        cached['rows'][0][5] = 'A' * 99
+        with open(cache_file, 'w') as cfh:
+            json.dump(cached, cfh)
+        r5 = get_samplesheet_reader(ssfile)
+        self.assertEqual( r5.get_lanes(), ['1', '2', '9'] )
+        self.assertEqual( r5.get_index_lengths_by_lane()['9'][0], 99 )
+        self.assertEqual( r5.get_rows(lane='9')[0].row, r1.get_rows(lane='1')[0].row )
+
+        # Rows that don't match the data mean the cache is replaced
+        del cached['rows'][0]
+        with open(cache_file, 'w') as cfh:
+            json.dump(cached, cfh)
+        self.assertEqual( get_samplesheet_reader(ssfile).get_lanes(), ['1', '2'] )
+
+        # Changing the sheet invalidates the cache
+        with open(ssfile) as ssfh:
+            lines = [ l for l in ssfh if not l.startswith('1,') ]
+        with open(ssfile, 'w') as ssfh:
+            ssfh.writelines(lines)
+        r4 = get_samplesheet_reader(ssfile)
+        self.assertEqual( r4.get_lanes(), ['2'] )
+        with open(cache_file) as cfh:
+            self.assertEqual( SampleSheetReader.from_cache(json.load(cfh)).get_lanes(), ['2'] )
+
+        # A corrupt cache is just replaced
+        with open(cache_file, 'w') as cfh:
+            print("{", file=cfh)
+        self.assertEqual( get_samplesheet_reader(ssfile).get_lanes(), ['2'] )
+        with open(cache_file) as cfh:
+            self.assertEqual( json.load(cfh)['rows'][0][0], '2' )
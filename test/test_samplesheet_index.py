@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Test the index of sample sheets by flowcell ID"""
+
+import os
+import unittest
+import time
+
+from sandbox import TestSandbox
+
+from illuminatus.SampleSheetIndex import SampleSheetIndex, flowcell_of
+
+class T(unittest.TestCase):
+
+    def setUp(self):
+        # See the errors in all their glory
+        self.maxDiff = None
+
+        self.sandbox = TestSandbox()
+        self.root = self.sandbox.make('samplesheets/')
+        self.db_file = os.path.join(self.sandbox.sandbox, 'index.sqlite')
+
+        # An old month and a current month. The sandbox keeps the directory mtimes
+        # unchanged as files are added.
+        self.sandbox.make('samplesheets/2019/3/old_FC1.csv', hours_age=24*400, content='v1')
+        self.sandbox.make('samplesheets/2019/3/other_FC2.csv', hours_age=24*400, content='x')
+        self.sandbox.make('samplesheets/2019/3/notes.txt', hours_age=24*400)
+        self.sandbox.make('samplesheets/2020/1/new_FC1.csv', hours_age=2, content='v2')
+        self.sandbox.touch('samplesheets', hours_age=24*400)
+
+    def tearDown(self):
+        self.sandbox.cleanup()
+
+    def ssi(self):
+        res = SampleSheetIndex(self.db_file, self.root)
+        self.addCleanup(res.close)
+        return res
+
+    ### THE TESTS ###
+    def test_flowcell_of(self):
+        self.assertEqual(flowcell_of('foo_bar_hxxxxdrxy.csv'), 'HXXXXDRXY')
+        self.assertEqual(flowcell_of('foo.csv'), None)
+        self.assertEqual(flowcell_of('foo_.csv'), None)
+        self.assertEqual(flowcell_of('foo_FC1.txt'), None)
+
+    def test_lookup(self):
+        ssi = self.ssi()
+        stats = ssi.refresh()
+        self.assertEqual(stats, dict(dirs_listed=5, sheets_hashed=3))
+
+        sheets = ssi.get_sheets('fc1')
+        self.assertEqual( [ s['path'] for s in sheets ],
+                          [ os.path.join(self.root, '2019/3/old_FC1.csv'),
+                            os.path.join(self.root, '2020/1/new_FC1.csv') ] )
+        self.assertEqual(ssi.get_latest('FC1')['path'], sheets[-1]['path'])
+        self.assertEqual(len(sheets[-1]['md5']), 32)
+        self.assertEqual(ssi.get_latest('FC3'), None)
+
+        recent = ssi.get_recent(time.time() - 3 * 3600)
+        self.assertEqual([ s['flowcell'] for s in recent ], ['FC1'])
+
+    def test_incremental(self):
+        """Only changed or recently modified directories are listed
+        """
+        self.ssi().refresh()
+
+        # The root and the 2019 dirs are old, but 2020/1 and 2020 are new so will
+        # be re-listed.
+        ssi = self.ssi()
+        self.assertEqual(ssi.refresh(), dict(dirs_listed=2, sheets_hashed=0))
+
+        # A sheet sneaking into 2019/3 without changing the mtime is not seen
+        self.sandbox.make('samplesheets/2019/3/sneaky_FC3.csv', hours_age=24*400)
+        ssi.refresh()
+        self.assertEqual(ssi.get_latest('FC3'), None)
+
+        # But a normal new file is
+        os.utime(os.path.join(self.root, '2019/3'))
+        self.assertEqual(ssi.refresh(), dict(dirs_listed=3, sheets_hashed=1))
+        self.assertTrue(ssi.get_latest('FC3'))
+
+        # A sheet re-written in place in the recent directory gets a new hash
+        md5_before = ssi.get_latest('FC1')['md5']
+        with open(os.path.join(self.root, '2020/1/new_FC1.csv'), 'w') as fh:
+            print('v3', file=fh)
+        # (2019/3 now counts as recent too)
+        self.assertEqual(ssi.refresh(), dict(dirs_listed=3, sheets_hashed=1))
+        self.assertNotEqual(ssi.get_latest('FC1')['md5'], md5_before)
+
+        # Removing a directory removes its sheets
+        for f in os.listdir(os.path.join(self.root, '2019/3')):
+            os.unlink(os.path.join(self.root, '2019/3', f))
+        os.rmdir(os.path.join(self.root, '2019/3'))
+        ssi.refresh()
+        self.assertEqual(ssi.get_sheets('FC2'), [])
+        self.assertEqual(len(ssi.get_sheets('FC1')), 1)
+
+    def test_rewritten_in_place(self):
+        """A sheet in an old directory that is re-written in place is not seen by
+           refresh(), but is caught by check_sheets()
+        """
+        ssi = self.ssi()
+        ssi.refresh()
+        old_sheet = ssi.get_sheets('FC1')[0]
+        self.assertEqual(ssi.check_sheets('FC1'), 0)
+
+        # Re-writing the file doesn't change the directory mtime
+        sheet_file = os.path.join(self.root, '2019/3/old_FC1.csv')
+        with open(sheet_file, 'w') as fh:
+            print('v3 is the newest', file=fh)
+        self.assertEqual(ssi.refresh(), dict(dirs_listed=2, sheets_hashed=0))
+        self.assertEqual(ssi.get_latest('FC1')['path'], os.path.join(self.root, '2020/1/new_FC1.csv'))
+
+        self.assertEqual(ssi.check_sheets('FC1'), 1)
+        self.assertEqual(ssi.check_sheets('FC1'), 0)
+        self.assertEqual(ssi.get_latest('FC1')['path'], sheet_file)
+        self.assertNotEqual(ssi.get_latest('FC1')['md5'], old_sheet['md5'])
+
+        # And a sheet that vanished is dropped
+        os.unlink(sheet_file)
+        self.assertEqual(ssi.check_sheets('FC1'), 1)
+        self.assertEqual(len(ssi.get_sheets('FC1')), 1)
+
+    def test_recent_rewritten_in_place(self):
+        """get_recent() sees a sheet re-written in place in an old directory
+        """
+        ssi = self.ssi()
+        ssi.refresh()
+        self.assertEqual([ s['flowcell'] for s in ssi.get_recent(time.time() - 3 * 3600) ], ['FC1'])
+
+        with open(os.path.join(self.root, '2019/3/other_FC2.csv'), 'w') as fh:
+            print('y', file=fh)
+        self.assertEqual(ssi.refresh(), dict(dirs_listed=2, sheets_hashed=0))
+        self.assertEqual( [ s['path'] for s in ssi.get_recent(time.time() - 3 * 3600) ],
+                          [ os.path.join(self.root, '2019/3/other_FC2.csv'),
+                            os.path.join(self.root, '2020/1/new_FC1.csv') ] )
+
+    def test_new_root(self):
+        """The index is reset if it is opened with a different root
+        """
+        self.ssi().refresh()
+
+        other_root = self.sandbox.make('other_samplesheets/')
+        ssi = SampleSheetIndex(self.db_file, other_root)
+        self.addCleanup(ssi.close)
+        self.assertEqual(ssi.get_sheets('FC1'), [])
+        self.assertEqual(ssi.refresh(), dict(dirs_listed=1, sheets_hashed=0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,9 @@
 
 import sys, os
 import unittest
-import xml.etree.ElementTree as ET
 
 from snakemake.workflow import Workflow
+from illuminatus.RunMeta import get_run_meta
 
 """ Can I unit test a Snakefile?
     Of course I can!
@@ -18,7 +18,7 @@ def get_ex(runid):
     """
     run_path = os.path.join(DATA_DIR, 'seqdata_examples', runid)
     return ( run_path,
-             ET.parse(run_path + "/RunInfo.xml").getroot() )
+             get_run_meta(run_path, save=False) )
 
 os.environ['TOOLBOX'] = 'dummy'
 sf = os.path.join(os.path.dirname(__file__), '..', 'Snakefile.read1qc')
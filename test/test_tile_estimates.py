@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import unittest
+
+from illuminatus.TileEstimates import ( ratio_ci, estimates, widest_ci, spread_order,
+                                        format_estimate )
+
+class T(unittest.TestCase):
+
+    def test_spread_order(self):
+        self.assertEqual(spread_order(list(range(8))), [0, 4, 2, 6, 1, 5, 3, 7])
+        self.assertEqual(spread_order(list('abcde')), list('acbde'))
+        self.assertEqual(spread_order([]), [])
+
+    def test_ratio_ci(self):
+        # No interval from one tile, or fraction from no reads
+        self.assertEqual(ratio_ci([10], [100]), (0.1, None))
+        self.assertEqual(ratio_ci([], []), (None, None))
+
+        # If the tiles agree, the binomial interval applies
+        p, hw = ratio_ci([10, 10], [100, 100])
+        self.assertEqual(p, 0.1)
+        self.assertAlmostEqual(hw, 1.96 * (0.1 * 0.9 / 200) ** 0.5)
+
+        # If not, the interval is wide with only two tiles
+        p, hw = ratio_ci([10, 30], [100, 100])
+        self.assertEqual(p, 0.2)
+        self.assertAlmostEqual(hw, 12.706 * 0.1)
+
+        # And narrower with more tiles
+        _, hw2 = ratio_ci([10, 30] * 4, [100, 100] * 4)
+        self.assertLess(hw2, hw / 5)
+
+    def test_estimates(self):
+        tile_counts = dict( tiles = ['2101', '2201', '2102', '2202'],
+                            clusters_pf = [1000] * 4,
+                            samples = { '12345GApool01__12345GA0001L01': [100, 110, 90, 100],
+                                        '12345GApool01__12345GA0002L01': [100, 100, 100, 100],
+                                        '67890GApool01__67890GA0001L01': [50, 60, 40, 50] },
+                            undetermined = [750, 730, 770, 750] )
+
+        ests = estimates(tile_counts)
+        self.assertEqual(list(ests), ['12345', '67890', 'Undetermined'])
+        self.assertEqual([ e[0] for e in ests.values() ], [0.2, 0.05, 0.75])
+        self.assertEqual(format_estimate(*ests['12345']), '20.00% ± 1.30%')
+        self.assertEqual(widest_ci(tile_counts), ests['Undetermined'][1])
+
+        # Just one tile, so no CI
+        tile_counts = dict( tiles = ['2101'], clusters_pf = [1000], samples = { '12345': [100] },
+                            undetermined = [900] )
+        self.assertIsNone(widest_ci(tile_counts))
+        self.assertEqual(format_estimate(*estimates(tile_counts)['Undetermined']), '90.00%')
+
+if __name__ == '__main__':
+    unittest.main()